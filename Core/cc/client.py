@@ -24,6 +24,7 @@ from send2trash import send2trash
 from cc.periodic_scheduler import PeriodicScheduler
 from cc.synchronization.models import SynchronizationGraph
 from cc.synchronization.syncengine import SyncEngineState
+from cc.synchronization.throttle import BandwidthThrottle
 from cc.synchronization_directory import SynchronizationDirectoryWatcher
 
 from cc.shell_extension_server import IPCCoreServer
@@ -459,6 +460,21 @@ class Client:
 
         self.startup()
 
+    def set_bandwidth_limits(self, limits, schedule):
+        """Apply new bandwidth limits to the running transfers and write them into the config.
+
+        :raises ValueError: if the limits or the schedule are invalid
+        """
+        if self.synchronization_graph is not None:
+            throttle = self.synchronization_graph.bademeister.queue.throttle
+        else:
+            throttle = BandwidthThrottle()
+        throttle.configure(limits, schedule)
+
+        self.config.bandwidth_limits = limits
+        self.config.bandwidth_schedule = schedule
+        write_config(self.config)
+
     def on_storage_directory_deleted(self, _, local_unique_id):
         """Delete the storage from the config and restarts"""
         logger.info('Detected deletion of storage directory "%s"', local_unique_id)
@@ -97,6 +97,36 @@ class LocalConfig(models.Config):
     enabled_storage_types = models.ConfigList(name='enabled_storage_types')
     """A list of storage types which the admin has enabled on the admin console."""
 
+    persistent_task_queue = models.ConfigItem(value=False, name='persistent_task_queue')
+    """Flag indicating if pending transfers are journaled and restored after a restart.
+
+    TODO: models.ConfigBool
+    """
+
+    bandwidth_limits = models.ConfigDict(name='bandwidth_limits')
+    """Bandwidth limits of the transfers in bytes per second, globally and per storage.
+
+    Example:
+        {"upload": 512000, "storages": {"dropbox_1": {"download": 2097152}}}
+    """
+
+    bandwidth_schedule = models.ConfigList(name='bandwidth_schedule')
+    """Periods in which the bandwidth limits are not enforced.
+
+    Example:
+        [{"start": "22:00", "end": "06:00"}]
+    """
+
+    read_ahead_depth = models.ConfigInt(value=2, name='read_ahead_depth')
+    """Number of chunks transfers read in advance in a background thread, 0 disables it."""
+
+    write_settle_interval = models.ConfigInt(value=2, name='write_settle_interval')
+    """Seconds the size and modification time of a local file have to be stable before it is
+    uploaded, 0 uploads it right away."""
+
+    write_settle_max_wait = models.ConfigInt(value=60, name='write_settle_max_wait')
+    """Seconds the upload of a local file still being written is deferred at most."""
+
     blocked_extensions = set()
     """Extensions to be blocked for uploading"""
 
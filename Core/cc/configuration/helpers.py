@@ -238,7 +238,13 @@ def write_config(config, file=None, auto_create_configuration_key=True):
         config_dict['general'] = {'sync_root_directory': config.sync_root,
                                   'device_id': config.device_id,
                                   'last_login': config.last_login,
-                                  'auth_token': config.auth_token}
+                                  'auth_token': config.auth_token,
+                                  'bandwidth_limits': config.bandwidth_limits,
+                                  'bandwidth_schedule': config.bandwidth_schedule,
+                                  'read_ahead_depth': config.read_ahead_depth,
+                                  'write_settle_interval': config.write_settle_interval,
+                                  'write_settle_max_wait': config.write_settle_max_wait,
+                                  'persistent_task_queue': config.persistent_task_queue}
         config_dict['admin_console_state'] = \
             {'policies': config.policies,
              'storage_providers': config.admin_console_csps,
@@ -362,6 +368,16 @@ def read_config(config, file=None):
             config.device_id = config_dict['general'].get('device_id', config.device_id)
             config.last_login = config_dict['general'].get('last_login', None)
             config.auth_token = config_dict['general'].get('auth_token', None)
+            config.bandwidth_limits = config_dict['general'].get('bandwidth_limits', {})
+            config.bandwidth_schedule = config_dict['general'].get('bandwidth_schedule', [])
+            config.read_ahead_depth = config_dict['general'].get('read_ahead_depth',
+                                                                 config.read_ahead_depth)
+            config.write_settle_interval = config_dict['general'].get(
+                'write_settle_interval', config.write_settle_interval)
+            config.write_settle_max_wait = config_dict['general'].get(
+                'write_settle_max_wait', config.write_settle_max_wait)
+            config.persistent_task_queue = config_dict['general'].get(
+                'persistent_task_queue', config.persistent_task_queue)
 
         if 'admin_console_state' in config_dict:
             policies = config_dict['admin_console_state'].get('policies', [])
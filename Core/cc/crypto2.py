@@ -1,13 +1,40 @@
-"""This module provides the functionality for asymmetric/symmetric encryption."""
+"""This module provides the functionality for asymmetric/symmetric encryption.
+
+Encrypted files start with :data:`MAGIC_NUMBER` and a json header holding the file key wrapped
+for every recipient. Two versions of the content follow the header:
+
+- :data:`VERSION` encrypts the whole content as one AES256-CFB stream. It can only be decrypted
+  sequentially and is not authenticated, files of this version are still read.
+- :data:`CHUNKED_VERSION` splits the content into chunks of `chunk_size` bytes (see
+  :data:`CHUNK_SIZE`), each encrypted with AES256-GCM and followed by its tag. The nonce of a
+  chunk is the random prefix from the header followed by the index of the chunk, the tag also
+  authenticates the header and whether the chunk is the final one. The final chunk is always
+  shorter than `chunk_size`, possibly empty, so a truncated file is detected as well. The file
+  key is wrapped with an OAEP label of this version, a file with a header rewritten to the
+  legacy version is refused instead of being decrypted without authentication. The chunks are
+  encrypted and decrypted independently of each other, see :class:`ChunkCipher`, which allows
+  seeking, decrypting a range of a file and processing chunks in parallel. New files are
+  encrypted in this version.
+
+Given an executor, the file wrappers encrypt and decrypt several chunks of the chunked version
+at once while reading the next ones, see :class:`ChunkPipeline`. The threads of
+:func:`chunk_executor` use several cores as far as the cryptography backend releases the GIL,
+a process pool works as well at the cost of pickling the chunks.
+"""
 import base64
+import collections
+import concurrent.futures
+import hashlib
 import io
 import json
 import os
 import struct
 import logging
+import threading
 import typing
 from collections import namedtuple
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import padding
@@ -16,6 +43,7 @@ from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
 import cc.crypto
+from cc.mime_type_stream import ReusableBufferReader, readinto_from, readinto_full
 
 # setting logger object
 logger = logging.getLogger(__name__)
@@ -30,9 +58,38 @@ ENCODING = 'utf-8'
 MAGIC_NUMBER = b'CROSSCLOUDCIPHERTEXT'
 VERSION = '0.1'
 
+#: version of the format encrypting the content in authenticated chunks
+CHUNKED_VERSION = '0.2'
+CHUNKED_ALGORITHM = 'AES256-GCM-CHUNKED'
+
+#: plaintext bytes per chunk of files encrypted in the chunked format
+CHUNK_SIZE = 64 * 1024
+
+#: the range of chunk sizes accepted from a header
+MIN_CHUNK_SIZE = 64
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+#: chunks processed by the executor of a :class:`ChunkPipeline` at once
+PIPELINE_DEPTH = 16
+
+#: number of parsed keys kept by :data:`KEY_CACHE`
+KEY_CACHE_SIZE = 64
+
 # 128 bits = block size AES
 AES_IV_LENGTH = 16
 
+# the nonce of a chunk is the prefix followed by the index of the chunk as 4 bytes
+GCM_NONCE_PREFIX_LENGTH = 8
+GCM_TAG_LENGTH = 16
+
+# additional authenticated data of the chunks after the digest of the header, marking the final
+# one
+_FINAL_CHUNK = b'\x01'
+_NOT_FINAL_CHUNK = b'\x00'
+
+# OAEP label of the file keys wrapped for the chunked version
+_CHUNKED_KEY_LABEL = MAGIC_NUMBER + b' ' + CHUNKED_VERSION.encode('ascii')
+
 # 256 bits = key size AES
 AES_KEY_LENGTH = 32
 
@@ -70,6 +127,10 @@ class NoKeyError(EncryptionException):
     """If the header does not contain a key to decrypt the content."""
 
 
+class IntegrityError(EncryptionException):
+    """Thrown if a chunk can't be authenticated, the file has been modified or truncated."""
+
+
 def generate_keypair():
     """ Generates a private/public keypair encoded as pem returned as a tuple of bytes"""
     private_key = rsa.generate_private_key(
@@ -109,18 +170,82 @@ def load_pem_private_key(pem_private_key_bytes, password=None):
                                               backend=default_backend())
 
 
-def encrypt_with_public_key(public_key, plaintext):
+class KeyCache:
+    """Cache of parsed key objects by the digest of their PEM, bounded to `max_entries`.
+
+    Parsing a PEM, above all of a private key, takes longer than encrypting a small file, while
+    the same few user, share and master keys are used for all files. The least recently used
+    keys are dropped first.
+    """
+
+    def __init__(self, max_entries=KEY_CACHE_SIZE):
+        """
+        :param max_entries: the number of keys kept, 0 disables the cache
+        """
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        #: (kind, sha256 of the PEM) -> key object, least recently used first
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def public_key(self, pem):
+        """Return the public key object of `pem`."""
+        return self._get('public', pem, load_pem_public_key)
+
+    def private_key(self, pem):
+        """Return the private key object of `pem`, which is not protected by a password."""
+        return self._get('private', pem, load_pem_private_key)
+
+    def _get(self, kind, pem, load):
+        """Return the key of `pem` from the cache, `load` parses it if not cached."""
+        key = kind, hashlib.sha256(pem).digest()
+        with self.lock:
+            key_object = self.entries.get(key)
+            if key_object is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return key_object
+            self.misses += 1
+
+        # parsing without holding the lock, a key might be parsed twice at the same time
+        key_object = load(pem)
+        with self.lock:
+            self.entries[key] = key_object
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return key_object
+
+    @property
+    def statistics(self):
+        """Return the size of the cache and how often it could be used."""
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+#: the keys parsed by the file wrappers and :func:`unwrap_private_key`
+KEY_CACHE = KeyCache()
+
+
+def encrypt_with_public_key(public_key, plaintext, label=None):
     """
     Encrypts a given plaintext using the given public key and OAEP padding (with
     MGF1 and SHA256
     :param public_key: the public key to be used for encryption (key object not bytes)
     :param plaintext: the plaintext to be encrypted (bytes)
+    :param label: the OAEP label, the same label is required for decryption
     :return: the ciphertext resulting from the encryption operation of the plaintext
     """
     return public_key.encrypt(plaintext, padding.OAEP(
         mgf=padding.MGF1(algorithm=hashes.SHA256()),
         algorithm=hashes.SHA256(),
-        label=None
+        label=label
     ))
 
 
@@ -164,9 +289,12 @@ def unwrap_private_key(wrapped_object, private_key_object):
     follows: 1) unwrapps an AES256 key using the private key. 2) decrypts the private
     key material wrapped by decrypting it with the AES256 key
     :param wrapped_object: the wrapped object to unwrap
-    :param private_key_object: the private key to unwrap
+    :param private_key_object: the private key to unwrap, either as object or in pem format
     :return: the unwrapped private key in pem format
     """
+    if isinstance(private_key_object, bytes):
+        private_key_object = KEY_CACHE.private_key(private_key_object)
+
     # checking version of the wrapped key object
     wrapped_version_info = wrapped_object['wrapping_method']
     if wrapped_version_info['version'] != WRAP_VERSION \
@@ -191,24 +319,28 @@ def unwrap_private_key(wrapped_object, private_key_object):
         raise KeyWrappingError('Could not unwrap key.')
 
 
-def decrypt_with_private_key(private_key, ciphertext):
+def decrypt_with_private_key(private_key, ciphertext, label=None):
     """
     Decrypts a given ciphertext using the given private key and assumes OAEP padding
     (with MGF1 and SHA256)
     :param private_key: the private key to use for decryption (key object not bytes)
     :param ciphertext: the ciphertext to decrypt (bytes)
+    :param label: the OAEP label the ciphertext has been encrypted with
     :return: the plaintext of the decrypted ciphertext
     """
     return private_key.decrypt(ciphertext, padding=padding.OAEP(
         mgf=padding.MGF1(algorithm=hashes.SHA256()),
         algorithm=hashes.SHA256(),
-        label=None))
+        label=label))
 
 
 def create_header(initialization_vector: bytes,
-                  keys, algorithm='AES256-CFB', version=VERSION) -> [bytes]:
+                  keys, algorithm='AES256-CFB', version=VERSION, chunk_size=None) -> [bytes]:
     """ Creates the header for an encrypted file, returns artifacts as list of bytes
-    ready to be joined"""
+    ready to be joined
+
+    :param chunk_size: the plaintext bytes per chunk, only for the chunked version
+    """
     header = [MAGIC_NUMBER]
 
     metadata = {'iv': base64.b64encode(initialization_vector).decode('ascii'),
@@ -216,6 +348,8 @@ def create_header(initialization_vector: bytes,
                          for key_sub, key in keys.items()},
                 'algorithm': algorithm,
                 'version': version}
+    if chunk_size is not None:
+        metadata['chunk_size'] = chunk_size
 
     json_str = json.dumps(metadata).encode(ENCODING)
 
@@ -231,6 +365,11 @@ def read_header(f_in: io.RawIOBase) -> dict:
     :param f_in: readable file-object
     :return: the header dict
     """
+    return _read_header(f_in)[0]
+
+
+def _read_header(f_in):
+    """Read the header like :func:`read_header`, return it along with the bytes read."""
     magic_number = f_in.read(len(MAGIC_NUMBER))
 
     if magic_number != MAGIC_NUMBER:
@@ -239,14 +378,173 @@ def read_header(f_in: io.RawIOBase) -> dict:
 
     header_length, = struct.unpack('<I', f_in.read(4))
 
-    header_str = f_in.read(header_length).decode(ENCODING)
-    return json.loads(header_str)
+    header_bytes = f_in.read(header_length)
+    raw_header = magic_number + struct.pack('<I', header_length) + header_bytes
+    return json.loads(header_bytes.decode(ENCODING)), raw_header
+
 
+class InPlaceCipher:
+    """Encrypt or decrypt chunks in the buffer they have been read into.
 
-class EncryptionFileWrapper(io.RawIOBase):
+    The cipher context writes into a scratch buffer which is reused for all chunks, it needs
+    room for an additional block.
+    """
+
+    def __init__(self, context):
+        """
+        :param context: an encryptor or decryptor of a stream mode (e.g. CFB)
+        """
+        self.context = context
+        self.scratch = bytearray()
+
+    def update(self, view: memoryview):
+        """Replace the data in `view` with its encrypted/decrypted counterpart."""
+        needed = len(view) + algorithms.AES.block_size // 8 - 1
+        if len(self.scratch) < needed:
+            self.scratch = bytearray(needed)
+        with memoryview(self.scratch) as scratch:
+            count = self.context.update_into(view, scratch)
+            # stream modes return as many bytes as they get
+            assert count == len(view)
+            view[:count] = scratch[:count]
+
+
+class ChunkCipher:
+    """Encrypt and decrypt the chunks of a file in the chunked format.
+
+    The chunks are independent of each other, they may be processed in any order and by several
+    threads at once.
+    """
+
+    def __init__(self, file_key, nonce_prefix, chunk_size=CHUNK_SIZE, header=b''):
+        """
+        :param file_key: the symmetric key of the file (AES256)
+        :param nonce_prefix: the random prefix of the nonces from the header
+        :param chunk_size: the plaintext bytes per chunk
+        :param header: the header of the file, authenticated along with every chunk
+        """
+        assert len(nonce_prefix) == GCM_NONCE_PREFIX_LENGTH
+        assert MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE
+        self._algorithm = algorithms.AES(file_key)
+        self.nonce_prefix = nonce_prefix
+        self.chunk_size = chunk_size
+        #: bytes of an encrypted chunk, except the final one
+        self.encrypted_chunk_size = chunk_size + GCM_TAG_LENGTH
+        self._header_digest = hashlib.sha256(header).digest()
+
+    def _associated_data(self, final):
+        return self._header_digest + (_FINAL_CHUNK if final else _NOT_FINAL_CHUNK)
+
+    def _nonce(self, index):
+        return self.nonce_prefix + struct.pack('>I', index)
+
+    def encrypt(self, index, plaintext, final):
+        """Return the chunk at `index` encrypted and followed by its tag.
+
+        :param final: True for the last chunk of the file, which is shorter than `chunk_size`
+        """
+        assert len(plaintext) < self.chunk_size if final else len(plaintext) == self.chunk_size
+        encryptor = Cipher(self._algorithm, modes.GCM(self._nonce(index)),
+                           backend=default_backend()).encryptor()
+        encryptor.authenticate_additional_data(self._associated_data(final))
+        return encryptor.update(plaintext) + encryptor.finalize() + encryptor.tag
+
+    def decrypt(self, index, chunk, final):
+        """Return the plaintext of the encrypted chunk at `index`.
+
+        :param final: True if `chunk` is the last chunk of the file
+        :raises IntegrityError: if the chunk is not the one encrypted at `index`
+        """
+        if len(chunk) < GCM_TAG_LENGTH:
+            raise IntegrityError('chunk {} is truncated'.format(index))
+        with memoryview(chunk) as view:
+            decryptor = Cipher(self._algorithm,
+                               modes.GCM(self._nonce(index), bytes(view[-GCM_TAG_LENGTH:])),
+                               backend=default_backend()).decryptor()
+            decryptor.authenticate_additional_data(self._associated_data(final))
+            try:
+                return decryptor.update(view[:-GCM_TAG_LENGTH]) + decryptor.finalize()
+            except InvalidTag:
+                raise IntegrityError('chunk {} can not be authenticated'.format(index))
+
+
+class ChunkPipeline:
+    """Process the chunks of a file on an executor, several at once, in the order they are read.
+
+    Up to `depth` chunks are read ahead and processed on the executor, while the results are
+    returned in the order of the chunks. Without an executor or if the first chunk read is the
+    final one, e.g. of small files, the chunks are processed by the calling thread.
+    """
+
+    def __init__(self, read_chunk, process, executor=None, depth=PIPELINE_DEPTH):
+        """
+        :param read_chunk: returns the next chunk as tuple (index, data, final), None after the
+            final one. If an executor is used, `data` must not be modified afterwards.
+        :param process: called with (index, data, final), returns the processed chunk
+        :param executor: a :class:`concurrent.futures.Executor`, a process pool requires
+            `process` to be picklable
+        :param depth: the number of chunks processed at once
+        """
+        self.read_chunk = read_chunk
+        self.process = process
+        self.executor = executor
+        self.depth = depth
+        self._pending = collections.deque()
+        # raised by `read_chunk`, raised again once the chunks before are returned
+        self._error = None
+
+    def next(self):
+        """Return the next processed chunk, None after the final one."""
+        if self.executor is None:
+            chunk = self.read_chunk()
+            return None if chunk is None else self.process(*chunk)
+
+        while self._error is None and len(self._pending) < self.depth:
+            try:
+                chunk = self.read_chunk()
+            except Exception as error:  # pylint: disable=broad-except
+                self._error = error
+                break
+            if chunk is None:
+                break
+            if chunk[2] and not self._pending:
+                # nothing to process next to the final chunk
+                return self.process(*chunk)
+            self._pending.append(self.executor.submit(self.process, *chunk))
+
+        if self._pending:
+            return self._pending.popleft().result()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        return None
+
+    def reset(self):
+        """Drop the chunks read ahead, e.g. to continue reading elsewhere."""
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._error = None
+
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def chunk_executor():
+    """Return the thread pool shared by the transfers to process chunks, a thread per core."""
+    global _EXECUTOR  # pylint: disable=global-statement
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _EXECUTOR
+
+
+class EncryptionFileWrapper(ReusableBufferReader):
     """ Wraps over an existing file object and encrypted the stream"""
 
-    def __init__(self, f_original, public_keys, file_key=None):
+    def __init__(self, f_original, public_keys, file_key=None, encryption_params=None,
+                 version=CHUNKED_VERSION, chunk_size=CHUNK_SIZE, executor=None):
         """
         initializer
 
@@ -258,82 +556,212 @@ class EncryptionFileWrapper(io.RawIOBase):
         :param file_key: the symmetric key used for encryption (AES256). If not
         passed, it will be generated randomly
         (os.urandom)
+        :param encryption_params: the :attr:`encryption_params` of a previous encryption of the
+        same file, the ciphertext is the same byte by byte
+        :param version: the version of the format, :data:`CHUNKED_VERSION` or :data:`VERSION`
+        :param chunk_size: the plaintext bytes per chunk of the chunked version
+        :param executor: an executor to encrypt several chunks of the chunked version at once,
+            see :class:`ChunkPipeline`
         """
         super().__init__()
 
         # we never encrypt a file without public keys ;)
         assert len(public_keys)
 
-        # setting symmetric key used for file encryption
-        if not file_key:
-            # creating random file key if not passed
-            self._file_key = os.urandom(AES_KEY_LENGTH)
+        if encryption_params is not None:
+            # encrypting exactly like before, in the version of the header
+            self._file_key, initialization_vector, header = encryption_params
+            metadata = read_header(io.BytesIO(header))
+            version = metadata['version']
+            chunk_size = metadata.get('chunk_size')
         else:
-            # setting file key if passed (assuming right size)
-            self._file_key = file_key
+            # setting symmetric key used for file encryption
+            if not file_key:
+                # creating random file key if not passed
+                self._file_key = os.urandom(AES_KEY_LENGTH)
+            else:
+                # setting file key if passed (assuming right size)
+                self._file_key = file_key
 
-        # creating random IV
-        initialization_vector = os.urandom(AES_IV_LENGTH)
+            # creating random IV, the prefix of the nonces of the chunks
+            initialization_vector = os.urandom(
+                GCM_NONCE_PREFIX_LENGTH if version == CHUNKED_VERSION else AES_IV_LENGTH)
 
-        # creating cipher to perform encryption using given IV
-        self._cypher = Cipher(algorithms.AES(self._file_key),
-                              modes.CFB(initialization_vector=initialization_vector),
-                              backend=default_backend())
-        self._encryptor = self._cypher.encryptor()
+        #: the version of the format written
+        self.version = version
         self._f_original = f_original
 
-        # wrapping encryption key (symmetric) with all public keys of intended recipients
-        keys = {}
-        for subject, public_key_str in public_keys.items():
-            public_key = serialization.load_pem_public_key(public_key_str,
-                                                           default_backend())
-            # wrapping symmetric key with public key of user
-            encrypted_file_key = encrypt_with_public_key(public_key=public_key,
-                                                         plaintext=self._file_key)
-
-            # storing wrapped file key
-            keys[subject] = encrypted_file_key
-
-        # creating header information and adding to output buffer
-        self._buffer = \
-            b''.join(create_header(
-                initialization_vector=initialization_vector, keys=keys))
+        if version == CHUNKED_VERSION:
+            if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+                raise ValueError('chunk size {} out of range'.format(chunk_size))
+            header_params = {'algorithm': CHUNKED_ALGORITHM, 'version': version,
+                             'chunk_size': chunk_size}
+            key_label = _CHUNKED_KEY_LABEL
+        else:
+            # creating cipher to perform encryption using given IV
+            self._cypher = Cipher(algorithms.AES(self._file_key),
+                                  modes.CFB(initialization_vector=initialization_vector),
+                                  backend=default_backend())
+            self._cipher_in_place = InPlaceCipher(self._cypher.encryptor())
+            header_params = {}
+            key_label = None
+
+        if encryption_params is not None:
+            self._buffer = header
+        else:
+            # wrapping encryption key (symmetric) with all public keys of intended recipients
+            keys = {}
+            for subject, public_key_str in public_keys.items():
+                public_key = KEY_CACHE.public_key(public_key_str)
+                # wrapping symmetric key with public key of user
+                encrypted_file_key = encrypt_with_public_key(public_key=public_key,
+                                                             plaintext=self._file_key,
+                                                             label=key_label)
+
+                # storing wrapped file key
+                keys[subject] = encrypted_file_key
+
+            # creating header information and adding to output buffer
+            self._buffer = \
+                b''.join(create_header(
+                    initialization_vector=initialization_vector, keys=keys, **header_params))
+
+        #: tuple (file key, initialization vector, header) to encrypt the file the same way again
+        self.encryption_params = (self._file_key, initialization_vector, self._buffer)
+        #: the header, holding the file key wrapped only, see :func:`unwrap_encryption_params`
+        self.header = self._buffer
 
         # determining header size
         self.header_size = len(self._buffer)
-
-    def read(self, count=None):
+        # number of header bytes already read
+        self._buffer_position = 0
+
+        if version == CHUNKED_VERSION:
+            self._chunk_cipher = ChunkCipher(self._file_key, initialization_vector, chunk_size,
+                                             header=self._buffer)
+            self._cipher_in_place = None
+
+        # the chunk encrypted last and how much of it has been read
+        self._chunk = b''
+        self._chunk_position = 0
+        # the index of the next chunk read from the wrapped FLO
+        self._chunk_index = 0
+        self._final_chunk_read = False
+        self._plaintext_buffer = None
+        if version == CHUNKED_VERSION:
+            self._pipeline = ChunkPipeline(self._read_plaintext_chunk,
+                                           self._chunk_cipher.encrypt, executor)
+
+    def readinto(self, buffer):
         """
-        reads data through the wrapper and encrypts the data
-        :param count: the bytes to read or -1
-        :return: the ciphertext = encrypted plaintext from wrapped FLO
+        reads data through the wrapper and encrypts the data in the given buffer
+        :param buffer: a writable bytes-like object
+        :return: the number of bytes read
         """
-        result = b''
-
-        # if buffer is filled (e.g. header), reading first part of result from buffer
-        if self._buffer:
-            if count:
-                result = self._buffer[:count]
-                self._buffer = self._buffer[count:]
-                # suggestion: if self._buffer == b'': self._buffer = None
-            else:
-                result = self._buffer
-                self._buffer = b''
-                # suggestion: self._buffer = None
-
-        # reading remaining part
-        if count is not None:
-            # if size to read defined, reading remaining part not yet read from buffer
-            plain_text = self._f_original.read(count - len(result))
+        with memoryview(buffer) as view:
+            count = 0
+
+            # if the header has not been read completely, reading first part of result from it
+            if self._buffer_position < self.header_size:
+                count = min(len(view), self.header_size - self._buffer_position)
+                view[:count] = self._buffer[self._buffer_position:self._buffer_position + count]
+                self._buffer_position += count
+
+            if self._cipher_in_place is None:
+                count += self._read_chunks(view[count:])
+            # reading remaining part and encrypting it where it has been read to
+            elif count < len(view):
+                plain_count = readinto_from(self._f_original, view[count:])
+                if plain_count:
+                    self._cipher_in_place.update(view[count:count + plain_count])
+                count += plain_count
+
+        # returning the size of the ciphertext
+        return count
+
+    def _read_chunks(self, view):
+        """Fill `view` with encrypted chunks, return the count."""
+        count = 0
+        while count < len(view):
+            if self._chunk_position == len(self._chunk):
+                chunk = self._pipeline.next()
+                if chunk is None:
+                    break
+                self._chunk = chunk
+                self._chunk_position = 0
+            chunk_count = min(len(view) - count, len(self._chunk) - self._chunk_position)
+            view[count:count + chunk_count] = \
+                self._chunk[self._chunk_position:self._chunk_position + chunk_count]
+            self._chunk_position += chunk_count
+            count += chunk_count
+        return count
+
+    def resume_at(self, offset):
+        """Continue the ciphertext at `offset`, e.g. to resume an upload.
+
+        In the chunked version of a seekable FLO, the FLO is seeked to the chunk at `offset`
+        and only that chunk is encrypted again. Otherwise the ciphertext before `offset` is
+        read and dropped. Nothing must have been read before.
+
+        :raises IOError: if the ciphertext ends before `offset`
+        """
+        assert self._buffer_position == 0 and self._chunk_index == 0, 'already read'
+        if offset <= self.header_size or self._cipher_in_place is not None or \
+                not self._f_original.seekable():
+            self._skip(offset)
+            return
+
+        start = self._f_original.tell()
+        size = self._f_original.seek(0, io.SEEK_END) - start
+        chunk_size = self._chunk_cipher.chunk_size
+        encrypted_size = size + (size // chunk_size + 1) * GCM_TAG_LENGTH
+        self._buffer_position = self.header_size
+        if offset - self.header_size > encrypted_size:
+            raise IOError('file ended {} bytes before {}'.format(
+                offset - self.header_size - encrypted_size, offset))
+        if offset - self.header_size == encrypted_size:
+            self._final_chunk_read = True
+            return
+
+        index, position = divmod(offset - self.header_size,
+                                 self._chunk_cipher.encrypted_chunk_size)
+        self._f_original.seek(start + index * chunk_size)
+        self._chunk_index = index
+        self._chunk = self._pipeline.next()
+        self._chunk_position = position
+
+    def _skip(self, offset):
+        """Read and drop the ciphertext up to `offset`."""
+        remaining = offset
+        with memoryview(bytearray(min(offset, CHUNK_SIZE))) as view:
+            while remaining:
+                count = self.readinto(view[:remaining])
+                if not count:
+                    raise IOError('file ended {} bytes before {}'.format(remaining, offset))
+                remaining -= count
+
+    def _read_plaintext_chunk(self):
+        """Return the next chunk of the plaintext as tuple (index, plaintext, final)."""
+        if self._final_chunk_read:
+            return None
+        chunk_size = self._chunk_cipher.chunk_size
+        if self._pipeline.executor is not None:
+            # the chunks are encrypted while the next ones are read
+            plaintext = bytearray(chunk_size)
         else:
-            # if no size defined -> reading whole original
-            plain_text = self._f_original.read()
-        if plain_text:
-            # encrypting and appending to result
-            result += self._encryptor.update(plain_text)
-
-        # returning ciphertext
-        return result
+            if self._plaintext_buffer is None:
+                self._plaintext_buffer = bytearray(chunk_size)
+            plaintext = self._plaintext_buffer
+        with memoryview(plaintext) as view:
+            plain_count = readinto_full(self._f_original, view)
+        # a full chunk is never the final one, it is followed by an empty one at the end
+        self._final_chunk_read = plain_count < chunk_size
+        self._chunk_index += 1
+        if plaintext is self._plaintext_buffer:
+            return self._chunk_index - 1, memoryview(plaintext)[:plain_count], \
+                self._final_chunk_read
+        del plaintext[plain_count:]
+        return self._chunk_index - 1, plaintext, self._final_chunk_read
 
     def readable(self):
         """
@@ -357,16 +785,57 @@ class EncryptionFileWrapper(io.RawIOBase):
         return False
 
 
-class DecryptionFileWrapper(io.RawIOBase):
+def unwrap_encryption_params(header, get_key_pair):
+    """Return the :attr:`EncryptionFileWrapper.encryption_params` of a file by its `header`.
+
+    The header holds the file key wrapped only, so it can be kept e.g. in a checkpoint.
+
+    :param header: the :attr:`EncryptionFileWrapper.header` of the file
+    :param get_key_pair: like for :class:`DecryptionFileWrapper`
+    :raises NoKeyError: if there is no key for any subject of the header
+    """
+    # pylint: disable=protected-access
+    decryption = DecryptionFileWrapper(io.BytesIO(header), get_key_pair)
+    initialization_vector = base64.b64decode(read_header(io.BytesIO(header))['iv'])
+    return decryption._file_key, initialization_vector, header
+
+
+def _unwrap_file_key(private_key, encrypted_file_key, version):
+    """Return the file key of a file of `version` unwrapped with `private_key`.
+
+    :raises IntegrityError: if the key has been wrapped for the chunked version, but the header
+        claims the legacy one
+    """
+    if version == CHUNKED_VERSION:
+        try:
+            return decrypt_with_private_key(private_key, encrypted_file_key,
+                                            label=_CHUNKED_KEY_LABEL)
+        except ValueError:
+            raise IntegrityError('the file key can not be unwrapped')
+    try:
+        return decrypt_with_private_key(private_key, encrypted_file_key)
+    except ValueError:
+        try:
+            decrypt_with_private_key(private_key, encrypted_file_key, label=_CHUNKED_KEY_LABEL)
+        except ValueError:
+            raise IntegrityError('the file key can not be unwrapped')
+        raise IntegrityError('the file key has been wrapped for version {}, refusing to read '
+                             'the file as version {}'.format(CHUNKED_VERSION, version))
+
+
+class DecryptionFileWrapper(ReusableBufferReader):
     """Wraps over an existing file object and decrypts the stream."""
 
-    def __init__(self, f_original: io.RawIOBase, get_key_pair: typing.Callable[[str], KeyPair]):
+    def __init__(self, f_original: io.RawIOBase, get_key_pair: typing.Callable[[str], KeyPair],
+                 executor=None):
         """
         initializer, NOTE: this starts reading the stream of f_original
         to extract header information if present!!
         :param f_original: the wrapped FLO
         :param get_key_pair: a function, called for each key_subject from the header until one does
          not throw a KeyError.
+        :param executor: an executor to decrypt several chunks of the chunked version at once,
+            see :class:`ChunkPipeline`
         """
         super().__init__()
 
@@ -374,11 +843,27 @@ class DecryptionFileWrapper(io.RawIOBase):
         self._f_original = f_original
 
         # reading json header contained in encrypted file
-        json_header = read_header(self._f_original)
+        json_header, raw_header = _read_header(self._f_original)
+        self.header_size = len(raw_header)
+
+        #: the version of the format read
+        self.version = json_header.get('version')
+        if self.version not in (VERSION, CHUNKED_VERSION):
+            raise EncryptionException('unsupported version {}'.format(self.version))
 
         # reading iv from header
         initialization_vector = base64.b64decode(json_header['iv'])
 
+        if self.version == CHUNKED_VERSION:
+            # checking the header before allocating buffers of the chunk size
+            chunk_size = json_header.get('chunk_size')
+            if type(chunk_size) is not int or \
+                    not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+                raise IntegrityError('chunk size {!r} out of range'.format(chunk_size))
+            if len(initialization_vector) != GCM_NONCE_PREFIX_LENGTH:
+                raise IntegrityError('nonce prefix of {} bytes'.format(
+                    len(initialization_vector)))
+
         # try to get a key for one of the subject in the file-header
         for private_key_subject in json_header['keys'].keys():
             try:
@@ -402,33 +887,151 @@ class DecryptionFileWrapper(io.RawIOBase):
         encrypted_file_key = base64.b64decode(encrypted_file_key_string)
 
         # getting private key (PEM)
-        private_key = serialization.load_pem_private_key(
-            private_pem, None, backend=default_backend())
-
-        # initializing file key (AES) by unwrapping wrapped key info with private key
-        self._file_key = decrypt_with_private_key(private_key=private_key,
-                                                  ciphertext=encrypted_file_key)
-
-        # initializing cipher to decrypt using file key
-        self._cypher = Cipher(algorithms.AES(self._file_key),
-                              modes.CFB(initialization_vector=initialization_vector),
-                              backend=default_backend())
-        self._decryptor = self._cypher.decryptor()
-
-    def read(self, count):
+        private_key = KEY_CACHE.private_key(private_pem)
+
+        # initializing file key (AES) by unwrapping wrapped key info with private key, the
+        # label binds the key to the version
+        self._file_key = _unwrap_file_key(private_key, encrypted_file_key, self.version)
+
+        if self.version == CHUNKED_VERSION:
+            self._chunk_cipher = ChunkCipher(self._file_key, initialization_vector, chunk_size,
+                                             header=raw_header)
+            self._cipher_in_place = None
+            # the chunk decrypted last and how much of it has been read
+            self._chunk = b''
+            self._chunk_position = 0
+            # the index of the next chunk read from the wrapped FLO
+            self._chunk_index = 0
+            self._final_chunk_read = False
+            self._encrypted_buffer = None
+            self._pipeline = ChunkPipeline(self._read_encrypted_chunk,
+                                           self._chunk_cipher.decrypt, executor)
+            # the position in the plaintext
+            self._position = 0
+            # the position of the first chunk in the wrapped FLO, if it is seekable
+            self._chunks_start = self._f_original.tell() if self._f_original.seekable() \
+                else None
+        else:
+            # initializing cipher to decrypt using file key
+            self._cypher = Cipher(algorithms.AES(self._file_key),
+                                  modes.CFB(initialization_vector=initialization_vector),
+                                  backend=default_backend())
+            self._decryptor = self._cypher.decryptor()
+            self._cipher_in_place = InPlaceCipher(self._decryptor)
+
+    def readinto(self, buffer):
         """
-        reads data through the wrapper and decrypts the data
-        :param count: the bytes to read or -1
-        :return: the plaintext = decrypted ciphertext from wrapped FLO
+        reads data through the wrapper and decrypts the data in the given buffer
+        :param buffer: a writable bytes-like object
+        :return: the number of bytes read
+        :raises IntegrityError: if a chunk of the chunked version can't be authenticated
         """
-        # reading ciphertext from wrapped FLO
-        cipher_text = self._f_original.read(count)
+        with memoryview(buffer) as view:
+            if self._cipher_in_place is None:
+                return self._read_chunks(view)
 
-        # decrypting
-        plain_text = self._decryptor.update(cipher_text)
+            # reading ciphertext from wrapped FLO
+            count = readinto_from(self._f_original, view)
 
-        # returning plaintext
-        return plain_text
+            # decrypting
+            if count:
+                self._cipher_in_place.update(view[:count])
+
+        # returning the size of the plaintext
+        return count
+
+    def _read_chunks(self, view):
+        """Fill `view` with the plaintext of the chunks, return the count."""
+        count = 0
+        while count < len(view):
+            if self._chunk_position == len(self._chunk):
+                chunk = self._pipeline.next()
+                if chunk is None:
+                    break
+                self._chunk = chunk
+                self._chunk_position = 0
+            chunk_count = min(len(view) - count, len(self._chunk) - self._chunk_position)
+            view[count:count + chunk_count] = \
+                self._chunk[self._chunk_position:self._chunk_position + chunk_count]
+            self._chunk_position += chunk_count
+            count += chunk_count
+        self._position += count
+        return count
+
+    def _read_encrypted_chunk(self):
+        """Return the next encrypted chunk as tuple (index, chunk, final)."""
+        if self._final_chunk_read:
+            return None
+        encrypted_chunk_size = self._chunk_cipher.encrypted_chunk_size
+        if self._pipeline.executor is not None:
+            # the chunks are decrypted while the next ones are read
+            encrypted = bytearray(encrypted_chunk_size)
+        else:
+            if self._encrypted_buffer is None:
+                self._encrypted_buffer = bytearray(encrypted_chunk_size)
+            encrypted = self._encrypted_buffer
+        with memoryview(encrypted) as view:
+            count = readinto_full(self._f_original, view)
+        if not count:
+            raise IntegrityError('the final chunk is missing')
+        # only the final chunk is shorter, a final chunk of full size fails to authenticate
+        self._final_chunk_read = count < encrypted_chunk_size
+        self._chunk_index += 1
+        if encrypted is self._encrypted_buffer:
+            return self._chunk_index - 1, memoryview(encrypted)[:count], self._final_chunk_read
+        del encrypted[count:]
+        return self._chunk_index - 1, encrypted, self._final_chunk_read
+
+    def plaintext_size(self, size):
+        """Return the size of the plaintext of the encrypted file of `size` bytes."""
+        size -= self.header_size
+        if self.version == CHUNKED_VERSION:
+            size = _chunked_plaintext_size(size, self._chunk_cipher.chunk_size)
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Continue reading at `offset` of the plaintext.
+
+        Only the chunked version can be seeked and only if the wrapped FLO can be seeked. Just
+        the chunk at `offset` is read and decrypted.
+
+        :raises ValueError: if `offset` is beyond the end of the plaintext
+        :raises IntegrityError: if the chunk at `offset` can't be authenticated or is missing
+
+        :return: the new position
+        """
+        if not self.seekable():
+            raise io.UnsupportedOperation('seek')
+        end = self._f_original.seek(0, io.SEEK_END)
+        size = _chunked_plaintext_size(end - self._chunks_start, self._chunk_cipher.chunk_size)
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += size
+        elif whence != io.SEEK_SET:
+            raise ValueError('invalid whence ({})'.format(whence))
+        if offset < 0:
+            raise ValueError('negative seek position {}'.format(offset))
+        if offset > size:
+            raise ValueError('seek position {} beyond the end {}'.format(offset, size))
+
+        index, chunk_offset = divmod(offset, self._chunk_cipher.chunk_size)
+        self._pipeline.reset()
+        self._chunk_index = index
+        # the chunk at `offset` is read even at the end, a missing final chunk fails then
+        self._final_chunk_read = False
+        self._f_original.seek(self._chunks_start +
+                              index * self._chunk_cipher.encrypted_chunk_size)
+        self._chunk = self._pipeline.next() or b''
+        self._chunk_position = min(chunk_offset, len(self._chunk))
+        self._position = offset
+        return offset
+
+    def tell(self):
+        """Return the position in the plaintext."""
+        if self._cipher_in_place is not None:
+            raise io.UnsupportedOperation('tell')
+        return self._position
 
     def readable(self):
         """
@@ -449,15 +1052,45 @@ class DecryptionFileWrapper(io.RawIOBase):
         determines if the FLO is seekable
         :return: true if seekable, false else
         """
-        return False
+        return self._cipher_in_place is None and self._chunks_start is not None
 
 
-def calc_header_size(subjects) -> int:
+def calc_header_size(subjects, version=CHUNKED_VERSION, chunk_size=CHUNK_SIZE) -> int:
     """Calculates the size of the header based on subjects
 
     it uses the create_header with fake key and iv date function in the background, to
     ensure this returns the correct size
     """
-    return \
-        len(b''.join(create_header(b'\0' * AES_IV_LENGTH,
-                                   {sub: b'\0' * 512 for sub in subjects})))
+    keys = {sub: b'\0' * 512 for sub in subjects}
+    if version == CHUNKED_VERSION:
+        header = create_header(b'\0' * GCM_NONCE_PREFIX_LENGTH, keys,
+                               algorithm=CHUNKED_ALGORITHM, version=version,
+                               chunk_size=chunk_size)
+    else:
+        header = create_header(b'\0' * AES_IV_LENGTH, keys)
+    return len(b''.join(header))
+
+
+def calc_encrypted_size(size, subjects, version=CHUNKED_VERSION, chunk_size=CHUNK_SIZE) -> int:
+    """Return the size of a file of `size` bytes once it is encrypted for `subjects`."""
+    if version == CHUNKED_VERSION:
+        size += GCM_TAG_LENGTH * (size // chunk_size + 1)
+    return size + calc_header_size(subjects, version, chunk_size)
+
+
+def calc_plaintext_size(size, subjects, version=CHUNKED_VERSION, chunk_size=CHUNK_SIZE) -> int:
+    """Return the size of the plaintext of a file of `size` bytes encrypted for `subjects`.
+
+    The inverse of :func:`calc_encrypted_size`.
+    """
+    size -= calc_header_size(subjects, version, chunk_size)
+    if version == CHUNKED_VERSION:
+        size = _chunked_plaintext_size(size, chunk_size)
+    return size
+
+
+def _chunked_plaintext_size(size, chunk_size):
+    """Return the size of the plaintext of `size` bytes of chunks."""
+    if size < GCM_TAG_LENGTH:
+        return 0
+    return size - GCM_TAG_LENGTH * ((size - GCM_TAG_LENGTH) // (chunk_size + GCM_TAG_LENGTH) + 1)
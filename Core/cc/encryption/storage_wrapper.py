@@ -1,18 +1,21 @@
 """A virtual filesystem which encrypts data while reading and decrypts while writing."""
 import contextlib
 import logging
+import os
 from collections import namedtuple
 
 import jars.fs.filesystem
 from jars import VERSION_ID
-from jars.streaming_utils import LimitedFileReader
 
 from cc import configuration
 import cc.crypto
 import cc.crypto2
+from cc.mime_type_stream import PreBufferedFileReader
 from cc.settings_sync import KEY_SUBJECT_SHARE, KEY_SUBJECT_USER
+from cc.synchronization.hash_cache import CachingFileReader, HashingFileReader, hash_file
 from cc.synchronization.syncengine import ItemHasNoStorageException
-from cc.synchronization.syncfsm import FILESYSTEM_ID, STORAGE, SHARE_ID, get_storage_path
+from cc.synchronization.syncfsm import (CONTENT_HASH, FILESYSTEM_ID, SIZE, STORAGE, SHARE_ID,
+                                        get_storage_path)
 
 logger = logging.getLogger(__name__)
 
@@ -50,12 +53,14 @@ class _EncryptionEventSinkWrapper:
 
     def storage_create(self, storage_id, path, event_props):
         """Create event sink method."""
+        self.enc_wrapper.invalidate_content_hash(path)
         event_props = self.enc_wrapper.wrap_props(path, event_props)
         self.event_sink.storage_create(storage_id=storage_id, path=path,
                                        event_props=event_props)
 
     def storage_move(self, storage_id, source_path, target_path, event_props):
         """Move event sink method."""
+        self.enc_wrapper.move_content_hash(source_path, target_path)
         event_props = self.enc_wrapper.wrap_props(source_path, event_props)
         self.event_sink.storage_move(
             storage_id=storage_id, source_path=source_path, target_path=target_path,
@@ -63,10 +68,16 @@ class _EncryptionEventSinkWrapper:
 
     def storage_modify(self, storage_id, path, event_props):
         """Modify event sink method."""
+        self.enc_wrapper.invalidate_content_hash(path)
         event_props = self.enc_wrapper.wrap_props(path, event_props)
         self.event_sink.storage_modify(storage_id=storage_id, path=path,
                                        event_props=event_props)
 
+    def storage_delete(self, storage_id, path):
+        """Delete event sink method."""
+        self.enc_wrapper.invalidate_content_hash(path)
+        self.event_sink.storage_delete(storage_id=storage_id, path=path)
+
 
 def _has_different_share_id(storage_id, old_props, new_props):
     """Check if the storage file has changed its storage id.
@@ -94,6 +105,9 @@ def _has_different_share_id(storage_id, old_props, new_props):
 class EncryptionWrapper:
     """Mixin for a storage provider it encrypts read data and decrypts written data."""
 
+    #: the :class:`cc.synchronization.hash_cache.ContentHashCache` of the written files, if any
+    hash_cache = None
+
     # this is a mix-in
     # pylint: disable=no-member
     def __init__(self, event_sink, syncengine, public_key_getter, private_key_getter, *args,
@@ -159,6 +173,12 @@ class EncryptionWrapper:
     def wrap_props(self, path, props):
         """Wrap the event properties."""
         logger.debug('wrapping event props for %s', path)
+        if not props.get(jars.IS_DIR, False) and CONTENT_HASH not in props:
+            # pairs a delete and a create of the same file as a move
+            content_hash = self.cached_content_hash(path)
+            if content_hash is not None:
+                props[CONTENT_HASH] = content_hash
+
         if 'version_id' in props and not props.get(jars.IS_DIR, False):
             if not isinstance(props['version_id'], EncryptedVersionTag):
                 try:
@@ -178,7 +198,8 @@ class EncryptionWrapper:
                     key_subjects=key_subjects)
                 logger.debug('Key subjects %s for path %s', key_subjects, path)
                 if key_subjects:
-                    props['size'] += cc.crypto2.calc_header_size(props['version_id'].key_subjects)
+                    props['size'] = cc.crypto2.calc_encrypted_size(
+                        props['size'], props['version_id'].key_subjects)
 
         return props
 
@@ -205,26 +226,67 @@ class EncryptionWrapper:
 
         try:
             wrapped_file_obj = cc.crypto2.DecryptionFileWrapper(
-                file_obj, self.private_key_getter)
+                file_obj, self.private_key_getter, executor=cc.crypto2.chunk_executor())
             subject_ids = tuple(sorted(wrapped_file_obj.subject_ids))
         except cc.crypto2.HeaderError as ex:
-            # the object is not encrypted remotely, so return a LimitedFileReader with the
+            # the object is not encrypted remotely, so return a PreBufferedFileReader with the
             # already read data
             # pylint:disable=redefined-variable-type
-            wrapped_file_obj = LimitedFileReader(file_obj, pre_buffer=ex.read_data)
+            wrapped_file_obj = PreBufferedFileReader(file_obj, pre_buffer=ex.read_data)
 
         if subject_ids and size is not None:
-            size += cc.crypto2.calc_header_size(subject_ids)
+            size = wrapped_file_obj.plaintext_size(size)
+
+        # the plaintext is hashed while it is written, saves reading the file once more
+        hashing_file_obj = None
+        if self.hash_cache is not None:
+            wrapped_file_obj = hashing_file_obj = HashingFileReader(wrapped_file_obj)
 
         new_version_id = super().write(path, wrapped_file_obj, original_version_id, size=size)
         logger.info("File was encrypted with the ids: %s", subject_ids)
 
+        if hashing_file_obj is not None:
+            self.store_content_hash(path, hashing_file_obj)
+
         return EncryptedVersionTag(new_version_id, subject_ids)
 
-    def open_read(self, path, expected_version_id=None):
+    def cached_content_hash(self, path):
+        """Return the cached content hash of the file at `path`, None if it is not cached."""
+        # pylint: disable=unused-argument,no-self-use
+        return None
+
+    def store_content_hash(self, path, hashing_file_obj):
+        """Store the content hash of the file just written in the hash cache.
+
+        Nothing is stored if the file has been modified by someone else in the meantime.
+        """
+        # pylint: disable=unused-argument
+        pass
+
+    def hash_while_reading(self, path, file_obj):
+        """Return `file_obj` of the file at `path`, wrapped to hash the plaintext read."""
+        # pylint: disable=unused-argument,no-self-use
+        return file_obj
+
+    def invalidate_content_hash(self, path):
+        """Drop the cached content hash of `path`, called on every event of it."""
+        # pylint: disable=unused-argument
+        pass
+
+    def move_content_hash(self, source, target):
+        """Keep the cached content hashes of `source` for `target`, called on move events."""
+        # pylint: disable=unused-argument
+        pass
+
+    def open_read(self, path, expected_version_id=None, encryption_header=None):
         """Return an EncryptionFileWrapper around the one returned by the wrapped storage.
 
         That means that the content read from the storage will be encrypted.
+
+        :param encryption_header: the `header` of a previously returned EncryptionFileWrapper,
+            to read the same ciphertext again, e.g. to resume an upload. The file key is
+            unwrapped with the private key of one of its subjects.
+        :raises cc.crypto2.NoKeyError: if there is no private key for the header
         """
         # parameter determining if encrypted, default false
         key_subjects = ()
@@ -234,8 +296,14 @@ class EncryptionWrapper:
         else:
             logger.warning('Not encrypting "%s" since there is no EncryptedVersionTag', path)
 
+        encryption_params = None
+        if key_subjects and encryption_header is not None:
+            encryption_params = cc.crypto2.unwrap_encryption_params(encryption_header,
+                                                                    self.private_key_getter)
+
         # getting FLO from assumed superclass of this mixin
         f_in = super().open_read(path=path, expected_version_id=expected_version_id)
+        f_in = self.hash_while_reading(path, f_in)
 
         if key_subjects:
             # get the public keys for this operation
@@ -247,7 +315,8 @@ class EncryptionWrapper:
                 raise cc.crypto2.NoKeyError
 
             f_in = cc.crypto2.EncryptionFileWrapper(
-                f_in, public_keys=keys)
+                f_in, public_keys=keys, encryption_params=encryption_params,
+                executor=cc.crypto2.chunk_executor())
 
         # returning potentially wrapped FLO
         return f_in
@@ -296,7 +365,92 @@ class EncryptionWrapper:
 
 class EncryptingFileSystem(EncryptionWrapper, jars.fs.Filesystem):
     # pylint: disable=too-many-ancestors
-    """Encryption file system class which simply places a encryptionwrapper around FileSystem."""
+    """Encryption file system class which simply places a encryptionwrapper around FileSystem.
+
+    The content hashes of the local files are cached in the `hash_cache`, if one is passed.
+    """
+
+    def __init__(self, *args, hash_cache=None, **kwargs):
+        self.hash_cache = hash_cache
+        self.local_root = kwargs['root']
+        super().__init__(*args, **kwargs)
+
+    def local_path(self, path):
+        """Return the path of the file `path` on the disk."""
+        return os.path.join(self.local_root, *path)
+
+    def get_content_hash(self, path):
+        """Return the content hash of the file at `path`, it is hashed if it is not cached.
+
+        :return: tuple `(algorithm, hexdigest)`, see :mod:`cc.synchronization.hash_cache`
+        :raises OSError: if the file can't be read
+        """
+        if self.hash_cache is None:
+            return hash_file(self.local_path(path))
+        return self.hash_cache.get(self.local_path(path))
+
+    def cached_content_hash(self, path):
+        if self.hash_cache is None:
+            return None
+        return self.hash_cache.lookup(self.local_path(path))
+
+    def store_content_hash(self, path, hashing_file_obj):
+        local_path = self.local_path(path)
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return
+        if stat.st_size == hashing_file_obj.read_count:
+            self.hash_cache.store(local_path, hashing_file_obj.content_hash, stat)
+
+    def hash_while_reading(self, path, file_obj):
+        """Hash the file while it is read, e.g. uploaded, unless its hash is cached already."""
+        if self.hash_cache is None:
+            return file_obj
+        local_path = self.local_path(path)
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return file_obj
+        if self.hash_cache.lookup(local_path, stat) is not None:
+            return file_obj
+        return CachingFileReader(file_obj, self.hash_cache, local_path, stat)
+
+    def add_content_hash_alias(self, path, content_hash):
+        """Record the `content_hash` of another algorithm for the file at `path`.
+
+        :param content_hash: e.g. the content hash of the storage the file was downloaded from
+        """
+        if self.hash_cache is not None:
+            self.hash_cache.add_alias(self.local_path(path), content_hash)
+
+    def write_copy(self, path, file_obj, content_hash, original_version_id=None):
+        """Write the plaintext of a local file to `path`, in place of a download.
+
+        :param file_obj: the file object of the local file, it is not decrypted
+        :param content_hash: the content hash of the local file, the write fails with
+            :class:`cc.synchronization.hash_cache.ContentChangedError` if it doesn't match
+        :return: the version id as wrapped by :meth:`wrap_props`, just like the events of the
+            file will be
+        """
+        if original_version_id:
+            (original_version_id, _) = original_version_id
+
+        hashing_file_obj = HashingFileReader(file_obj, expected_hash=content_hash)
+        version_id = jars.fs.Filesystem.write(self, path, hashing_file_obj, original_version_id)
+        if self.hash_cache is not None:
+            self.store_content_hash(path, hashing_file_obj)
+
+        props = {VERSION_ID: version_id, SIZE: hashing_file_obj.read_count}
+        return self.wrap_props(path, props)[VERSION_ID]
+
+    def invalidate_content_hash(self, path):
+        if self.hash_cache is not None:
+            self.hash_cache.invalidate(self.local_path(path))
+
+    def move_content_hash(self, source, target):
+        if self.hash_cache is not None:
+            self.hash_cache.move(self.local_path(source), self.local_path(target))
 
     def create_public_sharing_link(self, path):
         raise NotImplementedError
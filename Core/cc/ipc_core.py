@@ -463,6 +463,32 @@ class CrossCloudCore:
         cc.ipc_gui.appStateHasChanged(APP_STATE_SYNCED)
         return SUCCESS_OPERATION_RESPONSE
 
+    @ipc_core_exception_decorator
+    def getTransferStatistics(self):
+        """Return the throughput per storage, the running transfers and the ETA of the queue."""
+        # not performing this if not started -> no transfers
+        if not self.client_started or self.client.synchronization_graph is None:
+            return None
+
+        return self.client.synchronization_graph.bademeister.queue.transfer_metrics.statistics
+
+    @ipc_core_exception_decorator
+    def getBandwidthLimits(self):
+        """Return the bandwidth limits in bytes per second and the unthrottled periods."""
+        return {'limits': self.client.config.bandwidth_limits,
+                'schedule': self.client.config.bandwidth_schedule}
+
+    @ipc_core_exception_decorator
+    def setBandwidthLimits(self, limits, schedule=None):
+        """Change the bandwidth limits, they apply to the running transfers immediately.
+
+        :param limits: e.g. {"upload": 512000, "storages": {"dropbox_1": {"download": 2097152}}}
+        :param schedule: periods without limits, e.g. [{"start": "22:00", "end": "06:00"}]
+        """
+        logger.info("RPC-SERVER: set bandwidth limits %s, schedule %s", limits, schedule)
+        self.client.set_bandwidth_limits(limits, schedule or [])
+        return SUCCESS_OPERATION_RESPONSE
+
     @ipc_core_exception_decorator
     def getAppState(self):
         """returns the app state"""
@@ -1,11 +1,92 @@
-"""Module containing helpers to operate with file objects."""
+"""Module containing helpers to operate with file objects.
+
+The file objects of a transfer are stacked, e.g. an upload of an encrypted file is read through
+:class:`cc.crypto2.EncryptionFileWrapper`, :class:`cc.synchronization.models.ControlFileWrapper`
+and :class:`MimeTypeDetectingFileObject`. The wrappers implement `readinto`, so a chunk is read
+into a single buffer which is passed down the stack, instead of creating new bytes objects in
+every layer.
+"""
 import io
 import typing
 
 import magic
 
 
-class MimeTypeDetectingFileObject(io.RawIOBase):
+def readinto_from(file_obj, buffer) -> int:
+    """Read from `file_obj` into `buffer`, with `readinto` if the file object implements it.
+
+    :return: the number of bytes read
+    """
+    try:
+        count = file_obj.readinto(buffer)
+    except (AttributeError, NotImplementedError):
+        # io.RawIOBase subclasses only implementing `read` raise NotImplementedError
+        data = file_obj.read(len(buffer))
+        count = len(data)
+        buffer[:count] = data
+    return count or 0
+
+
+def readinto_full(file_obj, buffer) -> int:
+    """Read from `file_obj` until `buffer` is full or the file ended.
+
+    :return: the number of bytes read, less than the length of `buffer` only at the end
+    """
+    count = 0
+    with memoryview(buffer) as view:
+        while count < len(view):
+            read_count = readinto_from(file_obj, view[count:])
+            if not read_count:
+                break
+            count += read_count
+    return count
+
+
+class ReusableBufferReader(io.RawIOBase):
+    """Base class for file objects implementing `read` with `readinto`.
+
+    `read` reads into a buffer which is reused for every call, only the returned bytes object is
+    created per call. Subclasses implement :meth:`readinto`.
+    """
+
+    _read_buffer = None
+
+    def read(self, count=-1):
+        """Read up to `count` bytes, everything if `count` is None or negative."""
+        if count is None or count < 0:
+            return self.readall()
+        if self._read_buffer is None or len(self._read_buffer) < count:
+            self._read_buffer = bytearray(count)
+        with memoryview(self._read_buffer) as view:
+            read_count = self.readinto(view[:count])
+            return bytes(view[:read_count])
+
+    def readable(self):
+        return True
+
+
+class PreBufferedFileReader(ReusableBufferReader):
+    """Return the bytes of `pre_buffer` before the ones of the wrapped file object.
+
+    Used if data has already been read from a file object, e.g. to check for a header.
+    """
+
+    def __init__(self, orig_obj, pre_buffer=b''):
+        super().__init__()
+        self._orig_obj = orig_obj
+        self._pre_buffer = memoryview(pre_buffer)
+
+    def readinto(self, buffer):
+        """Read the pre buffer first, then from the wrapped file object."""
+        if self._pre_buffer:
+            count = min(len(buffer), len(self._pre_buffer))
+            buffer[:count] = self._pre_buffer[:count]
+            self._pre_buffer = self._pre_buffer[count:]
+            return count
+        return readinto_from(self._orig_obj, buffer)
+
+
+class MimeTypeDetectingFileObject(ReusableBufferReader):
     """File like class which tries to detect the mimetime as soon as enough data is availabe."""
 
     def __init__(self, orig_obj: io.RawIOBase,
@@ -24,22 +105,22 @@ class MimeTypeDetectingFileObject(io.RawIOBase):
         self.max_buffer_size = max_buffer_size
 
         # this buffer stores the bytes
-        self.buffer = b''
+        self.buffer = bytearray()
 
         self.detection_callback = detection_callback
         self.called_back = False
 
-    def read(self, count=None):
+    def readinto(self, buffer):
         """Pass the read to the orig_obj and tries to find out the mime-type."""
-        buffer = self._orig_obj.read(count)
+        count = readinto_from(self._orig_obj, buffer)
 
         if len(self.buffer) < self.max_buffer_size and not self.called_back:
             # lets add the buffer
-            self.buffer += buffer
+            self.buffer += buffer[:min(count, self.max_buffer_size - len(self.buffer))]
 
-        if (len(self.buffer) >= self.max_buffer_size or len(
-                buffer) != count) and not self.called_back:
-            self.detection_callback(magic.from_buffer(self.buffer, mime=True))
+        if (len(self.buffer) >= self.max_buffer_size or count != len(buffer)) and \
+                not self.called_back:
+            self.detection_callback(magic.from_buffer(bytes(self.buffer), mime=True))
             self.called_back = True
-            self.buffer = b''
-        return buffer
+            self.buffer = bytearray()
+        return count
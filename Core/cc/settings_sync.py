@@ -8,8 +8,6 @@ import sys
 
 import requests
 from requests import HTTPError
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
 from marshmallow import Schema, fields, post_dump
 
 import jars
@@ -1127,11 +1125,9 @@ def get_share_info(config):
                     enc_share_key = share.get('share_key_for_current_user',
                                               {}).get('encrypted_share_key')
                     if enc_share_key:
-                        user_private_key = serialization.load_pem_private_key(
-                            config.user_private_key, None, backend=default_backend())
                         share_private_key = cc.crypto2.unwrap_private_key(
                             wrapped_object=json.loads(enc_share_key),
-                            private_key_object=user_private_key)
+                            private_key_object=config.user_private_key)
                         share_public_key = share['public_share_key'].encode('ascii')
                         subject_id = KEY_SUBJECT_SHARE.format(0, csp['type'], share['unique_id'])
                         keypair = cc.crypto2.KeyPair(private_pem=share_private_key,
@@ -14,6 +14,7 @@ from jars.fs.filesystem import fs_to_cc_path
 
 from cc.configuration import constants
 import cc.ipc_gui
+from cc.synchronization.dispatcher import AGGREGATE
 from cc.synchronization.syncengine import normalize_path
 from cc.synchronization.syncfsm import FILESYSTEM_ID, STORAGE
 from cc.synctask import SyncTask, path_hash
@@ -379,8 +380,11 @@ class ShellExtensionInterface:
 
     def initialize_callbacks(self):
         """Initialize callbacks for all links."""
-        self.sync_graph.bademeister.queue.task_acked.connect(self.report_item_synced)
-        self.sync_graph.bademeister.queue.task_putted.connect(self.report_item_syncing)
+        task_queue = self.sync_graph.bademeister.queue
+        task_queue.dispatcher.connect(task_queue.task_acked, self.report_item_synced,
+                                      policy=AGGREGATE)
+        task_queue.dispatcher.connect(task_queue.task_putted, self.report_item_syncing,
+                                      policy=AGGREGATE)
 
 
 def create_sharing_menu_items(storage_id, storage):
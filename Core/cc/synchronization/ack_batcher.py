@@ -0,0 +1,65 @@
+"""Pass acks of completed tasks on to the SyncEngine in batches.
+
+Every ack sent to the :class:`cc.synchronization.syncengine.SyncEngine` directly is a message
+in the mailbox of the actor. If thousands of small tasks complete per minute, the acks crowd
+out the storage events. The :class:`AckBatcher` collects the acks of a link and passes them on
+with a single call once enough of them have been collected or the oldest one waited long
+enough.
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+#: number of acks which are passed on at once
+MAX_BATCH_SIZE = 50
+
+#: seconds an ack waits at most for more acks to arrive
+MAX_BATCH_DELAY = 0.2
+
+
+class AckBatcher:
+    """Collect acks and pass them on in batches, in the order they arrived."""
+
+    def __init__(self, sink, max_count=MAX_BATCH_SIZE, max_delay=MAX_BATCH_DELAY):
+        """
+        :param sink: callable taking a list of tasks, e.g. `SyncEngine.ack_tasks`
+        :param max_count: a batch is passed on once it contains that many acks
+        :param max_delay: seconds after the first ack of a batch it is passed on at the latest
+        """
+        assert max_count > 0
+        self.sink = sink
+        self.max_count = max_count
+        self.max_delay = max_delay
+
+        self.batch = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+        # held while passing on a batch, so batches are not overtaken by later ones
+        self.flush_lock = threading.Lock()
+
+    def ack(self, task):
+        """Add the ack of `task` to the current batch, use it as ack_callback of a task."""
+        with self.lock:
+            self.batch.append(task)
+            if len(self.batch) < self.max_count:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.max_delay, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Pass on the acks collected so far."""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.batch = self.batch, []
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+            if batch:
+                logger.debug('Passing on %d acks', len(batch))
+                self.sink(batch)
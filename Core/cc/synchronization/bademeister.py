@@ -1,51 +1,282 @@
 """The Bademeister manages the pool of workers."""
 import logging
+import threading
+import time
+from functools import partial
 
-from cc.synctask import STOP_TOKEN
+from cc.periodic_scheduler import PeriodicScheduler
+from cc.synctask import CONTROL_LANE, STOP_TOKEN
 from cc.synchronization.worker import Worker
 
 logger = logging.getLogger(__name__)
 
 # pylint: disable=too-many-instance-attributes
 
+#: bounds of the pool in adaptive mode
+MIN_THREAD_COUNT = 2
+MAX_THREAD_COUNT = 24
+
+#: seconds between two adjustments of the pool size in adaptive mode
+ADJUST_INTERVAL = 5
+
+#: lane -> number of workers only serving this lane, in addition to the general pool
+RESERVED_THREAD_COUNTS = {CONTROL_LANE: 2}
+
+
+class AdaptivePoolSizer:
+    """Determines the size of the worker pool using additive increase/multiplicative decrease.
+
+    Workers report every dispatched task with the time it took. Once per interval the sizer
+    compares throughput and latency with the previous interval:
+
+    - throughput dropped, or more workers did not help but made each task slower -> the
+      workers contend for bandwidth or the provider, shrink the pool multiplicatively
+    - more tasks are waiting than workers are available -> grow the pool additively
+    - nothing is waiting -> give back one worker
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, min_size=MIN_THREAD_COUNT, max_size=MAX_THREAD_COUNT, increase=2,
+                 decrease=0.75, tolerance=0.1):
+        assert 0 < min_size <= max_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.busy_time = 0.0
+        self.last_sample = None
+
+        #: throughput (tasks/s) and average latency (s) of the last interval
+        self.throughput = 0.0
+        self.latency = None
+        self.last_action = None
+
+    def reset(self):
+        """Forget all measurements, the next interval starts now."""
+        with self.lock:
+            self.completed = 0
+            self.busy_time = 0.0
+        self.last_sample = None
+        self.throughput = 0.0
+        self.latency = None
+        self.last_action = None
+
+    def record(self, task, duration):
+        """Record a dispatched task, called from the worker threads."""
+        # pylint: disable=unused-argument
+        with self.lock:
+            self.completed += 1
+            self.busy_time += duration
+
+    def clamp(self, size):
+        """Return the size within the bounds of the pool."""
+        return max(self.min_size, min(self.max_size, size))
+
+    def recommend(self, current_size, queue_depth):
+        """Return the number of workers the pool should have for the next interval.
+
+        :param current_size: the number of workers currently in the pool
+        :param queue_depth: the number of queued tasks which could be executed right now
+        """
+        now = time.monotonic()
+        with self.lock:
+            completed, busy_time = self.completed, self.busy_time
+            self.completed, self.busy_time = 0, 0.0
+
+        if self.last_sample is None:
+            # nothing measured so far
+            self.last_sample = now
+            return self.clamp(current_size)
+
+        elapsed = max(now - self.last_sample, 1e-6)
+        self.last_sample = now
+
+        throughput = completed / elapsed
+        latency = busy_time / completed if completed else None
+
+        last_throughput, last_latency = self.throughput, self.latency
+        self.throughput, self.latency = throughput, latency
+
+        not_improved = throughput <= last_throughput * (1 + self.tolerance)
+        slower = latency is not None and last_latency is not None and \
+            latency > last_latency * (1 + self.tolerance)
+
+        if completed and (throughput < last_throughput * (1 - self.tolerance) or
+                          (self.last_action == 'increase' and not_improved and slower)):
+            self.last_action = 'decrease'
+            target = int(current_size * self.decrease)
+        elif queue_depth > current_size:
+            self.last_action = 'increase'
+            target = current_size + self.increase
+        elif queue_depth == 0:
+            self.last_action = 'idle'
+            target = current_size - 1
+        else:
+            self.last_action = None
+            target = current_size
+
+        return self.clamp(target)
+
 
 class Bademeister:
-    """Keeps the pool funky fresh."""
+    """Keeps the pool funky fresh.
+
+    The general workers execute all tasks in the order they have been queued. Additionally a
+    few workers are reserved for the short tasks of certain lanes (see
+    :attr:`cc.synctask.SyncTask.lane`), so e.g. fetching the tree of a new storage does not
+    wait until the general workers are done with their transfers.
+    """
 
-    def __init__(self, queue, thread_count=5):
+    # pylint: disable=too-many-arguments
+    def __init__(self, queue, thread_count=5, adaptive=False, min_threads=MIN_THREAD_COUNT,
+                 max_threads=MAX_THREAD_COUNT, adjust_interval=ADJUST_INTERVAL,
+                 reserved_threads=None):
+        """Initialize the pool.
+
+        :param queue: the :class:`cc.synchronization.models.TaskQueue` to work on
+        :param thread_count: the number of general workers (initial number in adaptive mode)
+        :param adaptive: grow and shrink the pool depending on throughput and latency
+        :param min_threads: lower bound of the pool in adaptive mode
+        :param max_threads: upper bound of the pool in adaptive mode
+        :param adjust_interval: seconds between two adjustments in adaptive mode
+        :param reserved_threads: lane -> number of workers reserved for the lane, defaults to
+                                 :data:`RESERVED_THREAD_COUNTS`
+        """
         self.thread_count = thread_count
         self.queue = queue
 
         self.workers = []
 
+        if reserved_threads is None:
+            reserved_threads = RESERVED_THREAD_COUNTS
+        self.reserved_threads = dict(reserved_threads)
+        self.reserved_workers = []
+
+        # workers which have been asked to exit but might still be blocked in the queue
+        self.retired_workers = []
+        self.workers_lock = threading.RLock()
+
+        self.sizer = None
+        self.adjuster = None
+        self.adjust_interval = adjust_interval
+        if adaptive:
+            self.sizer = AdaptivePoolSizer(min_size=min_threads, max_size=max_threads)
+            self.thread_count = self.sizer.clamp(thread_count)
+
         # flag indicating if the step is running (has been started and not stopped)
         self.is_running = False
 
+    def _prepare_worker(self, lane=None):
+        if lane is None:
+            task_source = self.queue.get_task
+            on_dispatched = self.sizer.record if self.sizer is not None else None
+        else:
+            task_source = partial(self.queue.get_task, lanes=(lane,))
+            on_dispatched = None
+        return Worker(task_source=task_source,
+                      ack_sink=self.queue.ack_task,
+                      task_sink=self.queue.put_task,
+                      on_dispatched=on_dispatched,
+                      circuit_breaker=self.queue.circuit_breaker)
+
     def prepare_workers(self):
         """Return workers prepared to get things done."""
-        return [Worker(task_source=self.queue.get_task,
-                       ack_sink=self.queue.ack_task,
-                       task_sink=self.queue.put_task) for _ in range(self.thread_count)]
+        return [self._prepare_worker() for _ in range(self.thread_count)]
+
+    def prepare_reserved_workers(self):
+        """Return the workers reserved for their lanes."""
+        return [self._prepare_worker(lane)
+                for lane, count in self.reserved_threads.items() for _ in range(count)]
 
     def start(self):
         """ starts the whole threadpool """
-        self.workers = self.prepare_workers()
+        with self.workers_lock:
+            self.workers = self.prepare_workers()
+            self.reserved_workers = self.prepare_reserved_workers()
 
-        for worker in self.workers:
-            logger.debug("started worker %s", worker)
-            worker.start()
+            for worker in self.workers + self.reserved_workers:
+                logger.debug("started worker %s", worker)
+                worker.start()
 
         # setting flag
         self.is_running = True
 
+        if self.sizer is not None:
+            self.sizer.reset()
+            self.adjuster = PeriodicScheduler(self.adjust_interval, target=self.adjust)
+            self.adjuster.start()
+
     def stop(self):
         """ stops the whole threadpool  """
-        for _ in range(len(self.workers)):
-            self.queue.put_task(STOP_TOKEN)
-        self.workers.clear()
+        if self.adjuster is not None:
+            self.adjuster.stop()
+            self.adjuster = None
 
-        # setting flag
-        self.is_running = False
+        with self.workers_lock:
+            # setting flag
+            self.is_running = False
+
+            # retired workers blocked in the queue would swallow a stop token each
+            self.retired_workers = [worker for worker in self.retired_workers
+                                    if worker.is_alive()]
+            worker_count = len(self.workers) + len(self.reserved_workers) + \
+                len(self.retired_workers)
+            for _ in range(worker_count):
+                self.queue.put_task(STOP_TOKEN)
+            self.workers.clear()
+            self.reserved_workers.clear()
+            self.retired_workers.clear()
+
+    def resize(self, size):
+        """Grow or shrink the running pool to `size` workers."""
+        with self.workers_lock:
+            if not self.is_running:
+                return
+
+            while len(self.workers) < size:
+                worker = self._prepare_worker()
+                worker.start()
+                self.workers.append(worker)
+                logger.debug("started worker %s", worker)
+
+            while len(self.workers) > size:
+                worker = self.workers.pop()
+                worker.retire()
+                self.retired_workers.append(worker)
+                logger.debug("retiring worker %s", worker)
+
+            self.retired_workers = [worker for worker in self.retired_workers
+                                    if worker.is_alive()]
+
+    def adjust(self):
+        """Adjust the pool size to the observed throughput, latency and queue depth."""
+        if self.sizer is None or not self.is_running:
+            return
+
+        current_size = len(self.workers)
+        # tasks which can't start yet would only keep more workers waiting
+        target = self.sizer.recommend(current_size, self.queue.pending.admissible_count())
+        if target != current_size:
+            logger.info("Resizing worker pool from %d to %d (%.2f tasks/s, latency %s)",
+                        current_size, target, self.sizer.throughput, self.sizer.latency)
+            self.resize(target)
+
+    @property
+    def statistics(self):
+        """Return the current size of the pool and the measurements it is based on."""
+        result = {'worker_count': len(self.workers),
+                  'reserved_worker_count': dict(self.reserved_threads),
+                  'adaptive': self.sizer is not None}
+        if self.sizer is not None:
+            result.update({'min_worker_count': self.sizer.min_size,
+                           'max_worker_count': self.sizer.max_size,
+                           'throughput': self.sizer.throughput,
+                           'latency': self.sizer.latency})
+        return result
 
     # TODO XXX: add and put callbacks are currently only registered outside of the init function
     # in the shell extension. Fix that or fix the shell extension?
@@ -0,0 +1,156 @@
+"""Stop handing out tasks for storages which are currently not reachable.
+
+If a provider is down, every task against it fails with :class:`jars.CurrentlyNotPossibleError`
+or :class:`jars.UnavailableError`. Without further measures each of these tasks is retried
+with back-off until it runs out of retries, so a large backlog turns into a storm of failing
+requests. The :class:`CircuitBreaker` counts the consecutive failures per storage. Once a
+storage exceeds the threshold its circuit opens: the
+:class:`cc.synchronization.models.HashPathQueue` keeps all tasks involving the storage in the
+queue, except a single probe which is let through every `probe_interval` seconds. As soon as a
+task on the storage succeeds, the circuit closes and the backlog is handed out again.
+"""
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#: number of consecutive failures after which the tasks of a storage are parked
+FAILURE_THRESHOLD = 5
+
+#: seconds between two probes of a storage with an open circuit
+PROBE_INTERVAL = 30
+
+
+class CircuitBreaker:
+    """Track the availability of storages and decide if tasks involving them may start.
+
+    :meth:`admits` and :meth:`acquire` are called by the queue while holding its mutex, the
+    outcomes are recorded by the workers with :meth:`record_success` and
+    :meth:`record_failure`.
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, probe_interval=PROBE_INTERVAL):
+        """
+        :param failure_threshold: number of consecutive failures which open the circuit
+        :param probe_interval: seconds between two probes while the circuit is open
+        """
+        assert failure_threshold > 0
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+
+        #: called without arguments if parked tasks may be handed out (again)
+        self.wake_up = None
+
+        self.lock = threading.Lock()
+        #: storage_id -> number of consecutive failures
+        self.failures = collections.Counter()
+        #: storage_id -> monotonic time the next probe may start, for open circuits
+        self.opened = {}
+        # storage_id -> id of the task probing the storage
+        self.probes = {}
+
+    def admits(self, task):
+        """Return True if `task` does not involve a storage with an open circuit.
+
+        If a probe of the storage is due, the task is admitted as the probe.
+        """
+        return self.holding_back(task) is None
+
+    def holding_back(self, task):
+        """Return the storage of `task` with an open circuit which holds it back, or None."""
+        if task.cancelled:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            for storage_id in task.involved_storage_ids():
+                if storage_id in self.opened and \
+                        (storage_id in self.probes or now < self.opened[storage_id]):
+                    return storage_id
+            return None
+
+    def acquire(self, task):
+        """Register `task` as the probe of its storages with an open circuit."""
+        if task.cancelled:
+            return
+        with self.lock:
+            for storage_id in task.involved_storage_ids():
+                if storage_id in self.opened and storage_id not in self.probes:
+                    logger.info("Probing storage '%s' with '%s'", storage_id, task)
+                    self.probes[storage_id] = id(task)
+
+    def is_open(self, storage_ids):
+        """Return True if the circuit of any of `storage_ids` is open."""
+        with self.lock:
+            return any(storage_id in self.opened for storage_id in storage_ids)
+
+    def release(self, task):
+        """Let another probe start if `task` probed a storage without an outcome.
+
+        :return: True if a task may be handed out now, False otherwise.
+        """
+        with self.lock:
+            released = False
+            for storage_id, probe in list(self.probes.items()):
+                if probe == id(task):
+                    del self.probes[storage_id]
+                    self.opened[storage_id] = time.monotonic()
+                    released = True
+            return released
+
+    def record_success(self, storage_ids):
+        """Record that tasks on `storage_ids` succeeded, which closes their circuits."""
+        closed = []
+        with self.lock:
+            for storage_id in storage_ids:
+                self.failures.pop(storage_id, None)
+                self.probes.pop(storage_id, None)
+                if self.opened.pop(storage_id, None) is not None:
+                    closed.append(storage_id)
+
+        if closed:
+            logger.info("Storages %s are available again, resuming their tasks", closed)
+            self._wake_up()
+
+    def record_failure(self, storage_id, task):
+        """Record that `task` failed because `storage_id` is not available."""
+        with self.lock:
+            self.failures[storage_id] += 1
+            if storage_id in self.opened:
+                # only a failed probe postpones the next one, other tasks have been started
+                # before the circuit opened
+                if self.probes.get(storage_id) != id(task):
+                    return
+                del self.probes[storage_id]
+            elif self.failures[storage_id] >= self.failure_threshold:
+                logger.warning("Storage '%s' failed %d times in a row, parking its tasks",
+                               storage_id, self.failures[storage_id])
+            else:
+                return
+            self.opened[storage_id] = time.monotonic() + self.probe_interval
+            self._schedule_wake_up()
+
+    def _schedule_wake_up(self):
+        timer = threading.Timer(self.probe_interval, self._wake_up)
+        timer.daemon = True
+        timer.start()
+
+    def _wake_up(self):
+        if self.wake_up is not None:
+            self.wake_up()
+
+    def _state(self, storage_id):
+        if storage_id in self.probes:
+            return 'probing'
+        if storage_id in self.opened:
+            return 'open'
+        return 'closed'
+
+    @property
+    def statistics(self):
+        """Return the state of all storages with an open circuit or recent failures."""
+        with self.lock:
+            return {storage_id: {'state': self._state(storage_id),
+                                 'consecutive_failures': count}
+                    for storage_id, count in self.failures.items()}
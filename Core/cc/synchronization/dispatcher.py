@@ -0,0 +1,151 @@
+"""Deliver signals of the TaskQueue to slow receivers on a dedicated thread.
+
+The receivers of `task_acked` and `task_putted` run in the thread sending the signal, which is
+usually a worker. Some of them are slow, e.g. :func:`cc.settings_sync.log_task_to_backend`
+posts every task to the admin console. Connected via a :class:`SignalDispatcher` such a receiver
+is called on the dispatcher thread instead and the worker returns to the queue right away.
+
+The dispatcher buffers a bounded number of events. What happens to an event depends on the
+policy the receiver has been connected with:
+
+- :data:`DROP`: every event is delivered, once the buffer is full new events are dropped.
+- :data:`AGGREGATE`: only the latest event per path is delivered. An event replaces a buffered
+  one of the same receiver and path, which is useful for receivers only interested in the
+  current state of an item (e.g. the overlay icons of the shell extension). Once the buffer is
+  full, events for other paths are dropped.
+"""
+import collections
+import itertools
+import logging
+import threading
+
+from cc.synctask import SyncTask
+
+logger = logging.getLogger(__name__)
+
+DROP = 'drop'
+AGGREGATE = 'aggregate'
+
+#: number of buffered events
+DEFAULT_MAXSIZE = 10000
+
+
+class SignalDispatcher:
+    """Call receivers of blinker signals on a separate thread."""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        assert maxsize > 0
+        self.maxsize = maxsize
+
+        # key -> (receiver, sender), delivered in insertion order
+        self.events = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.thread = None
+        self.busy = False
+
+        #: number of delivered, dropped and aggregated events
+        self.delivered = 0
+        self.dropped = 0
+        self.aggregated = 0
+
+    def connect(self, signal, receiver, policy=DROP):
+        """Connect `receiver` to `signal`, the receiver is called on the dispatcher thread.
+
+        :param signal: the :class:`blinker.Signal` to connect to
+        :param receiver: a callable taking the sender of the signal, e.g. the task
+        :param policy: :data:`DROP` or :data:`AGGREGATE`
+        :return: the function connected to the signal, pass it to `signal.disconnect` to
+                 disconnect the receiver again
+        """
+        assert policy in (DROP, AGGREGATE)
+
+        def deliver_later(sender):
+            """Buffer the event for the dispatcher thread."""
+            self.submit(receiver, sender, policy)
+
+        signal.connect(deliver_later, weak=False)
+        return deliver_later
+
+    @staticmethod
+    def _path(sender):
+        if isinstance(sender, SyncTask) and sender.link is not None:
+            return sender.operates_on()
+        return None
+
+    def submit(self, receiver, sender, policy=DROP):
+        """Buffer a call of `receiver` with `sender`.
+
+        :return: False if the event has been dropped, True otherwise
+        """
+        path = self._path(sender) if policy == AGGREGATE else None
+        with self.condition:
+            if path is not None:
+                key = (AGGREGATE, id(receiver), path)
+                if self.events.pop(key, None) is not None:
+                    self.aggregated += 1
+                elif len(self.events) >= self.maxsize:
+                    self.dropped += 1
+                    return False
+            else:
+                if len(self.events) >= self.maxsize:
+                    self.dropped += 1
+                    if self.dropped % 1000 == 1:
+                        logger.warning("Signal dispatcher is full, dropped %d events so far",
+                                       self.dropped)
+                    return False
+                key = next(self.sequence)
+
+            self.events[key] = (receiver, sender)
+            self._ensure_thread()
+            self.condition.notify()
+        return True
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='SignalDispatcher',
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self):
+        """Deliver buffered events until there are none left for a while."""
+        delivered = False
+        while True:
+            with self.condition:
+                # counted under the lock, before `flush` may return
+                if delivered:
+                    self.delivered += 1
+                    delivered = False
+                if not self.events:
+                    self.busy = False
+                    self.condition.notify_all()
+                    if not self.condition.wait_for(lambda: self.events, timeout=60):
+                        # the next event starts a new thread
+                        self.thread = None
+                        return
+                _, (receiver, sender) = self.events.popitem(last=False)
+                self.busy = True
+
+            try:
+                receiver(sender)
+            except BaseException:
+                logger.exception('Receiver %s failed for %s', receiver, sender)
+            delivered = True
+
+    def flush(self, timeout=None):
+        """Wait until all buffered events have been delivered.
+
+        :return: True if all events have been delivered, False on timeout
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.events and not self.busy,
+                                           timeout=timeout)
+
+    @property
+    def statistics(self):
+        """Return the number of buffered, delivered, dropped and aggregated events."""
+        with self.condition:
+            return {'buffered': len(self.events),
+                    'delivered': self.delivered,
+                    'dropped': self.dropped,
+                    'aggregated': self.aggregated}
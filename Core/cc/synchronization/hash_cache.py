@@ -0,0 +1,376 @@
+"""Persistent cache of the content hashes of local files.
+
+Comparing a local file with another copy, detecting a moved file or finding a file with the
+same content requires the hash of the local file. Hashing means reading the whole file, so the
+hashes are cached by the identity of the file: the tuple (device, inode) of the file along with
+its size and modification time. A cached hash is only returned as long as the size and the
+modification time of the file did not change. Moving a file keeps its inode, the hash stays
+valid.
+
+Next to its own hash a file may have aliases: the content hashes of other algorithms known for
+the same content, e.g. the hash supplied by the storage a file has been downloaded from. The
+cache is indexed by all of them, :meth:`ContentHashCache.find` returns a local file of a content
+which is about to be downloaded.
+
+The local :class:`cc.encryption.storage_wrapper.EncryptingFileSystem` maintains the cache: it
+hashes the files it writes and the files it reads, e.g. to upload them, on the way. It drops
+the hashes of files modified or deleted according to its events. The cache is shared by all
+links and saved with their state.
+
+The hashes are tuples `(algorithm, hexdigest)`, just like the content hashes supplied by
+storages, see :data:`cc.synchronization.syncfsm.CONTENT_HASH`.
+"""
+import collections
+import hashlib
+import io
+import logging
+import os
+import pickle
+import threading
+
+import atomicwrites
+
+from cc.mime_type_stream import ReusableBufferReader, readinto_from
+
+logger = logging.getLogger(__name__)
+
+#: algorithm of the content hashes of local files
+HASH_ALGORITHM = 'md5'
+
+#: number of hashes kept, the least recently used ones are dropped first
+MAX_ENTRIES = 100000
+
+#: bytes read at once while hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_identity(stat):
+    """Return the tuple (device, inode) of a file from its :func:`os.stat` result."""
+    return stat.st_dev, stat.st_ino
+
+
+def is_unchanged(before, after):
+    """Return True if the :func:`os.stat` results `before` and `after` are of the same content."""
+    return (file_identity(before) == file_identity(after) and
+            (before.st_size, before.st_mtime_ns) == (after.st_size, after.st_mtime_ns))
+
+
+def hash_file(path):
+    """Return the content hash of the file at `path`, without the cache."""
+    with open(path, 'rb') as file_obj:
+        reader = HashingFileReader(file_obj)
+        while reader.read(HASH_CHUNK_SIZE):
+            pass
+    return reader.content_hash
+
+
+class ContentChangedError(IOError):
+    """The content read does not match the content hash it was expected to have."""
+
+
+class HashingFileReader(ReusableBufferReader):
+    """Hash the data read from the wrapped file object on the way.
+
+    If an `expected_hash` is given, reading the end of the file raises
+    :class:`ContentChangedError` unless the data matches it, so the consumer fails before it
+    is done with the data.
+    """
+
+    def __init__(self, orig_obj, expected_hash=None):
+        super().__init__()
+        self._orig_obj = orig_obj
+        self.expected_hash = expected_hash
+        self.hash = hashlib.new(HASH_ALGORITHM)
+        self.read_count = 0
+
+    def readinto(self, buffer):
+        """Read into `buffer` and add the data to the hash."""
+        count = readinto_from(self._orig_obj, buffer)
+        with memoryview(buffer) as view:
+            self.hash.update(view[:count])
+        self.read_count += count
+        if not count and self.expected_hash is not None and \
+                self.content_hash != self.expected_hash:
+            raise ContentChangedError('content hash {} does not match {}'.format(
+                self.content_hash, self.expected_hash))
+        return count
+
+    @property
+    def content_hash(self):
+        """Return the content hash of everything read so far."""
+        return HASH_ALGORITHM, self.hash.hexdigest()
+
+
+class CachingFileReader(HashingFileReader):
+    """Hash a local file while it is read, e.g. uploaded, and cache the hash at its end.
+
+    The hash is only stored if the file has been read from its start to its end and has not
+    been modified in the meantime. Seeking, e.g. to resume an upload, gives up on the hash.
+    """
+
+    def __init__(self, orig_obj, cache, path, stat):
+        """
+        :param cache: the :class:`ContentHashCache` the hash is stored in
+        :param path: the path of the file on the disk
+        :param stat: the :func:`os.stat` of the file before it has been opened
+        """
+        super().__init__(orig_obj)
+        self.cache = cache
+        self.path = path
+        self.stat = stat
+        # True as long as everything has been read from the start
+        self._complete = True
+
+    def readinto(self, buffer):
+        """Read into `buffer`, the hash is stored once the end has been read."""
+        count = super().readinto(buffer)
+        if not count and self._complete:
+            self._complete = False
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return count
+            if self.read_count == self.stat.st_size and is_unchanged(self.stat, stat):
+                self.cache.store(self.path, self.content_hash, self.stat)
+        return count
+
+    def seekable(self):
+        return self._orig_obj.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Seek the wrapped file object, the hash is not stored any more."""
+        self._complete = False
+        return self._orig_obj.seek(offset, whence)
+
+    def tell(self):
+        return self._orig_obj.tell()
+
+
+class ContentHashCache:
+    """Cache of the content hashes of local files, bounded to `max_entries`."""
+
+    def __init__(self, location=None, max_entries=MAX_ENTRIES):
+        """
+        :param location: path of the file the cache is saved to, None keeps it in memory only
+        :param max_entries: the number of hashes kept
+        """
+        self.location = location
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        #: (device, inode) -> (size, mtime_ns, content_hash, path), least recently used first
+        self.entries = collections.OrderedDict()
+        # path -> (device, inode), to drop the hash of a path once it has been modified
+        self.identities = {}
+        #: (device, inode) -> set of the content hashes of other algorithms of the same content
+        self.aliases = {}
+        # content hash or alias -> set of (device, inode) of the files with that content
+        self.by_hash = collections.defaultdict(set)
+        self.dirty = False
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, path, stat=None):
+        """Return the cached content hash of the file at `path`, or None.
+
+        :param stat: the :func:`os.stat` of the file, if already known
+        """
+        if stat is None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+        identity = file_identity(stat)
+        with self.lock:
+            entry = self.entries.get(identity)
+            if entry is None or entry[:2] != (stat.st_size, stat.st_mtime_ns):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(identity)
+            self.hits += 1
+            if entry[3] != path:
+                # moved, e.g. reported as a delete and a create
+                if self.identities.get(entry[3]) == identity:
+                    del self.identities[entry[3]]
+                self.identities[path] = identity
+                self.entries[identity] = entry[:3] + (path,)
+                self.dirty = True
+            return entry[2]
+
+    def store(self, path, content_hash, stat):
+        """Cache the `content_hash` of the file at `path` as it was at the time of `stat`."""
+        identity = file_identity(stat)
+        entry = (stat.st_size, stat.st_mtime_ns, content_hash, path)
+        with self.lock:
+            old_identity = self.identities.pop(path, None)
+            if old_identity is not None and old_identity != identity:
+                self._drop(old_identity)
+            if self.entries.get(identity, entry)[:3] != entry[:3]:
+                # the content changed, so did the hashes of the other algorithms
+                self._drop(identity)
+            self.entries[identity] = entry
+            self.entries.move_to_end(identity)
+            self.identities[path] = identity
+            self.by_hash[content_hash].add(identity)
+            while len(self.entries) > self.max_entries:
+                evicted_identity, evicted = next(iter(self.entries.items()))
+                if self.identities.get(evicted[3]) == evicted_identity:
+                    del self.identities[evicted[3]]
+                self._drop(evicted_identity)
+                self.evictions += 1
+            self.dirty = True
+
+    def add_alias(self, path, content_hash):
+        """Add the `content_hash` of another algorithm to the cached hash of the file at `path`.
+
+        The alias is dropped along with the hash, it is ignored if the hash is not cached.
+        """
+        with self.lock:
+            identity = self.identities.get(path)
+            if identity is None or identity not in self.entries or \
+                    content_hash == self.entries[identity][2]:
+                return
+            self.aliases.setdefault(identity, set()).add(content_hash)
+            self.by_hash[content_hash].add(identity)
+            self.dirty = True
+
+    def find(self, content_hash):
+        """Return a local file with the content of `content_hash`, or None.
+
+        :param content_hash: a content hash or an alias
+        :return: a tuple (path, own content hash) of a file unchanged since it was hashed
+        """
+        with self.lock:
+            candidates = [self.entries[identity]
+                          for identity in self.by_hash.get(content_hash, ())]
+        for size, mtime_ns, own_hash, path in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns) and \
+                    self.identities.get(path) == file_identity(stat):
+                return path, own_hash
+        return None
+
+    def _drop(self, identity):
+        """Remove the entry of `identity` and its aliases from the index, the lock is held."""
+        entry = self.entries.pop(identity, None)
+        hashes = self.aliases.pop(identity, set())
+        if entry is not None:
+            hashes.add(entry[2])
+        for content_hash in hashes:
+            identities = self.by_hash.get(content_hash)
+            if identities is not None:
+                identities.discard(identity)
+                if not identities:
+                    del self.by_hash[content_hash]
+
+    def get(self, path):
+        """Return the content hash of the file at `path`, the file is hashed if not cached.
+
+        :raises OSError: if the file can't be read
+        """
+        stat = os.stat(path)
+        content_hash = self.lookup(path, stat)
+        if content_hash is not None:
+            return content_hash
+
+        content_hash = hash_file(path)
+        # the file might have been modified while it was read
+        if is_unchanged(stat, os.stat(path)):
+            self.store(path, content_hash, stat)
+        return content_hash
+
+    def invalidate(self, path):
+        """Drop the hash of the file at `path` unless the file is unchanged since it was hashed.
+
+        Called for every event of the local file, the events of the files written by the client
+        itself leave the hashes stored while writing them. The hash of a deleted file is kept
+        until it is evicted, the file might have been moved and is found by its inode again.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        with self.lock:
+            identity = self.identities.get(path)
+            if identity is None:
+                return
+            entry = self.entries.get(identity)
+            if entry is not None and stat is not None and file_identity(stat) == identity and \
+                    entry[:2] == (stat.st_size, stat.st_mtime_ns):
+                return
+            del self.identities[path]
+            if stat is not None:
+                self._drop(identity)
+            self.dirty = True
+
+    def move(self, source, target):
+        """Keep the hashes of the file or the files of the directory moved to `target`."""
+        prefix = source + os.sep
+        with self.lock:
+            moved = [path for path in self.identities
+                     if path == source or path.startswith(prefix)]
+            for path in moved:
+                identity = self.identities.pop(path)
+                new_path = target + path[len(source):]
+                self.identities[new_path] = identity
+                if identity in self.entries:
+                    self.entries[identity] = self.entries[identity][:3] + (new_path,)
+            if moved:
+                self.dirty = True
+
+    def load(self):
+        """Load the cache saved by :meth:`save`, a missing or corrupt file is ignored."""
+        if self.location is None:
+            return
+        try:
+            with open(self.location, 'rb') as file_handle:
+                state = pickle.load(file_handle)
+        except FileNotFoundError:
+            return
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            logger.warning("Ignoring corrupt content hash cache '%s'", self.location,
+                           exc_info=True)
+            return
+
+        with self.lock:
+            self.entries = collections.OrderedDict(state['entries'])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.identities = {entry[3]: identity for identity, entry in self.entries.items()}
+            self.aliases = {identity: set(aliases)
+                            for identity, aliases in state['aliases'].items()
+                            if identity in self.entries}
+            self.by_hash = collections.defaultdict(set)
+            for identity, entry in self.entries.items():
+                self.by_hash[entry[2]].add(identity)
+            for identity, aliases in self.aliases.items():
+                for alias in aliases:
+                    self.by_hash[alias].add(identity)
+            self.dirty = False
+        logger.info("Loaded %d content hashes from '%s'", len(self.entries), self.location)
+
+    def save(self):
+        """Save the cache if it changed since it has been loaded or saved."""
+        if self.location is None or not self.dirty:
+            return
+        with self.lock:
+            state = {'entries': list(self.entries.items()),
+                     'aliases': {identity: set(aliases)
+                                 for identity, aliases in self.aliases.items()}}
+            self.dirty = False
+        with atomicwrites.atomic_write(self.location, mode='wb', overwrite=True) as file_handle:
+            pickle.dump(state, file_handle)
+
+    @property
+    def statistics(self):
+        """Return the size of the cache and how often it could be used."""
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
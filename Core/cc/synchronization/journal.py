@@ -0,0 +1,207 @@
+"""Append-only log of the tasks put on and acked by the TaskQueue.
+
+The :class:`cc.synchronization.models.TaskQueue` only lives in memory. If the client stops in the
+middle of a large synchronization, all pending transfers are lost and have to be rediscovered by
+fetching both file trees and evaluating the whole model again before the first byte is
+transferred. The :class:`TaskJournal` records every transfer put on the queue and every ack, so
+:meth:`cc.synchronization.models.SynchronizationGraph.startup` can put the outstanding tasks
+back on the queue right away.
+
+The journal is a stream of pickled records:
+
+- ``('put', seq, link_id, task_type, fields)``
+- ``('ack', seq)``
+
+A truncated record at the end (e.g. after a crash) is ignored.
+"""
+import logging
+import os
+import pickle
+import threading
+
+import atomicwrites
+
+from cc.synctask import (CreateDirSyncTask, DeleteSyncTask, DownloadSyncTask,
+                         UploadSyncTask)
+
+logger = logging.getLogger(__name__)
+
+PUT = 'put'
+ACK = 'ack'
+
+#: task type -> the attributes needed to construct the task again
+JOURNALED_TASK_FIELDS = {
+    UploadSyncTask: ('path', 'target_storage_id', 'source_version_id', 'target_path',
+                     'source_path', 'original_version_id'),
+    DownloadSyncTask: ('path', 'source_storage_id', 'source_version_id', 'target_path',
+                       'source_path', 'original_version_id'),
+    CreateDirSyncTask: ('path', 'target_storage_id', 'source_storage_id', 'target_path',
+                        'source_path', 'target_version_id', 'source_version_id',
+                        'original_version_id'),
+    DeleteSyncTask: ('path', 'target_storage_id', 'original_version_id', 'target_path')}
+
+TASK_TYPES = {task_type.__name__: task_type for task_type in JOURNALED_TASK_FIELDS}
+
+#: the log is rewritten with only the pending tasks once it contains that many records
+COMPACT_THRESHOLD = 10000
+
+
+class TaskJournal:
+    """Record the lifecycle of transfer tasks in an append-only file.
+
+    Attach the journal to a :class:`cc.synchronization.models.TaskQueue` with :meth:`attach`,
+    the tasks are recorded via the `task_putted` and `task_acked` signals. Only tasks listed in
+    :data:`JOURNALED_TASK_FIELDS` are recorded, all other tasks are cheap to issue again.
+    """
+
+    def __init__(self, location):
+        """
+        :param location: path of the journal file
+        """
+        self.location = location
+        self.lock = threading.Lock()
+
+        # id(task) -> (seq, task, record), the task is kept so its id is not reused
+        self.pending = {}
+        self.next_seq = 0
+        self.record_count = 0
+        self._file = None
+
+    def attach(self, task_queue):
+        """Record all tasks put on and acked by `task_queue`."""
+        task_queue.task_putted.connect(self.on_task_putted, weak=False)
+        task_queue.task_acked.connect(self.on_task_acked, weak=False)
+
+    def detach(self, task_queue):
+        """Stop recording the tasks of `task_queue`."""
+        task_queue.task_putted.disconnect(self.on_task_putted)
+        task_queue.task_acked.disconnect(self.on_task_acked)
+
+    def _append(self, record):
+        if self._file is None:
+            self._file = open(self.location, 'ab')
+        pickle.dump(record, self._file)
+        self._file.flush()
+        self.record_count += 1
+
+    def on_task_putted(self, task):
+        """Record a task put on the queue, tasks put back by a worker are recorded once."""
+        fields = JOURNALED_TASK_FIELDS.get(type(task))
+        if fields is None or task.link is None:
+            return
+
+        with self.lock:
+            if id(task) in self.pending:
+                return
+            record = (PUT, self.next_seq, task.link.link_id, type(task).__name__,
+                      {name: getattr(task, name) for name in fields})
+            self.pending[id(task)] = (self.next_seq, task, record)
+            self.next_seq += 1
+            try:
+                self._append(record)
+            except OSError:
+                logger.exception("Failed to write '%s' to the task journal", task)
+
+    def on_task_acked(self, task):
+        """Record that a task is done, regardless of its state."""
+        with self.lock:
+            entry = self.pending.pop(id(task), None)
+            if entry is None:
+                return
+            try:
+                self._append((ACK, entry[0]))
+                if self.record_count > COMPACT_THRESHOLD and \
+                        self.record_count > 2 * len(self.pending):
+                    self._compact()
+            except OSError:
+                logger.exception("Failed to write ack of '%s' to the task journal", task)
+
+    def _compact(self):
+        """Rewrite the journal with only the pending tasks."""
+        self.close()
+        records = [record for _, _, record in sorted(self.pending.values(),
+                                                     key=lambda entry: entry[0])]
+        with atomicwrites.atomic_write(self.location, mode='wb', overwrite=True) as file_handle:
+            for record in records:
+                pickle.dump(record, file_handle)
+        self.record_count = len(records)
+        logger.debug("Compacted task journal to %d records", self.record_count)
+
+    def close(self):
+        """Close the journal file, it is opened again with the next record."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def load(self):
+        """Read the journal and return the tasks which have been put but not acked.
+
+        The journal is cleared afterwards, the returned tasks are recorded again once they are
+        put on the queue.
+
+        :return: list of `(link_id, task)` in the order they have been put on the queue
+        """
+        outstanding = {}
+        try:
+            with open(self.location, 'rb') as file_handle:
+                while True:
+                    try:
+                        record = pickle.load(file_handle)
+                    except EOFError:
+                        break
+                    except (pickle.UnpicklingError, ValueError, AttributeError, ImportError):
+                        logger.warning("Ignoring corrupt tail of the task journal '%s'",
+                                       self.location, exc_info=True)
+                        break
+                    if record[0] == PUT:
+                        outstanding[record[1]] = record
+                    elif record[0] == ACK:
+                        outstanding.pop(record[1], None)
+        except FileNotFoundError:
+            logger.info("No task journal at '%s'", self.location)
+            return []
+
+        tasks = []
+        for _, _, link_id, task_type, fields in sorted(outstanding.values(),
+                                                        key=lambda record: record[1]):
+            try:
+                task = TASK_TYPES[task_type](**fields)
+            except (KeyError, TypeError):
+                logger.warning("Can't restore %s from the task journal", task_type,
+                               exc_info=True)
+                continue
+            task.rehydrated = True
+            tasks.append((link_id, task))
+
+        with self.lock:
+            self.close()
+            os.remove(self.location)
+            self.pending.clear()
+            self.record_count = 0
+        logger.info("Loaded %d outstanding tasks from '%s'", len(tasks), self.location)
+        return tasks
+
+
+def is_outstanding(task, model):
+    """Check if a restored task still has to be executed according to the loaded model.
+
+    The model only holds what has been persisted by :class:`cc.synchronization.state.State`,
+    that is the nodes and their equivalents. A task for a node that is gone or whose
+    equivalents already contain the result is dropped, the state sync issues a new task if it
+    is still necessary. Tasks based on outdated versions fail on execution with a version
+    mismatch.
+
+    :param task: the restored task
+    :param model: the model of the link the task belongs to
+    """
+    try:
+        node = model.get_node(task.path)
+    except KeyError:
+        return False
+
+    equivalents = node.props.get('equivalents', {}).get('new', {})
+    if isinstance(task, DeleteSyncTask):
+        return task.target_storage_id in equivalents
+
+    return not (equivalents.get(task.source_storage_id) == task.source_version_id and
+                task.target_storage_id in equivalents)
@@ -0,0 +1,139 @@
+"""Concurrency limits the TaskQueue enforces when handing out tasks to the workers.
+
+Storage providers differ a lot in how many parallel operations they accept. The local
+filesystem does not care, while some CSPs start to throttle (and answer with
+:class:`jars.CurrentlyNotPossibleError`) as soon as a few uploads run in parallel. The
+:class:`ConcurrencyLimiter` keeps track of the running tasks per storage and per task type, so
+the worker pool can be larger than the number of operations a single provider tolerates.
+"""
+import collections
+import logging
+
+from cc.synctask import BULK_LANE
+
+logger = logging.getLogger(__name__)
+
+#: Maximum number of concurrently running tasks per storage type (see `cc.STORAGE_LABELS`).
+#: Storage types which are not listed here are not limited.
+STORAGE_TYPE_CONCURRENCY_LIMITS = {'dropbox': 4,
+                                   'gdrive': 4,
+                                   'onedrive': 3,
+                                   'onedrivebusiness': 3,
+                                   'office365groups': 3,
+                                   'sharepoint': 3,
+                                   'owncloud': 2,
+                                   'nextcloud': 2,
+                                   'fairdocs': 2}
+
+#: Maximum number of concurrently running tasks of a certain type per storage type.
+TASK_TYPE_CONCURRENCY_LIMITS = {'dropbox': {'UploadSyncTask': 2},
+                                'owncloud': {'UploadSyncTask': 1},
+                                'nextcloud': {'UploadSyncTask': 1}}
+
+
+class ConcurrencyLimiter:
+    """Count running tasks per storage and task type and decide if another one may start.
+
+    Limits are keyed by `(storage_id, task_type)`, where a `task_type` of None limits all
+    transfers operating on the storage. A task occupies a slot on every storage returned by
+    :meth:`cc.synctask.SyncTask.involved_storage_ids` until it is released. Tasks of the
+    control lane are short, they are only subject to the limits of their task type.
+
+    The limiter is not thread safe on its own, :class:`cc.synchronization.models.HashPathQueue`
+    only calls it while holding its mutex.
+    """
+
+    def __init__(self):
+        #: (storage_id, task_type) -> maximum number of concurrently running tasks
+        self.limits = {}
+        #: (storage_id, task_type) -> number of currently running tasks
+        self.active = collections.Counter()
+        # id(task) -> the keys the task occupies
+        self._slots = {}
+
+    def set_limit(self, storage_id, limit, task_type=None):
+        """Set the number of tasks allowed to run concurrently on a storage.
+
+        :param storage_id: the storage the limit applies to
+        :param limit: the maximum number of concurrent tasks, None removes the limit
+        :param task_type: the class name of the task, e.g. 'UploadSyncTask'. If not given, the
+                          limit applies to all tasks operating on the storage.
+        """
+        key = (storage_id, task_type)
+        if limit is None:
+            self.limits.pop(key, None)
+        else:
+            assert limit > 0
+            self.limits[key] = limit
+        logger.info("Concurrency limit for '%s' (%s) is %s", storage_id, task_type, limit)
+
+    def apply_defaults(self, storage_id, storage_type):
+        """Configure the default limits of a storage type for the given storage."""
+        self.set_limit(storage_id, STORAGE_TYPE_CONCURRENCY_LIMITS.get(storage_type))
+        for task_type, limit in TASK_TYPE_CONCURRENCY_LIMITS.get(storage_type, {}).items():
+            self.set_limit(storage_id, limit, task_type=task_type)
+
+    @staticmethod
+    def _keys(task):
+        task_type = type(task).__name__
+        keys = []
+        for storage_id in task.involved_storage_ids():
+            if task.lane == BULK_LANE:
+                keys.append((storage_id, None))
+            keys.append((storage_id, task_type))
+        return keys
+
+    def admits(self, task):
+        """Return True if `task` may start without exceeding any of the limits.
+
+        Cancelled tasks are always admitted, the worker acks them right away.
+        """
+        if task.cancelled:
+            return True
+        return all(self.active[key] < self.limits[key]
+                   for key in self._keys(task) if key in self.limits)
+
+    def reserve(self, task, reserved):
+        """Return True if `task` may start next to the running tasks and those `reserved`.
+
+        If so, its slots are added to `reserved`. Used to count the tasks which could start at
+        once.
+
+        :param reserved: a :class:`collections.Counter` of the slots of other tasks
+        """
+        if task.cancelled:
+            return True
+        keys = self._keys(task)
+        if any(self.active[key] + reserved[key] >= self.limits[key]
+               for key in keys if key in self.limits):
+            return False
+        reserved.update(keys)
+        return True
+
+    def acquire(self, task):
+        """Occupy the slots of `task`, called when it is handed out to a worker."""
+        if id(task) in self._slots:
+            return
+        keys = self._keys(task)
+        self.active.update(keys)
+        self._slots[id(task)] = keys
+
+    def release(self, task):
+        """Free the slots occupied by `task`.
+
+        :return: True if the task occupied slots, False otherwise.
+        """
+        keys = self._slots.pop(id(task), None)
+        if keys is None:
+            return False
+        self.active.subtract(keys)
+        return True
+
+    @property
+    def statistics(self):
+        """Return the number of running tasks and the limit for every limited key."""
+        result = {}
+        for (storage_id, task_type), limit in self.limits.items():
+            name = storage_id if task_type is None else '{}/{}'.format(storage_id, task_type)
+            result[name] = {'running': self.active[(storage_id, task_type)], 'limit': limit}
+        return result
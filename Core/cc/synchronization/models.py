@@ -41,7 +41,11 @@ IMPORTANT: Calling restart on the graph will not re-read the configuration!
 """
 # pylint: disable=wrong-import-order
 # pylint: disable=ungrouped-imports
+import bisect
+import collections
+import heapq
 import io
+import itertools
 import logging
 import os
 import queue
@@ -71,12 +75,25 @@ from cc.configuration.helpers import (get_credentials_from_config,
 
 from cc.configuration.helpers import get_storage_cache_dir
 from cc.encryption.storage_wrapper import EncryptingFileSystem
+from cc.mime_type_stream import readinto_from
 from cc.periodic_scheduler import PeriodicScheduler
+from cc.synchronization.ack_batcher import AckBatcher
 from cc.synchronization.bademeister import Bademeister
+from cc.synchronization.circuit_breaker import CircuitBreaker
+from cc.synchronization.dispatcher import AGGREGATE, SignalDispatcher
 from cc.synchronization.exceptions import (PolicyError,
                                            SyncTaskCancelledException)
+from cc.synchronization.hash_cache import ContentHashCache
+from cc.synchronization.journal import TaskJournal, is_outstanding
+from cc.synchronization.limits import ConcurrencyLimiter
+from cc.synchronization.partial_download import PARTIAL_DOWNLOAD_DIR, remove_stale
 from cc.synchronization.state import State
-from cc.synchronization.syncengine import SyncEngine, SyncEngineState
+from cc.synchronization.syncengine import (MOVE_DETECTION_WINDOW, SyncEngine,
+                                           SyncEngineState)
+from cc.synchronization.read_ahead import READ_AHEAD_DEPTH
+from cc.synchronization.throttle import BandwidthThrottle
+from cc.synchronization.throughput import TransferMetrics
+from cc.synchronization.upload_session import UPLOAD_SESSION_DIR
 
 # pylint: disable=wrong-import-order
 # pylint: disable=ungrouped-imports
@@ -87,14 +104,24 @@ logger = logging.getLogger(__name__)
 
 
 class ControlFileWrapper(io.RawIOBase):
-    """A class which can be wrapped around a file object to cancel read operations."""
+    """A class which can be wrapped around a file object to cancel read operations.
 
-    def __init__(self, orig_obj, task, data_rate_callback=None):
+    If a :class:`cc.synchronization.throttle.BandwidthThrottle` is given, reading waits as long
+    as the transfer exceeds its bandwidth limits. The reads are reported to the
+    :class:`cc.synchronization.throughput.TransferMetrics` if given.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, orig_obj, task, data_rate_callback=None, throttle=None, metrics=None):
         super().__init__()
         self._orig_obj = orig_obj
         self.task = task
         self.data_rate_callback = data_rate_callback
+        self.throttle = throttle
+        self.metrics = metrics
         self.read_count = 0
+        # monotonic time the previous read returned, the time in between is spent by the reader
+        self.last_read = None
 
     def read(self, count=None):
         """Makes a transfer cancellable."""
@@ -102,15 +129,39 @@ class ControlFileWrapper(io.RawIOBase):
         if self.task.cancelled:
             raise SyncTaskCancelledException('Cancelled while read')
 
-        start_read_time = time.time()
+        started = time.monotonic()
         data = self._orig_obj.read(count)
+        self._account(len(data), started)
+        return data
+
+    def readinto(self, buffer):
+        """Makes a transfer cancellable, without copying the data."""
+        if self.task.cancelled:
+            raise SyncTaskCancelledException('Cancelled while read')
+
+        started = time.monotonic()
+        count = readinto_from(self._orig_obj, buffer)
+        self._account(count, started)
+        return count
+
+    def _account(self, count, started):
+        """Report a read of `count` bytes started at `started` and wait for the bandwidth."""
+        finished = time.monotonic()
+        read_seconds = finished - started
 
         # submits the current datarate to the data_rate_callback
-        if self.data_rate_callback:
-            self.data_rate_callback(len(data) /
-                                    time.time() - start_read_time)
-        self.read_count += len(data)
-        return data
+        if self.data_rate_callback and read_seconds > 0:
+            self.data_rate_callback(count / read_seconds)
+        self.read_count += count
+
+        if self.metrics is not None:
+            consumer_seconds = started - self.last_read if self.last_read is not None else 0
+            self.metrics.record(self.task, count, read_seconds, consumer_seconds)
+        if self.throttle is not None:
+            self.throttle.consume(self.task, count)
+            # waiting for the bandwidth is neither spent reading nor by the reader
+            finished = time.monotonic()
+        self.last_read = finished
 
     def tell(self):
         return self.read_count
@@ -172,6 +223,9 @@ class SynchronizationLink(object):
     classes to keep track of connection state, metrics and contents.
     """
 
+    #: the :class:`SynchronizationGraph` the link has been added to, if any
+    graph = None
+
     # pylint: disable=too-many-instance-attributes
     def __init__(self, local, remote, actor, engine, state, task_queue, metrics, config_dir):
         """Initialize the link with all pre-configured objects necessary to operate.
@@ -202,6 +256,10 @@ class SynchronizationLink(object):
 
         # Link with engine.
         self.engine.task_sink = self.task_sink
+        self.ack_batcher = AckBatcher(self.engine.ack_tasks)
+
+        # passes on the held back local deletes and writes once they are due, see startup
+        self.event_flusher = None
 
     @property
     def storages(self):
@@ -221,6 +279,31 @@ class SynchronizationLink(object):
             self.remote.storage_id: self.remote
         }
 
+    @property
+    def throttle(self):
+        """Return the bandwidth throttle shared by all transfers."""
+        return self.queue.throttle
+
+    @property
+    def transfer_metrics(self):
+        """Return the metrics collecting the throughput of all transfers."""
+        return self.queue.transfer_metrics
+
+    @property
+    def read_ahead_depth(self):
+        """Return the number of chunks transfers read in advance, 0 if they don't."""
+        return self.queue.read_ahead_depth
+
+    @property
+    def partial_download_dir(self):
+        """Return the directory of the partial files of resumable downloads."""
+        return os.path.join(self.config_dir, PARTIAL_DOWNLOAD_DIR)
+
+    @property
+    def upload_session_dir(self):
+        """Return the directory of the checkpoints of chunked uploads."""
+        return os.path.join(self.config_dir, UPLOAD_SESSION_DIR)
+
     @property
     def client_config(self):
         """Return the client config attatched to the client."""
@@ -229,13 +312,13 @@ class SynchronizationLink(object):
     def task_sink(self, task):
         """Add ack_callback to the sync engine of the link, and then put the task on the queue.
 
-        - Sets the ack_callback of the task to the ack_task of the syncengine
+        - Sets the ack_callback of the task to the ack batcher of the syncengine
         - Attaches this link to the task for future reference.
 
         :param task: a synctask that should be put on the global task queue.
         :return: None
         """
-        task.set_ack_callback(self.engine.ack_task)
+        task.set_ack_callback(self.ack_batcher.ack)
         task.link = self
         self.queue.put_task(task)
 
@@ -249,7 +332,7 @@ class SynchronizationLink(object):
 
     # pylint: disable=too-many-locals,too-many-arguments
     @classmethod
-    def using(cls, client_config, storage_config, task_queue):
+    def using(cls, client_config, storage_config, task_queue, hash_cache=None):
         """Build a SynchronizationLink from the given configuration and global task queue.
 
         :param configuration: configuration dictionary for the SP that should be setup with
@@ -259,6 +342,8 @@ class SynchronizationLink(object):
         :type task_queue: cc.synchronization.models.TaskQueue
         :param local_sync_root: path to the sync base directory
         :param config_dir: path to the configuration directory
+        :param hash_cache: the cache of the content hashes of the local files
+        :type hash_cache: cc.synchronization.hash_cache.ContentHashCache
         :return: a ready-to-use synchronization link
         """
         # Load SyncEngine state from disk if present.
@@ -277,7 +362,9 @@ class SynchronizationLink(object):
         # Setup Sync Engine
         sync_actor = SyncEngine.start(storage_metrics=metrics,
                                       task_sink=task_queue.put_task,
-                                      model=sync_state)
+                                      model=sync_state,
+                                      write_settle_interval=client_config.write_settle_interval,
+                                      write_settle_max_wait=client_config.write_settle_max_wait)
         sync_engine = sync_actor.proxy()
 
         # getting csps where storage name matches
@@ -285,6 +372,10 @@ class SynchronizationLink(object):
 
         storage_cls = csps[0]
 
+        # Providers throttle if they get too many requests at once.
+        with task_queue.pending.mutex:
+            task_queue.limiter.apply_defaults(storage_config['id'], storage_config['type'])
+
         remote = instantiate_storage(
             storage_cls,
             storage_id=storage_config.get('id'),
@@ -303,11 +394,14 @@ class SynchronizationLink(object):
             local_sync_root=local_sync_root,
             sync_engine=sync_engine,
             public_key_getter=partial(get_public_key_pem_by_subject, client_config),
-            private_key_getter=partial(get_private_key_pem_by_subject, client_config))
+            private_key_getter=partial(get_private_key_pem_by_subject, client_config),
+            hash_cache=hash_cache)
 
         # TODO Hack Hack Hack! This is needed by the EncryptionWrapper around the local storage.
         # This needs more refactoring is an improvement over the previous global config.
         local.client_config = client_config
+        # hashes the local files for the move detection
+        sync_engine.local_storage = local
 
         link = SynchronizationLink(local=local,
                                    remote=remote,
@@ -340,6 +434,12 @@ class SynchronizationLink(object):
         assert self.is_properly_configured()
         logger.info("Starting up '%s'...", self.link_id)
         self.engine.init()
+        remove_stale(self.partial_download_dir)
+        remove_stale(self.upload_session_dir)
+
+        self.event_flusher = PeriodicScheduler(interval=MOVE_DETECTION_WINDOW / 2,
+                                               target=self.engine.flush_pending_events)
+        self.event_flusher.start()
 
     def pause(self):
         """Pause link/syncengine operations.
@@ -374,6 +474,10 @@ class SynchronizationLink(object):
 
         # TODO XXX: Stop periodic writer for sync state model
 
+        if self.event_flusher is not None:
+            self.event_flusher.stop()
+            self.event_flusher = None
+
         if self.remote:
             logger.info("Shutting down remote storage.")
             try:
@@ -395,6 +499,7 @@ class SynchronizationLink(object):
 
         # Stop the sync engine and persist the current sync state model to disc.
         if self.engine:
+            self.ack_batcher.flush()
             self.save_state()
 
             logger.info("Stopping sync engine.")
@@ -422,7 +527,8 @@ class SynchronizationGraph(object):
     start, stop) can be used to issue commands on all contained links.
     """
 
-    def __init__(self, sync_root, bademeister, periodic_state_saver):
+    def __init__(self, sync_root, bademeister, periodic_state_saver, journal=None,
+                 hash_cache=None):
         """Initialize a SynchronizationGraph.
 
         This will usually only be called from within `.using`.
@@ -432,12 +538,20 @@ class SynchronizationGraph(object):
         :param bademeister: the worker pool containing the set of workers
         :type bademeister: cc.synchronization.bademeister.Bademeister
         :param periodic_state_saver: PeriodicScheduler used to save the state of the links.
+        :param journal: the journal of the task queue, if set the outstanding tasks of the
+                        last run are put on the queue again on startup.
+        :type journal: cc.synchronization.journal.TaskJournal
+        :param hash_cache: the cache of the content hashes of the local files, saved along with
+                           the state of the links.
+        :type hash_cache: cc.synchronization.hash_cache.ContentHashCache
         """
         self.sync_root = sync_root
         self.state = 'STOPPED'
         self.links = {}
         self.bademeister = bademeister
         self.periodic_state_saver = periodic_state_saver
+        self.journal = journal
+        self.hash_cache = hash_cache
 
     def add(self, link):
         """Add a new SynchronizationLink to the graph.
@@ -448,6 +562,7 @@ class SynchronizationGraph(object):
         """
         assert isinstance(link, SynchronizationLink)
         self.links[link.link_id] = link
+        link.graph = self
         logger.info("Added link '%s' to graph", link.link_id)
         return True
 
@@ -462,6 +577,7 @@ class SynchronizationGraph(object):
         item = self.links.pop(link.link_id, None)
 
         if item:
+            link.graph = None
             logger.info("Shutting down link.")
             assert link.shutdown()
             return True
@@ -469,6 +585,19 @@ class SynchronizationGraph(object):
         logger.error("Link not found!")
         return False
 
+    def find_local_copy(self, content_hash):
+        """Return a local file of any link with the content of `content_hash`, or None.
+
+        :param content_hash: a content hash of the local files or one of the storages
+        :return: a tuple (path on the disk, content hash of the local file)
+        """
+        if self.hash_cache is None:
+            return None
+        found = self.hash_cache.find(content_hash)
+        if found is None or not found[0].startswith(os.path.join(self.sync_root, '')):
+            return None
+        return found
+
     @classmethod
     def using(cls, configuration):
         """Construct a new SynchronizationGraph from a given client configuration.
@@ -480,16 +609,33 @@ class SynchronizationGraph(object):
         """
         # Create a new global task queue and worker pool.
         task_queue = cc.synchronization.models.TaskQueue()
-        task_queue.task_acked.connect(cc.ipc_gui.on_task_acked)
-        task_queue.task_acked.connect(partial(cc.settings_sync.log_task_to_backend, configuration),
-                                      weak=False)
+        task_queue.dispatcher.connect(task_queue.task_acked, cc.ipc_gui.on_task_acked,
+                                      policy=AGGREGATE)
+        task_queue.dispatcher.connect(task_queue.task_acked,
+                                      partial(cc.settings_sync.log_task_to_backend,
+                                              configuration))
+
+        task_queue.throttle.configure(configuration.bandwidth_limits,
+                                      configuration.bandwidth_schedule)
+        task_queue.read_ahead_depth = configuration.read_ahead_depth
 
         # Periodic scheduler needed
         periodic_state_saver = PeriodicScheduler(interval=90)
 
+        # Keep track of the transfers, so they survive a restart.
+        journal = None
+        if configuration.persistent_task_queue:
+            journal = TaskJournal(os.path.join(configuration.config_dir, 'task_journal'))
+            journal.attach(task_queue)
+
+        # The content hashes of the local files, shared by all links.
+        hash_cache = ContentHashCache(os.path.join(configuration.config_dir, 'content_hashes'))
+        hash_cache.load()
+
         # Instantiate a fresh graph and pass it the worker pool.
-        bademeister = Bademeister(task_queue)
-        graph = SynchronizationGraph(configuration.sync_root, bademeister, periodic_state_saver)
+        bademeister = Bademeister(task_queue, adaptive=True)
+        graph = SynchronizationGraph(configuration.sync_root, bademeister, periodic_state_saver,
+                                     journal=journal, hash_cache=hash_cache)
         periodic_state_saver.target = graph.save_state
 
         # For every configured SP in the current clients configuration, configure
@@ -499,7 +645,8 @@ class SynchronizationGraph(object):
             logger.info("Preparing Link for '%s'.", storage_config['id'])
             link = SynchronizationLink.using(client_config=configuration,
                                              storage_config=storage_config,
-                                             task_queue=task_queue)
+                                             task_queue=task_queue,
+                                             hash_cache=hash_cache)
             logger.debug(link)
             logger.debug("Successfully prepared synchronization link!")
             graph.add(link)
@@ -512,6 +659,8 @@ class SynchronizationGraph(object):
         """Save state for all links."""
         for link in self.links.values():
             link.save_state()
+        if self.hash_cache is not None:
+            self.hash_cache.save()
 
     def pause(self):
         """Pause all links currently configured in the graph."""
@@ -533,16 +682,25 @@ class SynchronizationGraph(object):
         """Startup the whole system.
 
         1. Try to create the sync directory
-        2. Start all configured Synchronization Links
-        3. Start the WorkerPool and its associated workers.
+        2. Restore the outstanding tasks of the last run from the journal
+        3. Start all configured Synchronization Links
+        4. Put the restored tasks on the queue
+        5. Start the WorkerPool and its associated workers.
         """
         logger.info('Try to create the sync root directory')
         os.makedirs(self.sync_root, exist_ok=True)
 
+        # the models must be checked before the links start to modify them
+        restored_tasks = self.restore_tasks()
+
         for link in self.links.values():
             logger.info('Starting link "%s"...', link.link_id)
             link.startup()
 
+        # queued behind the FetchFileTreeTasks issued by the links
+        for link, task in restored_tasks:
+            link.task_sink(task)
+
         logger.info("Booting the Bademeister!")
         self.bademeister.start()
 
@@ -552,6 +710,28 @@ class SynchronizationGraph(object):
         self.state = 'RUNNING'
         logger.info("Graph startup complete!")
 
+    def restore_tasks(self):
+        """Load the outstanding tasks of the last run from the journal.
+
+        Tasks of links which are not configured any longer and tasks which are already done
+        according to the model of their link are dropped.
+
+        :return: list of `(link, task)` tuples
+        """
+        if self.journal is None:
+            return []
+
+        restored_tasks = []
+        for link_id, task in self.journal.load():
+            link = self.links.get(link_id)
+            if link is None or not is_outstanding(task, link.state):
+                logger.debug("Dropping restored task '%s'", task)
+                continue
+            restored_tasks.append((link, task))
+
+        logger.info("Restored %d tasks from the journal", len(restored_tasks))
+        return restored_tasks
+
     def aggregate_state(self):
         """Get the aggregated (worst-case) state of the graph.
 
@@ -588,6 +768,12 @@ class SynchronizationGraph(object):
         logger.info("Shutting down Bademeister...")
         self.bademeister.stop()
 
+        if self.journal is not None:
+            self.journal.close()
+
+        if self.hash_cache is not None:
+            self.hash_cache.save()
+
         logger.debug('Shutdown complete!')
 
     def get_synclink_by_displayname(self, display_name):
@@ -642,13 +828,15 @@ def instantiate_storage(storage_factory, storage_id, config=None,
     return storage_instance
 
 
-def prepare_local_filesystem(local_sync_root, sync_engine, public_key_getter, private_key_getter):
+def prepare_local_filesystem(local_sync_root, sync_engine, public_key_getter, private_key_getter,
+                             hash_cache=None):
     """Create an instance of the local filesystem storage.
 
     :param local_sync_root: the local "mountpoint" of the filesystem
     :param sync_engine: the event sink (sync engine)
     :param public_key_getter: function to be used for public key retrieval
     :param private_key_getter: function to be used for private key retrieval
+    :param hash_cache: the cache of the content hashes of the local files
     :return: the setup 'local' encrypted filesystem
     """
     return EncryptingFileSystem(root=local_sync_root,
@@ -656,50 +844,370 @@ def prepare_local_filesystem(local_sync_root, sync_engine, public_key_getter, pr
                                 storage_id='local',
                                 syncengine=sync_engine,
                                 public_key_getter=public_key_getter,
-                                private_key_getter=private_key_getter)
+                                private_key_getter=private_key_getter,
+                                hash_cache=hash_cache)
 
 
 class HashPathQueue(queue.Queue):
     """Queue which improves perfomance of determining tasks operate on same link path combination.
 
     It uses an internal hashmap to store tasks which operate on the same link path combination.
+
+    Tasks are kept in one FIFO per lane (see :attr:`cc.synctask.SyncTask.lane`). By default a
+    task is handed out in the order it was put on the queue, regardless of its lane. Workers
+    reserved for certain lanes only get tasks of these lanes, so they never wait behind tasks
+    of other lanes.
+
+    Tasks operating below the path of a queued or running task which has to be done first
+    (see :attr:`cc.synctask.SyncTask.blocks_children`, e.g. the creation of the parent
+    directory) are held back until that task has been completed, see :meth:`complete`.
+
+    Tasks involving a storage with an open circuit are moved out of their lane once they are
+    come across, so they are not scanned again on every `get`. They are put back once the
+    circuit breaker wakes up the queue, see :meth:`wake_up`.
     """
 
     def _init(self, maxsize=0):
-        super()._init(maxsize)
+        # lane -> deque of (sequence number, task), STOP_TOKENs are queued in the lane None
+        self.lanes = collections.OrderedDict()
+        self.sequence = itertools.count()
         self.path_queue = dict()
 
-    def _put(self, task):
-        super(HashPathQueue, self)._put(task)
+        # path hash -> queued or running tasks its children have to wait for
+        self.parents = {}
+        # path hash of a parent -> list of (sequence number, task) waiting for it
+        self.waiting = {}
+        # storage id -> list of (sequence number, task) held back by its open circuit
+        self.parked = {}
+
+        # lanes served by reserved workers -> condition they wait on
+        self.lane_conditions = {}
+
+        #: :class:`cc.synchronization.limits.ConcurrencyLimiter` deciding which task may be
+        #: handed out next, if None the queue is strictly FIFO.
+        self.limiter = None
+
+        #: :class:`cc.synchronization.circuit_breaker.CircuitBreaker` holding back the tasks of
+        #: unavailable storages, if None all storages are considered available.
+        self.circuit_breaker = None
+
+    @property
+    def queue(self):
+        """Return all queued tasks in the order they have been put on the queue."""
+        return [task for _, task in heapq.merge(*self.lanes.values(), *self.waiting.values(),
+                                                *self.parked.values())]
+
+    def _qsize(self):
+        return sum(len(entries) for entries in self.lanes.values()) + self.waiting_count() + \
+            self.parked_count()
+
+    def waiting_count(self):
+        """Return the number of queued tasks waiting for their parent."""
+        return sum(len(entries) for entries in self.waiting.values())
+
+    def parked_count(self):
+        """Return the number of queued tasks held back by the open circuit of a storage."""
+        return sum(len(entries) for entries in self.parked.values())
+
+    def admissible_count(self):
+        """Return the number of queued tasks which the workers could start right now.
+
+        Tasks waiting for their parent, for the circuit of their storage to close (except a
+        single probe per storage) or for their back-off to pass are not counted, nor the
+        tasks exceeding the free slots of the concurrency limits.
+        """
+        with self.mutex:
+            now = time.time()
+            # slots of the limiter occupied by the tasks counted, storages probed
+            reserved = collections.Counter()
+            probed = set()
+            count = 0
+            for lane, entries in self.lanes.items():
+                if lane is None:
+                    continue
+                for _, task in entries:
+                    if self._admissible(task, now, reserved, probed):
+                        count += 1
+            return count
+
+    def _admissible(self, task, now, reserved, probed):
+        if task.execute_after > now:
+            # the worker puts it back until its back-off has passed
+            return False
+        if task.cancelled:
+            return True
+        if self.circuit_breaker is not None:
+            unavailable = [storage_id for storage_id in task.involved_storage_ids()
+                           if self.circuit_breaker.is_open((storage_id,))]
+            if unavailable:
+                if probed.intersection(unavailable) or not self.circuit_breaker.admits(task):
+                    return False
+                probed.update(unavailable)
+        return self.limiter is None or self.limiter.reserve(task, reserved)
+
+    def lane_sizes(self):
+        """Return the number of queued tasks per lane."""
+        with self.mutex:
+            return {lane: len(entries) for lane, entries in self.lanes.items()
+                    if lane is not None}
+
+    def _admits(self, task, verdicts):
+        if self.limiter is None or task == cc.synctask.STOP_TOKEN or task.cancelled:
+            return True
+
+        # tasks of the same type on the same storages share their verdict within a scan
+        key = (type(task), task.involved_storage_ids())
+        if key not in verdicts:
+            verdicts[key] = self.limiter.admits(task)
+        return verdicts[key]
+
+    def _holding_back(self, task, verdicts):
+        """Return the storage with an open circuit `task` has to wait for, or None."""
+        if self.circuit_breaker is None or task == cc.synctask.STOP_TOKEN or task.cancelled:
+            return None
+
+        # tasks on the same storages share their verdict within a scan
+        key = ('circuit', task.involved_storage_ids())
+        if key not in verdicts:
+            verdicts[key] = self.circuit_breaker.holding_back(task)
+        return verdicts[key]
 
+    def _find(self, lanes=None):
+        """Return `(lane, index)` of the first task which may be handed out or None.
+
+        Tasks held back by an open circuit are parked on the way.
+
+        :param lanes: only consider tasks of these lanes, None considers all lanes. STOP_TOKENs
+                      are handed out to every worker.
+        """
+        verdicts = {}
+        found = None
+        for lane, entries in self.lanes.items():
+            if lanes is not None and lane is not None and lane not in lanes:
+                continue
+            index = 0
+            while index < len(entries):
+                sequence, task = entries[index]
+                if found is not None and sequence > found[0]:
+                    break
+                storage_id = self._holding_back(task, verdicts)
+                if storage_id is not None:
+                    del entries[index]
+                    bisect.insort(self.parked.setdefault(storage_id, []), (sequence, task))
+                    continue
+                if self._admits(task, verdicts):
+                    found = (sequence, lane, index)
+                    break
+                index += 1
+        return None if found is None else found[1:]
+
+    def unpark(self, tasks):
+        """Put `tasks` back into their lanes if they are parked, e.g. once they are cancelled.
+
+        Must be called while holding the mutex.
+        """
+        if not self.parked:
+            return
+        task_ids = {id(task) for task in tasks}
+        for storage_id, entries in list(self.parked.items()):
+            kept = []
+            for sequence, task in entries:
+                if id(task) in task_ids:
+                    self._insert(sequence, task)
+                else:
+                    kept.append((sequence, task))
+            if len(kept) < len(entries):
+                self.parked[storage_id] = kept
+                self._notify_all()
+            if not kept:
+                del self.parked[storage_id]
+
+    def _unpark(self):
+        """Put the parked tasks back into their lanes, the circuit breaker decides again."""
+        parked, self.parked = self.parked, {}
+        for sequence, task in heapq.merge(*parked.values()):
+            self._insert(sequence, task)
+
+    def _condition(self, lanes):
+        if lanes is None:
+            return self.not_empty
+        lanes = tuple(lanes)
+        with self.mutex:
+            return self.lane_conditions.setdefault(lanes, threading.Condition(self.mutex))
+
+    def _notify_all(self, lane=None):
+        """Wake up all workers waiting for tasks of `lane`, or for any task if None."""
+        if lane is None:
+            self.not_empty.notify_all()
+        for lanes, condition in self.lane_conditions.items():
+            if lane is None or lane in lanes:
+                condition.notify_all()
+
+    def get(self, block=True, timeout=None, lanes=None):
+        """Remove and return the first task admitted by the limiter.
+
+        Works like :meth:`queue.Queue.get`, but also waits as long as every queued task would
+        exceed its concurrency limit.
+
+        :param lanes: only return tasks of these lanes (or STOP_TOKENs), None returns tasks of
+                      all lanes.
+        """
+        condition = self._condition(lanes)
+        with condition:
+            if not block:
+                location = self._find(lanes)
+                if location is None:
+                    raise queue.Empty
+            elif timeout is None:
+                location = self._find(lanes)
+                while location is None:
+                    condition.wait()
+                    location = self._find(lanes)
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = time.monotonic() + timeout
+                location = self._find(lanes)
+                while location is None:
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Empty
+                    condition.wait(remaining)
+                    location = self._find(lanes)
+            item = self._take(*location)
+            self.not_full.notify()
+            return item
+
+    def release(self, task):
+        """Release the concurrency slots held by `task` and wake up waiting workers."""
+        if self.limiter is None and self.circuit_breaker is None:
+            return
+        with self.not_empty:
+            released = self.limiter is not None and self.limiter.release(task)
+            if self.circuit_breaker is not None and self.circuit_breaker.release(task):
+                self._unpark()
+                released = True
+            if released:
+                self._notify_all()
+
+    def wake_up(self):
+        """Wake up all waiting workers, e.g. once the circuit of a storage closed.
+
+        The parked tasks are put back into their lanes.
+        """
+        with self.mutex:
+            self._unpark()
+            self._notify_all()
+
+    def _put(self, task):
         # Return early if we encounter a STOP_TOKEN.
         if task == cc.synctask.STOP_TOKEN:
+            self.lanes.setdefault(None, collections.deque()).append((next(self.sequence), task))
+            self._notify_all()
             logger.info("Put 'STOP_TOKEN' on task queue.")
             return
 
-        # Otherwise handle the task as we would normally.
-        path = task.operates_on()
-        self.path_queue.setdefault(path, [])
-        self.path_queue[path].append(task)
+        if task.blocks_children:
+            for path in task.operates_on_all():
+                parents = self.parents.setdefault(path, [])
+                if not any(parent is task for parent in parents):
+                    parents.append(task)
+
+        self._enqueue(next(self.sequence), task)
+
+        # Otherwise handle the task as we would normally, batches are found by all their paths
+        for path in task.operates_on_all():
+            self.path_queue.setdefault(path, [])
+            self.path_queue[path].append(task)
         logger.debug("Queued Task '%s'", task)
 
+    def _parent_of(self, task):
+        """Return the path hash of a queued or running task `task` has to wait for, or None."""
+        if not self.parents:
+            return None
+        for path in task.operates_on_all():
+            # the first element of the path hash is the link id
+            for length in range(len(path) - 1, 1, -1):
+                if path[:length] in self.parents:
+                    return path[:length]
+        return None
+
+    def _enqueue(self, sequence, task):
+        """Add `task` to its lane or let it wait for its parent."""
+        parent = self._parent_of(task)
+        if parent is not None:
+            logger.debug("Task '%s' waits for its parent '%s'", task, parent)
+            self.waiting.setdefault(parent, []).append((sequence, task))
+            return
+        self._insert(sequence, task)
+
+    def _insert(self, sequence, task):
+        """Add `task` to its lane at the position of `sequence`."""
+        entries = self.lanes.setdefault(task.lane, collections.deque())
+        if not entries or entries[-1][0] < sequence:
+            entries.append((sequence, task))
+        else:
+            # a task which waited for its parent keeps its position
+            bisect.insort(entries, (sequence, task))
+
+        # the general workers are notified by `put`, the reserved ones here
+        for lanes, condition in self.lane_conditions.items():
+            if task.lane in lanes:
+                condition.notify()
+
+    def complete(self, task):
+        """Let the tasks waiting for `task` be handed out, called once `task` has been acked.
+
+        The waiting tasks are released regardless of the outcome of `task`. If it failed, they
+        fail as well and the sync engine evaluates the items again.
+        """
+        if not task.blocks_children:
+            return
+        with self.mutex:
+            released = []
+            for path in task.operates_on_all():
+                parents = self.parents.get(path, [])
+                parents[:] = [parent for parent in parents if parent is not task]
+                if not parents:
+                    self.parents.pop(path, None)
+                    released.extend(self.waiting.pop(path, ()))
+
+            for sequence, child in sorted(released, key=lambda entry: entry[0]):
+                self._enqueue(sequence, child)
+            if released:
+                logger.debug("Released %d tasks waiting for '%s'", len(released), task)
+                self._notify_all()
+
     def _get(self):
-        """Retrieve item from queue and remove empty path_queue entry if necessary."""
-        task = super(HashPathQueue, self)._get()
+        return self._take(*self._find())
+
+    def _take(self, lane, index):
+        """Remove the task at `index` of `lane` and remove empty path_queue entry if necessary."""
+        entries = self.lanes[lane]
+        if index == 0:
+            _, task = entries.popleft()
+        else:
+            _, task = entries[index]
+            del entries[index]
 
         # Return early if we encounter a STOP_TOKEN.
         if task == cc.synctask.STOP_TOKEN:
             logger.info("Got 'STOP_TOKEN'.")
             return task
 
+        if self.limiter is not None:
+            self.limiter.acquire(task)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.acquire(task)
+
         # Otherwise handle the task as we would normally.
-        path = task.operates_on()
-        self.path_queue[path].remove(task)
-        logger.info("Got task '%s' from path_queue '%s'", task, path)
+        for path in task.operates_on_all():
+            self.path_queue[path].remove(task)
+            logger.info("Got task '%s' from path_queue '%s'", task, path)
 
-        if len(self.path_queue[path]) == 0:
-            del self.path_queue[path]
-            logger.debug("Deleting empty path_queue entry for '%s'.", path)
+            if len(self.path_queue[path]) == 0:
+                del self.path_queue[path]
+                logger.debug("Deleting empty path_queue entry for '%s'.", path)
 
         return task
 
@@ -712,13 +1220,58 @@ class HashPathQueue(queue.Queue):
         """
         return self.path_queue.get(operates_on_hash, [])
 
+    def replace(self, old_task, new_task):
+        """Replace the queued `old_task` by `new_task`, keeping its position in the queue.
+
+        Must be called while holding the mutex.
+        """
+        for entries in itertools.chain([self.lanes.get(old_task.lane, [])],
+                                       self.waiting.values(), self.parked.values()):
+            for index, (sequence, task) in enumerate(entries):
+                if task is old_task:
+                    entries[index] = (sequence, new_task)
+                    break
+            else:
+                continue
+            break
+        else:
+            raise ValueError('{} is not queued'.format(old_task))
+
+        if old_task.blocks_children:
+            for path in old_task.operates_on_all():
+                self.parents[path] = [new_task if parent is old_task else parent
+                                      for parent in self.parents.get(path, [])]
+
+        path_tasks = self.path_queue[old_task.operates_on()]
+        for index, task in enumerate(path_tasks):
+            if task is old_task:
+                path_tasks[index] = new_task
+                break
+        logger.debug("Replaced queued task '%s' by '%s'", old_task, new_task)
+
 
 class TaskQueue:
     """Contains multiple data structures to maintain tasks in certain states."""
 
     # pylint: disable=too-many-instance-attributes
-    def __init__(self):
+    def __init__(self, limiter=None, circuit_breaker=None, throttle=None):
+        if limiter is None:
+            limiter = ConcurrencyLimiter()
+        self.limiter = limiter
+
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker = circuit_breaker
+
         self.pending = HashPathQueue()
+        self.pending.limiter = limiter
+        self.pending.circuit_breaker = circuit_breaker
+        circuit_breaker.wake_up = self.pending.wake_up
+
+        if throttle is None:
+            throttle = BandwidthThrottle()
+        #: :class:`cc.synchronization.throttle.BandwidthThrottle` limiting all transfers
+        self.throttle = throttle
 
         self.running = set()
         self.running_lock = threading.Lock()
@@ -726,13 +1279,35 @@ class TaskQueue:
         self.cancel = dict()
         self.cancel_lock = threading.Lock()
 
+        #: the receivers run in the thread putting or acking the task, slow receivers should
+        #: be connected via the :attr:`dispatcher`
         self.task_acked = blinker.Signal()
         self.task_putted = blinker.Signal()
+        self.dispatcher = SignalDispatcher()
+
+        #: :class:`cc.synchronization.throughput.TransferMetrics` of all transfers
+        self.transfer_metrics = TransferMetrics()
+        self.transfer_metrics.attach(self)
+
+        #: number of chunks each transfer reads in advance in a background thread, 0 disables
+        #: the read-ahead, see :mod:`cc.synchronization.read_ahead`
+        self.read_ahead_depth = READ_AHEAD_DEPTH
+
+        #: task type -> number of pending tasks replaced by a newer task
+        self.superseded = collections.Counter()
 
     @property
     def statistics(self):
         """Return statistics."""
-        return {'sync_task_count': self.pending.qsize() + len(self.running)}
+        return {'sync_task_count': self.pending.qsize() + len(self.running),
+                'pending_tasks_by_lane': self.pending.lane_sizes(),
+                'tasks_waiting_for_parent': self.pending.waiting_count(),
+                'circuit_breakers': self.circuit_breaker.statistics,
+                'bandwidth_throttle': self.throttle.statistics,
+                'transfers': self.transfer_metrics.statistics,
+                'superseded_task_count': sum(self.superseded.values()),
+                'superseded_tasks': dict(self.superseded),
+                'signal_dispatcher': self.dispatcher.statistics}
 
     def _handle_cancel_sync_task(self, sync_task):
         cancelled_something = False
@@ -746,9 +1321,9 @@ class TaskQueue:
         # 1) cancel all running tasks
         with self.running_lock:
             for running_task in self.running:
-                if running_task.operates_on() == sync_task.operates_on():
-                    running_task.cancel()
-                    logger.info("Cancelled running task: '%s'.", running_task)
+                for task in running_task.tasks_operating_on(sync_task.operates_on()):
+                    task.cancel()
+                    logger.info("Cancelled running task: '%s'.", task)
                     cancelled_something = True
 
         # 2) cancel all tasks currently in the queue
@@ -757,9 +1332,12 @@ class TaskQueue:
             pending_tasks = self.pending.tasks_for(sync_task.operates_on())
             logger.debug("Found %d pending tasks.", len(pending_tasks))
             for pending_task in pending_tasks:
-                pending_task.cancel()
-                logger.info("Cancelled pending task prior to execution '%s'", pending_task)
-                cancelled_something = True
+                for task in pending_task.tasks_operating_on(sync_task.operates_on()):
+                    task.cancel()
+                    logger.info("Cancelled pending task prior to execution '%s'", task)
+                    cancelled_something = True
+            # cancelled tasks are acked right away, even if their storage is unavailable
+            self.pending.unpark(pending_tasks)
 
         # 3) check if any tasks are in progress or queued
         if not cancelled_something:
@@ -768,29 +1346,86 @@ class TaskQueue:
                 sync_task.state = cc.synctask.SyncTask.SUCCESSFUL
             sync_task.ack_callback(sync_task)
 
+    def _supersede(self, sync_task):
+        """Replace a stale pending task equal to `sync_task`.
+
+        Equal tasks are of the same type and operate on the same path and storages. The stale
+        task is acked as cancelled right away, the new one takes its place in the queue. If
+        `sync_task` is put back by a worker, a pending equal task has been issued after it and
+        `sync_task` itself is the stale one.
+
+        :return: True if a task has been superseded, False if `sync_task` still has to be queued.
+        """
+        with self.running_lock:
+            requeued = any(task is sync_task for task in self.running)
+
+        with self.pending.mutex:
+            stale_tasks = [task for task in self.pending.tasks_for(sync_task.operates_on())
+                           if type(task) is type(sync_task) and task == sync_task and
+                           task is not sync_task and not task.cancelled]
+            if not stale_tasks:
+                return False
+
+            if requeued:
+                superseded, replacement = sync_task, stale_tasks[0]
+            else:
+                superseded, replacement = stale_tasks[0], sync_task
+                self.pending.replace(superseded, replacement)
+
+        if requeued:
+            with self.running_lock:
+                self.running.discard(superseded)
+            self.pending.release(superseded)
+            self.pending.complete(superseded)
+
+        logger.info("Task '%s' superseded by '%s'", superseded, replacement)
+        superseded.superseded_by = replacement
+        superseded.state = cc.synctask.SyncTask.CANCELLED
+        self.superseded[type(superseded).__name__] += 1
+
+        superseded.ack_callback(superseded)
+        self.task_acked.send(superseded)
+        return True
+
     def put_task(self, sync_task):
         """Put a task onto the queue, if not a CancelSyncTask.
 
         If it is a CancelSyncTask it will cancel all running and queued SyncTasks.
         As another side effect it will put CancelSyncTask on a separate set
+
+        A pending task for the same path and storages is superseded by the new task, see
+        :meth:`_supersede`.
         """
         logger.info('[put_task] %s', sync_task)
         if isinstance(sync_task, cc.synctask.CancelSyncTask):
             self._handle_cancel_sync_task(sync_task)
             return
 
+        if isinstance(sync_task, cc.synctask.SyncTask) and sync_task.supersedable and \
+                self._supersede(sync_task):
+            if sync_task.superseded_by is None:
+                self.task_putted.send(sync_task)
+            return
+
+        # a worker puts back tasks which have to wait, they must not keep their slots
+        self.pending.release(sync_task)
         self.pending.put(sync_task)
 
         # syncing callbacks
         self.task_putted.send(sync_task)
+        if isinstance(sync_task, cc.synctask.BatchSyncTask):
+            for task in sync_task.tasks:
+                self.task_putted.send(task)
 
-    def get_task(self, block=True, timeout=None):
+    def get_task(self, block=True, timeout=None, lanes=None):
         """Return next task to be executed.
 
         Puts the task on the running list
         Should only be called by a worker who intends to process a taks.
+
+        :param lanes: only return tasks of these lanes, used by reserved workers.
         """
-        task = self.pending.get(block, timeout)
+        task = self.pending.get(block, timeout, lanes=lanes)
         # decrease internal semaphore for correct task count
         self.pending.task_done()
         with self.running_lock:
@@ -813,35 +1448,48 @@ class TaskQueue:
                 self.running.remove(task)
             except KeyError:
                 logger.exception("Failed removing task")
+        self.pending.release(task)
+        self.pending.complete(task)
 
         if task.state == cc.synctask.SyncTask.BLOCKED:
             # stop syncing blocked files
             task.state = cc.synctask.SyncTask.INVALID_OPERATION
 
         task.ack_callback(task)
+        if isinstance(task, cc.synctask.BatchSyncTask):
+            # the sync engine acks the tasks of the batch along with it
+            for sub_task in task.tasks:
+                self.task_acked.send(sub_task)
         self.task_acked.send(task)
 
         # check if there are any cancel tasks, and if, if there are any related left
         with self.cancel_lock:
-            path_hash = task.operates_on()
-            cancel_task = self.cancel.get(path_hash)
-            if cancel_task is not None:
-                are_tasks_running = False
-                # check the in queue
-                with self.pending.mutex:
-                    if len(self.pending.path_queue.get(path_hash, [])) != 0:
+            for path_hash in task.operates_on_all():
+                self._ack_cancel_task(path_hash)
+
+    def _ack_cancel_task(self, path_hash):
+        """Ack the cancel task for `path_hash` once no task for the path is left.
+
+        Must be called while holding the cancel_lock.
+        """
+        cancel_task = self.cancel.get(path_hash)
+        if cancel_task is not None:
+            are_tasks_running = False
+            # check the in queue
+            with self.pending.mutex:
+                if len(self.pending.path_queue.get(path_hash, [])) != 0:
+                    are_tasks_running = True
+            with self.running_lock:
+                for running_task in self.running:
+                    if path_hash in running_task.operates_on_all():
                         are_tasks_running = True
-                with self.running_lock:
-                    for running_task in self.running:
-                        if running_task.path == cancel_task.path:
-                            are_tasks_running = True
-                            break
-                    if not are_tasks_running:
-                        # ack the cancel task and remove it from the list if
-                        # there are not queued or running tasks left
-                        del self.cancel[path_hash]
-                        cancel_task.state = cc.synctask.SyncTask.SUCCESSFUL
-                        cancel_task.ack_callback(cancel_task)
+                        break
+                if not are_tasks_running:
+                    # ack the cancel task and remove it from the list if
+                    # there are not queued or running tasks left
+                    del self.cancel[path_hash]
+                    cancel_task.state = cc.synctask.SyncTask.SUCCESSFUL
+                    cancel_task.ack_callback(cancel_task)
 
     def path_has_tasks(self, path_hash, is_dir):
         """Check if a path is in the queue or in the actual execution.
@@ -856,7 +1504,7 @@ class TaskQueue:
             with self.running_lock:
                 # its only as much elements as workers, so iterations should be fine
                 for task in self.running:
-                    if path_hash == task.operates_on():
+                    if path_hash in task.operates_on_all():
                         result = True
                         break
             with self.pending.mutex:
@@ -0,0 +1,157 @@
+"""Download into partial files, so a failed download resumes where it stopped.
+
+A :class:`cc.synctask.DownloadSyncTask` of a storage supporting ranged reads does not stream
+the file straight into the local storage. It writes the data as read from the storage, before
+it is decrypted, into a partial file first. Every :data:`CHECKPOINT_INTERVAL` bytes and when
+the download fails the partial file is synced to the disk and its offset is recorded along
+with the version of the file. Once the download is complete the partial file is written to the
+local storage and removed.
+
+A later attempt of the same download, even after a restart, continues at the recorded offset,
+as long as it is of the same version. The storage is asked for the rest of the file starting at
+that offset and validates the version as well.
+
+Storages supporting ranged reads have a true `supports_ranged_read` attribute and accept an
+`offset` for `open_read`.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import time
+
+import atomicwrites
+
+logger = logging.getLogger(__name__)
+
+#: directory in the configuration directory the partial files are kept in
+PARTIAL_DOWNLOAD_DIR = 'partial_downloads'
+
+#: bytes written to a partial file between two checkpoints
+CHECKPOINT_INTERVAL = 8 * 1024 * 1024
+
+#: seconds after which a partial file not resumed is removed, see :func:`remove_stale`
+MAX_AGE = 7 * 24 * 60 * 60
+
+# bytes read from the storage at once
+_CHUNK_SIZE = 1024 * 1024
+
+
+def supports_ranged_read(storage):
+    """Return True if `storage` can read a file starting at an offset."""
+    return getattr(storage, 'supports_ranged_read', False) is True
+
+
+class PartialDownload:
+    """The partial file of a download and its checkpoint.
+
+    The partial file of a download is identified by the `key` of the download, the checkpoint
+    is only used for the same `version_id`.
+    """
+
+    def __init__(self, directory, key, version_id, checkpoint_interval=CHECKPOINT_INTERVAL):
+        """
+        :param directory: the directory of the partial files
+        :param key: a tuple identifying the download, e.g. link, storage and path of the file
+        :param version_id: the version of the file downloaded
+        :param checkpoint_interval: bytes written between two checkpoints
+        """
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        self.directory = directory
+        self.data_path = os.path.join(directory, name + '.part')
+        self.checkpoint_path = os.path.join(directory, name + '.checkpoint')
+        self.key = key
+        self.version_id = version_id
+        self.checkpoint_interval = checkpoint_interval
+        #: bytes of the partial file already downloaded
+        self.offset = 0
+
+    def resume(self):
+        """Return the offset to resume the download at, 0 if it has to start over.
+
+        Data of the partial file beyond the checkpoint is dropped, it might not have reached
+        the disk.
+        """
+        self.offset = 0
+        try:
+            with open(self.checkpoint_path, 'rb') as file_handle:
+                checkpoint = pickle.load(file_handle)
+            size = os.path.getsize(self.data_path)
+        except FileNotFoundError:
+            return 0
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            logger.warning("Ignoring corrupt checkpoint '%s'", self.checkpoint_path,
+                           exc_info=True)
+            return 0
+
+        if checkpoint.get('key') != self.key or \
+                checkpoint.get('version_id') != self.version_id or \
+                checkpoint.get('offset', 0) > size:
+            logger.info("Partial download of %s is outdated, starting over", self.key)
+            return 0
+        self.offset = checkpoint['offset']
+        return self.offset
+
+    def fill(self, file_obj):
+        """Append everything read from `file_obj` to the partial file.
+
+        A checkpoint is saved every `checkpoint_interval` bytes, at the end and when reading
+        fails, the exception is raised again.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.data_path, 'r+b' if self.offset else 'wb') as partial_file:
+            partial_file.seek(self.offset)
+            partial_file.truncate()
+            unsaved = 0
+            try:
+                while True:
+                    chunk = file_obj.read(_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    partial_file.write(chunk)
+                    self.offset += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= self.checkpoint_interval:
+                        self._checkpoint(partial_file)
+                        unsaved = 0
+            finally:
+                self._checkpoint(partial_file)
+
+    def _checkpoint(self, partial_file):
+        """Sync the partial file to the disk and record its offset."""
+        partial_file.flush()
+        os.fsync(partial_file.fileno())
+        checkpoint = {'key': self.key, 'version_id': self.version_id, 'offset': self.offset}
+        with atomicwrites.atomic_write(self.checkpoint_path, mode='wb',
+                                       overwrite=True) as file_handle:
+            pickle.dump(checkpoint, file_handle)
+
+    def open(self):
+        """Return the complete partial file opened for reading."""
+        return open(self.data_path, 'rb')
+
+    def discard(self):
+        """Remove the partial file and its checkpoint."""
+        for path in (self.checkpoint_path, self.data_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def remove_stale(directory, max_age=MAX_AGE, now=None):
+    """Remove the files in `directory` not touched for `max_age`, e.g. the partial files."""
+    if now is None:
+        now = time.time()
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                logger.info("Removing stale '%s'", path)
+                os.remove(path)
+        except OSError:
+            logger.debug("Could not remove '%s'", path, exc_info=True)
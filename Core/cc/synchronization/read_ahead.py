@@ -0,0 +1,133 @@
+"""Read the next chunks of a transfer in the background.
+
+Without read-ahead a transfer is strictly sequential: the provider reads a chunk from the local
+file, which is encrypted on the way, sends it and only then reads the next one. The
+:class:`ReadAheadReader` reads the file object of the source storage with a thread of its own
+and keeps up to `depth` chunks ready, so the disk, the encryption and the network overlap:
+
+- for an upload the reader thread reads and encrypts the local file, while the provider sends
+  the previous chunk,
+- for a download the reader thread receives the next chunk from the provider, while the
+  previous one is written to the disk.
+
+The reader sits below the :class:`cc.synchronization.models.ControlFileWrapper`, so the
+transfer can still be cancelled and throttled.
+"""
+import logging
+import queue
+import threading
+
+from cc.mime_type_stream import ReusableBufferReader, readinto_from
+
+logger = logging.getLogger(__name__)
+
+#: number of chunks read in advance by default
+READ_AHEAD_DEPTH = 2
+
+#: bytes read from the source with one call
+READ_AHEAD_CHUNK_SIZE = 1024 * 1024
+
+#: seconds the reader thread is waited for on close, a provider might not return at all
+CLOSE_TIMEOUT = 5
+
+# seconds the reader thread waits for room in the queue before checking if it has been stopped
+_PUT_INTERVAL = 0.1
+
+
+class ReadAheadReader(ReusableBufferReader):
+    """Read a file object in a background thread, keeping up to `depth` chunks ready.
+
+    The chunks are read into a fixed set of buffers, which are handed back to the reader thread
+    once they have been consumed. Exceptions of the wrapped file object are raised by the next
+    read. The reader must be closed before the wrapped file object.
+    """
+
+    def __init__(self, orig_obj, depth=READ_AHEAD_DEPTH, chunk_size=READ_AHEAD_CHUNK_SIZE):
+        """
+        :param orig_obj: the file object to read from
+        :param depth: the number of chunks read in advance
+        :param chunk_size: the bytes read from `orig_obj` with one call
+        """
+        super().__init__()
+        if depth < 1:
+            raise ValueError('depth must be at least 1, not {!r}'.format(depth))
+        self._orig_obj = orig_obj
+        self.depth = depth
+        self.chunk_size = chunk_size
+
+        #: tuples (buffer, count) of the chunks read, an exception or None at the end of file
+        self._filled = queue.Queue(maxsize=depth)
+        # the buffers to read into, one is read into while `depth` are queued and one consumed
+        self._empty = queue.Queue()
+        for _ in range(depth + 2):
+            self._empty.put(bytearray(chunk_size))
+
+        # the chunk currently consumed and the unread part of it
+        self._current_buffer = None
+        self._current = memoryview(b'')
+        self._eof = False
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._read_ahead, daemon=True,
+                                        name='ReadAhead-{}'.format(id(self)))
+        self._thread.start()
+
+    def _put(self, item):
+        """Queue `item` as soon as there is room, unless the reader is closed."""
+        while not self._stopped.is_set():
+            try:
+                self._filled.put(item, timeout=_PUT_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _read_ahead(self):
+        """Read chunks until the end of the file, an error or the reader is closed."""
+        try:
+            while not self._stopped.is_set():
+                buffer = self._empty.get()
+                if buffer is None:
+                    # closed
+                    return
+                count = readinto_from(self._orig_obj, buffer)
+                if not count:
+                    self._put(None)
+                    return
+                self._put((buffer, count))
+        except Exception as error:  # pylint: disable=broad-except
+            # raised in the thread consuming the chunks
+            self._put(error)
+
+    def readinto(self, buffer):
+        """Copy the next chunk read in advance into `buffer`, wait if there is none yet."""
+        while not self._current:
+            if self._eof:
+                return 0
+            if self._current_buffer is not None:
+                self._empty.put(self._current_buffer)
+                self._current_buffer = None
+
+            item = self._filled.get()
+            if item is None or isinstance(item, Exception):
+                self._eof = True
+                if item is None:
+                    return 0
+                raise item
+            self._current_buffer, count = item
+            self._current = memoryview(self._current_buffer)[:count]
+
+        count = min(len(buffer), len(self._current))
+        buffer[:count] = self._current[:count]
+        self._current = self._current[count:]
+        return count
+
+    def close(self):
+        """Stop the reader thread, the wrapped file object is not closed."""
+        if not self.closed:
+            self._stopped.set()
+            self._empty.put(None)
+            self._thread.join(CLOSE_TIMEOUT)
+            if self._thread.is_alive():
+                logger.warning('Read-ahead thread did not stop within %s seconds',
+                               CLOSE_TIMEOUT)
+        super().close()
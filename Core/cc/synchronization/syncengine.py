@@ -1,7 +1,9 @@
 """CrossCloud SyncEngine."""
 # pylint: disable=too-many-instance-attributes,wrong-import-order
+import collections
 import copy
 import logging
+import os
 import time
 from collections import namedtuple
 from datetime import datetime
@@ -15,26 +17,48 @@ from pykka.threading import ThreadingActorPriorityMailbox
 
 import cc.ipc_gui
 from cc.path import normalize_path_element
-from cc.synchronization.syncfsm import (DISPLAY_NAME, EVENT_RECEIVED,
+from cc.synchronization.syncfsm import (CONTENT_HASH, DISPLAY_NAME, EVENT_RECEIVED,
                                         FILESYSTEM_ID, FSM_NODE_CONFIG, IS_DIR,
-                                        MOVED, PUBLIC_SHARE, S_SYNCED, SE_FSM,
-                                        SHARE_ID, SIZE, STORAGE,
+                                        MODIFIED_DATE, MOVED, PUBLIC_SHARE, S_SYNCED,
+                                        S_UNKNOWN, SE_FSM, SHARE_ID, SIZE, STORAGE,
                                         SYNC_TASK_FAILED, SYNC_TASK_RUNNING,
                                         SYNC_TASK_STATE, get_storage_path)
-from cc.synctask import (CancelSyncTask, CompareSyncTask, CreateDirSyncTask,
-                         DeleteSyncTask, DownloadSyncTask, FetchFileTreeTask,
-                         MoveSyncTask, SyncTask, UploadSyncTask)
+from cc.synctask import (BatchSyncTask, CancelSyncTask, CompareSyncTask,
+                         CreateDirSyncTask, DeleteSyncTask, DownloadSyncTask,
+                         FetchFileTreeTask, MoveSyncTask, SyncTask,
+                         UploadSyncTask, batch_sibling_tasks)
 from enum import Enum
-from jars import SHARED
+from jars import SHARED, VERSION_ID
 
 __author__ = 'crosscloud GmbH'
 logger = logging.getLogger(__name__)
 
+#: uploads of files up to that size (in bytes) are combined into batches by the state sync
+SMALL_FILE_SIZE = 256 * 1024
+
+#: seconds the delete of a local file is held back, a create of the same file within that time
+#: is synchronized as a move
+MOVE_DETECTION_WINDOW = 2
+
+#: seconds the size and the modification time of a local file have to be stable before its
+#: events are passed on, a file still being written is not uploaded over and over again
+WRITE_SETTLE_INTERVAL = 2
+#: seconds the events of a local file are held back at most, even if it is still written to
+WRITE_SETTLE_MAX_WAIT = 60
+
 # pylint: disable=invalid-name
 SharedState = namedtuple('SharedState', field_names=['storage_id',
                                                      'share_id',
                                                      'public_shared'])
 
+#: the events of a local file held back until it settled, see :meth:`SyncEngine.storage_create`
+SettlingWrite = namedtuple('SettlingWrite', field_names=['first_seen',
+                                                         'changed',
+                                                         'created',
+                                                         'event_props',
+                                                         'path',
+                                                         'stat'])
+
 
 class SyncEngineState(Enum):
     """Possible states of the SyncEngine.
@@ -64,7 +88,13 @@ class SyncEngine(ThreadingActorPriorityMailbox):
     """
 
     # pylint: disable=too-many-arguments, too-many-public-methods
-    def __init__(self, storage_metrics, task_sink, model=None):
+    def __init__(self, storage_metrics, task_sink, model=None, write_settle_interval=0,
+                 write_settle_max_wait=WRITE_SETTLE_MAX_WAIT):
+        """
+        :param write_settle_interval: seconds the size and the modification time of a local
+            file have to be stable before its events trigger an upload, 0 disables it
+        :param write_settle_max_wait: seconds the events of a local file are held back at most
+        """
         super().__init__(self)
         if model is not None:
             self.root_node = model
@@ -86,6 +116,21 @@ class SyncEngine(ThreadingActorPriorityMailbox):
         #: sync_engine. Be aware of blocking calls etc.
         self.on_node_props_change = Signal()
 
+        #: seconds local deletes are held back for the move detection, 0 disables it
+        self.move_detection_window = MOVE_DETECTION_WINDOW
+        #: tuple(path) -> (deadline, path) of the local deletes held back, oldest first
+        self.pending_deletes = collections.OrderedDict()
+        #: tuple(target path) -> (source path, event props of the create) of the moves issued
+        self.detected_moves = {}
+        #: the local storage, it hashes the local files whose content hash is not known, see
+        #: :meth:`cc.encryption.storage_wrapper.EncryptingFileSystem.get_content_hash`
+        self.local_storage = None
+
+        self.write_settle_interval = write_settle_interval
+        self.write_settle_max_wait = write_settle_max_wait
+        #: tuple(path) -> :class:`SettlingWrite` of the local files possibly still written to
+        self.settling_writes = collections.OrderedDict()
+
     def _handle_failure(self, exception_type, exception_value, traceback):
         logger.error("In the syncengine. NOT shutting down",
                      exc_info=(exception_type, exception_value, traceback))
@@ -195,6 +240,7 @@ class SyncEngine(ThreadingActorPriorityMailbox):
         :param path: the path for the event
         :return:
         """
+        self.flush_pending_deletes()
         normalized_path = normalize_path(path)
         logger.debug("Deletion for %s(%s) from %s", path, normalized_path, storage_id)
 
@@ -205,7 +251,54 @@ class SyncEngine(ThreadingActorPriorityMailbox):
             logger.info("Node does not exist -> nothing to delete")
             return
 
+        if self._is_moving(normalized_path):
+            update_storage_delete(storage_id, del_node)
+            return
+
+        if storage_id == FILESYSTEM_ID:
+            pending = self.settling_writes.pop(tuple(normalized_path), None)
+            fsm = del_node.props.get(SE_FSM)
+            if pending is not None and pending.created and fsm is not None and \
+                    fsm.current == S_UNKNOWN:
+                # created and deleted again before it settled, there is nothing to synchronize
+                logger.debug("%s deleted before it settled", normalized_path)
+                update_storage_delete(storage_id, del_node)
+                if set(del_node.props[STORAGE]) == {storage_id} and not del_node.children:
+                    del_node.delete()
+                return
+
+        if storage_id == FILESYSTEM_ID and self._is_move_candidate(del_node):
+            # might be the first half of a move, see :meth:`storage_create`
+            logger.debug("Holding back the delete of %s to detect a move", normalized_path)
+            self.pending_deletes[tuple(normalized_path)] = \
+                (time.monotonic() + self.move_detection_window, path)
+            return
+
+        self._delete(storage_id, normalized_path, del_node)
+
+    def _delete(self, storage_id, normalized_path, del_node):
+        """Trigger the delete event on `del_node` and all its children."""
+
         logger.debug("Triggering a delete event on %s and all it's children", normalized_path)
+
+        # the delete of a directory removes the whole subtree on the target storage, the
+        # deletes the children issue are settled along with it
+        directory_deletes = {}
+        subtree_deletes = []
+
+        def issue_directory_task(task):
+            """Issue a task of the deleted node, remember its deletes."""
+            if isinstance(task, DeleteSyncTask):
+                directory_deletes[task.target_storage_id] = task
+            self.issue_sync_task(task)
+
+        def issue_subtree_task(task):
+            """Issue a task of a child, deletes are held back."""
+            if isinstance(task, DeleteSyncTask):
+                subtree_deletes.append(task)
+            else:
+                self.issue_sync_task(task)
+
         for node in del_node:
             logger.debug("triggering e_deleted for %s", node.path)
             fsm = self.get_default_fsm(path=node.path)
@@ -214,7 +307,8 @@ class SyncEngine(ThreadingActorPriorityMailbox):
                 try:
                     node.props[STORAGE][storage_id][EVENT_RECEIVED] = True
                     fsm.e_deleted(node=node, storage_id=storage_id,
-                                  task_sink=self.issue_sync_task,
+                                  task_sink=issue_directory_task if node is del_node
+                                  else issue_subtree_task,
                                   event_props={},
                                   csps=[self.storage_metrics])
 
@@ -225,7 +319,19 @@ class SyncEngine(ThreadingActorPriorityMailbox):
                     # won't be deleted properly (see client#933 for more information).
                     logger.debug(
                             "Tried to delete %s from %s which might have already been deleted.",
-                            path, storage_id)
+                            normalized_path, storage_id)
+
+        for task in subtree_deletes:
+            directory_delete = directory_deletes.get(task.target_storage_id)
+            if directory_delete is None:
+                self.issue_sync_task(task)
+            else:
+                directory_delete.subtree_tasks.append(task)
+        for task in directory_deletes.values():
+            if task.subtree_tasks:
+                logger.info("Deleting %s recursively on %s, %d deletes of children are settled "
+                            "with it", normalized_path, task.target_storage_id,
+                            len(task.subtree_tasks))
 
     def storage_create(self, storage_id, path, event_props):
         """
@@ -236,10 +342,20 @@ class SyncEngine(ThreadingActorPriorityMailbox):
         :param path: the path
         :return
         """
+        self.flush_pending_deletes()
         name = path[-1]
         normed_path = normalize_path(path)
         logger.debug("Got create message for %s(%s)", path, normed_path)
 
+        if storage_id == FILESYSTEM_ID and self.pending_deletes:
+            # saved by replacing it, not deleted
+            self.pending_deletes.pop(tuple(normed_path), None)
+            if not event_props.get(IS_DIR, False):
+                source_path = self._find_moved_file(path, normed_path, event_props)
+                if source_path is not None:
+                    self._issue_detected_move(source_path, path, event_props)
+                    return
+
         # Ensure full path structure has entries for the current storage
         # tree nodes need normed path, display name gets unnormalized version.
         curr_path = []
@@ -264,7 +380,11 @@ class SyncEngine(ThreadingActorPriorityMailbox):
                                            storage_id=storage_id,
                                            old_props=old_props,
                                            node=node)
+        if self._is_moving(normed_path):
+            return
         if self.state == SyncEngineState.RUNNING:
+            if self._hold_unsettled_write(storage_id, path, node, event_props, created=True):
+                return
             node.props[STORAGE][storage_id][EVENT_RECEIVED] = True
             fsm.e_created(csps=[self.storage_metrics],
                           node=node,
@@ -299,9 +419,12 @@ class SyncEngine(ThreadingActorPriorityMailbox):
         :param path: the path
         :param event_props event properties of the modify
         """
+        self.flush_pending_deletes()
         name = path[-1]
         normed_path = normalize_path(path)
         logger.debug("Got modify message for %s(%s)", path, normed_path)
+        if storage_id == FILESYSTEM_ID:
+            self.pending_deletes.pop(tuple(normed_path), None)
 
         event_props[DISPLAY_NAME] = name
 
@@ -318,7 +441,11 @@ class SyncEngine(ThreadingActorPriorityMailbox):
                                            old_props=old_props,
                                            node=node)
 
+        if self._is_moving(normed_path):
+            return
         if self.state == SyncEngineState.RUNNING:
+            if self._hold_unsettled_write(storage_id, path, node, event_props, created=False):
+                return
             if SE_FSM in node.props:
                 logging.debug('Triggering e_modified(current state: %s)',
                               node.props[SE_FSM].current)
@@ -331,6 +458,252 @@ class SyncEngine(ThreadingActorPriorityMailbox):
             if SE_FSM in node.props:
                 logging.debug('now in state: %s', node.props[SE_FSM].current)
 
+    def _hold_unsettled_write(self, storage_id, path, node, event_props, created):
+        """Hold back the event of a local file until its size and modification time settled.
+
+        The props of the node are up to date nevertheless, :meth:`flush_settled_writes` passes
+        on the last event once the file has not changed for the `write_settle_interval`.
+
+        :param created: True for a create, a create followed by modifies is passed on as create
+        :return: True if the event is held back
+        """
+        if storage_id != FILESYSTEM_ID or not self.write_settle_interval or \
+                node.props[STORAGE][storage_id].get(IS_DIR, False):
+            return False
+
+        now = time.monotonic()
+        key = tuple(node.path)
+        try:
+            stat = self._stat_local_file(path)
+        except OSError:
+            # deleted already, the delete event follows
+            stat = None
+        pending = self.settling_writes.get(key)
+        if pending is None:
+            logger.debug("Waiting for %s to settle", node.path)
+            self.settling_writes[key] = SettlingWrite(first_seen=now, changed=now,
+                                                      created=created, event_props=event_props,
+                                                      path=path, stat=stat)
+            return True
+
+        changed = pending.changed
+        if (event_props.get(SIZE), event_props.get(MODIFIED_DATE), stat) != \
+                (pending.event_props.get(SIZE), pending.event_props.get(MODIFIED_DATE),
+                 pending.stat):
+            changed = now
+        self.settling_writes[key] = pending._replace(changed=changed, event_props=event_props,
+                                                     path=path, stat=stat)
+        return True
+
+    def _stat_local_file(self, path):
+        """Return the tuple (size, modification time in ns) of the local file at `path`.
+
+        :return: None if there is no local storage to find the file in
+        :raises OSError: if the file is gone
+        """
+        if self.local_storage is None:
+            return None
+        stat = os.stat(self.local_storage.local_path(path))
+        return stat.st_size, stat.st_mtime_ns
+
+    def flush_settled_writes(self, now=None):
+        """Pass on the held back events of the local files which settled.
+
+        A file settled once its size and modification time did not change for the
+        `write_settle_interval` or its events have been held back for the
+        `write_settle_max_wait`. The file itself is checked as well, it might have been written
+        to without an event yet. Called periodically by the link.
+        """
+        if now is None:
+            now = time.monotonic()
+        settled = [key for key, pending in self.settling_writes.items()
+                   if now - pending.changed >= self.write_settle_interval or
+                   now - pending.first_seen >= self.write_settle_max_wait]
+        for key in settled:
+            pending = self.settling_writes.pop(key)
+            path = list(key)
+            try:
+                stat = self._stat_local_file(pending.path)
+            except OSError:
+                logger.info("%s has been deleted before it settled", pending.path)
+                continue
+            try:
+                node = self.root_node.get_node(path)
+                storage = node.props[STORAGE][FILESYSTEM_ID]
+            except KeyError:
+                # its node has been removed, e.g. by a move of its parent, the file is still there
+                logger.info("The node of %s is gone before it settled, creating it again",
+                            pending.path)
+                self.storage_create(storage_id=FILESYSTEM_ID, path=pending.path,
+                                    event_props=pending.event_props)
+                continue
+            if self.state != SyncEngineState.RUNNING:
+                # picked up by the state sync
+                continue
+            if stat != pending.stat and now - pending.first_seen < self.write_settle_max_wait:
+                logger.debug("%s changed without an event, waiting for it to settle", path)
+                self.settling_writes[key] = pending._replace(changed=now, stat=stat)
+                continue
+
+            logger.debug("%s settled after %.1f seconds", path, now - pending.first_seen)
+            fsm = self.get_default_fsm(path=path)
+            storage[EVENT_RECEIVED] = True
+            event = fsm.e_created if pending.created else fsm.e_modified
+            event(csps=[self.storage_metrics],
+                  node=node,
+                  task_sink=self.issue_sync_task,
+                  event_props=pending.event_props,
+                  storage_id=FILESYSTEM_ID)
+
+    def flush_pending_events(self, now=None):
+        """Pass on the held back local deletes and writes which are due."""
+        self.flush_pending_deletes(now)
+        self.flush_settled_writes(now)
+
+    def _is_move_candidate(self, node):
+        """Return True if the delete of the local file `node` might be half of a move.
+
+        Only files in sync with a content hash can be paired with a create. The file is gone
+        already, the hash of a file created locally is kept from its upload, see
+        :meth:`_keep_uploaded_content_hash`.
+        """
+        if not self.move_detection_window or self.state != SyncEngineState.RUNNING or \
+                node.children:
+            return False
+        fsm = node.props.get(SE_FSM)
+        if fsm is None or fsm.current != S_SYNCED:
+            return False
+
+        storages = node.props.get(STORAGE, {})
+        local = storages.get(FILESYSTEM_ID, {})
+        remote = storages.get(self.storage_metrics.storage_id, {})
+        if local.get(IS_DIR, True) or local.get(CONTENT_HASH) is None:
+            return False
+        equivalents = node.props.get('equivalents', {}).get('new', {})
+        return VERSION_ID in remote and \
+            equivalents.get(FILESYSTEM_ID) == local.get(VERSION_ID) and \
+            equivalents.get(self.storage_metrics.storage_id) == remote[VERSION_ID]
+
+    def _is_moving(self, normalized_path):
+        """Return True if `normalized_path` is the source or target of a detected move."""
+        if not self.detected_moves:
+            return False
+        path = tuple(normalized_path)
+        return path in self.detected_moves or \
+            any(tuple(source) == path for source, _ in self.detected_moves.values())
+
+    def _find_moved_file(self, path, normalized_path, event_props):
+        """Return the path of a held back delete of the file created at `path`.
+
+        The size, the modification date and the content hash of the deleted file must match.
+        The created file is hashed if its hash is not known and the size and the modification
+        date of a deleted file match.
+        """
+        content_hash = event_props.get(CONTENT_HASH)
+        for source_path in self.pending_deletes:
+            if list(source_path) == normalized_path:
+                continue
+            try:
+                local = self.root_node.get_node(list(source_path)).props[STORAGE][FILESYSTEM_ID]
+            except KeyError:
+                continue
+            if local.get(SIZE) != event_props.get(SIZE) or \
+                    local.get(MODIFIED_DATE) != event_props.get(MODIFIED_DATE):
+                continue
+            if content_hash is None:
+                content_hash = self._hash_local_file(path)
+                if content_hash is None:
+                    return None
+                event_props[CONTENT_HASH] = content_hash
+            if tuple(local[CONTENT_HASH]) == tuple(content_hash):
+                return list(source_path)
+        return None
+
+    def _hash_local_file(self, path):
+        """Return the content hash of the local file at `path`, None if it can't be hashed."""
+        if self.local_storage is None:
+            return None
+        try:
+            return self.local_storage.get_content_hash(path)
+        except OSError:
+            logger.debug("Can't hash %s", path, exc_info=True)
+            return None
+
+    def _keep_uploaded_content_hash(self, node, task):
+        """Keep the content hash of the local file of `node`, cached while it was uploaded.
+
+        The hash is only kept as long as the file has not been modified since.
+        """
+        local = node.props[STORAGE].get(FILESYSTEM_ID, {})
+        if self.local_storage is None or local.get(CONTENT_HASH) is not None or \
+                local.get(VERSION_ID) != task.source_version_id:
+            return
+        content_hash = self.local_storage.cached_content_hash(task.source_path)
+        if content_hash is not None:
+            local[CONTENT_HASH] = content_hash
+
+    def _issue_detected_move(self, source_path, path, event_props):
+        """Move the remote copy of the file deleted at `source_path` to `path`.
+
+        The events of both nodes are only recorded until the move is acknowledged, see
+        :meth:`_ack_detected_move`.
+        """
+        del self.pending_deletes[tuple(source_path)]
+        remote_id = self.storage_metrics.storage_id
+        source_node = self.root_node.get_node(source_path)
+        update_storage_delete(FILESYSTEM_ID, source_node)
+
+        normed_path = normalize_path(path)
+        curr_path = []
+        for elem in path[:-1]:
+            curr_path.append(normalize_path_element(elem))
+            node = self.root_node.get_node_safe(curr_path)
+            storage = node.props.setdefault(STORAGE, {}).setdefault(FILESYSTEM_ID, {})
+            storage[DISPLAY_NAME] = elem
+        event_props[DISPLAY_NAME] = path[-1]
+        node = self.root_node.get_node_safe(normed_path)
+        self.get_default_fsm(path=normed_path)
+        update_storage_props(FILESYSTEM_ID, node, event_props)
+
+        logger.info("Detected a move of %s to %s", source_path, normed_path)
+        self.detected_moves[tuple(normed_path)] = (source_path, event_props)
+        self.issue_sync_task(MoveSyncTask(
+            path=normed_path,
+            source_storage_id=remote_id,
+            source_path=get_storage_path(source_node, remote_id),
+            target_path=get_storage_path(node, remote_id, FILESYSTEM_ID),
+            source_version_id=source_node.props[STORAGE][remote_id][VERSION_ID]))
+
+    def flush_pending_deletes(self, now=None):
+        """Pass on the local deletes held back longer than the move detection window.
+
+        Called with every event and periodically by the link.
+        """
+        if now is None:
+            now = time.monotonic()
+        while self.pending_deletes:
+            source_path, (deadline, path) = next(iter(self.pending_deletes.items()))
+            if deadline > now:
+                break
+            del self.pending_deletes[source_path]
+            try:
+                del_node = self.root_node.get_node(list(source_path))
+            except KeyError:
+                continue
+            logger.debug("No move of %s detected, deleting it", path)
+            self._delete(FILESYSTEM_ID, list(source_path), del_node)
+
+    def ack_tasks(self, tasks):
+        """Acknowledge a batch of tasks in one turn of the actor.
+
+        :param tasks: the tasks in the order they have been completed
+        """
+        for task in tasks:
+            try:
+                self.ack_task(task)
+            except BaseException:
+                logger.exception('Acknowledging %s failed', task)
+
     def ack_task(self, task):
         """
         Acknowledge a task
@@ -339,9 +712,18 @@ class SyncEngine(ThreadingActorPriorityMailbox):
         """
         logger.debug('acknowledging %s', task)
 
-        if isinstance(task, FetchFileTreeTask):
+        if isinstance(task, BatchSyncTask):
+            self._ack_batch_task(task)
+        elif task.superseded_by is not None:
+            self._ack_superseded_task(task)
+        elif task.rehydrated:
+            self._ack_rehydrated_task(task)
+        elif isinstance(task, FetchFileTreeTask):
             self._ack_fetch_file_tree_task(task)
         else:
+            if isinstance(task, DeleteSyncTask) and task.subtree_tasks:
+                self._ack_subtree_tasks(task)
+
             path = task.path
 
             fsm = self.get_default_fsm(path=path)
@@ -362,6 +744,9 @@ class SyncEngine(ThreadingActorPriorityMailbox):
             elif isinstance(task, CreateDirSyncTask):
                 self._ack_updownload_task(fsm, node, task)
 
+            elif isinstance(task, MoveSyncTask) and tuple(path) in self.detected_moves:
+                self._ack_detected_move(fsm, node, task)
+
             elif isinstance(task, MoveSyncTask):
                 self._ack_move_task(fsm, node, task)
 
@@ -374,6 +759,76 @@ class SyncEngine(ThreadingActorPriorityMailbox):
             else:
                 logger.critical("Ack of task %s not handled", task)
 
+    def _ack_batch_task(self, task):
+        """Acknowledge the tasks of a batch one by one.
+
+        Tasks the batch did not get to take the state of the batch, e.g. if it has been
+        cancelled or the batch call of the storage failed.
+        """
+        for sub_task in task.tasks:
+            if sub_task.state == SyncTask.UNEXECUTED:
+                sub_task.state = task.state
+            self.ack_task(sub_task)
+
+    def _ack_subtree_tasks(self, task):
+        """Settle the deletes of the children of a recursively deleted directory.
+
+        They take the state of the directory delete and are acked deepest first, so no node is
+        removed before its children.
+        """
+        for sub_task in sorted(task.subtree_tasks, key=lambda sub_task: len(sub_task.path),
+                               reverse=True):
+            sub_task.state = task.state
+            try:
+                self.ack_task(sub_task)
+            except BaseException:
+                logger.exception('Acknowledging %s failed', sub_task)
+
+    def _ack_superseded_task(self, task):
+        """Handle a task which was replaced by a newer one before it was executed.
+
+        The node already waits for the replacement, only the metrics reserved for an upload
+        are given back. The deletes of the children settled with a directory delete are
+        handed over to the replacement.
+        """
+        logger.debug('%s has been superseded by %s', task, task.superseded_by)
+        if isinstance(task, DeleteSyncTask):
+            task.superseded_by.subtree_tasks.extend(task.subtree_tasks)
+            task.subtree_tasks = []
+        if isinstance(task, UploadSyncTask) and task.target_storage_id != FILESYSTEM_ID:
+            try:
+                file_size = self.root_node.get_node(task.path).props[STORAGE][FILESYSTEM_ID][SIZE]
+            except KeyError:
+                return
+            self._update_storage_metrics(task.target_storage_id, file_size)
+
+    def _ack_rehydrated_task(self, task):
+        """Handle a task which has been restored from the task journal after a restart.
+
+        No state machine waits for such a task, only the equivalents of a successful transfer
+        are recorded. The state sync (or the next event) then finds the node in sync.
+        """
+        if task.state != SyncTask.SUCCESSFUL:
+            logger.info('Restored task %s did not succeed: %s', task, task.state)
+            return
+
+        try:
+            node = self.root_node.get_node(task.path)
+        except KeyError:
+            logger.info('Node of restored task %s is gone', task)
+            return
+
+        equivalents = node.props.setdefault('equivalents', {})
+        if isinstance(task, DeleteSyncTask):
+            new_equivalents = equivalents.setdefault('new', {})
+            new_equivalents.pop(task.target_storage_id, None)
+            if len(new_equivalents) == 1:
+                equivalents['new'] = {}
+        elif isinstance(task, (UploadSyncTask, DownloadSyncTask, CreateDirSyncTask)):
+            equivalents['old'] = equivalents.get('new', {})
+            equivalents['new'] = {task.source_storage_id: task.source_version_id,
+                                  task.target_storage_id: task.target_version_id}
+
     def _ack_compare_task(self, fsm, node, task):
         if task.state == SyncTask.SUCCESSFUL:
             result = task.equivalents
@@ -460,6 +915,8 @@ class SyncEngine(ThreadingActorPriorityMailbox):
                 equivalents['new'] = {
                     task.source_storage_id: task.source_version_id,
                     task.target_storage_id: task.target_version_id}
+            if task.source_storage_id == FILESYSTEM_ID:
+                self._keep_uploaded_content_hash(node, task)
         else:
             # if upload -> revert metrics updates
             if task.target_storage_id != FILESYSTEM_ID:
@@ -512,6 +969,62 @@ class SyncEngine(ThreadingActorPriorityMailbox):
                                      task_sink=self.issue_sync_task,
                                      csps=[self.storage_metrics])
 
+    def _ack_detected_move(self, fsm, node, task):
+        """Acknowledge the move of a remote copy to the path a local file has been moved to.
+
+        The remote props of the source node are taken over by the moved node, unless the event
+        of the remote move has already been received. If the move failed, the file is uploaded
+        again and the source deleted, just as without the move detection.
+        """
+        source_path, event_props = self.detected_moves.pop(tuple(task.path))
+        remote_id = task.source_storage_id
+        try:
+            source_node = self.root_node.get_node(source_path)
+        except KeyError:
+            source_node = None
+
+        if task.state == SyncTask.SUCCESSFUL and source_node is not None:
+            storages = node.props.setdefault(STORAGE, {})
+            remote = storages.get(remote_id, {})
+            if VERSION_ID not in remote:
+                remote = dict(source_node.props[STORAGE][remote_id])
+                remote.pop('deleted', None)
+                remote[DISPLAY_NAME] = task.target_path[-1]
+                if task.target_version_id is not None:
+                    remote[VERSION_ID] = task.target_version_id
+                storages[remote_id] = remote
+            node.props['equivalents'] = {
+                'new': {FILESYSTEM_ID: storages[FILESYSTEM_ID][VERSION_ID],
+                        remote_id: remote.get(VERSION_ID)},
+                'old': {}}
+
+            # the file is gone at the source on both storages
+            del source_node.props[STORAGE][remote_id]
+            source_node.props['equivalents'] = {'new': {}, 'old': {}}
+            if all(storage.get('deleted') for storage in source_node.props[STORAGE].values()):
+                source_node.delete()
+                source_node = None
+        elif source_node is not None:
+            logger.info("Moving %s failed, uploading it again", task.path)
+
+        if self.state != SyncEngineState.RUNNING:
+            return
+        if source_node is not None:
+            if task.state == SyncTask.SUCCESSFUL:
+                # created again in the meantime
+                self.get_default_fsm(source_path).e_check(
+                    node=source_node, task_sink=self.issue_sync_task,
+                    csps=[self.storage_metrics])
+            else:
+                self._delete(FILESYSTEM_ID, source_path, source_node)
+        if fsm.current == S_UNKNOWN:
+            fsm.e_created(csps=[self.storage_metrics], node=node,
+                          task_sink=self.issue_sync_task, event_props=event_props,
+                          storage_id=FILESYSTEM_ID)
+        else:
+            fsm.e_check(csps=[self.storage_metrics], node=node,
+                        task_sink=self.issue_sync_task)
+
     def _ack_fetch_file_tree_task(self, task):
         """
         Adds the fetched tree model to the local model
@@ -667,8 +1180,13 @@ class SyncEngine(ThreadingActorPriorityMailbox):
                 del storages[storage_id]
 
     def _sync_state(self):
-        """Force an (re-)evaluation of all nodes in the model by triggering the e_check method."""
+        """Force an (re-)evaluation of all nodes in the model by triggering the e_check method.
+
+        The tasks issued are collected, siblings which can be executed together are put on the
+        task sink as batches (see :func:`cc.synctask.batch_sibling_tasks`).
+        """
         logger.debug('Starting state sync')
+        tasks = []
         for node in self.root_node:
             if node.parent is None:
                 # ignore the root
@@ -678,12 +1196,23 @@ class SyncEngine(ThreadingActorPriorityMailbox):
             fsm.current = S_SYNCED
             try:
                 fsm.e_check(csps=[self.storage_metrics],
-                            task_sink=self.task_sink, node=node)
+                            task_sink=tasks.append, node=node)
             except BaseException:
                 logger.exception('State Sync for node %s failed', node.path,
                                  extra={'path': node.path,
                                         'node props': node.props})
-        logger.debug('Done with state sync')
+
+        for task in batch_sibling_tasks(tasks, self._is_small_upload):
+            self.task_sink(task)
+        logger.debug('Done with state sync, issued %d tasks', len(tasks))
+
+    def _is_small_upload(self, task):
+        """Return True if the file of the upload is small enough to be part of a batch."""
+        try:
+            size = self.root_node.get_node(task.path).props[STORAGE][FILESYSTEM_ID][SIZE]
+        except KeyError:
+            return False
+        return size is not None and size <= SMALL_FILE_SIZE
 
     def cancel_all_tasks(self):
         """Try to cancel all SyncTasks for each Node"""
@@ -729,6 +1258,8 @@ def update_storage_props(storage_id, node, props):
         storage_props[SHARED] = props.get(SHARED, False)
         storage_props['share_id'] = props.get('share_id', DELETE)
         storage_props['public_share'] = props.get('public_share', False)
+        # only some storages supply a hash of the content
+        storage_props[CONTENT_HASH] = props.get(CONTENT_HASH, DELETE)
 
         storage_props.pop('deleted', None)
 
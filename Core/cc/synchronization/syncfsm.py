@@ -8,6 +8,7 @@ from copy import deepcopy
 
 import yaml
 
+import cc.crypto2
 import cc.ipc_gui
 from cc import path
 from cc.synctask import (CancelSyncTask, CompareSyncTask, CreateDirSyncTask,
@@ -40,6 +41,8 @@ STORAGE_ID = 'storage_id'
 STORAGE = 'storage'
 IS_DIR = 'is_dir'
 SIZE = 'size'
+#: tuple (algorithm, digest) of the content, if supplied by the storage
+CONTENT_HASH = 'content_hash'
 SHARE_ID = 'share_id'
 PUBLIC_SHARE = 'public_share'
 DISPLAY_NAME = 'display_name'
@@ -183,7 +186,9 @@ def while_issue_download(event):
             target_path=get_storage_path(event.node, FILESYSTEM_ID,
                                          event.source_storage_id),
             original_version_id=event.node.props[STORAGE].get(
-                FILESYSTEM_ID, {}).get('version_id')))
+                FILESYSTEM_ID, {}).get('version_id'),
+            content_hash=event.node.props[STORAGE][event.source_storage_id].get(
+                CONTENT_HASH)))
     else:
         event.task_sink(
             CreateDirSyncTask(path=event.node.path,
@@ -556,11 +561,20 @@ def while_conflicted(event):
     # keep sorted to be deterministic, can be removed with py36
     for csp in sorted(storage):
         storage_path = get_storage_path(event.node, csp)
+        storage_props = event.node.props[STORAGE][csp]
+        size = storage_props.get(SIZE)
+        key_subjects = getattr(storage_props.get('version_id'), 'key_subjects', None)
+        if csp == FILESYSTEM_ID and key_subjects and isinstance(size, int):
+            # the local size is the size of the file once it is encrypted, but the local file
+            # is compared as it is
+            size = cc.crypto2.calc_plaintext_size(size, key_subjects)
         storage_id_paths.append(
             PathWithStorageAndVersion(storage_id=csp,
                                       path=storage_path,
                                       expected_version_id=None,
-                                      is_dir=event.node.props[STORAGE][csp][IS_DIR]))
+                                      is_dir=storage_props[IS_DIR],
+                                      size=size,
+                                      content_hash=storage_props.get(CONTENT_HASH)))
 
     task = CompareSyncTask(event.node.path, storage_id_paths)
     event.task_sink(task)
@@ -0,0 +1,212 @@
+"""Limit the bandwidth used by uploads and downloads.
+
+A large initial sync easily saturates the uplink of an office connection. Every upload and
+download streams through a :class:`cc.synchronization.models.ControlFileWrapper`, which passes
+the number of bytes it has read to the :class:`BandwidthThrottle` of the task queue. The
+throttle keeps a :class:`TokenBucket` per configured limit, a global one per direction and
+optionally one per storage and direction. All workers share the same buckets, so the limits
+apply to the sum of all running transfers.
+
+The limits are configured in bytes per second:
+
+>>> throttle.configure({'upload': 500 * 1024,
+...                     'storages': {'dropbox_1': {'download': 2 * 1024 * 1024}}},
+...                    schedule=[{'start': '22:00', 'end': '06:00'}])
+
+During the periods of the `schedule` the transfers are not throttled at all.
+"""
+import collections
+import datetime
+import logging
+import threading
+import time
+
+from cc.synctask import DownloadSyncTask, UploadSyncTask
+
+logger = logging.getLogger(__name__)
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+DIRECTIONS = (UPLOAD, DOWNLOAD)
+
+#: seconds a throttled transfer sleeps at most before checking if it has been cancelled
+MAX_SLEEP = 0.5
+
+
+class TokenBucket:
+    """Hand out `rate` bytes per second, allowing bursts of up to `burst` bytes.
+
+    A transfer takes the bytes it has already read, which may put the bucket into debt. The
+    transfer then has to wait until the bucket has been refilled. The bucket is not thread safe
+    on its own, :class:`BandwidthThrottle` only calls it while holding its lock.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: bytes per second
+        :param burst: bytes which may be transferred at once, defaults to one second of `rate`
+        """
+        self.rate = None
+        self.burst = None
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate of the bucket, the tokens collected so far are kept."""
+        if rate <= 0:
+            raise ValueError('rate must be positive, not {!r}'.format(rate))
+        self.rate = rate
+        self.burst = burst or rate
+        if self.burst < 1:
+            self.burst = 1
+
+    def take(self, amount, now):
+        """Take `amount` bytes from the bucket.
+
+        :param now: the current :func:`time.monotonic`
+        :return: seconds until the bucket is out of debt
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0, -self.tokens / self.rate)
+
+
+def parse_period(period):
+    """Return the period `{'start': 'HH:MM', 'end': 'HH:MM'}` as tuple of :class:`datetime.time`.
+
+    :raises ValueError: if the times can't be parsed
+    """
+    try:
+        return tuple(datetime.datetime.strptime(period[key], '%H:%M').time()
+                     for key in ('start', 'end'))
+    except (KeyError, TypeError) as error:
+        raise ValueError('invalid period {!r}'.format(period)) from error
+
+
+def in_period(period, at):
+    """Return True if the time `at` is within `period`, which may span midnight."""
+    start, end = period
+    if start <= end:
+        return start <= at < end
+    return at >= start or at < end
+
+
+class BandwidthThrottle:
+    """Make transfers wait if they exceed the global or the per-storage bandwidth limits."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #: (storage_id, direction) -> :class:`TokenBucket`, a storage_id of None is global
+        self.buckets = {}
+        #: tuples of :class:`datetime.time` (start, end), in which transfers are not throttled
+        self.unthrottled_periods = []
+        #: direction -> seconds transfers had to wait
+        self.waited = collections.Counter()
+
+    def set_limit(self, direction, rate, storage_id=None):
+        """Set the bandwidth limit of a direction.
+
+        :param direction: :data:`UPLOAD` or :data:`DOWNLOAD`
+        :param rate: bytes per second, None removes the limit
+        :param storage_id: the storage the limit applies to, None for all transfers
+        """
+        if direction not in DIRECTIONS:
+            raise ValueError('unknown direction {!r}'.format(direction))
+        key = (storage_id, direction)
+        with self.lock:
+            if rate is None:
+                self.buckets.pop(key, None)
+            elif key in self.buckets:
+                self.buckets[key].set_rate(rate)
+            else:
+                self.buckets[key] = TokenBucket(rate)
+        logger.info("Bandwidth limit for %s on '%s' is %s bytes/s", direction,
+                    storage_id or 'all storages', rate)
+
+    def set_schedule(self, periods):
+        """Set the periods in which transfers are not throttled.
+
+        :param periods: list of tuples of :class:`datetime.time` (start, end)
+        """
+        with self.lock:
+            self.unthrottled_periods = list(periods)
+
+    def configure(self, limits, schedule=()):
+        """Replace all limits and the schedule with the configured ones.
+
+        :param limits: dict with the global limits per direction and the limits per storage
+                       under 'storages', see the module documentation
+        :param schedule: list of periods `{'start': 'HH:MM', 'end': 'HH:MM'}` in which
+                         transfers are not throttled
+        :raises ValueError: if the configuration is invalid, nothing is changed in that case
+        """
+        rates = {}
+        for storage_id, storage_limits in [(None, limits)] + \
+                list(limits.get('storages', {}).items()):
+            for direction in DIRECTIONS:
+                rate = storage_limits.get(direction)
+                if rate is not None:
+                    if not isinstance(rate, (int, float)) or rate <= 0:
+                        raise ValueError('invalid {} limit {!r}'.format(direction, rate))
+                    rates[(storage_id, direction)] = rate
+        periods = [parse_period(period) for period in schedule]
+
+        with self.lock:
+            removed = set(self.buckets) - set(rates)
+        for storage_id, direction in removed:
+            self.set_limit(direction, None, storage_id=storage_id)
+        for (storage_id, direction), rate in rates.items():
+            self.set_limit(direction, rate, storage_id=storage_id)
+        self.set_schedule(periods)
+
+    def is_suspended(self, at=None):
+        """Return True if the limits are not enforced at the given time (default: now)."""
+        if at is None:
+            at = datetime.datetime.now().time()
+        return any(in_period(period, at) for period in self.unthrottled_periods)
+
+    @staticmethod
+    def transfer_of(task):
+        """Return the tuple (storage_id, direction) of the transfer done by `task`, or None."""
+        if isinstance(task, UploadSyncTask):
+            return task.target_storage_id, UPLOAD
+        if isinstance(task, DownloadSyncTask):
+            return task.source_storage_id, DOWNLOAD
+        return None
+
+    def consume(self, task, amount):
+        """Account `amount` bytes transferred by `task`, wait if a limit has been exceeded.
+
+        The wait ends early if the task gets cancelled.
+        """
+        transfer = self.transfer_of(task)
+        if transfer is None or not amount:
+            return
+        storage_id, direction = transfer
+
+        with self.lock:
+            buckets = [self.buckets[key] for key in ((None, direction), (storage_id, direction))
+                       if key in self.buckets]
+            if not buckets or self.is_suspended():
+                return
+            now = time.monotonic()
+            delay = max(bucket.take(amount, now) for bucket in buckets)
+            self.waited[direction] += delay
+
+        deadline = now + delay
+        while not task.cancelled:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, MAX_SLEEP))
+
+    @property
+    def statistics(self):
+        """Return the configured limits and the time transfers had to wait."""
+        with self.lock:
+            return {'limits': {'{}:{}'.format(storage_id or '*', direction): bucket.rate
+                               for (storage_id, direction), bucket in self.buckets.items()},
+                    'suspended': self.is_suspended(),
+                    'waited_seconds': dict(self.waited)}
@@ -0,0 +1,253 @@
+"""Measure the throughput of uploads and downloads.
+
+Every transfer streams through a :class:`cc.synchronization.models.ControlFileWrapper`, which
+reports each read to the :class:`TransferMetrics` of the task queue along with the time the
+read took and the time the consumer spent with the previous chunk. For an upload the reads hit
+the local filesystem and the consumer is the provider, for a download it is the other way
+round. From that the metrics keep:
+
+- the bytes and the rate of every running transfer,
+- a moving average of the throughput per storage and direction, summed over all transfers,
+- the time spent in provider calls and in local I/O per storage and direction,
+- the bytes queued per storage and direction and the estimated time to transfer them,
+- the bytes not downloaded at all, since a local file with the same content has been copied.
+"""
+import collections
+import logging
+import threading
+import time
+
+from cc.synchronization.syncfsm import SIZE, STORAGE
+from cc.synchronization.throttle import UPLOAD, BandwidthThrottle
+from cc.synctask import BatchSyncTask
+
+logger = logging.getLogger(__name__)
+
+#: seconds over which the throughput is averaged
+THROUGHPUT_WINDOW = 10
+
+
+def transfer_size(task):
+    """Return the size of the file transferred by `task` according to the model of its link.
+
+    :return: the size in bytes or None if it is not known
+    """
+    try:
+        node = task.link.state.get_node(task.path)
+        size = node.props[STORAGE][task.source_storage_id][SIZE]
+    except (AttributeError, KeyError, TypeError):
+        return None
+    return size if isinstance(size, int) else None
+
+
+class TransferProgress:
+    """The progress of a single queued or running transfer."""
+
+    def __init__(self, task, key, size=None):
+        """
+        :param key: tuple (storage_id, direction) of the transfer
+        :param size: the expected size, only transfers with a size count as queued bytes
+        """
+        self.task = task
+        self.key = key
+        self.size = size
+        #: monotonic time the current attempt started, None while the task is queued
+        self.started = None
+        #: bytes read in all attempts
+        self.bytes_transferred = 0
+        #: bytes read in the current attempt
+        self.attempt_bytes = 0
+
+    @property
+    def remaining(self):
+        """Return the bytes of the transfer which still count as queued."""
+        if not self.size:
+            return 0
+        return max(0, self.size - self.bytes_transferred)
+
+    @property
+    def rate(self):
+        """Return the average rate of the current attempt in bytes per second."""
+        elapsed = time.monotonic() - self.started
+        return self.attempt_bytes / elapsed if elapsed > 0 else 0
+
+
+class StorageThroughput:
+    """Throughput and time split of all transfers of a storage in one direction."""
+
+    def __init__(self, window=THROUGHPUT_WINDOW):
+        self.window = window
+        #: (monotonic time, bytes) of the reads within the window
+        self.samples = collections.deque()
+        # monotonic time of the first sample ever
+        self.first = None
+        self.window_bytes = 0
+        self.total_bytes = 0
+        self.provider_seconds = 0
+        self.local_seconds = 0
+        #: bytes of the pending and running transfers still to be transferred
+        self.queued_bytes = 0
+        #: bytes and files copied from local files instead of transferring them
+        self.deduplicated_bytes = 0
+        self.deduplicated_files = 0
+
+    def _expire(self, now):
+        while self.samples and self.samples[0][0] < now - self.window:
+            _, amount = self.samples.popleft()
+            self.window_bytes -= amount
+
+    def add(self, amount, now):
+        """Add `amount` bytes transferred at `now`."""
+        self._expire(now)
+        if self.first is None:
+            self.first = now
+        self.samples.append((now, amount))
+        self.window_bytes += amount
+        self.total_bytes += amount
+
+    def rate(self, now):
+        """Return the moving average of the throughput in bytes per second."""
+        self._expire(now)
+        if not self.samples:
+            return 0
+        # right after the first transfer started the window is not filled yet
+        span = min(max(now - self.first, 1), self.window)
+        return self.window_bytes / span
+
+
+class TransferMetrics:
+    """Collect the metrics of all transfers of a task queue.
+
+    The bytes are reported by the transfers with :meth:`record`, the queued bytes are tracked
+    with the `task_putted` and `task_acked` signals of the queue, see :meth:`attach`.
+    """
+
+    def __init__(self, window=THROUGHPUT_WINDOW):
+        """
+        :param window: seconds over which the throughput is averaged
+        """
+        self.window = window
+        self.lock = threading.Lock()
+        #: (storage_id, direction) -> :class:`StorageThroughput`
+        self.storages = {}
+        #: id(task) -> :class:`TransferProgress` of the queued and running transfers
+        self.transfers = {}
+
+    def attach(self, task_queue):
+        """Track the queued transfers of `task_queue`."""
+        task_queue.task_putted.connect(self.on_task_putted, weak=False)
+        task_queue.task_acked.connect(self.on_task_acked, weak=False)
+
+    def _storage(self, key):
+        if key not in self.storages:
+            self.storages[key] = StorageThroughput(self.window)
+        return self.storages[key]
+
+    def on_task_putted(self, task):
+        """Add the size of a transfer to the queued bytes of its storage."""
+        if isinstance(task, BatchSyncTask):
+            # the tasks of the batch are sent separately
+            return
+        key = BandwidthThrottle.transfer_of(task)
+        if key is None:
+            return
+        with self.lock:
+            progress = self.transfers.get(id(task))
+            if progress is not None:
+                # put back by a worker, it is queued again
+                progress.started = None
+                return
+        size = transfer_size(task)
+        with self.lock:
+            self.transfers[id(task)] = TransferProgress(task, key, size)
+            self._storage(key).queued_bytes += size or 0
+
+    def on_task_acked(self, task):
+        """Remove a finished transfer, its remaining bytes are no longer queued."""
+        with self.lock:
+            progress = self.transfers.pop(id(task), None)
+            if progress is not None:
+                self._storage(progress.key).queued_bytes -= progress.remaining
+
+    def record(self, task, amount, read_seconds, consumer_seconds):
+        """Record that `task` read `amount` bytes.
+
+        :param read_seconds: time the read took
+        :param consumer_seconds: time since the previous read, the consumer processed the data
+        """
+        key = BandwidthThrottle.transfer_of(task)
+        if key is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            progress = self.transfers.get(id(task))
+            if progress is None:
+                # not put on the queue, e.g. executed directly
+                progress = self.transfers[id(task)] = TransferProgress(task, key)
+            if progress.started is None:
+                progress.started = now
+                progress.attempt_bytes = 0
+
+            storage = self._storage(key)
+            remaining = progress.remaining
+            progress.bytes_transferred += amount
+            progress.attempt_bytes += amount
+            storage.queued_bytes -= remaining - progress.remaining
+            storage.add(amount, now)
+
+            if key[1] == UPLOAD:
+                storage.local_seconds += read_seconds
+                storage.provider_seconds += consumer_seconds
+            else:
+                storage.provider_seconds += read_seconds
+                storage.local_seconds += consumer_seconds
+
+    def record_deduplicated(self, task, amount):
+        """Record that `task` copied `amount` bytes from a local file instead of transferring."""
+        key = BandwidthThrottle.transfer_of(task)
+        if key is None:
+            return
+        with self.lock:
+            storage = self._storage(key)
+            storage.deduplicated_bytes += amount
+            storage.deduplicated_files += 1
+            progress = self.transfers.get(id(task))
+            if progress is not None:
+                # nothing left to transfer
+                storage.queued_bytes -= progress.remaining
+                progress.size = None
+
+    @property
+    def statistics(self):
+        """Return the metrics of the storages and the running transfers."""
+        now = time.monotonic()
+        with self.lock:
+            storages = {}
+            for (storage_id, direction), storage in self.storages.items():
+                rate = storage.rate(now)
+                eta = storage.queued_bytes / rate if rate else None
+                storages.setdefault(storage_id, {})[direction] = {
+                    'bytes_per_second': rate,
+                    'bytes_transferred': storage.total_bytes,
+                    'provider_seconds': storage.provider_seconds,
+                    'local_seconds': storage.local_seconds,
+                    'queued_bytes': storage.queued_bytes,
+                    'eta_seconds': eta,
+                    'deduplicated_bytes': storage.deduplicated_bytes,
+                    'deduplicated_files': storage.deduplicated_files}
+            etas = [direction['eta_seconds'] for directions in storages.values()
+                    for direction in directions.values() if direction['queued_bytes']]
+            running = [{'path': progress.task.path,
+                        'type': type(progress.task).__name__,
+                        'bytes_transferred': progress.bytes_transferred,
+                        'size': progress.size,
+                        'bytes_per_second': progress.rate}
+                       for progress in self.transfers.values()
+                       if progress.started is not None]
+            deduplicated = sum(storage.deduplicated_bytes
+                               for storage in self.storages.values())
+
+        # transfers of different storages and directions run in parallel
+        eta = None if None in etas else max(etas, default=0)
+        return {'storages': storages, 'running': running, 'eta_seconds': eta,
+                'deduplicated_bytes': deduplicated}
@@ -0,0 +1,122 @@
+"""Upload large files in chunks, so a failed upload resumes at the last committed chunk.
+
+A :class:`cc.synctask.UploadSyncTask` of a file larger than :data:`CHUNK_SIZE` to a storage
+supporting upload sessions sends the file in chunks. After every chunk the storage committed,
+the :class:`UploadSession` saves a checkpoint: the id of the session, the bytes committed and
+the header the file has been encrypted with. A later attempt of the same upload, after a
+back-off or a restart, asks the storage how far the session got and continues from there.
+
+The file is encrypted with the same key, initialization vector and header again, so the data
+sent is the same byte by byte. The file key is unwrapped from the header again, the checkpoint
+holds it wrapped only. The encryption continues at the chunk of the committed offset, the
+bytes before are not read again. As the same key and nonces must never encrypt another
+plaintext, a checkpoint is only used for the same version, size and modification date of
+the file.
+
+Storages supporting upload sessions have a true `supports_upload_session` attribute and the
+methods:
+
+- `upload_session_start(path, size)`, returns the id of a new session,
+- `upload_session_offset(session_id)`, returns the bytes committed or None if the session is
+  unknown or expired,
+- `upload_session_append(session_id, offset, data)`, commits `data` at `offset`,
+- `upload_session_finish(session_id, path, original_version_id)`, returns the version id of
+  the uploaded file.
+"""
+import hashlib
+import logging
+import os
+import pickle
+
+import atomicwrites
+
+logger = logging.getLogger(__name__)
+
+#: directory in the configuration directory the checkpoints are kept in
+UPLOAD_SESSION_DIR = 'upload_sessions'
+
+#: bytes sent with one call, files up to that size are uploaded at once
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def supports_upload_session(storage):
+    """Return True if `storage` can upload a file in chunks."""
+    return getattr(storage, 'supports_upload_session', False) is True
+
+
+class UploadSession:
+    """The checkpoint of a chunked upload.
+
+    The checkpoint of an upload is identified by the `key` of the upload, it is only used for
+    the same `version_id` and `file_identity` of the local file.
+    """
+
+    def __init__(self, directory, key, version_id, file_identity=None):
+        """
+        :param directory: the directory of the checkpoints
+        :param key: a tuple identifying the upload, e.g. link, storage and path of the file
+        :param version_id: the version of the local file uploaded
+        :param file_identity: a tuple changing with the content of the local file, e.g. its
+                              size and modification date
+        """
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        self.directory = directory
+        self.location = os.path.join(directory, name + '.session')
+        self.key = key
+        self.version_id = version_id
+        self.file_identity = file_identity
+        self.reset()
+
+    def reset(self):
+        """Start over with a new session."""
+        #: the id of the session on the storage, None until it has been started
+        self.session_id = None
+        #: bytes committed by the storage
+        self.offset = 0
+        #: the header the file has been encrypted with, None if it is not encrypted
+        self.encryption_header = None
+
+    def load(self):
+        """Load the checkpoint of a previous attempt.
+
+        :return: True if there is a checkpoint of the same version
+        """
+        self.reset()
+        try:
+            with open(self.location, 'rb') as file_handle:
+                checkpoint = pickle.load(file_handle)
+        except FileNotFoundError:
+            return False
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            logger.warning("Ignoring corrupt upload session '%s'", self.location, exc_info=True)
+            return False
+
+        if checkpoint.get('key') != self.key or \
+                checkpoint.get('version_id') != self.version_id or \
+                checkpoint.get('file_identity') != self.file_identity or \
+                'encryption_header' not in checkpoint:
+            logger.info("Upload session of %s is outdated, starting over", self.key)
+            return False
+        self.session_id = checkpoint['session_id']
+        self.offset = checkpoint['offset']
+        self.encryption_header = checkpoint['encryption_header']
+        return True
+
+    def save(self):
+        """Save the checkpoint."""
+        os.makedirs(self.directory, exist_ok=True)
+        checkpoint = {'key': self.key,
+                      'version_id': self.version_id,
+                      'session_id': self.session_id,
+                      'file_identity': self.file_identity,
+                      'offset': self.offset,
+                      'encryption_header': self.encryption_header}
+        with atomicwrites.atomic_write(self.location, mode='wb', overwrite=True) as file_handle:
+            pickle.dump(checkpoint, file_handle)
+
+    def discard(self):
+        """Remove the checkpoint."""
+        try:
+            os.remove(self.location)
+        except FileNotFoundError:
+            pass
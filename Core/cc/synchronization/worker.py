@@ -29,11 +29,89 @@ def calculate_waiting_time(num_retries, max_delay=30, delta=10, base=1.5):
     return random.random() * delta + value
 
 
+def unavailable_storage_ids(task, error):
+    """Return the storages which caused `error`, all storages of the task if unknown."""
+    storage_id = getattr(error, 'storage_id', None)
+    if storage_id is not None:
+        return storage_id,
+    return task.involved_storage_ids()
+
+
+def execute_task(task, circuit_breaker=None):
+    """Execute `task` and set its state according to the outcome.
+
+    Errors which might go away by retrying the task later on
+    (:class:`jars.CurrentlyNotPossibleError` and :class:`cc.crypto2.NoKeyError`) are raised, the
+    state of the task is not changed then. So is :class:`jars.UnavailableError` if the circuit
+    of the storage is open, the queue holds the task back until the storage is available.
+
+    :param circuit_breaker: the :class:`cc.synchronization.circuit_breaker.CircuitBreaker` the
+                            availability of the involved storages is reported to, a task
+                            only counts as a success if the storages answered definitely
+    """
+    # pylint: disable=too-many-branches
+    # True once a storage gave a definite answer, the task might have failed nevertheless
+    storage_answered = False
+    try:
+        if task.cancelled:
+            raise SyncTaskCancelledException("Task was cancelled upfront")
+
+        logger.info("Calling 'execute' on Task '%s'", task)
+        task.execute()
+        logger.info("Finished 'execute' on Task '%s'", task)
+        task.state = cc.synctask.SyncTask.SUCCESSFUL
+        storage_answered = True
+    except jars.CurrentlyNotPossibleError as error:
+        if circuit_breaker is not None:
+            for storage_id in unavailable_storage_ids(task, error):
+                circuit_breaker.record_failure(storage_id, task)
+        raise
+    except cc.crypto2.NoKeyError:
+        raise
+    except PolicyError as error:
+        logger.info("PolicyError", exc_info=True)
+        cc.ipc_gui.displayNotification(title='Policy Error', description=error.message)
+        task.state = cc.synctask.SyncTask.INVALID_OPERATION
+    except (jars.InvalidOperationError, FileNotFoundError):
+        logger.info('Failed with invalid operation error, %s', task, exc_info=True)
+        task.state = cc.synctask.SyncTask.INVALID_OPERATION
+        storage_answered = True
+    except jars.VersionIdNotMatchingError:
+        logger.info('Version IDs are not matching for %s', task, exc_info=True)
+        task.state = cc.synctask.SyncTask.VERSION_ID_MISMATCH
+        storage_answered = True
+    except (SyncTaskCancelledException, jars.CancelledException):
+        logger.debug('Task got cancelled', exc_info=True)
+        task.state = cc.synctask.SyncTask.CANCELLED
+    except jars.UnavailableError as error:
+        logger.info("service is unavailable", exc_info=True)
+        if circuit_breaker is not None:
+            storage_ids = unavailable_storage_ids(task, error)
+            for storage_id in storage_ids:
+                circuit_breaker.record_failure(storage_id, task)
+            if circuit_breaker.is_open(storage_ids):
+                raise
+        if hasattr(task, 'state'):
+            task.state = cc.synctask.SyncTask.INVALID_OPERATION
+        return
+    except jars.AuthenticationError:
+        if hasattr(task, 'state'):
+            task.state = cc.synctask.SyncTask.INVALID_AUTHENTICATION
+        logger.info("service is not authenticated", exc_info=True)
+    except BaseException:
+        if hasattr(task, 'state'):
+            task.state = cc.synctask.SyncTask.INVALID_OPERATION
+        logger.warning('Uncatched exception from task, %s', task, exc_info=True)
+
+    if circuit_breaker is not None and storage_answered:
+        circuit_breaker.record_success(task.involved_storage_ids())
+
+
 class Worker(threading.Thread):
     """  class started n-times  """
 
     def __init__(self, ack_sink, task_source, task_sink, wait_delay=0.1,
-                 max_retries=10):
+                 max_retries=10, on_dispatched=None, circuit_breaker=None):
         # pylint: disable=too-many-arguments
         super().__init__(daemon=True)
         self.max_retries = max_retries
@@ -42,9 +120,23 @@ class Worker(threading.Thread):
         self.task_source = task_source
         self.ack_sink = ack_sink
 
+        #: called with the task and the time it took after each dispatch
+        self.on_dispatched = on_dispatched
+
+        #: :class:`cc.synchronization.circuit_breaker.CircuitBreaker` the outcomes are
+        #: reported to
+        self.circuit_breaker = circuit_breaker
+
+        # set if the worker should exit before fetching the next task
+        self.retired = False
+
+    def retire(self):
+        """Let the worker exit once it is done with its current task. (non-blocking)"""
+        self.retired = True
+
     def run(self):
         """Starts an endless loop to acquire sync tasks from the queue."""
-        while True:
+        while not self.retired:
             try:
                 task = self.task_source()
                 if task == STOP_TOKEN:
@@ -58,25 +150,31 @@ class Worker(threading.Thread):
                         self.task_sink(task)
                     else:
                         logger.debug("dispatching task %s", task)
+                        start_time = time.monotonic()
                         self.dispatch(task)
+                        if self.on_dispatched is not None:
+                            self.on_dispatched(task, time.monotonic() - start_time)
             except BaseException:
                 logger.exception('Broad exception caught in worker thread execution')
 
+        if self.retired:
+            logger.debug("retired worker %s", self)
+
     def dispatch(self, task):
         """Call the execute method on the given task and handle errors."""
-        # pylint: disable=too-many-branches,too-many-statements
         try:
-            if task.cancelled:
-                raise SyncTaskCancelledException("Task was cancelled upfront")
-
-            # increment the try counter
-            task.tries += 1
-
-            logger.info("Calling 'execute' on Task '%s'", task)
-            task.execute()
-            logger.info("Finished 'execute' on Task '%s'", task)
-            task.state = cc.synctask.SyncTask.SUCCESSFUL
-        except (jars.CurrentlyNotPossibleError, cc.crypto2.NoKeyError):
+            # increment the try counter, cancelled tasks are not tried at all
+            if not task.cancelled:
+                task.tries += 1
+            execute_task(task, self.circuit_breaker)
+        except (jars.CurrentlyNotPossibleError, jars.UnavailableError, cc.crypto2.NoKeyError):
+            if self.circuit_breaker is not None and \
+                    self.circuit_breaker.is_open(task.involved_storage_ids()):
+                # the queue holds the task back until the storage is available again, that
+                # does not count as a try
+                task.tries -= 1
+                self.task_sink(task)
+                return
             if task.tries >= self.max_retries:
                 logger.info("SyncTask could not be executed! -> failed ", exc_info=True)
                 task.state = cc.synctask.SyncTask.CURRENTLY_NOT_POSSIBLE
@@ -88,30 +186,5 @@ class Worker(threading.Thread):
                             exc_info=True)
                 self.task_sink(task)
                 return
-        except PolicyError as error:
-            logger.info("PolicyError", exc_info=True)
-            cc.ipc_gui.displayNotification(title='Policy Error', description=error.message)
-            task.state = cc.synctask.SyncTask.INVALID_OPERATION
-        except (jars.InvalidOperationError, FileNotFoundError):
-            logger.info('Failed with invalid operation error, %s', task, exc_info=True)
-            task.state = cc.synctask.SyncTask.INVALID_OPERATION
-        except jars.VersionIdNotMatchingError:
-            logger.info('Version IDs are not matching for %s', task, exc_info=True)
-            task.state = cc.synctask.SyncTask.VERSION_ID_MISMATCH
-        except (SyncTaskCancelledException, jars.CancelledException):
-            logger.debug('Task got cancelled', exc_info=True)
-            task.state = cc.synctask.SyncTask.CANCELLED
-        except jars.UnavailableError:
-            if hasattr(task, 'state'):
-                task.state = cc.synctask.SyncTask.INVALID_OPERATION
-            logger.info("service is unavailable", exc_info=True)
-        except jars.AuthenticationError:
-            if hasattr(task, 'state'):
-                task.state = cc.synctask.SyncTask.INVALID_AUTHENTICATION
-            logger.info("service is not authenticated", exc_info=True)
-        except BaseException:
-            if hasattr(task, 'state'):
-                task.state = cc.synctask.SyncTask.INVALID_OPERATION
-            logger.warning('Uncatched exception from task, %s', task, exc_info=True)
 
         self.ack_sink(task)
@@ -1,15 +1,19 @@
 """A Collection of task which can be issued to the worker in order to handle synchronization."""
+import collections
 import contextlib
-import hashlib
 import logging
 import mimetypes
 from collections import namedtuple
 
-from jars.streaming_utils import LimitedFileReader
-
+import cc.crypto2
 import cc.synchronization
-from cc.mime_type_stream import MimeTypeDetectingFileObject
+from cc.mime_type_stream import (MimeTypeDetectingFileObject, PreBufferedFileReader,
+                                 readinto_full)
 from cc.synchronization.exceptions import PolicyError
+from cc.synchronization.partial_download import PartialDownload, supports_ranged_read
+from cc.synchronization.read_ahead import READ_AHEAD_CHUNK_SIZE, ReadAheadReader
+from cc.synchronization.upload_session import (CHUNK_SIZE, UploadSession,
+                                               supports_upload_session)
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +22,11 @@ MIMETYPE_CC_FOLDER = 'application/vdn.crosscloud.folder'
 DEFAULT_MIME_TYPE = 'application/octet-stream'
 STOP_TOKEN = 0xDEADBEEF
 
+#: lane of long running transfers
+BULK_LANE = 'bulk'
+#: lane of short control and metadata tasks, served by reserved workers as well
+CONTROL_LANE = 'control'
+
 __author__ = "crosscloud GmbH"
 
 
@@ -44,6 +53,15 @@ class SyncTask(object):
 
     display_in_ui = False
 
+    #: a pending task of this type is replaced by an equal task put on the queue later on
+    supersedable = False
+
+    #: the lane of the task queue the task is handed out from
+    lane = BULK_LANE
+
+    #: tasks operating below the path of this task are only handed out once it has been acked
+    blocks_children = False
+
     def __init__(self, path):
         self.state = SyncTask.UNEXECUTED
         self.path = path
@@ -52,6 +70,10 @@ class SyncTask(object):
         self.tries = 0
         self.ack_callback = None
         self.link = None
+        #: the task which replaced this one while it was still pending
+        self.superseded_by = None
+        #: the task has been restored from the task journal after a restart
+        self.rehydrated = False
 
     @property
     def mime_type(self):
@@ -75,6 +97,18 @@ class SyncTask(object):
         assert self.link is not None
         return path_hash(self.link.link_id, self.path)
 
+    def operates_on_all(self):
+        """Return the hashables of all link path combinations the task operates on."""
+        return [self.operates_on()]
+
+    def tasks_operating_on(self, path_hash):
+        """Return the tasks operating on `path_hash`, the task itself or parts of a batch."""
+        return [self] if self.operates_on() == path_hash else []
+
+    def involved_storage_ids(self):
+        """Return the ids of all storages the task operates on."""
+        return ()
+
     def __eq__(self, other):
         return isinstance(other, self.__class__) \
                and self.path == other.path
@@ -84,7 +118,11 @@ class SyncTask(object):
 
     def __repr__(self):
         repr = [type(self).__name__]
-        repr.extend(['{}={}'.format(*item) for item in self.__dict__.items()])
+        for name, value in self.__dict__.items():
+            if isinstance(value, list) and value and isinstance(value[0], SyncTask):
+                # batches and recursive deletes might contain thousands of tasks
+                value = '[{} tasks]'.format(len(value))
+            repr.append('{}={}'.format(name, value))
         return '<' + ' '.join(repr) + '>'
 
     def __hash__(self):
@@ -110,6 +148,7 @@ class CopySyncTask(SyncTask):
     """Copy Task as a base class for Uploads, Downloads and CreateDirs."""
 
     display_in_ui = True
+    supersedable = True
 
     def __init__(self, path,
                  target_storage_id,
@@ -148,13 +187,69 @@ class CopySyncTask(SyncTask):
                hash(self.target_storage_id) ^ \
                hash(self.source_storage_id)
 
+    def involved_storage_ids(self):
+        """Return the source and the target storage."""
+        return self.source_storage_id, self.target_storage_id
+
+    def read_ahead(self, file_src, stack, size=None):
+        """Return `file_src` read in advance by a background thread, if enabled for the link.
+
+        Files fitting into a single chunk are returned as they are, there is nothing to overlap.
+
+        :param stack: the :class:`contextlib.ExitStack` `file_src` is closed with, the
+                      read-ahead is stopped before
+        :param size: the size of the file if known
+        """
+        depth = self.link.read_ahead_depth
+        if not depth or (size is not None and size <= READ_AHEAD_CHUNK_SIZE):
+            return file_src
+        return stack.enter_context(contextlib.closing(ReadAheadReader(file_src, depth)))
+
     def execute(self):
         """This is the Baseclass for Up/Download and createDir tasks."""
         super().execute()
 
 
+def read_chunk(file_obj, size):
+    """Read `size` bytes from `file_obj`, less only at the end of the file."""
+    chunk = bytearray(size)
+    del chunk[readinto_full(file_obj, chunk):]
+    return chunk
+
+
+def skip(file_obj, count):
+    """Read and drop the next `count` bytes of `file_obj`.
+
+    :raises IOError: if the file ends before
+    """
+    remaining = count
+    while remaining:
+        read = len(read_chunk(file_obj, min(remaining, CHUNK_SIZE)))
+        if not read:
+            raise IOError('file ended {} bytes before {}'.format(remaining, count))
+        remaining -= read
+
+
+def resume_at(file_obj, offset):
+    """Continue reading the just opened `file_obj` at `offset`.
+
+    An encrypting file object encrypts only the chunk at `offset` again, other seekable files
+    are seeked and the rest are read up to `offset`.
+    """
+    if hasattr(file_obj, 'resume_at'):
+        file_obj.resume_at(offset)
+    elif file_obj.seekable():
+        file_obj.seek(offset)
+    else:
+        skip(file_obj, offset)
+
+
 class UploadSyncTask(CopySyncTask):
-    """Task for uploading file."""
+    """Task for uploading file.
+
+    Files larger than a chunk are uploaded in chunks to storages supporting upload sessions,
+    a later attempt resumes at the last committed chunk, see :meth:`upload_chunked`.
+    """
     DISPLAY_NAME = 'Upload'
 
     def __init__(self, path, target_storage_id,
@@ -168,51 +263,157 @@ class UploadSyncTask(CopySyncTask):
                          source_version_id=source_version_id,
                          source_path=source_path,
                          original_version_id=original_version_id)
+        #: bytes uploaded by previous attempts
+        self.bytes_resumed = 0
 
     def check_mime(self, mime_type: str) -> None:
         """Check if the mime type should be blocked"""
         if mime_type in self.link.client_config.blocked_mime_types:
             raise PolicyError(self.source_path)
 
-    def execute(self):
-        """Perform the actions necessary to upload a resource."""
-        logger.info("Execute 'UploadSyncTask'.")
+    def open_source(self, stack, size=None, session=None):
+        """Open the file to upload and return the arguments for `write` of the target storage.
 
+        :param stack: a :class:`contextlib.ExitStack` the opened file is closed with
+        :param size: the size of the file, if already known
+        :param session: the :class:`cc.synchronization.upload_session.UploadSession` of a
+                        chunked upload, the file is encrypted with its header and read from
+                        its offset on
+        :return: tuple of the keyword arguments for `write` and the
+                 :class:`cc.synchronization.models.ControlFileWrapper` counting the bytes read
+        """
         extension = self.source_path[-1].rsplit('.', 1)
         if extension and extension[-1].casefold() in self.link.client_config.blocked_extensions:
             raise PolicyError(self.source_path)
 
         # open the file from the target storage
-        file_src = self.link.storages[self.source_storage_id].open_read(
-            path=self.source_path,
-            expected_version_id=self.source_version_id)
-
-        with contextlib.closing(file_src) as file_src:
-            # the wrapper makes it possible to cancel the transfer
-            f_control_wrapper = cc.synchronization.models.ControlFileWrapper(file_src, self)
+        open_kwargs = {}
+        if session is not None and session.encryption_header is not None:
+            open_kwargs['encryption_header'] = session.encryption_header
+        file_src = stack.enter_context(contextlib.closing(
+            self.link.storages[self.source_storage_id].open_read(
+                path=self.source_path,
+                expected_version_id=self.source_version_id,
+                **open_kwargs)))
+        if size is None:
+            size = self.link.storages[self.source_storage_id].get_props(self.target_path)['size']
 
+        offset = 0
+        if session is not None:
+            session.encryption_header = getattr(file_src, 'header', None)
+            offset = session.offset
+            # committed already, continuing with the same ciphertext
+            resume_at(file_src, offset)
+        file_src = self.read_ahead(file_src, stack, size - offset)
+
+        # the wrapper makes it possible to cancel and throttle the transfer
+        f_control_wrapper = cc.synchronization.models.ControlFileWrapper(
+            file_src, self, throttle=self.link.throttle, metrics=self.link.transfer_metrics)
+
+        f_wrapper = f_control_wrapper
+        if not offset:
+            # the type has been checked by the attempt which uploaded the beginning
             f_wrapper = MimeTypeDetectingFileObject(f_control_wrapper, self.check_mime)
 
-            size = self.link.storages[self.source_storage_id].get_props(self.target_path)['size']
+        return {'path': self.target_path,
+                'file_obj': f_wrapper,
+                'original_version_id': self.original_version_id,
+                'size': size}, f_control_wrapper
 
-            self.target_version_id = self.link.storages[self.target_storage_id].write(
-                path=self.target_path,
-                file_obj=f_wrapper,
-                original_version_id=self.original_version_id,
-                size=size)
+    def execute(self):
+        """Perform the actions necessary to upload a resource."""
+        logger.info("Execute 'UploadSyncTask'.")
 
+        storage = self.link.storages[self.target_storage_id]
+        size = None
+        if supports_upload_session(storage):
+            props = self.link.storages[self.source_storage_id].get_props(self.target_path)
+            size = props['size']
+            if size > CHUNK_SIZE:
+                self.upload_chunked(storage, size, props.get('modified_date'))
+                assert self.target_version_id is not None
+                return
+
+        with contextlib.ExitStack() as stack:
+            write_args, f_control_wrapper = self.open_source(stack, size)
+            self.target_version_id = storage.write(**write_args)
             self.bytes_transferred = f_control_wrapper.tell()
 
         assert self.target_version_id is not None
 
+    def upload_chunked(self, storage, size, modified_date=None):
+        """Upload the file in chunks, continuing the session of a previous attempt.
+
+        The checkpoint of the session is saved after every committed chunk.
+
+        :param storage: the target storage, supporting upload sessions
+        :param size: the size of the file
+        :param modified_date: the modification date of the file, a checkpoint is only used
+                              for the same size and modification date
+        """
+        session = UploadSession(
+            self.link.upload_session_dir,
+            key=(self.link.link_id, self.target_storage_id, tuple(self.target_path)),
+            version_id=self.source_version_id,
+            file_identity=(size, modified_date))
+        if session.load():
+            offset = storage.upload_session_offset(session.session_id)
+            if offset is None or offset > size:
+                logger.info("Upload session of %s is gone, starting over", self.target_path)
+                session.reset()
+            else:
+                session.offset = offset
+                logger.info("Resuming the upload of %s at %d bytes", self.target_path, offset)
+        if session.session_id is None:
+            session.session_id = storage.upload_session_start(path=self.target_path, size=size)
+        self.bytes_resumed = session.offset
+
+        with contextlib.ExitStack() as stack:
+            try:
+                write_args, f_control_wrapper = self.open_source(stack, size, session)
+            except cc.crypto2.EncryptionException:
+                if not session.offset:
+                    raise
+                logger.info("Can't encrypt %s like before, starting over", self.target_path,
+                            exc_info=True)
+                session.reset()
+                session.session_id = storage.upload_session_start(path=self.target_path,
+                                                                  size=size)
+                self.bytes_resumed = 0
+                write_args, f_control_wrapper = self.open_source(stack, size, session)
+            try:
+                session.save()
+                while True:
+                    chunk = read_chunk(write_args['file_obj'], CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    storage.upload_session_append(session_id=session.session_id,
+                                                  offset=session.offset, data=chunk)
+                    session.offset += len(chunk)
+                    session.save()
+            finally:
+                self.bytes_transferred = f_control_wrapper.tell()
+
+        self.target_version_id = storage.upload_session_finish(
+            session_id=session.session_id,
+            path=self.target_path,
+            original_version_id=self.original_version_id)
+        session.discard()
+
 
 class DownloadSyncTask(CopySyncTask):
-    """Task for downloading file."""
+    """Task for downloading file.
+
+    If the content hash of the file is known and a local file of any link has the same content,
+    the local file is copied instead, see :meth:`copy_local_file`. Downloads from storages
+    supporting ranged reads resume where a previous attempt stopped, see
+    :meth:`fetch_partial`.
+    """
     DISPLAY_NAME = 'Download'
 
     def __init__(self, path, source_storage_id,
                  source_version_id, target_path=None, source_path=None,
-                 original_version_id=None):
+                 original_version_id=None, content_hash=None):
         super().__init__(path=path,
                          target_storage_id=FILESYSTEM_ID,
                          target_version_id=None,
@@ -221,25 +422,126 @@ class DownloadSyncTask(CopySyncTask):
                          source_version_id=source_version_id,
                          source_path=source_path,
                          original_version_id=original_version_id)
+        #: the content hash of the file on the source storage, if it supplies one
+        self.content_hash = content_hash
+        #: bytes copied from a local file instead of downloading them
+        self.bytes_deduplicated = 0
+        #: bytes downloaded by previous attempts
+        self.bytes_resumed = 0
+
+    def copy_local_file(self, stack):
+        """Copy a local file with the content of the download, if there is one.
+
+        :param stack: a :class:`contextlib.ExitStack` the local file is closed with
+        :return: True if the file has been copied
+        """
+        graph = self.link.graph
+        if self.content_hash is None or graph is None:
+            return False
+        found = graph.find_local_copy(self.content_hash)
+        if found is None:
+            return False
+        local_path, local_hash = found
+        try:
+            file_src = stack.enter_context(open(local_path, 'rb'))
+        except OSError:
+            logger.info("Could not open '%s', downloading instead", local_path, exc_info=True)
+            return False
+
+        logger.info("Copying '%s' instead of downloading it", local_path)
+        # cancellable, but neither throttled nor counted as transferred
+        f_wrapper = cc.synchronization.models.ControlFileWrapper(file_src, self)
+        self.target_version_id = self.link.storages[self.target_storage_id].write_copy(
+            path=self.target_path,
+            file_obj=f_wrapper,
+            content_hash=local_hash,
+            original_version_id=self.original_version_id)
+        self.bytes_deduplicated = f_wrapper.tell()
+        if self.link.transfer_metrics is not None:
+            self.link.transfer_metrics.record_deduplicated(self, self.bytes_deduplicated)
+        return True
+
+    def fetch_partial(self, stack):
+        """Download the file into its partial file, continuing a previous attempt.
+
+        :param stack: a :class:`contextlib.ExitStack` the partial file is closed with
+        :return: the :class:`cc.synchronization.partial_download.PartialDownload` and its
+                 complete partial file opened for reading
+        """
+        partial = PartialDownload(
+            self.link.partial_download_dir,
+            key=(self.link.link_id, self.source_storage_id, tuple(self.source_path)),
+            version_id=self.source_version_id)
+        self.bytes_resumed = partial.resume()
+        if self.bytes_resumed:
+            logger.info("Resuming the download of %s at %d bytes", self.source_path,
+                        self.bytes_resumed)
+
+        with contextlib.ExitStack() as fetch_stack:
+            file_src = fetch_stack.enter_context(contextlib.closing(
+                self.link.storages[self.source_storage_id].open_read(
+                    path=self.source_path,
+                    expected_version_id=self.source_version_id,
+                    offset=self.bytes_resumed)))
+            file_src = self.read_ahead(file_src, fetch_stack)
+            f_wrapper = cc.synchronization.models.ControlFileWrapper(
+                file_src, self, throttle=self.link.throttle,
+                metrics=self.link.transfer_metrics)
+            try:
+                partial.fill(f_wrapper)
+            finally:
+                self.bytes_transferred = f_wrapper.tell()
+        return partial, stack.enter_context(partial.open())
 
     def execute(self):
         """ will execute an download """
-        file_src = self.link.storages[self.source_storage_id].open_read(
-            path=self.source_path,
-            expected_version_id=self.source_version_id)
-        with contextlib.closing(file_src) as file_src:
-            f_wrapper = cc.synchronization.models.ControlFileWrapper(file_src, self)
-            self.target_version_id = self.link.storages[self.target_storage_id].write(
-                path=self.target_path,
-                file_obj=f_wrapper,
-                original_version_id=self.original_version_id)
-            self.bytes_transferred = f_wrapper.tell()
+        with contextlib.ExitStack() as stack:
+            if self.copy_local_file(stack):
+                return
+            if supports_ranged_read(self.link.storages[self.source_storage_id]):
+                partial, file_src = self.fetch_partial(stack)
+                try:
+                    self.target_version_id = self.link.storages[self.target_storage_id].write(
+                        path=self.target_path,
+                        file_obj=file_src,
+                        original_version_id=self.original_version_id)
+                finally:
+                    # the download is complete, a failing write starts it over
+                    partial.discard()
+            else:
+                self.download(stack)
+
+        if self.content_hash is not None:
+            # the next download of the same content is copied from this file
+            self.link.storages[self.target_storage_id].add_content_hash_alias(
+                self.target_path, self.content_hash)
+
+    def download(self, stack):
+        """Stream the file from the source storage into the local storage.
+
+        :param stack: a :class:`contextlib.ExitStack` the source file is closed with
+        """
+        file_src = stack.enter_context(contextlib.closing(
+            self.link.storages[self.source_storage_id].open_read(
+                path=self.source_path,
+                expected_version_id=self.source_version_id)))
+        file_src = self.read_ahead(file_src, stack)
+        f_wrapper = cc.synchronization.models.ControlFileWrapper(
+            file_src, self, throttle=self.link.throttle,
+            metrics=self.link.transfer_metrics)
+        self.target_version_id = self.link.storages[self.target_storage_id].write(
+            path=self.target_path,
+            file_obj=f_wrapper,
+            original_version_id=self.original_version_id)
+        self.bytes_transferred = f_wrapper.tell()
 
 
 class CreateDirSyncTask(CopySyncTask):
     """Task for creating directory on storage."""
     DISPLAY_NAME = 'Create Directory'
     display_in_ui = True
+    lane = CONTROL_LANE
+    blocks_children = True
 
     def __init__(self, path, target_storage_id, source_storage_id, target_path=None,
                  source_path=None, target_version_id='is_dir', source_version_id='is_dir',
@@ -268,6 +570,7 @@ class DeleteSyncTask(SyncTask):
     """Task for deleting file on storage."""
     DISPLAY_NAME = 'Delete'
     display_in_ui = True
+    supersedable = True
 
     def __init__(self, path, target_storage_id, original_version_id, target_path=None):
         super().__init__(path)
@@ -277,6 +580,9 @@ class DeleteSyncTask(SyncTask):
         else:
             self.target_path = path
         self.original_version_id = original_version_id
+        #: deletes of the children of a directory, which are done by deleting the directory
+        #: and acked along with this task
+        self.subtree_tasks = []
 
     def __hash__(self):
         return super().__hash__() ^ hash(self.target_storage_id)
@@ -284,6 +590,10 @@ class DeleteSyncTask(SyncTask):
     def __eq__(self, other):
         return super().__eq__(other) and self.target_storage_id == other.target_storage_id
 
+    def involved_storage_ids(self):
+        """Return the storage the item is deleted from."""
+        return self.target_storage_id,
+
     def execute(self):
         """ will be called to execute a delete """
         try:
@@ -323,17 +633,22 @@ class MoveSyncTask(SyncTask):
                self.source_path == other.source_path and \
                self.source_storage_id == other.source_storage_id
 
+    def involved_storage_ids(self):
+        """Return the storage the item is moved on."""
+        return self.source_storage_id,
+
     def execute(self):
         """ will be called to execute a move operation """
         storage = self.link.storages[self.source_storage_id]
-        storage.move(source=self.source_path, target=self.target_path,
-                     expected_source_vid=self.source_version_id)
+        self.target_version_id = storage.move(source=self.source_path, target=self.target_path,
+                                              expected_source_vid=self.source_version_id)
 
 
 class CancelSyncTask(SyncTask):
     """Task for cancelling other task."""
 
     DISPLAY_NAME = 'Cancel'
+    lane = CONTROL_LANE
 
     def __init__(self, path):
         super().__init__(path)
@@ -347,11 +662,30 @@ class CancelSyncTask(SyncTask):
 
 PathWithStorageAndVersion = namedtuple('PathWithStorageAndVersion',
                                        ['storage_id', 'path', 'expected_version_id',
-                                        'is_dir'])
+                                        'is_dir', 'size', 'content_hash'])
+# the size and the content hash (a tuple (algorithm, digest)) are only known for some storages
+PathWithStorageAndVersion.__new__.__defaults__ = (None, None)
+
+#: bytes of every copy compared at once by the CompareSyncTask
+COMPARE_BLOCK_SIZE = 512 * 1024
 
 
 class CompareSyncTask(SyncTask):
-    """This task is intended to compare different files on different csps."""
+    """This task is intended to compare different files on different csps.
+
+    The copies are compared in the following steps, each one only with the copies whose
+    equality is still undecided:
+
+    1. Copies with the same content hash supplied by their storages are equal. The content
+       hashes of local files are taken from the hash cache, if they are cached.
+    2. The copies are opened, encrypted ones are decrypted. Copies of different (plaintext)
+       sizes differ, no more than their header has been read.
+    3. The remaining copies are read block by block, each by a thread of its own. The copies
+       are split up as soon as their blocks differ and a copy is closed as soon as it is known
+       to differ from all others.
+    """
+
+    lane = CONTROL_LANE
 
     def __init__(self, path, storage_id_paths):
         super().__init__(path)
@@ -360,49 +694,131 @@ class CompareSyncTask(SyncTask):
         # iterable of iterable where the inner iterable represent equal files
         self.equivalents = []
 
-    def execute(self):
-        """ compare all files by downloading them and md5hash it, then summarizes """
-        # pylint: disable=redefined-variable-type
+    def involved_storage_ids(self):
+        """Return all storages a copy of the item is compared on."""
+        return tuple(sip.storage_id for sip in self.storage_id_paths or ())
+
+    def content_hash(self, sip):
+        """Return the content hash of the copy `sip`, None if it is not known without reading."""
+        if sip.content_hash is not None:
+            return tuple(sip.content_hash)
+        cached_content_hash = getattr(self.link.storages[sip.storage_id],
+                                      'cached_content_hash', None)
+        if cached_content_hash is None:
+            return None
+        content_hash = cached_content_hash(sip.path)
+        # only tuples are content hashes, storages without a hash cache return None
+        return content_hash if isinstance(content_hash, tuple) else None
+
+    def open_copy(self, sip, stack):
+        """Open the copy `sip` for comparison.
+
+        :param stack: the :class:`contextlib.ExitStack` the copy is closed with
+        :return: tuple of the file object returning the plaintext and the size of the plaintext,
+                 the size is None if it is not known
+        """
+        storage = self.link.storages[sip.storage_id]
+        file_in = stack.enter_context(contextlib.closing(
+            storage.open_read(path=sip.path, expected_version_id=sip.expected_version_id)))
+        size = sip.size if isinstance(sip.size, int) and sip.size > 0 else None
 
-        result = {}
+        try:
+            file_in = cc.crypto2.DecryptionFileWrapper(
+                file_in, self.link.client_config.get_private_key_pem_by_subject)
+            if size is not None:
+                size = file_in.plaintext_size(size)
+        except cc.crypto2.HeaderError as header_error:
+            file_in = PreBufferedFileReader(file_in, pre_buffer=header_error.read_data)
+
+        return file_in, size
+
+    @staticmethod
+    def compare_blocks(groups, file_objs, stacks):
+        """Split up the groups of copies until their blocks differ or all have been read.
+
+        :param groups: lists of indexes of copies which might be equal
+        :param file_objs: the file objects of the copies by index
+        :param stacks: the :class:`contextlib.ExitStack` of every copy, closed as soon as the
+                       copy is known to differ from all others
+        :return: list of lists of the indexes of equal copies
+        """
+        equal = []
+        while groups:
+            undecided = []
+            for group in groups:
+                if len(group) == 1:
+                    # differs from all others, the rest is not needed
+                    equal.append(group)
+                    stacks[group[0]].close()
+                    continue
+
+                copies_by_block = {}
+                for index in group:
+                    block = bytes(read_chunk(file_objs[index], COMPARE_BLOCK_SIZE))
+                    copies_by_block.setdefault(block, []).append(index)
+                for block, copies in copies_by_block.items():
+                    if block:
+                        undecided.append(copies)
+                    else:
+                        # read completely
+                        equal.append(copies)
+            groups = undecided
+        return equal
 
-        # all files
-        file_storage_id_paths = [sip for sip in self.storage_id_paths if not sip.is_dir]
+    def execute(self):
+        """Compare all files and group the equal ones in :attr:`equivalents`."""
+        result = []
 
         # dirs are equivalent anyways
         all_dirs = [sip.storage_id for sip in self.storage_id_paths if sip.is_dir]
         if all_dirs:
-            result['dir'] = all_dirs
-
-        # creates a md5 hash objects to all files
-        open_hashes = [hashlib.md5() for _ in file_storage_id_paths]
-
-        for sip, hash_ in zip(file_storage_id_paths, open_hashes):
-            storage = self.link.storages[sip.storage_id]
-            file_in = storage.open_read(path=sip.path, expected_version_id=sip.expected_version_id)
-
-            try:
-                file_in = cc.crypto2.DecryptionFileWrapper(
-                    file_in, self.link.client_config.get_private_key_pem_by_subject)
-            except cc.crypto2.HeaderError as header_error:
-                file_in = cc.synchronization.models.ControlFileWrapper(
-                    LimitedFileReader(file_in, pre_buffer=header_error.read_data), self)
-
-            while True:
-                buf = file_in.read(1024 * 512)
-                if not buf:
-                    break
-                hash_.update(buf)
-
-        for sip, hash_ in zip(self.storage_id_paths, open_hashes):
-            result.setdefault(hash_.hexdigest(), []).append(sip.storage_id)
-
-        self.equivalents = result.values()
+            result.append(all_dirs)
+
+        # copies with the same content hash are equal, only the first one of them is compared
+        copies = collections.OrderedDict()
+        for sip in self.storage_id_paths:
+            if not sip.is_dir:
+                copies.setdefault(self.content_hash(sip) or sip.storage_id, []).append(sip)
+        representatives = [sips[0] for sips in copies.values()]
+
+        with contextlib.ExitStack() as stack:
+            opened = []
+            groups_by_size = collections.OrderedDict()
+            for index, sip in enumerate(representatives):
+                copy_stack = stack.enter_context(contextlib.ExitStack())
+                file_in, size = self.open_copy(sip, copy_stack)
+                groups_by_size.setdefault(size, []).append(index)
+                opened.append((file_in, copy_stack))
+
+            if None in groups_by_size:
+                # copies of unknown size might be equal to any other
+                groups = [list(range(len(representatives)))]
+            else:
+                groups = list(groups_by_size.values())
+
+            file_objs = {}
+            for index in [index for group in groups if len(group) > 1 for index in group]:
+                file_in, copy_stack = opened[index]
+                # reading ahead in the background reads all copies concurrently
+                file_in = copy_stack.enter_context(contextlib.closing(
+                    ReadAheadReader(file_in, chunk_size=COMPARE_BLOCK_SIZE)))
+                file_objs[index] = cc.synchronization.models.ControlFileWrapper(file_in, self)
+
+            equal = self.compare_blocks(groups, file_objs,
+                                        [copy_stack for _, copy_stack in opened])
+
+        sips_by_copy = list(copies.values())
+        for indexes in equal:
+            result.append([sip.storage_id for index in indexes for sip in sips_by_copy[index]])
+
+        self.equivalents = result
 
 
 class FetchFileTreeTask(SyncTask):
     """Task for fetching file tree of given storage."""
 
+    lane = CONTROL_LANE
+
     def __init__(self, storage_id, path=None):
         if path is None:
             path = []
@@ -418,6 +834,10 @@ class FetchFileTreeTask(SyncTask):
         return super().__eq__(other) and \
                self.storage_id == other.storage_id
 
+    def involved_storage_ids(self):
+        """Return the storage the tree is fetched from."""
+        return self.storage_id,
+
     def execute(self):
         """Will be called to execute a fetch tree operation """
         storage = self.link.storages[self.storage_id]
@@ -434,6 +854,223 @@ class FetchFileTreeTask(SyncTask):
         storage.start_events()
 
 
+class BatchSyncTask(SyncTask):
+    """Base class of tasks executing several tasks of the same kind on siblings at once.
+
+    Storages may implement a batch variant of the operation (see :attr:`batch_method`), which
+    is called with all tasks of the batch at once. Otherwise the tasks are executed one after
+    another by the worker executing the batch. Either way the batch saves the round trips
+    through the task queue, the worker and the sync engine for every single task.
+
+    The tasks of a batch keep their own state. The sync engine acks them one by one once the
+    batch is done, tasks the batch did not get to take the state of the batch.
+    """
+
+    #: name of the method a storage implements to execute the whole batch with one call
+    batch_method = None
+
+    def __init__(self, path, tasks):
+        """
+        :param path: the path of the parent directory of the tasks
+        :param tasks: the tasks to execute, all operating on children of `path`
+        """
+        # set before the link, which is passed on to the tasks
+        self.tasks = list(tasks)
+        super().__init__(path)
+
+    @property
+    def link(self):
+        """The link of the batch and all of its tasks."""
+        return self._link
+
+    @link.setter
+    def link(self, link):
+        self._link = link
+        for task in self.tasks:
+            task.link = link
+
+    def operates_on_all(self):
+        """Return the hashables of the paths of all tasks in the batch."""
+        return [task.operates_on() for task in self.tasks]
+
+    def tasks_operating_on(self, path_hash):
+        """Return the tasks of the batch operating on `path_hash`."""
+        return [task for task in self.tasks if task.operates_on() == path_hash]
+
+    def involved_storage_ids(self):
+        """Return the storages of all tasks in the batch."""
+        storage_ids = []
+        for task in self.tasks:
+            storage_ids.extend(storage_id for storage_id in task.involved_storage_ids()
+                               if storage_id not in storage_ids)
+        return tuple(storage_ids)
+
+    def cancel(self):
+        """Mark the batch and all of its tasks to be cancelled. (non-blocking)"""
+        super().cancel()
+        for task in self.tasks:
+            task.cancel()
+
+    def pending_tasks(self):
+        """Return the tasks which have not been executed yet.
+
+        Tasks which have been cancelled in the meantime are marked as such.
+        """
+        tasks = []
+        for task in self.tasks:
+            if task.state != SyncTask.UNEXECUTED:
+                continue
+            if task.cancelled:
+                task.state = SyncTask.CANCELLED
+                continue
+            tasks.append(task)
+        return tasks
+
+    def execute(self):
+        """Execute the pending tasks, with a single call if the storage supports it."""
+        tasks = self.pending_tasks()
+        storage = self.link.storages[self.target_storage_id]
+        batch_call = getattr(storage, self.batch_method, None)
+        if len(tasks) > 1 and batch_call is not None:
+            logger.info("Executing %d tasks with '%s'", len(tasks), self.batch_method)
+            self.execute_batch(batch_call, tasks)
+        else:
+            self.execute_sequentially(tasks)
+
+    @staticmethod
+    def execute_sequentially(tasks):
+        """Execute the tasks one after another, the way a worker would.
+
+        :class:`jars.CurrentlyNotPossibleError` stops the batch, the worker retries the batch
+        with the tasks which have not been executed yet.
+        """
+        # the worker module imports this one
+        from cc.synchronization.worker import execute_task
+        for task in tasks:
+            task.tries += 1
+            execute_task(task)
+
+    def execute_batch(self, batch_call, tasks):
+        """Execute the tasks with the batch method of the storage."""
+        raise NotImplementedError(
+            "execute_batch not implemented. This should be implemented by the child.")
+
+    @property
+    def target_storage_id(self):
+        """The storage all tasks of the batch write to."""
+        return self.tasks[0].target_storage_id
+
+    @property
+    def mime_type(self):
+        """Batches are not about a single file, use the type of a folder."""
+        return MIMETYPE_CC_FOLDER
+
+
+class BatchCreateDirSyncTask(BatchSyncTask):
+    """Task for creating sibling directories on a storage.
+
+    Storages supporting batches implement `make_dirs(paths)`, which returns the version ids of
+    the created directories in the order of `paths`.
+    """
+    DISPLAY_NAME = 'Create Directories'
+    lane = CONTROL_LANE
+    blocks_children = True
+    batch_method = 'make_dirs'
+
+    def execute_batch(self, batch_call, tasks):
+        """Create all directories with one call."""
+        version_ids = batch_call(paths=[task.target_path for task in tasks])
+        for task, version_id in zip(tasks, version_ids):
+            task.target_version_id = version_id
+            task.state = SyncTask.SUCCESSFUL
+
+
+class BatchUploadSyncTask(BatchSyncTask):
+    """Task for uploading small sibling files.
+
+    Storages supporting batches implement `write_many(files)`, where `files` is a list of the
+    keyword arguments of `write` for every file. It returns the version ids of the written
+    files in the order of `files`.
+    """
+    DISPLAY_NAME = 'Upload Files'
+    batch_method = 'write_many'
+
+    def execute_batch(self, batch_call, tasks):
+        """Open all files and upload them with one call.
+
+        Tasks whose file can't be opened are executed on their own afterwards, which sets
+        their state according to the error.
+        """
+        with contextlib.ExitStack() as stack:
+            prepared = []
+            failed = []
+            for task in tasks:
+                try:
+                    prepared.append((task,) + task.open_source(stack))
+                except BaseException:
+                    logger.info("Can't add '%s' to the batch", task.path, exc_info=True)
+                    failed.append(task)
+
+            if prepared:
+                version_ids = batch_call(files=[write_args for _, write_args, _ in prepared])
+                for (task, _, f_control_wrapper), version_id in zip(prepared, version_ids):
+                    task.target_version_id = version_id
+                    task.bytes_transferred = f_control_wrapper.tell()
+                    task.state = SyncTask.SUCCESSFUL
+
+        self.execute_sequentially(failed)
+
+
+#: task type -> type of the batch combining tasks of that type
+BATCH_TYPES = {CreateDirSyncTask: BatchCreateDirSyncTask,
+               UploadSyncTask: BatchUploadSyncTask}
+
+#: siblings are only combined if there are at least that many of them
+MIN_BATCH_SIZE = 4
+
+#: maximum number of tasks in a batch
+MAX_BATCH_SIZE = 100
+
+
+def batch_sibling_tasks(tasks, is_small_file, min_size=MIN_BATCH_SIZE, max_size=MAX_BATCH_SIZE):
+    """Combine sibling CreateDirSyncTasks and uploads of small files into batches.
+
+    Tasks are combined if they are of the same type, their paths have the same parent and
+    they write to the same storage.
+
+    :param tasks: the tasks in the order they have been issued
+    :param is_small_file: callable returning True if the file of an upload is small enough
+                          to be part of a batch
+    :return: the tasks to put on the queue, a batch takes the position of its first task
+    """
+    groups = {}
+    result = []
+    for task in tasks:
+        batch_type = BATCH_TYPES.get(type(task))
+        if batch_type is None or task.cancelled or \
+                (batch_type is BatchUploadSyncTask and not is_small_file(task)):
+            result.append(task)
+            continue
+
+        key = (batch_type, tuple(task.path[:-1]), task.target_storage_id)
+        group = groups.get(key)
+        if group is None or len(group[1]) >= max_size:
+            group = groups[key] = (batch_type, [])
+            result.append(group)
+        group[1].append(task)
+
+    batched = []
+    for item in result:
+        if not isinstance(item, tuple):
+            batched.append(item)
+        elif len(item[1]) >= min_size:
+            batch_type, group = item
+            batched.append(batch_type(path=group[0].path[:-1], tasks=group))
+        else:
+            batched.extend(item[1])
+    return batched
+
+
 def path_hash(link_id, path):
     """Return a hashable of the link identifier and path combination."""
     return tuple([link_id]) + tuple(path)
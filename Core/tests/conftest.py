@@ -86,6 +86,12 @@ def config(request):
     test_config.share_key_pairs = {}
     test_config.blocked_extensions = set()
     test_config.blocked_mime_types = set()
+    test_config.bandwidth_limits = {}
+    test_config.bandwidth_schedule = []
+    test_config.read_ahead_depth = 2
+    test_config.write_settle_interval = 2
+    test_config.write_settle_max_wait = 60
+    test_config.persistent_task_queue = False
     return test_config
 
 
@@ -7,7 +7,7 @@ import bushn
 
 from cc.encryption.storage_wrapper import EncryptionWrapper, EncryptedVersionTag, \
     get_key_subjects, _has_different_share_id
-from cc.synchronization.syncfsm import STORAGE
+from cc.synchronization.syncfsm import CONTENT_HASH, IS_DIR, STORAGE
 from tests.synchronization.se.conftest import FILESYSTEM_ID
 
 # pylint: disable=protected-access, redefined-outer-name
@@ -371,3 +371,13 @@ def test_encryption_version_tag():
     vid_6 = EncryptedVersionTag(vid_2, False)
     assert vid_6.version_id == version_id
     assert vid_6.key_subjects is False
+
+
+def test_wrap_props_content_hash(encryption_wrapper):
+    """The cached content hash of a file is added to its props, not the one of a directory."""
+    encryption_wrapper.cached_content_hash.return_value = ('md5', 'x')
+    props = EncryptionWrapper.wrap_props(encryption_wrapper, ['path'], {'size': 1, IS_DIR: False})
+    assert props[CONTENT_HASH] == ('md5', 'x')
+
+    props = EncryptionWrapper.wrap_props(encryption_wrapper, ['dir'], {'size': 0, IS_DIR: True})
+    assert CONTENT_HASH not in props
@@ -77,6 +77,7 @@ def link_with_storages():
         'local': mock.Mock(),
         'remote': mock.Mock()
     }
+    link.read_ahead_depth = 0
     return link
 
 
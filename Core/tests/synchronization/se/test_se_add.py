@@ -5,6 +5,7 @@ Test for adding files and directories
 # pylint: disable=unused-import
 import logging
 from datetime import datetime
+from unittest import mock
 
 import pytest
 from jars import VERSION_ID
@@ -184,3 +185,109 @@ def test_modify_while_uploading_downloading(sync_engine_tester, target_storage_i
     sync_engine_tester.assert_expected_tasks(expected_tasks)
 
     assert len(sync_engine_tester.sync_engine.root_node) == 2
+
+
+def test_add_file_settles(sync_engine_tester):
+    """A local file is only uploaded once its size and modification date are stable."""
+    test_path = ['a.txt']
+    sync_engine = sync_engine_tester.sync_engine
+    sync_engine.write_settle_interval = 2
+    sync_engine.write_settle_max_wait = 10
+    sync_engine_tester.init_with_files([])
+
+    with mock.patch('time.monotonic', return_value=100):
+        sync_engine.storage_create(path=test_path, storage_id=FILESYSTEM_ID,
+                                   event_props={VERSION_ID: 1, IS_DIR: False, SIZE: 10})
+    for version_id, now in enumerate([101, 102.5, 103], start=2):
+        with mock.patch('time.monotonic', return_value=now):
+            sync_engine.storage_modify(path=test_path, storage_id=FILESYSTEM_ID,
+                                       event_props={VERSION_ID: version_id, IS_DIR: False,
+                                                    SIZE: version_id * 10})
+    # the last modify did not change the size
+    with mock.patch('time.monotonic', return_value=103.5):
+        sync_engine.storage_modify(path=test_path, storage_id=FILESYSTEM_ID,
+                                   event_props={VERSION_ID: 5, IS_DIR: False, SIZE: 40})
+
+    sync_engine.flush_settled_writes(now=104.5)
+    assert not sync_engine_tester.task_list
+    sync_engine.flush_settled_writes(now=105)
+    sync_engine_tester.assert_expected_tasks([
+        UploadSyncTask(path=test_path, target_storage_id=CSP_1.storage_id,
+                       source_version_id=5)])
+    assert not sync_engine.settling_writes
+
+
+def test_add_file_settle_max_wait(sync_engine_tester):
+    """A file written to all the time is uploaded after the maximum wait, a deleted not at all."""
+    sync_engine = sync_engine_tester.sync_engine
+    sync_engine.write_settle_interval = 2
+    sync_engine.write_settle_max_wait = 10
+    sync_engine_tester.init_with_files([])
+
+    with mock.patch('time.monotonic', return_value=100):
+        sync_engine.storage_create(path=['a.txt'], storage_id=FILESYSTEM_ID,
+                                   event_props={VERSION_ID: 1, IS_DIR: False, SIZE: 10})
+        sync_engine.storage_create(path=['b.txt'], storage_id=FILESYSTEM_ID,
+                                   event_props={VERSION_ID: 1, IS_DIR: False, SIZE: 10})
+        sync_engine.storage_delete(path=['b.txt'], storage_id=FILESYSTEM_ID)
+    for second in range(1, 11):
+        with mock.patch('time.monotonic', return_value=100 + second):
+            sync_engine.storage_modify(path=['a.txt'], storage_id=FILESYSTEM_ID,
+                                       event_props={VERSION_ID: 1 + second, IS_DIR: False,
+                                                    SIZE: 10 + second})
+        sync_engine.flush_settled_writes(now=100 + second)
+
+    sync_engine_tester.assert_expected_tasks([
+        UploadSyncTask(path=['a.txt'], target_storage_id=CSP_1.storage_id,
+                       source_version_id=11)])
+
+
+def test_add_file_settle_stat(sync_engine_tester, tmpdir):
+    """A file written to without an event yet is not uploaded, neither is a deleted one."""
+    sync_engine = sync_engine_tester.sync_engine
+    sync_engine.write_settle_interval = 2
+    sync_engine.write_settle_max_wait = 10
+    sync_engine.local_storage = mock.Mock(local_path=lambda path: str(tmpdir.join(*path)))
+    sync_engine_tester.init_with_files([])
+
+    for name in ['a.txt', 'b.txt']:
+        tmpdir.join(name).write_binary(b'hello')
+        with mock.patch('time.monotonic', return_value=100):
+            sync_engine.storage_create(path=[name], storage_id=FILESYSTEM_ID,
+                                       event_props={VERSION_ID: 1, IS_DIR: False, SIZE: 5})
+    tmpdir.join('a.txt').write_binary(b'hello world')
+    tmpdir.join('b.txt').remove()
+
+    sync_engine.flush_settled_writes(now=102)
+    assert not sync_engine_tester.task_list
+    assert list(sync_engine.settling_writes) == [('a.txt',)]
+
+    sync_engine.flush_settled_writes(now=104)
+    sync_engine_tester.assert_expected_tasks([
+        UploadSyncTask(path=['a.txt'], target_storage_id=CSP_1.storage_id,
+                       source_version_id=1)])
+
+
+def test_add_file_settle_node_gone(sync_engine_tester, tmpdir):
+    """The event of a file whose node is gone while it settled is held back again."""
+    sync_engine = sync_engine_tester.sync_engine
+    sync_engine.write_settle_interval = 2
+    sync_engine.local_storage = mock.Mock(local_path=lambda path: str(tmpdir.join(*path)))
+    sync_engine_tester.init_with_files([])
+
+    tmpdir.join('A.txt').write_binary(b'hello')
+    with mock.patch('time.monotonic', return_value=100):
+        sync_engine.storage_create(path=['A.txt'], storage_id=FILESYSTEM_ID,
+                                   event_props={VERSION_ID: 1, IS_DIR: False, SIZE: 5})
+    sync_engine.root_node.get_node(['a.txt']).delete()
+
+    with mock.patch('time.monotonic', return_value=102):
+        sync_engine.flush_settled_writes(now=102)
+    assert not sync_engine_tester.task_list
+    assert sync_engine.root_node.has_child('a.txt')
+
+    sync_engine.flush_settled_writes(now=104)
+    sync_engine_tester.assert_expected_tasks([
+        UploadSyncTask(path=['a.txt'], target_storage_id=CSP_1.storage_id,
+                       source_version_id=1, target_path=['A.txt'],
+                       source_path=['A.txt'])])
@@ -9,7 +9,7 @@ import pytest
 
 from cc.synctask import CompareSyncTask, MoveSyncTask, \
     PathWithStorageAndVersion, SyncTask
-from .conftest import CSP_1, FILESYSTEM_ID, sync_engine_tester
+from .conftest import CSP_1, FILESYSTEM_ID, MBYTE, sync_engine_tester
 
 __author__ = 'crosscloud GmbH'
 
@@ -35,12 +35,14 @@ def test_conflict_simple(sync_engine_tester, equal):
                                 storage_id=CSP_1.storage_id,
                                 path=test_file,
                                 expected_version_id=None,
-                                is_dir=False),
+                                is_dir=False,
+                                size=MBYTE),
                             PathWithStorageAndVersion(
                                 storage_id=FILESYSTEM_ID,
                                 path=test_file,
                                 expected_version_id=None,
-                                is_dir=False)])]
+                                is_dir=False,
+                                size=MBYTE)])]
 
     sync_engine_tester.assert_expected_tasks(expected_tasks)
 
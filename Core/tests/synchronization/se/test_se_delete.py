@@ -62,14 +62,16 @@ def test_delete_directory(sync_engine_tester):
         storage_id=CSP_1.storage_id,
         path=node_to_test.path)
 
-    expected_tasks = []
-    for child_node in tree:
-        if child_node.parent is not None:
-            expected_tasks.append(DeleteSyncTask(original_version_id=child_node.props[VERSION_ID],
-                                                 path=child_node.path,
-                                                 target_storage_id=FILESYSTEM_ID))
+    # the directory is deleted recursively, the deletes of the children are settled with it
+    expected_task = DeleteSyncTask(original_version_id=node_to_test.props[VERSION_ID],
+                                   path=node_to_test.path, target_storage_id=FILESYSTEM_ID)
+    for child_node in node_to_test:
+        if child_node is not node_to_test:
+            expected_task.subtree_tasks.append(
+                DeleteSyncTask(original_version_id=child_node.props[VERSION_ID],
+                               path=child_node.path, target_storage_id=FILESYSTEM_ID))
 
-    sync_engine_tester.assert_expected_tasks(expected_tasks)
+    sync_engine_tester.assert_expected_tasks([expected_task])
 
     sync_engine_tester.ack_all_tasks()
 
@@ -97,12 +99,20 @@ def test_delete_child_before_parent(sync_engine_tester):
     node_top = next(iter(tree.children))
     node_child = next(iter(node_top))
 
+    # a child deleted on its own gets its own task, the rest is deleted with the directory
     expected_tasks = []
-    for child_node in tree:
-        if child_node.parent is not None:
-            expected_tasks.append(DeleteSyncTask(original_version_id=child_node.props[VERSION_ID],
-                                                 path=child_node.path,
-                                                 target_storage_id=CSP_1.storage_id))
+    if node_child is not node_top:
+        expected_tasks.append(DeleteSyncTask(original_version_id=node_child.props[VERSION_ID],
+                                             path=node_child.path,
+                                             target_storage_id=CSP_1.storage_id))
+    expected_top = DeleteSyncTask(original_version_id=node_top.props[VERSION_ID],
+                                  path=node_top.path, target_storage_id=CSP_1.storage_id)
+    expected_tasks.append(expected_top)
+    for child_node in node_top:
+        if child_node is not node_top and child_node is not node_child:
+            expected_top.subtree_tasks.append(
+                DeleteSyncTask(original_version_id=child_node.props[VERSION_ID],
+                               path=child_node.path, target_storage_id=CSP_1.storage_id))
 
     # ... and delete the child
     sync_engine_tester.sync_engine.storage_delete(
@@ -2,11 +2,21 @@
 Test for moving files and directories
 
 """
+import datetime
+import os
+import time
+from unittest import mock
+
 import pytest
 from jars import VERSION_ID, IS_DIR
 
-from cc.synctask import (DeleteSyncTask, DownloadSyncTask, UploadSyncTask)
-from .conftest import CSP_1, FILESYSTEM_ID
+from cc.synchronization.hash_cache import ContentHashCache
+from cc.synchronization.syncengine import MOVE_DETECTION_WINDOW
+from cc.synchronization.syncfsm import (CONTENT_HASH, MODIFIED_DATE, S_SYNCED, SE_FSM, SIZE,
+                                        STORAGE)
+from cc.synctask import (DeleteSyncTask, DownloadSyncTask, MoveSyncTask, SyncTask,
+                         UploadSyncTask)
+from .conftest import CSP_1, FILESYSTEM_ID, MBYTE
 
 __author__ = 'crosscloud GmbH'
 
@@ -50,3 +60,147 @@ def test_move_file(sync_engine_tester, source_storage_id, target_storage_id):
                            path=source_path, target_storage_id=target_storage_id)]
 
     sync_engine_tester.assert_expected_tasks(expected_tasks)
+
+
+def init_move_detection(sync_engine_tester, content_hash=('md5', 'a')):
+    """Init the sync engine with a synced file `a.txt` whose local content hash is known."""
+    sync_engine_tester.init_with_files([['a.txt']])
+    local = sync_engine_tester.sync_engine.root_node.get_node(['a.txt']).props[STORAGE][
+        FILESYSTEM_ID]
+    local[CONTENT_HASH] = content_hash
+    return local
+
+
+def create_props(local, **props):
+    """Return the props of a create event of a file like the `local` one."""
+    event_props = {VERSION_ID: 5, IS_DIR: False, SIZE: local[SIZE],
+                   MODIFIED_DATE: local[MODIFIED_DATE], CONTENT_HASH: local[CONTENT_HASH]}
+    event_props.update(props)
+    return event_props
+
+
+def test_move_detected(sync_engine_tester):
+    """A local delete followed by a create of the same file is moved on the remote."""
+    sync_engine = sync_engine_tester.sync_engine
+    local = init_move_detection(sync_engine_tester)
+
+    sync_engine.storage_delete(storage_id=FILESYSTEM_ID, path=['a.txt'])
+    assert sync_engine_tester.task_list == []
+    sync_engine.storage_create(storage_id=FILESYSTEM_ID, path=['B.txt'],
+                               event_props=create_props(local))
+
+    move = MoveSyncTask(path=['b.txt'], source_storage_id=CSP_1.storage_id,
+                        source_path=['a.txt'], target_path=['B.txt'], source_version_id=1)
+    sync_engine_tester.assert_expected_tasks([move])
+
+    # the remote event of the move does not trigger anything before the move is acked
+    sync_engine.storage_create(storage_id=CSP_1.storage_id, path=['B.txt'],
+                               event_props={VERSION_ID: 7, IS_DIR: False, SIZE: MBYTE})
+    assert sync_engine_tester.task_list == [move]
+
+    move = sync_engine_tester.task_list[0]
+    move.state = SyncTask.SUCCESSFUL
+    move.target_version_id = 7
+    sync_engine_tester.ack_task(move)
+    sync_engine.storage_delete(storage_id=CSP_1.storage_id, path=['a.txt'])
+
+    assert sync_engine_tester.task_list == []
+    assert not sync_engine.root_node.has_child('a.txt')
+    node = sync_engine.root_node.get_node(['b.txt'])
+    assert node.props[SE_FSM].current == S_SYNCED
+    assert node.props['equivalents']['new'] == {FILESYSTEM_ID: 5, CSP_1.storage_id: 7}
+
+
+def test_move_failed(sync_engine_tester):
+    """The file is uploaded and the source deleted if the move fails."""
+    sync_engine = sync_engine_tester.sync_engine
+    local = init_move_detection(sync_engine_tester)
+
+    sync_engine.storage_delete(storage_id=FILESYSTEM_ID, path=['a.txt'])
+    sync_engine.storage_create(storage_id=FILESYSTEM_ID, path=['b.txt'],
+                               event_props=create_props(local))
+    move, = sync_engine_tester.task_list
+    move.state = SyncTask.VERSION_ID_MISMATCH
+    sync_engine_tester.ack_task(move)
+
+    sync_engine_tester.assert_expected_tasks([
+        DeleteSyncTask(path=['a.txt'], target_storage_id=CSP_1.storage_id,
+                       original_version_id=1),
+        UploadSyncTask(path=['b.txt'], target_storage_id=CSP_1.storage_id,
+                       source_version_id=5)])
+
+
+@pytest.mark.parametrize('props', [{SIZE: 1}, {CONTENT_HASH: ('md5', 'b')},
+                                   {MODIFIED_DATE: datetime.datetime(2017, 1, 1)},
+                                   {CONTENT_HASH: None}])
+def test_move_not_detected(sync_engine_tester, props):
+    """Files differing in size, modification date or content hash are not paired."""
+    sync_engine = sync_engine_tester.sync_engine
+    local = init_move_detection(sync_engine_tester)
+
+    sync_engine.storage_delete(storage_id=FILESYSTEM_ID, path=['a.txt'])
+    sync_engine.storage_create(storage_id=FILESYSTEM_ID, path=['b.txt'],
+                               event_props=create_props(local, **props))
+    sync_engine_tester.assert_expected_tasks([
+        UploadSyncTask(path=['b.txt'], target_storage_id=CSP_1.storage_id,
+                       source_version_id=5)])
+
+    # the delete is passed on once the window is over
+    sync_engine.flush_pending_deletes(now=time.monotonic() + MOVE_DETECTION_WINDOW)
+    sync_engine_tester.assert_expected_tasks([
+        UploadSyncTask(path=['b.txt'], target_storage_id=CSP_1.storage_id,
+                       source_version_id=5),
+        DeleteSyncTask(path=['a.txt'], target_storage_id=CSP_1.storage_id,
+                       original_version_id=1)])
+
+
+def test_replaced_not_deleted(sync_engine_tester):
+    """A file deleted and created at the same path has been replaced, not deleted."""
+    sync_engine = sync_engine_tester.sync_engine
+    local = init_move_detection(sync_engine_tester)
+
+    sync_engine.storage_delete(storage_id=FILESYSTEM_ID, path=['a.txt'])
+    sync_engine.storage_create(storage_id=FILESYSTEM_ID, path=['a.txt'],
+                               event_props=create_props(local, **{CONTENT_HASH: ('md5', 'b')}))
+    sync_engine.flush_pending_deletes(now=time.monotonic() + MOVE_DETECTION_WINDOW)
+
+    sync_engine_tester.assert_expected_tasks([
+        UploadSyncTask(path=['a.txt'], target_storage_id=CSP_1.storage_id,
+                       source_version_id=5, original_version_id=1)])
+
+
+def test_move_of_created_file(sync_engine_tester, tmpdir):
+    """A file created locally keeps the hash of its upload, its move is detected."""
+    sync_engine = sync_engine_tester.sync_engine
+    sync_engine_tester.init_with_files([['c.txt']])
+    cache = ContentHashCache()
+    sync_engine.local_storage = mock.Mock(
+        get_content_hash=lambda path: cache.get(str(tmpdir.join(*path))),
+        cached_content_hash=lambda path: cache.lookup(str(tmpdir.join(*path))))
+
+    tmpdir.join('a.txt').write_binary(b'hello')
+    event_props = {VERSION_ID: 5, IS_DIR: False, SIZE: 5,
+                   MODIFIED_DATE: datetime.datetime.fromtimestamp(tmpdir.join('a.txt').mtime())}
+    sync_engine.storage_create(storage_id=FILESYSTEM_ID, path=['a.txt'],
+                               event_props=dict(event_props))
+    upload, = sync_engine_tester.task_list
+    # hashed while it is read for the upload
+    cache.get(str(tmpdir.join('a.txt')))
+    upload.state = SyncTask.SUCCESSFUL
+    upload.target_version_id = 7
+    sync_engine_tester.ack_task(upload)
+    sync_engine.storage_create(storage_id=CSP_1.storage_id, path=['a.txt'],
+                               event_props={VERSION_ID: 7, IS_DIR: False, SIZE: 5})
+    assert sync_engine_tester.task_list == []
+
+    # the create of the moved file is reported without a hash, it is hashed by the engine
+    os.rename(str(tmpdir.join('a.txt')), str(tmpdir.join('b.txt')))
+    cache.invalidate(str(tmpdir.join('a.txt')))
+    sync_engine.storage_delete(storage_id=FILESYSTEM_ID, path=['a.txt'])
+    assert sync_engine_tester.task_list == []
+    sync_engine.storage_create(storage_id=FILESYSTEM_ID, path=['b.txt'],
+                               event_props=dict(event_props))
+
+    sync_engine_tester.assert_expected_tasks([
+        MoveSyncTask(path=['b.txt'], source_storage_id=CSP_1.storage_id,
+                     source_path=['a.txt'], target_path=['b.txt'], source_version_id=7)])
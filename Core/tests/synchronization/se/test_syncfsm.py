@@ -12,9 +12,11 @@ import requests
 from bushn import Node
 from jars import StorageMetrics
 
+from cc.crypto2 import calc_encrypted_size
+from cc.encryption.storage_wrapper import EncryptedVersionTag
 from cc.synchronization import syncfsm
 from cc.synchronization.syncengine import SyncEngine
-from cc.synchronization.syncfsm import DISPLAY_NAME, FILESYSTEM_ID, SIZE, STORAGE, \
+from cc.synchronization.syncfsm import DISPLAY_NAME, FILESYSTEM_ID, IS_DIR, SIZE, STORAGE, \
     NoStorageForFileException, get_storage_path
 
 from cc.synctask import SyncTask, UploadSyncTask
@@ -324,6 +326,25 @@ def test_on_resolving():
                                             task_sink=event.task_sink)
 
 
+def test_while_conflicted_sizes():
+    """The CompareSyncTask gets the sizes of the copies as they are read."""
+    root = Node(name=None)
+    node = root.add_child('a.txt')
+    node.props[STORAGE] = {
+        FILESYSTEM_ID: {'version_id': EncryptedVersionTag(1, ('user',)), IS_DIR: False,
+                        SIZE: calc_encrypted_size(1000, ('user',))},
+        CSP_1.storage_id: {'version_id': 2, IS_DIR: False, SIZE: 1200,
+                           syncfsm.CONTENT_HASH: ('md5', 'abc')}}
+    event = MagicMock(spec=['task_sink', 'node'])
+    event.node = node
+
+    syncfsm.while_conflicted(event)
+
+    task, = event.task_sink.call_args[0]
+    assert [(sip.size, sip.content_hash) for sip in task.storage_id_paths] == \
+        [(1200, ('md5', 'abc')), (1000, None)]
+
+
 def test_get_storage_path():
     """
     creates a small tree and sees if sync-rule inheritance works
@@ -17,7 +17,8 @@ from cc.synchronization.syncengine import (STORAGE, normalize_path,
                                            SyncEngineState)
 # fixture import
 # pylint: disable=unused-import
-from cc.synctask import CancelSyncTask
+from cc.synctask import (MIN_BATCH_SIZE, BatchCreateDirSyncTask, CancelSyncTask,
+                         CreateDirSyncTask, DeleteSyncTask, SyncTask, UploadSyncTask)
 from .conftest import CSP_1, MBYTE, storage_metrics, storage_model_with_files, sync_engine, \
     sync_engine_tester
 
@@ -85,6 +86,85 @@ def test_sync_state(sync_engine):
             assert hopefully_called_mock.e_check.called
 
 
+def test_sync_state_batches_siblings(sync_engine):
+    """Siblings issued by the state sync are put on the task sink as a batch."""
+    parent = sync_engine.root_node.add_child('parent')
+    for index in range(MIN_BATCH_SIZE):
+        parent.add_child(str(index))
+
+    def e_check(csps, task_sink, node):
+        # pylint: disable=unused-argument
+        task_sink(CreateDirSyncTask(path=node.path, target_storage_id=CSP_1.storage_id,
+                                    source_storage_id=syncfsm.FILESYSTEM_ID))
+
+    sync_engine.get_default_fsm = Mock()
+    sync_engine.get_default_fsm.return_value.e_check.side_effect = e_check
+    sync_engine.task_sink = Mock()
+    sync_engine._sync_state()
+
+    tasks = [args[0] for args, _ in sync_engine.task_sink.call_args_list]
+    assert [type(task) for task in tasks] == [CreateDirSyncTask, BatchCreateDirSyncTask]
+    assert tasks[0].path == ['parent']
+    assert tasks[1].path == ['parent']
+    assert [task.path for task in tasks[1].tasks] == [['parent', str(index)]
+                                                      for index in range(MIN_BATCH_SIZE)]
+
+
+def test_ack_batch_task(sync_engine):
+    """The tasks of a batch are acked one by one, unexecuted ones with the state of the batch."""
+    tasks = [CreateDirSyncTask(path=['a', name], target_storage_id=CSP_1.storage_id,
+                               source_storage_id=syncfsm.FILESYSTEM_ID) for name in 'bc']
+    tasks[0].state = SyncTask.SUCCESSFUL
+    batch = BatchCreateDirSyncTask(path=['a'], tasks=tasks)
+    batch.state = SyncTask.CANCELLED
+    for task in tasks:
+        sync_engine.root_node.get_node_safe(task.path)
+
+    with mock.patch.object(sync_engine, 'ack_task', wraps=sync_engine.ack_task) as ack_task, \
+            mock.patch.object(sync_engine, 'get_default_fsm'), \
+            mock.patch.object(sync_engine, '_ack_updownload_task'):
+        sync_engine.ack_task(batch)
+        assert ack_task.call_args_list == [mock.call(batch)] + [mock.call(task) for task in tasks]
+    assert [task.state for task in tasks] == [SyncTask.SUCCESSFUL, SyncTask.CANCELLED]
+
+
+
+def test_ack_recursive_delete(sync_engine):
+    """The deletes of the children are acked deepest first with the state of the directory."""
+    directory = DeleteSyncTask(path=['a'], target_storage_id=CSP_1.storage_id,
+                               original_version_id=syncfsm.IS_DIR)
+    children = [DeleteSyncTask(path=path, target_storage_id=CSP_1.storage_id,
+                               original_version_id=1)
+                for path in (['a', 'b'], ['a', 'b', 'c'], ['a', 'd'])]
+    directory.subtree_tasks.extend(children)
+    directory.state = SyncTask.SUCCESSFUL
+    for task in children:
+        sync_engine.root_node.get_node_safe(task.path)
+
+    with mock.patch.object(sync_engine, 'ack_task', wraps=sync_engine.ack_task) as ack_task, \
+            mock.patch.object(sync_engine, 'get_default_fsm'), \
+            mock.patch.object(sync_engine, '_ack_delete_task'):
+        sync_engine.ack_task(directory)
+        acked = [call[0][0] for call in ack_task.call_args_list]
+    assert [task.path for task in acked] == [['a'], ['a', 'b', 'c'], ['a', 'b'], ['a', 'd']]
+    assert all(child.state == SyncTask.SUCCESSFUL for child in children)
+
+
+def test_ack_superseded_recursive_delete(sync_engine):
+    """The replacement of a directory delete takes over the deletes of the children."""
+    directory = DeleteSyncTask(path=['a'], target_storage_id=CSP_1.storage_id,
+                               original_version_id=syncfsm.IS_DIR)
+    child = DeleteSyncTask(path=['a', 'b'], target_storage_id=CSP_1.storage_id,
+                           original_version_id=1)
+    directory.subtree_tasks.append(child)
+    replacement = DeleteSyncTask(path=['a'], target_storage_id=CSP_1.storage_id,
+                                 original_version_id=syncfsm.IS_DIR)
+    directory.superseded_by = replacement
+
+    sync_engine.ack_task(directory)
+    assert replacement.subtree_tasks == [child]
+    assert directory.subtree_tasks == []
+
 @pytest.mark.parametrize('node_props', [{},
                                         {syncfsm.STORAGE: {
                                             syncfsm.FILESYSTEM_ID: {'deleted': True}
@@ -335,6 +415,50 @@ def test_cancel_all_tasks(sync_engine_tester):
     sync_engine_tester.assert_expected_tasks(expected_tasks)
 
 
+def test_ack_tasks(sync_engine):
+    """A batch of acks is processed in order, a failing ack does not stop the others."""
+    tasks = [Mock(), Mock(), Mock()]
+    with mock.patch.object(sync_engine, 'ack_task', side_effect=[None, ValueError, None]):
+        sync_engine.ack_tasks(tasks)
+        assert sync_engine.ack_task.call_args_list == [mock.call(task) for task in tasks]
+
+
+def test_ack_superseded_task(sync_engine_tester):
+    """A superseded upload only gives back the reserved space, the node waits for the new one."""
+    test_path = ['hello.txt']
+    sync_engine_tester.init_with_files([test_path])
+    sync_engine_tester.task_list.clear()
+    free_space = sync_engine_tester.storage_metrics.free_space
+    node_props = deepcopy(sync_engine_tester.sync_engine.query(test_path))
+
+    task = UploadSyncTask(test_path, target_storage_id=CSP_1.storage_id, source_version_id=1)
+    task.superseded_by = UploadSyncTask(test_path, target_storage_id=CSP_1.storage_id,
+                                        source_version_id=2)
+    task.state = SyncTask.CANCELLED
+    sync_engine_tester.sync_engine.ack_task(task)
+
+    assert sync_engine_tester.storage_metrics.free_space == free_space + MBYTE
+    assert sync_engine_tester.task_list == []
+    assert sync_engine_tester.sync_engine.query(test_path)[STORAGE] == node_props[STORAGE]
+
+
+def test_ack_rehydrated_task(sync_engine_tester):
+    """A restored upload only records the equivalents, no state machine waits for it."""
+    test_path = ['hello.txt']
+    sync_engine_tester.init_with_files([test_path])
+    sync_engine_tester.task_list.clear()
+
+    task = UploadSyncTask(test_path, target_storage_id=CSP_1.storage_id, source_version_id=2)
+    task.rehydrated = True
+    task.target_version_id = 3
+    task.state = SyncTask.SUCCESSFUL
+    sync_engine_tester.sync_engine.ack_task(task)
+
+    assert sync_engine_tester.task_list == []
+    equivalents = sync_engine_tester.sync_engine.query(test_path)['equivalents']
+    assert equivalents['new'] == {'local': 2, CSP_1.storage_id: 3}
+
+
 @pytest.mark.parametrize('old_state', [SyncEngineState.STATE_SYNC,
                                        SyncEngineState.RUNNING,
                                        SyncEngineState.OFFLINE,
@@ -0,0 +1,61 @@
+"""Tests covering the functionality of cc.synchronization.ack_batcher."""
+import threading
+from unittest import mock
+
+from cc.synchronization.ack_batcher import AckBatcher
+
+
+def test_ack_batcher_flush_by_count():
+    """A full batch is passed on right away."""
+    sink = mock.Mock()
+    batcher = AckBatcher(sink, max_count=3, max_delay=60)
+
+    batcher.ack(1)
+    batcher.ack(2)
+    sink.assert_not_called()
+    batcher.ack(3)
+    sink.assert_called_once_with([1, 2, 3])
+
+    # the timer of the passed on batch does not fire
+    assert batcher.timer is None
+
+
+def test_ack_batcher_flush_by_time():
+    """A batch is passed on after the delay even if it is not full."""
+    passed_on = threading.Event()
+    batches = []
+
+    def sink(batch):
+        batches.append(batch)
+        passed_on.set()
+
+    batcher = AckBatcher(sink, max_count=100, max_delay=0.05)
+    batcher.ack(1)
+    batcher.ack(2)
+    assert passed_on.wait(timeout=5)
+    assert batches == [[1, 2]]
+
+
+def test_ack_batcher_keeps_order():
+    """Acks from several threads are passed on in the order they arrived."""
+    batches = []
+    batcher = AckBatcher(batches.append, max_count=7, max_delay=0.01)
+
+    lock = threading.Lock()
+    acked = []
+
+    def ack_some(offset):
+        for index in range(offset, offset + 100):
+            with lock:
+                acked.append(index)
+                batcher.ack(index)
+
+    threads = [threading.Thread(target=ack_some, args=(offset,)) for offset in (0, 100, 200)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.flush()
+
+    assert [task for batch in batches for task in batch] == acked
+    assert all(len(batch) <= 7 for batch in batches)
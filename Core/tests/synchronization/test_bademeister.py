@@ -1,11 +1,12 @@
 """Tests covering the functionality of cc.sychronization.bademeister."""
 import io
 import logging
+import threading
 import pytest
 import mock
 import cc
 
-from cc.synchronization.bademeister import Bademeister
+from cc.synchronization.bademeister import AdaptivePoolSizer, Bademeister
 from cc.synchronization.worker import Worker
 from cc.synchronization.models import TaskQueue
 
@@ -106,3 +107,131 @@ def test_extension_policy_wrapper():
 
     task2 = cc.synctask.UploadSyncTask(path2, None, None)
     wrapper2 = cc.synchronization.models.PolicyWrapper(f_test, task2, policies)
+
+
+def test_adaptive_sizer_grows_with_backlog():
+    """More tasks waiting than workers available lets the pool grow within its bounds."""
+    sizer = AdaptivePoolSizer(min_size=2, max_size=6, increase=2)
+    assert sizer.recommend(current_size=2, queue_depth=100) == 2
+
+    for _ in range(10):
+        sizer.record(None, 0.1)
+    assert sizer.recommend(current_size=2, queue_depth=100) == 4
+    assert sizer.last_action == 'increase'
+
+    # the maximum is never exceeded
+    assert sizer.recommend(current_size=6, queue_depth=100) == 6
+
+
+def test_adaptive_sizer_shrinks_on_contention():
+    """If more workers only make every task slower, the pool shrinks multiplicatively."""
+    sizer = AdaptivePoolSizer(min_size=2, max_size=24, decrease=0.5)
+    sizer.recommend(current_size=8, queue_depth=100)
+
+    for _ in range(10):
+        sizer.record(None, 0.1)
+    sizer.last_sample -= 1
+    assert sizer.recommend(current_size=8, queue_depth=100) == 10
+
+    # same throughput, but each task took much longer
+    for _ in range(10):
+        sizer.record(None, 1.0)
+    sizer.last_sample -= 1
+    assert sizer.recommend(current_size=10, queue_depth=100) == 5
+    assert sizer.last_action == 'decrease'
+
+
+def test_adaptive_sizer_shrinks_when_idle():
+    """Without waiting tasks one worker after the other is given back."""
+    sizer = AdaptivePoolSizer(min_size=2, max_size=24)
+    sizer.recommend(current_size=3, queue_depth=0)
+    assert sizer.recommend(current_size=3, queue_depth=0) == 2
+    assert sizer.recommend(current_size=2, queue_depth=0) == 2
+
+
+def test_bademeister_adjust_to_admissible_tasks():
+    """Tasks which can't start yet don't let the pool grow."""
+    queue = TaskQueue()
+    queue.limiter.set_limit('remote', 1)
+    for name in 'abcd':
+        task = cc.synctask.UploadSyncTask(path=[name], target_storage_id='remote',
+                                          source_version_id=None)
+        task.link = dummy_link_with_id("local::remote")
+        queue.put_task(task)
+    bademeister = Bademeister(queue=queue, thread_count=2, adaptive=True, min_threads=1,
+                              max_threads=4, adjust_interval=60)
+    bademeister.is_running = True
+    bademeister.sizer.recommend = mock.Mock(return_value=0)
+
+    bademeister.adjust()
+    bademeister.sizer.recommend.assert_called_once_with(0, 1)
+
+
+def test_bademeister_resize():
+    """Resizing starts new workers and retires surplus ones."""
+    queue = TaskQueue()
+    bademeister = Bademeister(queue=queue, thread_count=2, adaptive=True, min_threads=1,
+                              max_threads=4, adjust_interval=60)
+    bademeister.start()
+    assert bademeister.statistics['worker_count'] == 2
+
+    bademeister.resize(4)
+    assert len(bademeister.workers) == 4
+    assert all(worker.is_alive() for worker in bademeister.workers)
+
+    bademeister.resize(1)
+    assert len(bademeister.workers) == 1
+    assert len(bademeister.retired_workers) == 3
+    assert all(worker.retired for worker in bademeister.retired_workers)
+
+    all_workers = bademeister.workers + bademeister.retired_workers + \
+        bademeister.reserved_workers
+    bademeister.stop()
+    assert not bademeister.workers
+    assert not bademeister.retired_workers
+    assert not bademeister.reserved_workers
+
+    # the stop tokens reach every worker, including the retired ones
+    for worker in all_workers:
+        worker.join(timeout=5)
+        assert not worker.is_alive()
+
+
+def test_reserved_workers_not_blocked_by_transfers():
+    """A tree can be fetched while all general workers are busy with transfers."""
+    queue = TaskQueue()
+    bademeister = Bademeister(queue=queue, thread_count=1,
+                              reserved_threads={cc.synctask.CONTROL_LANE: 1})
+    transfer_running = threading.Event()
+    transfer_done = threading.Event()
+    fetched = threading.Event()
+
+    def transfer():
+        transfer_running.set()
+        assert transfer_done.wait(timeout=5)
+
+    upload = cc.synctask.UploadSyncTask(path=['a'], target_storage_id='remote',
+                                        source_version_id=None)
+    upload.execute = transfer
+    waiting_upload = cc.synctask.UploadSyncTask(path=['b'], target_storage_id='remote',
+                                                source_version_id=None)
+    waiting_upload.execute = mock.Mock()
+    fetch = cc.synctask.FetchFileTreeTask(storage_id='remote')
+    fetch.execute = mock.Mock()
+    for task in upload, waiting_upload, fetch:
+        task.link = dummy_link_with_id("local::remote")
+        task.set_ack_callback(mock.Mock())
+    fetch.set_ack_callback(lambda task: fetched.set())
+
+    bademeister.start()
+    try:
+        queue.put_task(upload)
+        assert transfer_running.wait(timeout=5)
+        queue.put_task(waiting_upload)
+        queue.put_task(fetch)
+
+        assert fetched.wait(timeout=5)
+        assert not waiting_upload.execute.called
+    finally:
+        transfer_done.set()
+        bademeister.stop()
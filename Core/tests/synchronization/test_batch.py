@@ -0,0 +1,264 @@
+"""Tests for the batch tasks combining tasks of siblings."""
+import io
+import os
+import threading
+import time
+from unittest import mock
+
+import jars
+import jars.fs
+
+from cc import synctask
+from cc.synchronization.bademeister import Bademeister
+from cc.synchronization.models import TaskQueue
+from cc.synchronization.worker import Worker
+from cc.synctask import (BatchCreateDirSyncTask, BatchUploadSyncTask, CreateDirSyncTask,
+                         SyncTask, UploadSyncTask, batch_sibling_tasks)
+from . import dummy_link_with_id
+
+
+def make_create_dir(*path, target_storage_id='remote'):
+    """Return a CreateDirSyncTask of `path`."""
+    return CreateDirSyncTask(path=list(path), target_storage_id=target_storage_id,
+                             source_storage_id='local')
+
+
+def make_upload(*path, version_id=1):
+    """Return an UploadSyncTask of `path`."""
+    return UploadSyncTask(path=list(path), target_storage_id='remote',
+                          source_version_id=version_id)
+
+
+def link_with_remote(remote):
+    """Return a dummy link with `remote` as remote storage."""
+    link = dummy_link_with_id('local::remote')
+    link.storages = {'local': mock.Mock(), 'remote': remote}
+    link.client_config.blocked_extensions = []
+    link.client_config.blocked_mime_types = []
+    link.read_ahead_depth = 0
+    return link
+
+
+def test_batch_sibling_tasks():
+    """Siblings of the same type and storage are combined if there are enough of them."""
+    dirs = [make_create_dir('a', str(index)) for index in range(5)]
+    other_storage = [make_create_dir('a', str(index), target_storage_id='other')
+                     for index in range(2)]
+    small = [make_upload('b', str(index)) for index in range(4)]
+    large = make_upload('b', 'large')
+    delete = synctask.DeleteSyncTask(path=['a', 'x'], target_storage_id='remote',
+                                     original_version_id=1)
+
+    tasks = [dirs[0], large, delete] + other_storage + dirs[1:] + small
+    batched = batch_sibling_tasks(tasks, is_small_file=lambda task: task is not large)
+
+    assert [type(task) for task in batched] == [BatchCreateDirSyncTask, UploadSyncTask,
+                                                synctask.DeleteSyncTask, CreateDirSyncTask,
+                                                CreateDirSyncTask, BatchUploadSyncTask]
+    assert batched[0].path == ['a']
+    assert batched[0].tasks == dirs
+    assert batched[3:5] == other_storage
+    assert batched[5].path == ['b']
+    assert batched[5].tasks == small
+
+
+def test_batch_sibling_tasks_max_size():
+    """Large groups of siblings are split up."""
+    dirs = [make_create_dir(str(index)) for index in range(9)]
+    batched = batch_sibling_tasks(dirs, is_small_file=None, min_size=2, max_size=4)
+
+    assert [batch.tasks for batch in batched[:2]] == [dirs[:4], dirs[4:8]]
+    assert [batch.path for batch in batched[:2]] == [[], []]
+    assert batched[2] is dirs[8]
+
+
+def test_batch_link():
+    """The link of a batch is the link of all of its tasks."""
+    batch = BatchCreateDirSyncTask(path=['a'], tasks=[make_create_dir('a', 'b'),
+                                                      make_create_dir('a', 'c')])
+    batch.link = dummy_link_with_id('local::remote')
+
+    assert all(task.link is batch.link for task in batch.tasks)
+    assert batch.operates_on_all() == [('local::remote', 'a', 'b'), ('local::remote', 'a', 'c')]
+    assert batch.tasks_operating_on(('local::remote', 'a', 'c')) == [batch.tasks[1]]
+    assert batch.involved_storage_ids() == ('local', 'remote')
+
+
+def test_batch_create_dir_sequential():
+    """Without a batch call the tasks are executed one by one, each with its own state."""
+    remote = mock.Mock(spec=['make_dir'])
+    remote.make_dir.side_effect = ['vid-b', FileNotFoundError, 'vid-d']
+    tasks = [make_create_dir('a', name) for name in 'bcd']
+    batch = BatchCreateDirSyncTask(path=['a'], tasks=tasks)
+    batch.link = link_with_remote(remote)
+
+    batch.execute()
+
+    assert remote.make_dir.call_args_list == [mock.call(path=['a', name]) for name in 'bcd']
+    assert [task.state for task in tasks] == [SyncTask.SUCCESSFUL, SyncTask.INVALID_OPERATION,
+                                              SyncTask.SUCCESSFUL]
+    assert [task.target_version_id for task in tasks] == ['vid-b', 'is_dir', 'vid-d']
+
+
+def test_batch_create_dir_batch_call():
+    """A storage implementing `make_dirs` creates all directories with a single call."""
+    remote = mock.Mock(spec=['make_dir', 'make_dirs'])
+    remote.make_dirs.return_value = ['vid-b', 'vid-d']
+    tasks = [make_create_dir('a', name) for name in 'bcd']
+    tasks[1].cancel()
+    batch = BatchCreateDirSyncTask(path=['a'], tasks=tasks)
+    batch.link = link_with_remote(remote)
+
+    batch.execute()
+
+    remote.make_dirs.assert_called_once_with(paths=[['a', 'b'], ['a', 'd']])
+    assert not remote.make_dir.called
+    assert [task.state for task in tasks] == [SyncTask.SUCCESSFUL, SyncTask.CANCELLED,
+                                              SyncTask.SUCCESSFUL]
+    assert [task.target_version_id for task in tasks] == ['vid-b', 'is_dir', 'vid-d']
+
+
+def test_batch_upload_batch_call():
+    """A storage implementing `write_many` gets all files at once."""
+    written = {}
+
+    def write_many(files):
+        for write_args in files:
+            written[tuple(write_args['path'])] = write_args['file_obj'].read()
+        return ['vid-' + write_args['path'][-1] for write_args in files]
+
+    remote = mock.Mock(spec=['write', 'write_many'])
+    remote.write_many.side_effect = write_many
+    tasks = [make_upload('a', name) for name in ('b.txt', 'c.txt')]
+    batch = BatchUploadSyncTask(path=['a'], tasks=tasks)
+    batch.link = link_with_remote(remote)
+    local = batch.link.storages['local']
+    local.open_read.side_effect = lambda path, expected_version_id: io.BytesIO(b'hello')
+    local.get_props.return_value = {'size': 5}
+
+    batch.execute()
+
+    assert written == {('a', 'b.txt'): b'hello', ('a', 'c.txt'): b'hello'}
+    assert not remote.write.called
+    assert [task.state for task in tasks] == [SyncTask.SUCCESSFUL] * 2
+    assert [task.target_version_id for task in tasks] == ['vid-b.txt', 'vid-c.txt']
+    assert [task.bytes_transferred for task in tasks] == [5, 5]
+
+
+def test_batch_retried_with_pending_tasks():
+    """If a task can't be executed currently, the batch is retried with the remaining tasks."""
+    remote = mock.Mock(spec=['make_dir'])
+    remote.make_dir.side_effect = ['vid-b', jars.CurrentlyNotPossibleError(storage_id='remote'),
+                                   'vid-c', 'vid-d']
+    tasks = [make_create_dir('a', name) for name in 'bcd']
+    batch = BatchCreateDirSyncTask(path=['a'], tasks=tasks)
+    batch.link = link_with_remote(remote)
+
+    ack_sink, task_sink = [], []
+    worker = Worker(ack_sink=ack_sink.append, task_source=None, task_sink=task_sink.append)
+    worker.dispatch(batch)
+    assert task_sink == [batch]
+    assert [task.state for task in tasks] == [SyncTask.SUCCESSFUL, SyncTask.UNEXECUTED,
+                                              SyncTask.UNEXECUTED]
+
+    worker.dispatch(batch)
+    assert ack_sink == [batch]
+    assert batch.state == SyncTask.SUCCESSFUL
+    assert [task.state for task in tasks] == [SyncTask.SUCCESSFUL] * 3
+    assert remote.make_dir.call_args_list[2:] == [mock.call(path=['a', name]) for name in 'cd']
+
+
+def test_cancel_task_in_batch():
+    """A CancelSyncTask only cancels the task of the batch operating on its path."""
+    ack_callback = mock.Mock()
+    task_queue = TaskQueue()
+    acked = []
+    task_queue.task_acked.connect(acked.append, weak=False)
+
+    tasks = [make_create_dir('a', name) for name in 'bc']
+    batch = BatchCreateDirSyncTask(path=['a'], tasks=tasks)
+    batch.link = dummy_link_with_id('local::remote')
+    batch.set_ack_callback(ack_callback)
+    task_queue.put_task(batch)
+    assert task_queue.path_has_tasks(tasks[1].operates_on(), is_dir=False)
+
+    cancel = synctask.CancelSyncTask(path=['a', 'c'])
+    cancel.link = batch.link
+    cancel.set_ack_callback(mock.Mock())
+    task_queue.put_task(cancel)
+    assert not tasks[0].cancelled
+    assert tasks[1].cancelled
+    assert not batch.cancelled
+
+    assert task_queue.get_task(block=False) is batch
+    batch.state = SyncTask.SUCCESSFUL
+    task_queue.ack_task(batch)
+
+    ack_callback.assert_called_once_with(batch)
+    assert acked == tasks + [batch]
+    cancel.ack_callback.assert_called_once_with(cancel)
+    assert not task_queue.path_has_tasks(tasks[1].operates_on(), is_dir=False)
+
+
+def run_tasks(tasks, link):
+    """Let three workers execute `tasks` and return the time it took."""
+    task_queue = TaskQueue()
+    done = threading.Semaphore(0)
+
+    bademeister = Bademeister(task_queue, thread_count=3, reserved_threads={})
+    bademeister.start()
+    try:
+        start = time.time()
+        for task in tasks:
+            task.link = link
+            task.set_ack_callback(lambda task: done.release())
+            task_queue.put_task(task)
+        for _ in tasks:
+            assert done.acquire(timeout=60)
+        return time.time() - start
+    finally:
+        bademeister.stop()
+
+
+def test_batch_benchmark_local_filesystem(tmpdir):
+    """Compare creating directories and uploading small files one by one and in batches.
+
+    The local filesystem storage is used on both sides, it does not implement the batch calls,
+    so the difference is the overhead of the task queue and the workers per task.
+    """
+    count = 300
+    source = tmpdir.mkdir('source')
+    for index in range(count):
+        source.join('files').ensure(str(index)).write('small file {}'.format(index))
+    local = jars.fs.Filesystem(root=str(source), event_sink=mock.Mock(), storage_id='local')
+
+    def make_tasks():
+        tasks = [make_create_dir('dirs', str(index)) for index in range(count)]
+        tasks.extend(make_upload('files', str(index),
+                                 version_id=local.get_props(['files', str(index)])['version_id'])
+                     for index in range(count))
+        return tasks
+
+    timings = {}
+    for mode in 'single', 'batched':
+        target = tmpdir.mkdir(mode)
+        target.mkdir('dirs')
+        target.mkdir('files')
+        remote = jars.fs.Filesystem(root=str(target), event_sink=mock.Mock(),
+                                    storage_id='remote')
+        link = link_with_remote(remote)
+        link.storages = {'local': local, 'remote': remote}
+
+        tasks = make_tasks()
+        if mode == 'batched':
+            queued = batch_sibling_tasks(tasks, is_small_file=lambda task: True)
+        else:
+            queued = tasks
+        timings[mode] = run_tasks(queued, link)
+
+        assert all(task.state == SyncTask.SUCCESSFUL for task in tasks)
+        assert len(os.listdir(str(target.join('dirs')))) == count
+        assert len(os.listdir(str(target.join('files')))) == count
+
+    print('single: {:.0f} tasks/s, batched: {:.0f} tasks/s'.format(
+        2 * count / timings['single'], 2 * count / timings['batched']))
@@ -0,0 +1,200 @@
+"""Tests for the circuit breaker holding back the tasks of unavailable storages."""
+import threading
+import time
+from queue import Empty
+from unittest import mock
+
+import jars
+import pytest
+
+from cc import synctask
+from cc.synchronization.bademeister import Bademeister
+from cc.synchronization.circuit_breaker import CircuitBreaker
+from cc.synchronization.models import TaskQueue
+from cc.synchronization.worker import Worker
+from . import dummy_link_with_id
+
+
+def make_upload(name, storage_id='remote'):
+    """Return an upload of `name` to `storage_id`."""
+    task = synctask.UploadSyncTask(path=[name], target_storage_id=storage_id,
+                                   source_version_id=None)
+    task.link = dummy_link_with_id('local::' + storage_id)
+    task.set_ack_callback(mock.Mock())
+    return task
+
+
+def test_circuit_opens_and_probes():
+    """After enough failures only one probe at a time is let through, a success closes it."""
+    breaker = CircuitBreaker(failure_threshold=3, probe_interval=0.1)
+    breaker.wake_up = mock.Mock()
+    probe, other = make_upload('a'), make_upload('b')
+
+    for _ in range(2):
+        breaker.record_failure('remote', other)
+    assert breaker.admits(other)
+
+    breaker.record_failure('remote', other)
+    assert not breaker.admits(other)
+    assert breaker.admits(make_upload('c', storage_id='other'))
+    assert breaker.statistics == {'remote': {'state': 'open', 'consecutive_failures': 3}}
+
+    time.sleep(0.3)
+    breaker.wake_up.assert_called_once_with()
+    assert breaker.admits(probe)
+    breaker.acquire(probe)
+    assert not breaker.admits(other)
+
+    # a failed probe postpones the next one
+    breaker.record_failure('remote', probe)
+    assert not breaker.admits(other)
+
+    time.sleep(0.3)
+    breaker.acquire(probe)
+    breaker.record_success(probe.involved_storage_ids())
+    assert breaker.admits(other)
+    assert breaker.statistics == {}
+    assert breaker.wake_up.call_count == 3
+
+
+def test_circuit_released_probe():
+    """A probe finishing without an outcome lets the next probe start right away."""
+    breaker = CircuitBreaker(failure_threshold=1, probe_interval=0.05)
+    probe, other = make_upload('a'), make_upload('b')
+    breaker.record_failure('remote', probe)
+
+    time.sleep(0.1)
+    breaker.acquire(probe)
+    assert not breaker.admits(other)
+    assert breaker.release(probe)
+    assert breaker.admits(other)
+
+
+def test_queue_parks_tasks_of_unavailable_storage():
+    """The queue holds back the tasks of a storage with an open circuit."""
+    queue = TaskQueue(circuit_breaker=CircuitBreaker(failure_threshold=1, probe_interval=60))
+    parked, available = make_upload('a'), make_upload('b', storage_id='other')
+    queue.put_task(parked)
+    queue.put_task(available)
+
+    queue.circuit_breaker.record_failure('remote', parked)
+    assert queue.statistics['circuit_breakers']['remote']['state'] == 'open'
+    assert queue.get_task(block=False) is available
+    with pytest.raises(Empty):
+        queue.get_task(block=False)
+
+    # a waiting worker is woken up once the storage is available again
+    timer = threading.Timer(0.1, queue.circuit_breaker.record_success, args=[('remote',)])
+    timer.start()
+    assert queue.get_task(timeout=5) is parked
+    timer.join()
+
+
+def test_queue_keeps_parked_tasks_apart():
+    """Parked tasks are not scanned again until the circuit breaker wakes up the queue."""
+    queue = TaskQueue(circuit_breaker=CircuitBreaker(failure_threshold=1, probe_interval=60))
+    parked = [make_upload(str(index)) for index in range(3)]
+    available = make_upload('b', storage_id='other')
+    for task in parked + [available]:
+        queue.put_task(task)
+    queue.circuit_breaker.record_failure('remote', parked[0])
+
+    assert queue.get_task(block=False) is available
+    assert queue.pending.parked_count() == 3
+    assert queue.pending.qsize() == 3
+    assert queue.pending.queue == parked
+    with mock.patch.object(queue.circuit_breaker, 'holding_back') as holding_back:
+        with pytest.raises(Empty):
+            queue.get_task(block=False)
+    assert not holding_back.called
+
+    # a cancelled task is handed out right away to be acked
+    cancel = synctask.CancelSyncTask(parked[1].path)
+    cancel.link = parked[1].link
+    queue.put_task(cancel)
+    assert queue.get_task(block=False) is parked[1]
+    assert queue.pending.parked_count() == 2
+
+    queue.circuit_breaker.record_success(('remote',))
+    assert queue.pending.parked_count() == 0
+    assert queue.get_task(block=False) is parked[0]
+    assert queue.get_task(block=False) is parked[2]
+
+
+def test_worker_unavailable_task_requeued():
+    """A task failing with an unavailable storage goes back to the queue once it opens."""
+    breaker = CircuitBreaker(failure_threshold=1, probe_interval=60)
+    ack_sink, task_sink = [], []
+    worker = Worker(ack_sink=ack_sink.append, task_source=None, task_sink=task_sink.append,
+                    circuit_breaker=breaker)
+
+    task = make_upload('a')
+    task.execute = mock.Mock(side_effect=jars.UnavailableError('remote', None))
+    worker.dispatch(task)
+
+    assert task_sink == [task]
+    assert not ack_sink
+    assert task.tries == 0
+    assert breaker.is_open(['remote'])
+
+
+def test_worker_parked_task_does_not_count_as_try():
+    """A task failing on a storage with an open circuit goes back to the queue untried."""
+    breaker = CircuitBreaker(failure_threshold=1, probe_interval=60)
+    ack_sink, task_sink = [], []
+    worker = Worker(ack_sink=ack_sink.append, task_source=None, task_sink=task_sink.append,
+                    circuit_breaker=breaker)
+
+    task = make_upload('a')
+    task.execute = mock.Mock(side_effect=jars.CurrentlyNotPossibleError(storage_id='remote'))
+    worker.dispatch(task)
+
+    assert task_sink == [task]
+    assert task.tries == 0
+    assert task.execute_after == 0
+    assert breaker.is_open(['remote'])
+
+    task.execute = mock.Mock()
+    worker.dispatch(task)
+    assert ack_sink == [task]
+    assert task.state == synctask.SyncTask.SUCCESSFUL
+    assert not breaker.is_open(['remote'])
+
+
+def test_circuit_breaker_limits_attempts():
+    """While a storage is down, the backlog is not tried over and over again."""
+    count = 30
+    available = threading.Event()
+    attempts = []
+
+    def execute():
+        attempts.append(time.time())
+        if not available.is_set():
+            raise jars.CurrentlyNotPossibleError(storage_id='remote')
+
+    task_queue = TaskQueue(circuit_breaker=CircuitBreaker(failure_threshold=3,
+                                                          probe_interval=0.1))
+    done = threading.Semaphore(0)
+    task_queue.task_acked.connect(lambda task: done.release(), weak=False)
+    tasks = [make_upload(str(index)) for index in range(count)]
+    for task in tasks:
+        task.execute = execute
+
+    bademeister = Bademeister(task_queue, thread_count=3, reserved_threads={})
+    with mock.patch('cc.synchronization.worker.calculate_waiting_time', return_value=0):
+        bademeister.start()
+        try:
+            for task in tasks:
+                task_queue.put_task(task)
+            time.sleep(0.5)
+            failed_attempts = len(attempts)
+            available.set()
+            for _ in tasks:
+                assert done.acquire(timeout=30)
+        finally:
+            bademeister.stop()
+
+    # a few tasks ran into the failures before the circuit opened, then only probes
+    assert failed_attempts < 15
+    assert all(task.state == synctask.SyncTask.SUCCESSFUL for task in tasks)
+    assert all(task.tries <= 3 for task in tasks)
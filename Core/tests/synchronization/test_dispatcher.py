@@ -0,0 +1,177 @@
+"""Tests covering the functionality of cc.synchronization.dispatcher."""
+import threading
+import time
+from unittest import mock
+
+import blinker
+
+from cc import synctask
+from cc.synchronization.bademeister import Bademeister
+from cc.synchronization.dispatcher import AGGREGATE, SignalDispatcher
+from cc.synchronization.models import TaskQueue
+from . import dummy_link_with_id
+
+
+def make_upload(name, link_id='local::remote'):
+    """Return an upload of `name` which does nothing when executed."""
+    task = synctask.UploadSyncTask(path=[name], target_storage_id='remote',
+                                   source_version_id=None)
+    task.link = dummy_link_with_id(link_id)
+    task.execute = mock.Mock()
+    task.set_ack_callback(mock.Mock())
+    return task
+
+
+def test_dispatcher_delivers_in_order():
+    """Receivers are called in order on the dispatcher thread."""
+    signal = blinker.Signal()
+    dispatcher = SignalDispatcher()
+    received = []
+
+    def receiver(task):
+        received.append((task, threading.current_thread()))
+
+    dispatcher.connect(signal, receiver)
+    tasks = [make_upload(name) for name in 'abc']
+    for task in tasks:
+        signal.send(task)
+
+    assert dispatcher.flush(timeout=5)
+    assert [task for task, _ in received] == tasks
+    assert all(thread is not threading.current_thread() for _, thread in received)
+    assert dispatcher.statistics == {'buffered': 0, 'delivered': 3, 'dropped': 0,
+                                     'aggregated': 0}
+
+
+def test_dispatcher_drops_when_full():
+    """Once the buffer is full, events are dropped instead of blocking the sender."""
+    signal = blinker.Signal()
+    dispatcher = SignalDispatcher(maxsize=2)
+    blocked = threading.Event()
+    received = []
+
+    def receiver(task):
+        received.append(task)
+        blocked.wait(timeout=5)
+
+    dispatcher.connect(signal, receiver)
+    tasks = [make_upload(name) for name in 'abcd']
+    signal.send(tasks[0])
+    # wait until the first event is taken out of the buffer
+    while not received:
+        time.sleep(0.01)
+    for task in tasks[1:]:
+        signal.send(task)
+
+    blocked.set()
+    assert dispatcher.flush(timeout=5)
+    assert received == tasks[:3]
+    assert dispatcher.statistics['dropped'] == 1
+
+
+def test_dispatcher_aggregates_per_path():
+    """Only the latest event per path is delivered, it moves to the end of the buffer."""
+    signal = blinker.Signal()
+    dispatcher = SignalDispatcher()
+    blocked = threading.Event()
+    received = []
+
+    def receiver(task):
+        received.append(task)
+        blocked.wait(timeout=5)
+
+    dispatcher.connect(signal, receiver, policy=AGGREGATE)
+    first = make_upload('first')
+    signal.send(first)
+    while not received:
+        time.sleep(0.01)
+
+    old_a, b, new_a = make_upload('a'), make_upload('b'), make_upload('a')
+    for task in old_a, b, new_a, synctask.STOP_TOKEN:
+        signal.send(task)
+
+    blocked.set()
+    assert dispatcher.flush(timeout=5)
+    assert received == [first, b, new_a, synctask.STOP_TOKEN]
+    assert dispatcher.statistics['aggregated'] == 1
+
+
+def test_dispatcher_survives_failing_receiver():
+    """An exception in a receiver does not stop the delivery of other events."""
+    signal = blinker.Signal()
+    dispatcher = SignalDispatcher()
+    received = []
+    dispatcher.connect(signal, mock.Mock(side_effect=ValueError))
+    dispatcher.connect(signal, received.append)
+
+    task = make_upload('a')
+    signal.send(task)
+    assert dispatcher.flush(timeout=5)
+    assert received == [task]
+
+
+def test_dispatcher_counts_delivered_after_receiver():
+    """An event is counted once its receiver returned, at the latest when flush returns."""
+    dispatcher = SignalDispatcher()
+    running, release = threading.Event(), threading.Event()
+
+    def receiver(task):
+        # pylint: disable=unused-argument
+        running.set()
+        assert release.wait(timeout=5)
+
+    dispatcher.submit(receiver, make_upload('a'))
+    assert running.wait(timeout=5)
+    assert dispatcher.statistics['delivered'] == 0
+    assert not dispatcher.flush(timeout=0.05)
+
+    release.set()
+    assert dispatcher.flush(timeout=5)
+    assert dispatcher.statistics['delivered'] == 1
+
+
+def run_tasks(count, connect_receiver):
+    """Let three workers execute `count` tasks and return the time it took."""
+    task_queue = TaskQueue()
+    connect_receiver(task_queue)
+    done = threading.Semaphore(0)
+    task_queue.task_acked.connect(lambda task: done.release(), weak=False)
+
+    bademeister = Bademeister(task_queue, thread_count=3, reserved_threads={})
+    bademeister.start()
+    try:
+        start = time.time()
+        for index in range(count):
+            task_queue.put_task(make_upload(str(index)))
+        for _ in range(count):
+            assert done.acquire(timeout=30)
+        return time.time() - start
+    finally:
+        bademeister.stop()
+
+
+def test_dispatcher_benchmark_slow_receiver():
+    """Compare worker throughput with a slow receiver called directly and via the dispatcher."""
+    count = 150
+
+    def slow_receiver(task):
+        # pylint: disable=unused-argument
+        time.sleep(0.01)
+
+    synchronous = run_tasks(
+        count, lambda task_queue: task_queue.task_acked.connect(slow_receiver, weak=False))
+    dispatchers = []
+
+    def connect_dispatched(task_queue):
+        task_queue.dispatcher.connect(task_queue.task_acked, slow_receiver)
+        dispatchers.append(task_queue.dispatcher)
+
+    dispatched = run_tasks(count, connect_dispatched)
+
+    print('synchronous: {:.0f} tasks/s, dispatched: {:.0f} tasks/s'.format(
+        count / synchronous, count / dispatched))
+    assert dispatched < synchronous
+
+    # the receiver still gets every event
+    assert dispatchers[0].flush(timeout=30)
+    assert dispatchers[0].statistics['delivered'] == count
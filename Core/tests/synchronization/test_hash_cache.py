@@ -0,0 +1,292 @@
+"""Tests for the cache of the content hashes of local files."""
+import hashlib
+import io
+import os
+from unittest import mock
+
+import pytest
+
+from cc.crypto2 import EncryptionFileWrapper
+from cc.encryption.storage_wrapper import EncryptingFileSystem, _EncryptionEventSinkWrapper
+from cc.synchronization.hash_cache import (CachingFileReader, ContentChangedError,
+                                           ContentHashCache, HashingFileReader)
+from cc.synchronization.throughput import TransferMetrics
+from cc.synctask import DownloadSyncTask
+from ..test_crypto2 import EXAMPLE_KEYPAIR_PUB
+
+
+def md5(data):
+    """Return the content hash of `data`."""
+    return 'md5', hashlib.md5(data).hexdigest()
+
+
+def write(path, data, mtime_ns=None):
+    """Write `data` to the file at `path` and set its modification time."""
+    with open(path, 'wb') as file_obj:
+        file_obj.write(data)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_get(tmpdir):
+    """A file is only hashed if its hash is not cached."""
+    path = str(tmpdir.join('a'))
+    write(path, b'hello')
+    cache = ContentHashCache()
+
+    assert cache.lookup(path) is None
+    with mock.patch('cc.synchronization.hash_cache.hash_file',
+                    wraps=lambda _: md5(b'hello')) as hash_file:
+        assert cache.get(path) == md5(b'hello')
+        assert cache.get(path) == md5(b'hello')
+    assert hash_file.call_count == 1
+    assert cache.statistics == {'entries': 1, 'hits': 1, 'misses': 2, 'evictions': 0}
+
+
+def test_modified(tmpdir):
+    """The hash of a file is not used once the size or the modification time changed."""
+    path = str(tmpdir.join('a'))
+    write(path, b'hello', mtime_ns=10 ** 18)
+    cache = ContentHashCache()
+    cache.get(path)
+
+    write(path, b'hallo', mtime_ns=2 * 10 ** 18)
+    assert cache.lookup(path) is None
+    assert cache.get(path) == md5(b'hallo')
+
+    write(path, b'hello!', mtime_ns=2 * 10 ** 18)
+    assert cache.lookup(path) is None
+
+
+def test_eviction(tmpdir):
+    """The least recently used hashes are dropped first."""
+    cache = ContentHashCache(max_entries=2)
+    paths = [str(tmpdir.join(name)) for name in 'abc']
+    for path in paths:
+        write(path, path.encode())
+
+    cache.get(paths[0])
+    cache.get(paths[1])
+    assert cache.lookup(paths[0]) is not None
+    cache.get(paths[2])
+
+    assert cache.lookup(paths[0]) is not None
+    assert cache.lookup(paths[1]) is None
+    assert cache.lookup(paths[2]) is not None
+    assert cache.statistics['evictions'] == 1
+    assert sorted(cache.identities) == [paths[0], paths[2]]
+
+
+def test_invalidate(tmpdir):
+    """Events only drop the hashes of files which changed since they were hashed."""
+    path = str(tmpdir.join('a'))
+    write(path, b'hello')
+    cache = ContentHashCache()
+    cache.get(path)
+
+    cache.invalidate(path)
+    assert cache.lookup(path) == md5(b'hello')
+
+    write(path, b'hello world')
+    cache.invalidate(path)
+    assert not cache.entries
+
+
+def test_delete_and_create(tmpdir):
+    """The hash of a file moved by a delete and a create is found by its inode."""
+    path, new_path = str(tmpdir.join('a')), str(tmpdir.join('b'))
+    write(path, b'hello')
+    cache = ContentHashCache()
+    cache.get(path)
+
+    os.rename(path, new_path)
+    cache.invalidate(path)
+    assert not cache.identities
+    assert cache.lookup(new_path) == md5(b'hello')
+    assert cache.identities == {new_path: mock.ANY}
+
+
+def test_move(tmpdir):
+    """The hashes of moved files and directories are kept."""
+    tmpdir.mkdir('dir')
+    path = str(tmpdir.join('dir', 'a'))
+    write(path, b'hello')
+    cache = ContentHashCache()
+    cache.get(path)
+
+    os.rename(str(tmpdir.join('dir')), str(tmpdir.join('moved')))
+    cache.move(str(tmpdir.join('dir')), str(tmpdir.join('moved')))
+    moved_path = str(tmpdir.join('moved', 'a'))
+    assert list(cache.identities) == [moved_path]
+
+    write(moved_path, b'hello world')
+    cache.invalidate(moved_path)
+    assert not cache.entries
+
+
+def test_save_load(tmpdir):
+    """The cache is saved if it changed and loaded again."""
+    path = str(tmpdir.join('a'))
+    location = str(tmpdir.join('content_hashes'))
+    write(path, b'hello')
+
+    cache = ContentHashCache(location)
+    cache.save()
+    assert not os.path.exists(location)
+    cache.get(path)
+    cache.save()
+    assert not cache.dirty
+
+    loaded = ContentHashCache(location)
+    loaded.load()
+    assert loaded.lookup(path) == md5(b'hello')
+    assert loaded.identities == cache.identities
+
+
+def test_find(tmpdir):
+    """Files are found by their content hash or an alias, as long as they are unchanged."""
+    path = str(tmpdir.join('a'))
+    write(path, b'hello', mtime_ns=10 ** 18)
+    location = str(tmpdir.join('content_hashes'))
+    cache = ContentHashCache(location)
+    cache.get(path)
+    cache.add_alias(path, ('dropbox', 'abc'))
+
+    assert cache.find(md5(b'hello')) == (path, md5(b'hello'))
+    assert cache.find(('dropbox', 'abc')) == (path, md5(b'hello'))
+    assert cache.find(md5(b'hallo')) is None
+
+    cache.save()
+    loaded = ContentHashCache(location)
+    loaded.load()
+    assert loaded.find(('dropbox', 'abc')) == (path, md5(b'hello'))
+
+    write(path, b'hallo', mtime_ns=2 * 10 ** 18)
+    assert cache.find(('dropbox', 'abc')) is None
+    cache.get(path)
+    assert not cache.aliases
+    assert cache.find(('dropbox', 'abc')) is None
+    assert cache.find(md5(b'hallo')) == (path, md5(b'hallo'))
+
+
+def test_load_corrupt(tmpdir):
+    """A corrupt cache is ignored."""
+    location = tmpdir.join('content_hashes')
+    location.write(b'garbage', mode='wb')
+    cache = ContentHashCache(str(location))
+    cache.load()
+    assert not cache.entries
+
+
+def test_hashing_file_reader():
+    """The data is hashed while it is read."""
+    reader = HashingFileReader(io.BytesIO(b'hello'))
+    assert reader.read(3) == b'hel'
+    assert reader.readinto(bytearray(10)) == 2
+    assert reader.read_count == 5
+    assert reader.content_hash == md5(b'hello')
+
+
+def test_hashing_file_reader_expected_hash():
+    """Reading the end of data not matching the expected hash fails."""
+    reader = HashingFileReader(io.BytesIO(b'hello'), expected_hash=md5(b'hallo'))
+    assert reader.read(5) == b'hello'
+    with pytest.raises(ContentChangedError):
+        reader.read(5)
+
+
+def test_caching_file_reader(tmpdir):
+    """A file read from the start to the end is cached, unless it is modified or seeked."""
+    path = str(tmpdir.join('a'))
+    write(path, b'hello')
+    cache = ContentHashCache()
+
+    with open(path, 'rb') as file_obj:
+        reader = CachingFileReader(file_obj, cache, path, os.stat(path))
+        assert reader.read(5) == b'hello'
+        assert cache.lookup(path) is None
+        assert reader.read(5) == b''
+    assert cache.lookup(path) == md5(b'hello')
+
+    write(path, b'hallo!', mtime_ns=10 ** 18)
+    with open(path, 'rb') as file_obj:
+        reader = CachingFileReader(file_obj, cache, path, os.stat(path))
+        assert reader.seek(1) == 1
+        assert reader.read() == b'allo!'
+    assert cache.lookup(path) is None
+
+    with open(path, 'rb') as file_obj:
+        reader = CachingFileReader(file_obj, cache, path, os.stat(path))
+        write(path, b'hello!', mtime_ns=2 * 10 ** 18)
+        reader.read()
+    assert cache.lookup(path) is None
+
+
+def test_upload_caches_content_hash(tmpdir):
+    """A local file is hashed while it is encrypted for an upload."""
+    path = str(tmpdir.join('a'))
+    write(path, b'hello' * 100000)
+    filesystem = mock.Mock(spec=EncryptingFileSystem, hash_cache=ContentHashCache())
+    filesystem.local_path.return_value = path
+
+    with open(path, 'rb') as file_obj:
+        plaintext = EncryptingFileSystem.hash_while_reading(filesystem, ['a'], file_obj)
+        encrypted = EncryptionFileWrapper(plaintext, {'bob': EXAMPLE_KEYPAIR_PUB})
+        while encrypted.read(64 * 1024):
+            pass
+    assert filesystem.hash_cache.lookup(path) == md5(b'hello' * 100000)
+
+    # cached already, not hashed again
+    with open(path, 'rb') as file_obj:
+        assert EncryptingFileSystem.hash_while_reading(filesystem, ['a'], file_obj) is file_obj
+
+
+def test_download_copies_local_file(tmpdir):
+    """A download of a content present locally is copied from the local file."""
+    path = str(tmpdir.join('a'))
+    write(path, b'hello')
+    link = mock.Mock()
+    link.graph.find_local_copy.return_value = (path, md5(b'hello'))
+    link.transfer_metrics = TransferMetrics()
+    local, remote = mock.Mock(), mock.Mock()
+    local.write_copy.side_effect = lambda file_obj, **_: file_obj.read() and 'vid'
+    link.storages = {'local': local, 'remote': remote}
+
+    task = DownloadSyncTask(path=['b'], source_storage_id='remote', source_version_id=1,
+                            content_hash=('dropbox', 'abc'))
+    task.link = link
+    task.execute()
+
+    link.graph.find_local_copy.assert_called_once_with(('dropbox', 'abc'))
+    assert not remote.open_read.called
+    assert task.target_version_id == 'vid'
+    assert (task.bytes_transferred, task.bytes_deduplicated) == (0, 5)
+    statistics = link.transfer_metrics.statistics
+    assert statistics['storages']['remote']['download']['deduplicated_files'] == 1
+    assert statistics['deduplicated_bytes'] == 5
+
+    # nothing found, the file is downloaded and its content hash recorded
+    link.graph.find_local_copy.return_value = None
+    remote.open_read.return_value = io.BytesIO(b'hello')
+    link.read_ahead_depth = 0
+    task.execute()
+    local.write.assert_called_once_with(path=['b'], file_obj=mock.ANY,
+                                        original_version_id=None)
+    local.add_content_hash_alias.assert_called_once_with(['b'], ('dropbox', 'abc'))
+
+
+def test_events_invalidate():
+    """The events of the local storage drop the content hashes."""
+    enc_wrapper = mock.Mock()
+    enc_wrapper.wrap_props.side_effect = lambda path, props: props
+    sink = _EncryptionEventSinkWrapper(mock.Mock(), enc_wrapper)
+
+    sink.storage_modify(storage_id='local', path=['a'], event_props={})
+    sink.storage_create(storage_id='local', path=['b'], event_props={})
+    sink.storage_delete(storage_id='local', path=['c'])
+    sink.storage_move(storage_id='local', source_path=['d'], target_path=['e'], event_props={})
+
+    assert enc_wrapper.invalidate_content_hash.call_args_list == [
+        mock.call(['a']), mock.call(['b']), mock.call(['c'])]
+    enc_wrapper.move_content_hash.assert_called_once_with(['d'], ['e'])
+    sink.event_sink.storage_delete.assert_called_once_with(storage_id='local', path=['c'])
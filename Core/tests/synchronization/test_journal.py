@@ -0,0 +1,169 @@
+"""Tests for the journal of the task queue."""
+# pylint: disable=redefined-outer-name
+from unittest import mock
+
+import pytest
+from bushn import Node
+
+import cc.synchronization.journal
+from cc import synctask
+from cc.synchronization.journal import TaskJournal, is_outstanding
+from cc.synchronization.models import SynchronizationGraph, TaskQueue
+from . import dummy_link_with_id
+
+
+@pytest.fixture
+def journal(tmpdir):
+    """A journal attached to a fresh task queue."""
+    journal = TaskJournal(str(tmpdir.join('task_journal')))
+    journal.queue = TaskQueue()
+    journal.attach(journal.queue)
+    yield journal
+    journal.close()
+
+
+def put_upload(task_queue, name, version_id=1):
+    """Put an upload of `name` on the queue."""
+    task = synctask.UploadSyncTask(path=[name], target_storage_id='remote',
+                                   source_version_id=version_id)
+    task.link = dummy_link_with_id('local::remote')
+    task.set_ack_callback(mock.Mock())
+    task_queue.put_task(task)
+    return task
+
+
+def test_journal_outstanding_tasks(journal):
+    """Tasks which have been put but not acked are restored in order."""
+    tasks = [put_upload(journal.queue, name) for name in 'abc']
+    delete = synctask.DeleteSyncTask(path=['d'], target_storage_id='remote',
+                                     original_version_id=4)
+    delete.link = dummy_link_with_id('local::remote')
+    journal.queue.put_task(delete)
+
+    # not journaled
+    fetch = synctask.FetchFileTreeTask(storage_id='remote')
+    fetch.link = dummy_link_with_id('local::remote')
+    journal.queue.put_task(fetch)
+
+    running = journal.queue.get_task(block=False)
+    running.state = synctask.SyncTask.SUCCESSFUL
+    journal.queue.ack_task(running)
+    journal.close()
+
+    restored = journal.load()
+    assert [link_id for link_id, _ in restored] == ['local::remote'] * 3
+    assert [task.path for _, task in restored] == [['b'], ['c'], ['d']]
+    for (_, task), original in zip(restored, tasks[1:] + [delete]):
+        assert type(task) is type(original)
+        assert task.__dict__ == dict(original.__dict__, link=None, ack_callback=None,
+                                     rehydrated=True)
+
+    # the journal starts from scratch
+    assert journal.load() == []
+
+
+def test_journal_requeued_task_recorded_once(journal):
+    """A task put back by a worker is not recorded twice."""
+    task = put_upload(journal.queue, 'a')
+    assert journal.queue.get_task(block=False) is task
+    journal.queue.put_task(task)
+    assert journal.record_count == 1
+
+    journal.queue.ack_task(journal.queue.get_task(block=False))
+    journal.close()
+    assert journal.load() == []
+
+
+def test_journal_superseded_task(journal):
+    """A superseded task is acked, its replacement is outstanding."""
+    put_upload(journal.queue, 'a', version_id=1)
+    put_upload(journal.queue, 'a', version_id=2)
+    journal.close()
+
+    restored = journal.load()
+    assert [task.source_version_id for _, task in restored] == [2]
+
+
+def test_journal_truncated_tail(journal):
+    """A partially written record at the end of the journal is ignored."""
+    put_upload(journal.queue, 'a')
+    put_upload(journal.queue, 'b')
+    journal.close()
+
+    with open(journal.location, 'rb+') as file_handle:
+        file_handle.truncate(len(file_handle.read()) - 5)
+
+    assert [task.path for _, task in journal.load()] == [['a']]
+
+
+def test_journal_compaction(journal):
+    """The journal is rewritten once it is mostly made of acked tasks."""
+    with mock.patch.object(cc.synchronization.journal, 'COMPACT_THRESHOLD', 10):
+        put_upload(journal.queue, 'outstanding')
+        journal.queue.get_task(block=False)
+        for index in range(10):
+            put_upload(journal.queue, str(index))
+            journal.queue.ack_task(journal.queue.get_task(block=False))
+
+    assert journal.record_count < 10
+    journal.close()
+    assert [task.path for _, task in journal.load()] == [['outstanding']]
+
+
+def test_journal_missing_file(tmpdir):
+    """Without a journal there is nothing to restore."""
+    assert TaskJournal(str(tmpdir.join('nothing'))).load() == []
+
+
+def test_is_outstanding():
+    """Restored tasks are checked against the equivalents of the model."""
+    model = Node(name=None)
+    model.get_node_safe(['a']).props['equivalents'] = {'new': {'local': 1, 'remote': 'x'}}
+    model.get_node_safe(['b'])
+
+    done = synctask.UploadSyncTask(path=['a'], target_storage_id='remote',
+                                   source_version_id=1)
+    modified = synctask.UploadSyncTask(path=['a'], target_storage_id='remote',
+                                       source_version_id=2)
+    new = synctask.UploadSyncTask(path=['b'], target_storage_id='remote',
+                                  source_version_id=1)
+    gone = synctask.UploadSyncTask(path=['c'], target_storage_id='remote',
+                                   source_version_id=1)
+    delete = synctask.DeleteSyncTask(path=['a'], target_storage_id='remote',
+                                     original_version_id='x')
+    deleted = synctask.DeleteSyncTask(path=['b'], target_storage_id='remote',
+                                      original_version_id='x')
+
+    assert not is_outstanding(done, model)
+    assert is_outstanding(modified, model)
+    assert is_outstanding(new, model)
+    assert not is_outstanding(gone, model)
+    assert is_outstanding(delete, model)
+    assert not is_outstanding(deleted, model)
+
+
+def test_graph_restore_tasks(journal):
+    """The graph puts the outstanding tasks back on the queue after the links started."""
+    put_upload(journal.queue, 'a')
+    put_upload(journal.queue, 'b')
+    unknown = synctask.UploadSyncTask(path=['c'], target_storage_id='other',
+                                      source_version_id=1)
+    unknown.link = dummy_link_with_id('local::other')
+    journal.queue.put_task(unknown)
+    journal.close()
+
+    model = Node(name=None)
+    model.get_node_safe(['a'])
+    link = mock.Mock()
+    link.state = model
+
+    graph = SynchronizationGraph(sync_root=None, bademeister=mock.Mock(),
+                                 periodic_state_saver=mock.Mock(), journal=journal)
+    graph.links = {'local::remote': link}
+    with mock.patch('os.makedirs'):
+        graph.startup()
+
+    link.startup.assert_called_once_with()
+    restored = [args[0] for args, _ in link.task_sink.call_args_list]
+    assert [task.path for task in restored] == [['a']]
+    assert restored[0].rehydrated
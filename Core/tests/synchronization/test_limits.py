@@ -0,0 +1,68 @@
+"""Tests covering the functionality of cc.synchronization.limits."""
+from cc import synctask
+from cc.synchronization.limits import ConcurrencyLimiter
+
+
+def test_limiter_acquire_release():
+    """Ensure slots are counted per storage and freed again."""
+    limiter = ConcurrencyLimiter()
+    limiter.set_limit('remote', 2)
+
+    tasks = [synctask.UploadSyncTask(path=[name], target_storage_id='remote',
+                                     source_version_id=None) for name in 'abc']
+
+    limiter.acquire(tasks[0])
+    # acquiring twice does not occupy a second slot
+    limiter.acquire(tasks[0])
+    assert limiter.admits(tasks[1])
+    limiter.acquire(tasks[1])
+    assert not limiter.admits(tasks[2])
+    assert limiter.statistics['remote'] == {'running': 2, 'limit': 2}
+
+    assert limiter.release(tasks[0])
+    assert not limiter.release(tasks[0])
+    assert limiter.admits(tasks[2])
+
+
+def test_limiter_admits_cancelled_tasks():
+    """Cancelled tasks are acked right away and must never wait for a slot."""
+    limiter = ConcurrencyLimiter()
+    limiter.set_limit('remote', 1)
+
+    running = synctask.DeleteSyncTask(path=['a'], target_storage_id='remote',
+                                      original_version_id=None)
+    limiter.acquire(running)
+
+    cancelled = synctask.DeleteSyncTask(path=['b'], target_storage_id='remote',
+                                        original_version_id=None)
+    assert not limiter.admits(cancelled)
+    cancelled.cancel()
+    assert limiter.admits(cancelled)
+
+
+def test_limiter_defaults_for_storage_type():
+    """The default limits of a storage type are applied to the storage id."""
+    limiter = ConcurrencyLimiter()
+    limiter.apply_defaults('dropbox1', 'dropbox')
+    assert ('dropbox1', None) in limiter.limits
+    assert ('dropbox1', 'UploadSyncTask') in limiter.limits
+
+    limiter.apply_defaults('local', 'filesystem')
+    assert ('local', None) not in limiter.limits
+
+
+def test_limiter_control_lane():
+    """Control tasks are only limited per task type, not by the transfers on the storage."""
+    limiter = ConcurrencyLimiter()
+    limiter.set_limit('remote', 1)
+
+    upload = synctask.UploadSyncTask(path=['a'], target_storage_id='remote',
+                                     source_version_id=None)
+    fetch = synctask.FetchFileTreeTask(storage_id='remote')
+    limiter.acquire(upload)
+    assert limiter.admits(fetch)
+
+    limiter.set_limit('remote', 1, task_type='FetchFileTreeTask')
+    limiter.acquire(fetch)
+    assert not limiter.admits(synctask.FetchFileTreeTask(storage_id='remote'))
+    assert limiter.statistics['remote'] == {'running': 1, 'limit': 1}
@@ -44,10 +44,15 @@ def test_task_sink():
     link.task_sink(task)
 
     # This will only be called once acked.
-    engine.ack_task.assert_not_called()
+    engine.ack_tasks.assert_not_called()
 
     # But But it must be added to the queue
     task_queue.put_task.assert_called_once_with(task)
 
     # The callback must be set correctly.
-    task.set_ack_callback.assert_called_once_with(engine.ack_task)
+    task.set_ack_callback.assert_called_once_with(link.ack_batcher.ack)
+
+    # acks reach the engine in batches
+    link.ack_batcher.ack(task)
+    link.ack_batcher.flush()
+    engine.ack_tasks.assert_called_once_with([task])
@@ -0,0 +1,141 @@
+"""Tests for resuming downloads from partial files."""
+import io
+import os
+
+import pytest
+
+from cc.synchronization.exceptions import SyncTaskCancelledException
+from cc.synchronization.partial_download import PartialDownload, remove_stale
+from cc.synctask import DownloadSyncTask
+from .test_throttle import StandInStorage, make_link
+
+MBYTE = 1024 * 1024
+
+
+class FlakyFile(io.BytesIO):
+    """A download failing with a network error once `fail_after` bytes have been read."""
+
+    def __init__(self, data, fail_after=None):
+        super().__init__(data)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.fail_after is not None and self.tell() >= self.fail_after:
+            raise ConnectionError('connection reset')
+        if self.fail_after is not None and size is not None and size >= 0:
+            size = min(size, self.fail_after - self.tell())
+        return super().read(size)
+
+
+class RangedStandInStorage(StandInStorage):
+    """Stand-in storage reading files from an offset, the reads fail after `fail_after` bytes."""
+    supports_ranged_read = True
+
+    def __init__(self, storage_id, files=None, version_id=1):
+        super().__init__(storage_id, files)
+        self.version_id = version_id
+        self.fail_after = None
+        #: offsets of the files opened
+        self.offsets = []
+
+    def open_read(self, path, expected_version_id=None, offset=0):
+        if expected_version_id != self.version_id:
+            raise ValueError('version mismatch')
+        self.offsets.append(offset)
+        return FlakyFile(self.files[tuple(path)][offset:], self.fail_after)
+
+
+@pytest.fixture
+def link(tmpdir):
+    """A link downloading `a` from a ranged storage, with the partial files in `tmpdir`."""
+    link = make_link(throttle=None, size=3 * MBYTE)
+    link.storages['remote'] = RangedStandInStorage(
+        'remote', {('a',): bytes(range(256)) * 12 * 1024})
+    link.partial_download_dir = str(tmpdir.join('partial_downloads'))
+    link.graph = None
+    return link
+
+
+def download(link, version_id=1):
+    """Return a download of `a` of `version_id`."""
+    task = DownloadSyncTask(path=['a'], source_storage_id='remote', source_version_id=version_id)
+    task.link = link
+    return task
+
+
+def test_download_resumed(link):
+    """A download failing on a network error continues at the last checkpoint."""
+    remote = link.storages['remote']
+    remote.fail_after = int(2.5 * MBYTE)
+
+    task = download(link)
+    with pytest.raises(ConnectionError):
+        task.execute()
+    assert task.bytes_transferred == int(2.5 * MBYTE)
+    assert link.storages['local'].files[('a',)] == b'x' * 3 * MBYTE
+
+    remote.fail_after = None
+    task = download(link)
+    task.execute()
+    assert remote.offsets == [0, int(2.5 * MBYTE)]
+    assert (task.bytes_resumed, task.bytes_transferred) == (int(2.5 * MBYTE), MBYTE // 2)
+    assert link.storages['local'].files[('a',)] == remote.files[('a',)]
+    assert not os.listdir(link.partial_download_dir)
+
+
+def test_download_cancelled(link):
+    """A cancelled download is resumed as well."""
+    task = download(link)
+    task.cancelled = True
+    with pytest.raises(SyncTaskCancelledException):
+        task.execute()
+
+    task = download(link)
+    task.execute()
+    assert link.storages['local'].files[('a',)] == link.storages['remote'].files[('a',)]
+
+
+def test_download_new_version(link):
+    """A partial file of another version is not resumed."""
+    remote = link.storages['remote']
+    remote.fail_after = MBYTE
+    with pytest.raises(ConnectionError):
+        download(link).execute()
+
+    remote.fail_after = None
+    remote.version_id = 2
+    remote.files[('a',)] = b'z' * 2 * MBYTE
+    download(link, version_id=2).execute()
+    assert remote.offsets == [0, 0]
+    assert link.storages['local'].files[('a',)] == b'z' * 2 * MBYTE
+
+
+def test_checkpoint(tmpdir):
+    """Only the data up to the last checkpoint is resumed."""
+    partial = PartialDownload(str(tmpdir), key=('link', 'remote', ('a',)), version_id=1,
+                              checkpoint_interval=4)
+    with pytest.raises(ConnectionError):
+        partial.fill(FlakyFile(b'0123456789', fail_after=6))
+    assert partial.resume() == 6
+
+    # data written after the last checkpoint
+    with open(partial.data_path, 'ab') as partial_file:
+        partial_file.write(b'garbage')
+    assert partial.resume() == 6
+    partial.fill(io.BytesIO(b'6789'))
+    with partial.open() as partial_file:
+        assert partial_file.read() == b'0123456789'
+
+    other = PartialDownload(str(tmpdir), key=('link', 'remote', ('a',)), version_id=2)
+    assert other.resume() == 0
+
+
+def test_remove_stale(tmpdir):
+    """Partial files not resumed for a while are removed."""
+    partial = PartialDownload(str(tmpdir), key=('link', 'remote', ('a',)), version_id=1)
+    partial.fill(io.BytesIO(b'data'))
+    remove_stale(str(tmpdir))
+    assert len(tmpdir.listdir()) == 2
+    remove_stale(str(tmpdir), now=os.path.getmtime(partial.data_path) + 10, max_age=5)
+    assert not tmpdir.listdir()
+    remove_stale(str(tmpdir.join('missing')))
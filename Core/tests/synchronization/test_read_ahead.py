@@ -0,0 +1,140 @@
+"""Tests for reading transfers in advance."""
+import io
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from cc.synchronization.models import ControlFileWrapper
+from cc.synchronization.read_ahead import ReadAheadReader
+from cc.synctask import DownloadSyncTask, UploadSyncTask
+from .test_throttle import make_link
+
+MBYTE = 1024 * 1024
+
+
+class SlowFile(io.RawIOBase):
+    """A file of `size` bytes, each read takes `latency` seconds like a slow disk or network."""
+
+    def __init__(self, size, latency=0, fail_after=None):
+        super().__init__()
+        self.remaining = size
+        self.latency = latency
+        self.fail_after = fail_after
+        self.reads = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.fail_after is not None and self.reads >= self.fail_after:
+            raise OSError('disk gone')
+        self.reads += 1
+        time.sleep(self.latency)
+        count = min(len(buffer), self.remaining)
+        buffer[:count] = b'x' * count
+        self.remaining -= count
+        return count
+
+
+def consume(file_obj, chunk_size, latency=0):
+    """Read `file_obj` like a provider sending every chunk in `latency` seconds.
+
+    :return: the number of bytes read
+    """
+    total = 0
+    while True:
+        chunk = file_obj.read(chunk_size)
+        if not chunk:
+            return total
+        total += len(chunk)
+        time.sleep(latency)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 1000, 4096, 10000])
+def test_read_ahead(chunk_size):
+    """The data is returned in the same order, regardless of the size of the reads."""
+    data = bytes(range(256)) * 100
+    with ReadAheadReader(io.BytesIO(data), depth=2, chunk_size=4096) as reader:
+        chunks = []
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        assert reader.read(10) == b''
+    assert b''.join(chunks) == data
+
+
+def test_read_ahead_bounded():
+    """The reader thread does not read more than `depth` chunks in advance."""
+    source = SlowFile(100 * 1024)
+    with ReadAheadReader(source, depth=2, chunk_size=1024) as reader:
+        time.sleep(0.2)
+        # two chunks queued, the reader waits for room with the third one
+        assert source.reads == 3
+        assert len(reader.read(1024)) == 1024
+        time.sleep(0.2)
+        assert source.reads == 4
+
+
+def test_read_ahead_error():
+    """Errors of the wrapped file object are raised in the thread consuming the chunks."""
+    with ReadAheadReader(SlowFile(10 * 1024, fail_after=2), depth=4, chunk_size=1024) as reader:
+        assert len(reader.read(1024)) == 1024
+        assert len(reader.read(1024)) == 1024
+        with pytest.raises(OSError):
+            reader.read(1024)
+
+
+def test_read_ahead_close():
+    """Closing the reader stops the thread, even while it waits for room in the queue."""
+    reader = ReadAheadReader(SlowFile(100 * 1024), depth=1, chunk_size=1024)
+    time.sleep(0.1)
+    reader.close()
+    assert not reader._thread.is_alive()  # pylint: disable=protected-access
+    assert not [thread for thread in threading.enumerate()
+                if thread.name == 'ReadAhead-{}'.format(id(reader))]
+
+
+def test_transfers_read_ahead():
+    """Uploads and downloads of files larger than a chunk are read in advance."""
+    link = make_link(throttle=None, size=3 * MBYTE)
+    link.read_ahead_depth = 2
+
+    upload = UploadSyncTask(path=['a'], target_storage_id='remote', source_version_id=None)
+    upload.link = link
+    download = DownloadSyncTask(path=['a'], source_storage_id='remote', source_version_id=None)
+    download.link = link
+
+    with mock.patch('cc.synctask.ReadAheadReader', wraps=ReadAheadReader) as read_ahead:
+        upload.execute()
+        assert link.storages['remote'].files[('a',)] == link.storages['local'].files[('a',)]
+        link.storages['remote'].files[('a',)] = b'z' * 3 * MBYTE
+        download.execute()
+        assert link.storages['local'].files[('a',)] == b'z' * 3 * MBYTE
+
+    assert read_ahead.call_count == 2
+    assert upload.bytes_transferred == download.bytes_transferred == 3 * MBYTE
+
+
+def test_benchmark_read_ahead():
+    """Benchmark an upload from a slow disk to a slow provider with and without read-ahead."""
+    size, latency = 32 * MBYTE, 0.01
+    timings = {}
+    for depth in (0, 1, 2, 4):
+        source = SlowFile(size, latency=latency)
+        if depth:
+            source = ReadAheadReader(source, depth=depth, chunk_size=MBYTE)
+        task = UploadSyncTask(path=['a'], target_storage_id='remote', source_version_id=None)
+
+        start = time.perf_counter()
+        with ControlFileWrapper(source, task) as wrapper:
+            assert consume(wrapper, MBYTE, latency=latency) == size
+        timings[depth] = time.perf_counter() - start
+        print('read-ahead depth {}: {} MiB in {:.2f}s'.format(depth, size // MBYTE,
+                                                              timings[depth]))
+
+    # reading and sending overlap
+    assert timings[2] < timings[0] * 0.8
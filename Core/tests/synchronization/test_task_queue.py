@@ -1,6 +1,8 @@
 """Various tests for TaskQueue"""
+from queue import Empty
 from unittest import mock
 import time
+import threading
 
 import pytest
 
@@ -376,3 +378,276 @@ def test_path_has_tasks_with_one_running_task(sample_create_dir_task):
     path_hash = cc.synctask.path_hash("local::remote2", sample_create_dir_task.path)
     assert queue.path_has_tasks(path_hash=path_hash, is_dir=True) is False
     assert queue.path_has_tasks(path_hash=path_hash, is_dir=False) is False
+
+
+def test_concurrency_limit_per_storage():
+    """A task is not handed out while its storage is at the concurrency limit."""
+    ack_tasks = []
+    queue = TaskQueue()
+    queue.limiter.set_limit('remote', 1)
+
+    tasks = [cc.synctask.UploadSyncTask(path=[name], target_storage_id='remote',
+                                        source_version_id=None) for name in 'ab']
+    other = cc.synctask.UploadSyncTask(path=['c'], target_storage_id='other',
+                                       source_version_id=None)
+    for task in tasks + [other]:
+        task.link = dummy_link_with_id("local::remote")
+        task.set_ack_callback(ack_tasks.append)
+        queue.put_task(task)
+
+    assert queue.get_task(block=False) == tasks[0]
+
+    # the second task on 'remote' has to wait, the one on 'other' overtakes it
+    assert queue.get_task(block=False) == other
+    with pytest.raises(Empty):
+        queue.get_task(block=False)
+
+    queue.ack_task(tasks[0])
+    assert queue.get_task(block=False) == tasks[1]
+
+
+def test_concurrency_limit_per_task_type():
+    """Limits for a task type do not affect other task types on the same storage."""
+    ack_tasks = []
+    queue = TaskQueue()
+    queue.limiter.set_limit('remote', 1, task_type='UploadSyncTask')
+
+    uploads = [cc.synctask.UploadSyncTask(path=[name], target_storage_id='remote',
+                                          source_version_id=None) for name in 'ab']
+    download = cc.synctask.DownloadSyncTask(path=['c'], source_storage_id='remote',
+                                            source_version_id=None)
+    for task in uploads + [download]:
+        task.link = dummy_link_with_id("local::remote")
+        task.set_ack_callback(ack_tasks.append)
+        queue.put_task(task)
+
+    assert queue.get_task(block=False) == uploads[0]
+    assert queue.get_task(block=False) == download
+    with pytest.raises(Empty):
+        queue.get_task(block=False)
+
+
+def test_concurrency_limit_released_on_requeue():
+    """A worker putting back a task for a later retry frees its slot."""
+    queue = TaskQueue()
+    queue.limiter.set_limit('remote', 1)
+
+    task = cc.synctask.UploadSyncTask(path=['a'], target_storage_id='remote',
+                                      source_version_id=None)
+    task.link = dummy_link_with_id("local::remote")
+    queue.put_task(task)
+
+    assert queue.get_task(block=False) == task
+    queue.put_task(task)
+    assert queue.get_task(block=False) == task
+
+
+def test_supersede_pending_task():
+    """A newer task for the same path replaces the pending one in place."""
+    ack_tasks = []
+    acked_signal = []
+    queue = TaskQueue()
+    queue.task_acked.connect(acked_signal.append, weak=False)
+
+    first, other, second = [
+        cc.synctask.UploadSyncTask(path=[name], target_storage_id='remote',
+                                   source_version_id=version)
+        for name, version in [('a', 1), ('b', 1), ('a', 2)]]
+    for task in first, other, second:
+        task.link = dummy_link_with_id("local::remote")
+        task.set_ack_callback(ack_tasks.append)
+        queue.put_task(task)
+
+    assert ack_tasks == [first]
+    assert acked_signal == [first]
+    assert first.state == cc.synctask.SyncTask.CANCELLED
+    assert first.superseded_by is second
+    assert queue.statistics['superseded_task_count'] == 1
+    assert queue.statistics['superseded_tasks'] == {'UploadSyncTask': 1}
+
+    # the replacement keeps the position of the superseded task
+    assert queue.pending.qsize() == 2
+    assert queue.pending.tasks_for(second.operates_on()) == [second]
+    assert queue.get_task(block=False) is second
+    assert queue.get_task(block=False) is other
+    assert not queue.pending.path_queue
+
+
+def test_supersede_only_same_kind():
+    """Tasks of another type or for another storage are not superseded."""
+    ack_tasks = []
+    queue = TaskQueue()
+
+    tasks = [cc.synctask.UploadSyncTask(path=['a'], target_storage_id='remote',
+                                        source_version_id=1),
+             cc.synctask.UploadSyncTask(path=['a'], target_storage_id='other',
+                                        source_version_id=1),
+             cc.synctask.DownloadSyncTask(path=['a'], source_storage_id='remote',
+                                          source_version_id=1),
+             cc.synctask.MoveSyncTask(path=['a'], source_path=['a'], target_path=['b'],
+                                      source_storage_id='remote', source_version_id=1),
+             cc.synctask.MoveSyncTask(path=['a'], source_path=['a'], target_path=['c'],
+                                      source_storage_id='remote', source_version_id=1)]
+    for task in tasks:
+        task.link = dummy_link_with_id("local::remote")
+        task.set_ack_callback(ack_tasks.append)
+        queue.put_task(task)
+
+    assert not ack_tasks
+    assert queue.pending.qsize() == len(tasks)
+    assert queue.statistics['superseded_task_count'] == 0
+
+
+def test_supersede_requeued_task():
+    """A task put back by a worker is stale if a newer one has been issued meanwhile."""
+    ack_tasks = []
+    queue = TaskQueue()
+
+    first, second = [cc.synctask.UploadSyncTask(path=['a'], target_storage_id='remote',
+                                                source_version_id=version)
+                     for version in (1, 2)]
+    for task in first, second:
+        task.link = dummy_link_with_id("local::remote")
+        task.set_ack_callback(ack_tasks.append)
+
+    queue.put_task(first)
+    assert queue.get_task(block=False) is first
+    queue.put_task(second)
+
+    # the worker puts the first task back for a later retry
+    queue.put_task(first)
+
+    assert ack_tasks == [first]
+    assert first.superseded_by is second
+    assert not queue.running
+    assert queue.pending.qsize() == 1
+    assert queue.get_task(block=False) is second
+
+
+def test_lanes():
+    """Reserved workers only get tasks of their lanes, general workers get all in order."""
+    queue = TaskQueue()
+    uploads = [cc.synctask.UploadSyncTask(path=[name], target_storage_id='remote',
+                                          source_version_id=None) for name in 'ab']
+    fetch = cc.synctask.FetchFileTreeTask(storage_id='remote')
+    create_dir = cc.synctask.CreateDirSyncTask(path=['c'], target_storage_id='remote',
+                                               source_storage_id='local')
+    for task in uploads + [fetch, create_dir]:
+        task.link = dummy_link_with_id("local::remote")
+        queue.put_task(task)
+
+    assert queue.statistics['pending_tasks_by_lane'] == {cc.synctask.BULK_LANE: 2,
+                                                         cc.synctask.CONTROL_LANE: 2}
+    assert queue.pending.queue == uploads + [fetch, create_dir]
+
+    control = (cc.synctask.CONTROL_LANE,)
+    assert queue.get_task(block=False, lanes=control) is fetch
+    assert queue.get_task(block=False) is uploads[0]
+    assert queue.get_task(block=False, lanes=control) is create_dir
+    with pytest.raises(Empty):
+        queue.get_task(block=False, lanes=control)
+    assert queue.get_task(block=False) is uploads[1]
+
+    # every worker stops
+    queue.put_task(cc.synctask.STOP_TOKEN)
+    assert queue.get_task(block=False, lanes=control) == cc.synctask.STOP_TOKEN
+
+
+def test_lanes_wake_up_reserved_worker():
+    """A waiting reserved worker is woken up by a task of its lane."""
+    queue = TaskQueue()
+    fetch = cc.synctask.FetchFileTreeTask(storage_id='remote')
+    fetch.link = dummy_link_with_id("local::remote")
+
+    timer = threading.Timer(0.1, queue.put_task, args=[fetch])
+    timer.start()
+    assert queue.get_task(timeout=5, lanes=(cc.synctask.CONTROL_LANE,)) is fetch
+    timer.join()
+
+
+def test_children_wait_for_parent():
+    """Tasks below a directory which is still to be created are held back until it is acked."""
+    queue = TaskQueue()
+    parent = cc.synctask.CreateDirSyncTask(path=['a'], target_storage_id='remote',
+                                           source_storage_id='local')
+    child = cc.synctask.UploadSyncTask(path=['a', 'x'], target_storage_id='remote',
+                                       source_version_id=None)
+    sibling = cc.synctask.UploadSyncTask(path=['b'], target_storage_id='remote',
+                                         source_version_id=None)
+    child_dir = cc.synctask.CreateDirSyncTask(path=['a', 'y'], target_storage_id='remote',
+                                              source_storage_id='local')
+    grandchild = cc.synctask.UploadSyncTask(path=['a', 'y', 'z'], target_storage_id='remote',
+                                            source_version_id=None)
+    for task in parent, child, sibling, child_dir, grandchild:
+        task.link = dummy_link_with_id("local::remote")
+        task.set_ack_callback(mock.Mock())
+        queue.put_task(task)
+
+    assert queue.get_task(block=False) is parent
+    assert queue.get_task(block=False) is sibling
+    with pytest.raises(Empty):
+        queue.get_task(block=False)
+    assert queue.statistics['tasks_waiting_for_parent'] == 3
+    assert queue.path_has_tasks(child.operates_on(), is_dir=False)
+
+    queue.ack_task(parent)
+    assert queue.statistics['tasks_waiting_for_parent'] == 1
+    assert queue.get_task(block=False) is child
+    assert queue.get_task(block=False) is child_dir
+    with pytest.raises(Empty):
+        queue.get_task(block=False)
+
+    queue.ack_task(child_dir)
+    assert queue.get_task(block=False) is grandchild
+
+
+def test_children_wake_up_worker():
+    """A worker waiting for a task gets the children once their parent has been acked."""
+    queue = TaskQueue()
+    parent = cc.synctask.CreateDirSyncTask(path=['a'], target_storage_id='remote',
+                                           source_storage_id='local')
+    child = cc.synctask.UploadSyncTask(path=['a', 'x'], target_storage_id='remote',
+                                       source_version_id=None)
+    for task in parent, child:
+        task.link = dummy_link_with_id("local::remote")
+        task.set_ack_callback(mock.Mock())
+        queue.put_task(task)
+    assert queue.get_task(block=False) is parent
+
+    timer = threading.Timer(0.1, queue.ack_task, args=[parent])
+    timer.start()
+    assert queue.get_task(timeout=5) is child
+    timer.join()
+
+
+def test_admissible_count():
+    """Only tasks a worker could start right now are counted as admissible."""
+    queue = TaskQueue()
+    queue.limiter.set_limit('remote', 2)
+    parent = cc.synctask.CreateDirSyncTask(path=['a'], target_storage_id='other',
+                                           source_storage_id='local')
+    child = cc.synctask.UploadSyncTask(path=['a', 'x'], target_storage_id='other',
+                                       source_version_id=None)
+    uploads = [cc.synctask.UploadSyncTask(path=[name], target_storage_id='remote',
+                                          source_version_id=None) for name in 'bcd']
+    backing_off = cc.synctask.UploadSyncTask(path=['e'], target_storage_id='other',
+                                             source_version_id=None)
+    backing_off.execute_after = time.time() + 60
+    parked = [cc.synctask.UploadSyncTask(path=[name], target_storage_id='down',
+                                         source_version_id=None) for name in 'fg']
+    for task in [parent, child, backing_off] + uploads + parked:
+        task.link = dummy_link_with_id("local::remote")
+        task.set_ack_callback(mock.Mock())
+        queue.put_task(task)
+    assert queue.pending.qsize() == 8
+
+    # the parent, two uploads within the limit and a probe of the storage which is down
+    queue.circuit_breaker.opened['down'] = time.monotonic() - 1
+    assert queue.pending.admissible_count() == 4
+    queue.circuit_breaker.opened['down'] = time.monotonic() + 60
+    assert queue.pending.admissible_count() == 3
+
+    assert queue.get_task(block=False) is parent
+    assert queue.pending.admissible_count() == 2
+    queue.ack_task(parent)
+    assert queue.pending.admissible_count() == 3
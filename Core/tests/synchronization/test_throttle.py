@@ -0,0 +1,182 @@
+"""Tests for the bandwidth throttling of uploads and downloads."""
+import datetime
+import io
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from cc.synchronization.models import TaskQueue
+from cc.synchronization.throttle import (DOWNLOAD, UPLOAD, BandwidthThrottle, TokenBucket,
+                                         in_period, parse_period)
+from cc.synctask import DownloadSyncTask, SyncTask, UploadSyncTask
+from . import dummy_link_with_id
+
+
+class StandInStorage:
+    """In memory stand-in for a storage, `write` reads the file object like a provider."""
+
+    def __init__(self, storage_id, files=None):
+        self.storage_id = storage_id
+        self.files = files or {}
+
+    def open_read(self, path, expected_version_id=None):
+        # pylint: disable=unused-argument
+        return io.BytesIO(self.files[tuple(path)])
+
+    def get_props(self, path):
+        return {'size': len(self.files[tuple(path)])}
+
+    def write(self, path, file_obj, original_version_id=None, size=None):
+        # pylint: disable=unused-argument
+        chunks = []
+        while True:
+            chunk = file_obj.read(64 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.files[tuple(path)] = b''.join(chunks)
+        return 'vid'
+
+
+def make_link(throttle, size, remote_id='remote'):
+    """Return a link between a local and a remote stand-in storage, each with a file `a`."""
+    link = dummy_link_with_id('local::' + remote_id)
+    link.storages = {'local': StandInStorage('local', {('a',): b'x' * size}),
+                     remote_id: StandInStorage(remote_id, {('a',): b'y' * size})}
+    link.throttle = throttle
+    link.client_config.blocked_extensions = []
+    link.client_config.blocked_mime_types = []
+    link.read_ahead_depth = 0
+    return link
+
+
+def timed_upload(link, remote_id='remote'):
+    """Upload `a` and return the seconds it took."""
+    task = UploadSyncTask(path=['a'], target_storage_id=remote_id, source_version_id=None)
+    task.link = link
+    start = time.monotonic()
+    task.execute()
+    assert link.storages[remote_id].files[('a',)] == link.storages['local'].files[('a',)]
+    return time.monotonic() - start
+
+
+def test_token_bucket():
+    """A bucket allows a burst, then the bytes taken have to be paid back."""
+    bucket = TokenBucket(rate=100)
+    now = bucket.updated
+    assert bucket.take(100, now) == 0
+    assert bucket.take(50, now) == pytest.approx(0.5)
+    assert bucket.take(50, now + 1) == 0
+    # the bucket does not fill up beyond the burst size
+    assert bucket.take(150, now + 100) == pytest.approx(0.5)
+
+
+def test_periods():
+    """Periods may span midnight."""
+    night = parse_period({'start': '22:00', 'end': '06:00'})
+    assert in_period(night, datetime.time(23, 0))
+    assert in_period(night, datetime.time(5, 59))
+    assert not in_period(night, datetime.time(12, 0))
+    with pytest.raises(ValueError):
+        parse_period({'start': '22:00'})
+
+
+def test_configure():
+    """The configuration replaces all limits, invalid ones are rejected."""
+    throttle = BandwidthThrottle()
+    throttle.set_limit(DOWNLOAD, 100, storage_id='old')
+    throttle.configure({'upload': 1000, 'storages': {'remote': {'download': 500}}},
+                       schedule=[{'start': '22:00', 'end': '06:00'}])
+
+    assert throttle.statistics['limits'] == {'*:upload': 1000, 'remote:download': 500}
+    assert throttle.unthrottled_periods == [(datetime.time(22), datetime.time(6))]
+
+    with pytest.raises(ValueError):
+        throttle.configure({'upload': -1})
+    with pytest.raises(ValueError):
+        throttle.configure({}, schedule=[{'start': 'midnight', 'end': '06:00'}])
+    assert throttle.statistics['limits'] == {'*:upload': 1000, 'remote:download': 500}
+
+
+def test_transfer_of():
+    """Uploads are accounted on the target, downloads on the source storage."""
+    upload = UploadSyncTask(path=['a'], target_storage_id='remote', source_version_id=1)
+    download = DownloadSyncTask(path=['a'], source_storage_id='remote', source_version_id=1)
+    assert BandwidthThrottle.transfer_of(upload) == ('remote', UPLOAD)
+    assert BandwidthThrottle.transfer_of(download) == ('remote', DOWNLOAD)
+    assert BandwidthThrottle.transfer_of(SyncTask(path=['a'])) is None
+
+
+def test_upload_throttled():
+    """An upload exceeding the global limit takes as long as the limit demands."""
+    throttle = BandwidthThrottle()
+    throttle.set_limit(UPLOAD, 200 * 1024)
+    link = make_link(throttle, size=400 * 1024)
+
+    # the first 200 KiB are the burst, the rest takes a second
+    assert 0.9 < timed_upload(link) < 3
+    assert throttle.statistics['waited_seconds'][UPLOAD] > 0.9
+
+
+def test_limits_per_storage_and_direction():
+    """A limit only slows down transfers of its storage and direction."""
+    throttle = BandwidthThrottle()
+    throttle.set_limit(UPLOAD, 100 * 1024, storage_id='slow')
+    throttle.set_limit(DOWNLOAD, 100 * 1024)
+
+    assert timed_upload(make_link(throttle, size=400 * 1024)) < 0.5
+    assert timed_upload(make_link(throttle, size=200 * 1024, remote_id='slow'), 'slow') > 0.9
+
+
+def test_limit_shared_by_transfers():
+    """Concurrent transfers share the bandwidth of the limit."""
+    throttle = BandwidthThrottle()
+    throttle.set_limit(UPLOAD, 200 * 1024)
+    links = [make_link(throttle, size=200 * 1024) for _ in range(3)]
+    threads = [threading.Thread(target=timed_upload, args=[link]) for link in links]
+
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 600 KiB at 200 KiB/s with a burst of 200 KiB
+    assert time.monotonic() - start > 1.8
+
+
+def test_schedule_suspends_limits():
+    """During an unthrottled period the limits are not enforced."""
+    throttle = BandwidthThrottle()
+    throttle.set_limit(UPLOAD, 100 * 1024)
+    now = datetime.datetime.now()
+    throttle.set_schedule([((now - datetime.timedelta(hours=1)).time(),
+                            (now + datetime.timedelta(hours=1)).time())])
+
+    assert throttle.statistics['suspended']
+    assert timed_upload(make_link(throttle, size=1024 * 1024)) < 0.5
+
+
+def test_cancel_while_throttled():
+    """A cancelled transfer does not wait for the bandwidth."""
+    throttle = BandwidthThrottle()
+    throttle.set_limit(UPLOAD, 1024)
+    task = UploadSyncTask(path=['a'], target_storage_id='remote', source_version_id=None)
+    threading.Timer(0.1, task.cancel).start()
+
+    start = time.monotonic()
+    throttle.consume(task, 100 * 1024)
+    assert time.monotonic() - start < 1
+
+
+def test_task_queue_throttle():
+    """The task queue shares its throttle with the transfers and reports its limits."""
+    task_queue = TaskQueue()
+    task_queue.throttle.set_limit(UPLOAD, 1000)
+    assert task_queue.statistics['bandwidth_throttle']['limits'] == {'*:upload': 1000}
+
+    with mock.patch.object(task_queue.throttle, 'consume') as consume:
+        link = make_link(task_queue.throttle, size=10)
+        timed_upload(link)
+    assert mock.call(mock.ANY, 10) in consume.call_args_list
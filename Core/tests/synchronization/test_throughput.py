@@ -0,0 +1,124 @@
+"""Tests for the throughput metrics of the transfers."""
+import io
+import time
+from unittest import mock
+
+import pytest
+
+from cc.synchronization.models import ControlFileWrapper, TaskQueue
+from cc.synchronization.syncfsm import SIZE, STORAGE
+from cc.synchronization.throughput import StorageThroughput, TransferMetrics
+from cc.synctask import DownloadSyncTask, SyncTask, UploadSyncTask
+from . import dummy_link_with_id
+
+
+def make_upload(name, size=None):
+    """Return an upload of `name`, the model of its link knows the `size`."""
+    task = UploadSyncTask(path=[name], target_storage_id='remote', source_version_id=1)
+    task.link = dummy_link_with_id('local::remote')
+    task.link.state = mock.Mock()
+    task.link.state.get_node.return_value.props = {STORAGE: {'local': {SIZE: size}}}
+    task.set_ack_callback(mock.Mock())
+    return task
+
+
+def test_moving_average():
+    """The throughput is averaged over the window."""
+    storage = StorageThroughput(window=10)
+    storage.add(1000, now=100)
+    # less than a second passed, the rate is not extrapolated
+    assert storage.rate(now=100.5) == 1000
+    storage.add(1000, now=104)
+    assert storage.rate(now=105) == 400
+    assert storage.rate(now=112) == 100
+    assert storage.rate(now=120) == 0
+    assert storage.total_bytes == 2000
+
+
+def test_queued_bytes_and_eta():
+    """Queued transfers count with their size, the ETA is based on the throughput."""
+    task_queue = TaskQueue()
+    metrics = task_queue.transfer_metrics
+    first, second = make_upload('a', size=1000), make_upload('b', size=3000)
+    task_queue.put_task(first)
+    task_queue.put_task(second)
+
+    remote = metrics.statistics['storages']['remote']['upload']
+    assert remote['queued_bytes'] == 4000
+    assert remote['eta_seconds'] is None
+
+    assert task_queue.get_task(block=False) is first
+    metrics.record(first, 600, read_seconds=0.1, consumer_seconds=0)
+    statistics = metrics.statistics
+    remote = statistics['storages']['remote']['upload']
+    assert remote['queued_bytes'] == 3400
+    assert remote['bytes_per_second'] == 600
+    assert remote['eta_seconds'] == pytest.approx(3400 / 600)
+    assert statistics['eta_seconds'] == remote['eta_seconds']
+    assert statistics['running'] == [{'path': ['a'], 'type': 'UploadSyncTask',
+                                      'bytes_transferred': 600, 'size': 1000,
+                                      'bytes_per_second': mock.ANY}]
+
+    # the rest of the first transfer is no longer queued once it is done
+    first.state = SyncTask.SUCCESSFUL
+    task_queue.ack_task(first)
+    statistics = metrics.statistics
+    assert statistics['storages']['remote']['upload']['queued_bytes'] == 3000
+    assert statistics['running'] == []
+
+
+def test_requeued_transfer_counted_once():
+    """A transfer put back by a worker is not queued twice."""
+    task_queue = TaskQueue()
+    task = make_upload('a', size=1000)
+    task_queue.put_task(task)
+    assert task_queue.get_task(block=False) is task
+    task_queue.transfer_metrics.record(task, 400, read_seconds=0, consumer_seconds=0)
+
+    task_queue.put_task(task)
+    statistics = task_queue.transfer_metrics.statistics
+    assert statistics['storages']['remote']['upload']['queued_bytes'] == 600
+    assert statistics['running'] == []
+
+
+def test_unknown_size_not_queued():
+    """Transfers without a known size don't count as queued bytes."""
+    metrics = TransferMetrics()
+    task = make_upload('a')
+    task.link.state.get_node.side_effect = KeyError
+    metrics.on_task_putted(task)
+    assert metrics.statistics['storages']['remote']['upload']['queued_bytes'] == 0
+    assert metrics.statistics['eta_seconds'] == 0
+
+
+def test_provider_and_local_time():
+    """Reading a download is time spent on the provider, the time in between local I/O."""
+    metrics = TransferMetrics()
+    task = DownloadSyncTask(path=['a'], source_storage_id='remote', source_version_id=1)
+
+    class SlowFile(io.BytesIO):
+        """A file of the provider taking a while to return data."""
+
+        def read(self, *args):
+            time.sleep(0.05)
+            return super().read(*args)
+
+    wrapper = ControlFileWrapper(SlowFile(b'x' * 300), task, metrics=metrics)
+    while wrapper.read(100):
+        # writing to the local file
+        time.sleep(0.01)
+
+    download = metrics.statistics['storages']['remote']['download']
+    assert download['bytes_transferred'] == 300
+    assert download['provider_seconds'] >= 0.2
+    assert 0.03 <= download['local_seconds'] < download['provider_seconds']
+
+
+def test_data_rate_callback():
+    """The data rate is the number of bytes read divided by the time it took."""
+    rates = []
+    task = SyncTask(path=[])
+    wrapper = ControlFileWrapper(io.BytesIO(b'0' * 200), task, data_rate_callback=rates.append)
+    with mock.patch('time.monotonic', side_effect=[10, 10.5]):
+        wrapper.read(100)
+    assert rates == [200]
@@ -0,0 +1,254 @@
+"""Tests for uploading files in chunks and resuming the uploads."""
+import io
+import os
+import pickle
+import time
+from unittest import mock
+
+import pytest
+
+from cc.crypto2 import (ChunkCipher, DecryptionFileWrapper, EncryptionFileWrapper,
+                        calc_encrypted_size, unwrap_encryption_params)
+from cc.synchronization.upload_session import UploadSession
+from cc.synctask import UploadSyncTask
+from .test_throttle import StandInStorage, make_link
+from ..test_crypto2 import EXAMPLE_KEYPAIR_PRIVATE, EXAMPLE_KEYPAIR_PUB
+
+MBYTE = 1024 * 1024
+
+
+class SessionStandInStorage(StandInStorage):
+    """Stand-in storage with upload sessions, appending fails after `fail_after` chunks."""
+    supports_upload_session = True
+
+    def __init__(self, storage_id, files=None, latency=0):
+        super().__init__(storage_id, files)
+        self.latency = latency
+        self.fail_after = None
+        #: session id -> [path, data]
+        self.sessions = {}
+        #: (session id, offset) of the chunks appended
+        self.appended = []
+
+    def upload_session_start(self, path, size):
+        # pylint: disable=unused-argument
+        session_id = 'session{}'.format(len(self.sessions))
+        self.sessions[session_id] = [path, bytearray()]
+        return session_id
+
+    def upload_session_offset(self, session_id):
+        session = self.sessions.get(session_id)
+        return len(session[1]) if session is not None else None
+
+    def upload_session_append(self, session_id, offset, data):
+        if self.fail_after is not None and len(self.appended) >= self.fail_after:
+            raise ConnectionError('connection reset')
+        time.sleep(self.latency)
+        session = self.sessions[session_id]
+        assert offset == len(session[1])
+        session[1] += data
+        self.appended.append((session_id, offset))
+
+    def upload_session_finish(self, session_id, path, original_version_id=None):
+        # pylint: disable=unused-argument
+        session_path, data = self.sessions.pop(session_id)
+        assert session_path == path
+        self.files[tuple(path)] = bytes(data)
+        return 'vid'
+
+
+class EncryptingStandInStorage(StandInStorage):
+    """Local stand-in storage encrypting the files read, like the encrypting filesystem."""
+
+    def __init__(self, storage_id, files=None):
+        super().__init__(storage_id, files)
+        #: path -> modification date
+        self.modified_dates = {}
+        #: the EncryptionFileWrappers returned
+        self.opened = []
+
+    def open_read(self, path, expected_version_id=None, encryption_header=None):
+        # pylint: disable=unused-argument
+        encryption_params = None
+        if encryption_header is not None:
+            encryption_params = unwrap_encryption_params(
+                encryption_header, lambda subject_id: EXAMPLE_KEYPAIR_PRIVATE)
+        wrapper = EncryptionFileWrapper(io.BytesIO(self.files[tuple(path)]),
+                                        {'bob': EXAMPLE_KEYPAIR_PUB},
+                                        encryption_params=encryption_params)
+        self.opened.append(wrapper)
+        return wrapper
+
+    def get_props(self, path):
+        return {'size': calc_encrypted_size(len(self.files[tuple(path)]), ['bob']),
+                'modified_date': self.modified_dates.get(tuple(path))}
+
+
+@pytest.fixture
+def link(tmpdir):
+    """A link uploading `a` of 5 chunks in a session, with the checkpoints in `tmpdir`."""
+    link = make_link(throttle=None, size=5 * MBYTE)
+    link.storages['local'].files[('a',)] = bytes(range(256)) * 20 * 1024
+    link.storages['remote'] = SessionStandInStorage('remote')
+    link.upload_session_dir = str(tmpdir.join('upload_sessions'))
+    with mock.patch('cc.synctask.CHUNK_SIZE', MBYTE):
+        yield link
+
+
+def upload(link):
+    """Return an upload of `a`."""
+    task = UploadSyncTask(path=['a'], target_storage_id='remote', source_version_id=1)
+    task.link = link
+    return task
+
+
+def test_upload_resumed(link):
+    """A failed upload continues after the last committed chunk."""
+    remote = link.storages['remote']
+    remote.fail_after = 2
+    task = upload(link)
+    with pytest.raises(ConnectionError):
+        task.execute()
+    assert ('a',) not in remote.files
+
+    remote.fail_after = None
+    task = upload(link)
+    task.execute()
+    assert task.target_version_id == 'vid'
+    assert [offset for _, offset in remote.appended] == [0, MBYTE, 2 * MBYTE, 3 * MBYTE,
+                                                        4 * MBYTE]
+    assert {session_id for session_id, _ in remote.appended} == {'session0'}
+    assert (task.bytes_resumed, task.bytes_transferred) == (2 * MBYTE, 3 * MBYTE)
+    assert remote.files[('a',)] == link.storages['local'].files[('a',)]
+    assert not os.listdir(link.upload_session_dir)
+
+
+def test_upload_session_expired(link):
+    """An upload starts over if the storage forgot the session."""
+    remote = link.storages['remote']
+    remote.fail_after = 2
+    with pytest.raises(ConnectionError):
+        upload(link).execute()
+    remote.sessions.clear()
+
+    remote.fail_after = None
+    task = upload(link)
+    task.execute()
+    assert task.bytes_resumed == 0
+    assert remote.files[('a',)] == link.storages['local'].files[('a',)]
+
+
+def test_upload_resumed_encrypted(link):
+    """A resumed upload of an encrypted file sends the same ciphertext."""
+    plaintext = link.storages['local'].files[('a',)]
+    link.storages['local'] = EncryptingStandInStorage('local', {('a',): plaintext})
+    remote = link.storages['remote']
+    remote.fail_after = 3
+    with pytest.raises(ConnectionError):
+        upload(link).execute()
+
+    # the checkpoint holds the file key wrapped only
+    file_key = link.storages['local'].opened[0].encryption_params[0]
+    location, = os.listdir(link.upload_session_dir)
+    with open(os.path.join(link.upload_session_dir, location), 'rb') as file_handle:
+        checkpoint = file_handle.read()
+    assert file_key not in checkpoint
+    assert pickle.loads(checkpoint)['encryption_header'] == \
+        link.storages['local'].opened[0].header
+
+    remote.fail_after = None
+    with mock.patch.object(ChunkCipher, 'encrypt', autospec=True,
+                           side_effect=ChunkCipher.encrypt) as encrypt:
+        upload(link).execute()
+    decrypted = DecryptionFileWrapper(io.BytesIO(remote.files[('a',)]),
+                                      lambda subject_id: EXAMPLE_KEYPAIR_PRIVATE)
+    assert decrypted.read() == plaintext
+
+    # encrypting again from the chunk of the committed offset on
+    # pylint: disable=protected-access
+    resumed = link.storages['local'].opened[1]
+    indexes = [call[0][1] for call in encrypt.call_args_list]
+    first = (3 * MBYTE - resumed.header_size) // resumed._chunk_cipher.encrypted_chunk_size
+    last = len(plaintext) // resumed._chunk_cipher.chunk_size
+    assert indexes == list(range(first, last + 1))
+
+
+def test_upload_changed_file_starts_over(link):
+    """An upload starts over with a new key if the file changed under the same version."""
+    plaintext = link.storages['local'].files[('a',)]
+    local = EncryptingStandInStorage('local', {('a',): plaintext})
+    local.modified_dates[('a',)] = 1
+    link.storages['local'] = local
+    remote = link.storages['remote']
+    remote.fail_after = 3
+    with pytest.raises(ConnectionError):
+        upload(link).execute()
+
+    changed = bytes(reversed(plaintext))
+    local.files[('a',)] = changed
+    local.modified_dates[('a',)] = 2
+    remote.fail_after = None
+    task = upload(link)
+    task.execute()
+    assert task.bytes_resumed == 0
+    assert {session_id for session_id, _ in remote.appended} == {'session0', 'session1'}
+    assert local.opened[1].encryption_params[0] != local.opened[0].encryption_params[0]
+    decrypted = DecryptionFileWrapper(io.BytesIO(remote.files[('a',)]),
+                                      lambda subject_id: EXAMPLE_KEYPAIR_PRIVATE)
+    assert decrypted.read() == changed
+
+
+def test_small_file_uploaded_at_once(link):
+    """Files up to a chunk are written with a single call."""
+    link.storages['local'].files[('a',)] = b'x' * MBYTE
+    upload(link).execute()
+    assert not link.storages['remote'].appended
+    assert link.storages['remote'].files[('a',)] == b'x' * MBYTE
+
+
+def test_checkpoint_other_version(tmpdir):
+    """A checkpoint is only used for the same version of the file."""
+    session = UploadSession(str(tmpdir), key=('link', 'remote', ('a',)), version_id=1)
+    session.session_id, session.offset = 'session', 10
+    session.save()
+
+    assert UploadSession(str(tmpdir), key=('link', 'remote', ('a',)), version_id=1).load()
+    other = UploadSession(str(tmpdir), key=('link', 'remote', ('a',)), version_id=2)
+    assert not other.load()
+    assert (other.session_id, other.offset) == (None, 0)
+
+
+def test_checkpoint_other_file_identity(tmpdir):
+    """A checkpoint is only used for the same size and modification date of the file."""
+    session = UploadSession(str(tmpdir), key=('link', 'remote', ('a',)), version_id=1,
+                            file_identity=(10, 1))
+    session.session_id, session.offset = 'session', 10
+    session.save()
+
+    assert UploadSession(str(tmpdir), key=('link', 'remote', ('a',)), version_id=1,
+                         file_identity=(10, 1)).load()
+    for file_identity in ((10, 2), (11, 1)):
+        assert not UploadSession(str(tmpdir), key=('link', 'remote', ('a',)), version_id=1,
+                                 file_identity=file_identity).load()
+
+
+def test_benchmark_resume(link):
+    """Benchmark an upload failing at 80% finished by starting over and by resuming."""
+    remote = link.storages['remote']
+    remote.latency = 0.05
+    timings = {}
+    for resume in (False, True):
+        remote.fail_after = len(remote.appended) + 4
+        with pytest.raises(ConnectionError):
+            upload(link).execute()
+        if not resume:
+            remote.sessions.clear()
+        remote.fail_after = None
+
+        start = time.perf_counter()
+        upload(link).execute()
+        timings[resume] = time.perf_counter() - start
+        print('resume {}: {:.2f}s'.format(resume, timings[resume]))
+        assert remote.files[('a',)] == link.storages['local'].files[('a',)]
+
+    assert timings[True] < timings[False] * 0.5
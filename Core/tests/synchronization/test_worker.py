@@ -1,5 +1,6 @@
 """Tests that cover the functionality of the cc.synchronization.worker module."""
 import collections
+import hashlib
 import io
 import logging
 import time
@@ -9,9 +10,12 @@ import pytest
 import jars
 
 import cc
+from cc.crypto2 import EncryptionFileWrapper
 from cc.synchronization import syncengine
+from cc.synchronization.exceptions import PolicyError
 from cc.synchronization.worker import (SyncTaskCancelledException, Worker,
-                                       calculate_waiting_time)
+                                       calculate_waiting_time, execute_task)
+from ..test_crypto2 import EXAMPLE_KEYPAIR_PRIVATE, EXAMPLE_KEYPAIR_PUB
 
 __author__ = 'crosscloud GmbH'
 
@@ -93,6 +97,28 @@ def test_worker_run_and_ensure_proper_dispatch(task, exec_func_side_effect, exec
     assert task in ack_sink
 
 
+@pytest.mark.parametrize('side_effect, answered', [
+    (None, True),
+    (jars.InvalidOperationError('Boom!'), True),
+    (FileNotFoundError('Boom!'), True),
+    (jars.VersionIdNotMatchingError('Boom!'), True),
+    (PolicyError(['a.txt']), False),
+    (jars.AuthenticationError('Boom!'), False),
+    (jars.CancelledException('Boom!'), False),
+    (BaseException('Boom!'), False),
+])
+def test_execute_task_records_success(side_effect, answered):
+    """Only tasks the storages gave a definite answer to close the circuit."""
+    task = cc.synctask.UploadSyncTask(['a.txt'], 'remote', None)
+    task.execute = mock.Mock(side_effect=side_effect)
+    circuit_breaker = mock.Mock()
+
+    with mock.patch('cc.ipc_gui.displayNotification'):
+        execute_task(task, circuit_breaker=circuit_breaker)
+
+    assert circuit_breaker.record_success.called == answered
+
+
 @pytest.mark.parametrize('task', [
     (cc.synctask.CreateDirSyncTask(None, None, None)),
     (cc.synctask.DownloadSyncTask(None, None, None)),
@@ -432,7 +458,7 @@ def test_control_file_speed():
 
     f_test = io.StringIO("0" * 200)
     wrapped_f = cc.synchronization.models.ControlFileWrapper(f_test, sync_task, callback)
-    with mock.patch("time.time", new=mock.MagicMock(side_effect=[0, 1])):
+    with mock.patch("time.monotonic", new=mock.MagicMock(side_effect=[0, 1])):
         wrapped_f.read(100)
 
     assert callback.super_speed == 100
@@ -514,3 +540,144 @@ def test_worker_dispatch_compare_dir():
     assert len(task.equivalents) == 1
     assert {tuple(l) for l in iter(task.equivalents)} == \
            {tuple(l) for l in [range(4)]}
+
+
+class ProviderFile(io.BytesIO):
+    """A file of a provider, each read takes `latency` seconds."""
+
+    def __init__(self, data, latency=0):
+        super().__init__(data)
+        self.latency = latency
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        time.sleep(self.latency)
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer):
+        time.sleep(self.latency)
+        count = super().readinto(buffer)
+        self.bytes_read += count
+        return count
+
+
+def compare_task(files, sizes=None, content_hashes=None):
+    """Return a CompareSyncTask of the `files`, one per storage numbered by their index."""
+    sizes = sizes or [len(file.getvalue()) for file in files]
+    content_hashes = content_hashes or [None] * len(files)
+    link_mock = mock.MagicMock()
+    link_mock.storages = {}
+    link_mock.client_config.get_private_key_pem_by_subject.return_value = \
+        EXAMPLE_KEYPAIR_PRIVATE
+
+    to_compare = []
+    for num, (file, size, content_hash) in enumerate(zip(files, sizes, content_hashes)):
+        to_compare.append(cc.synctask.PathWithStorageAndVersion(
+            storage_id=num, path=['A'], expected_version_id=None, is_dir=False, size=size,
+            content_hash=content_hash))
+        link_mock.storages[num] = mock.MagicMock()
+        link_mock.storages[num].open_read.return_value = file
+
+    task = cc.synctask.CompareSyncTask(['a'], to_compare)
+    task.link = link_mock
+    return task
+
+
+def test_compare_different_sizes():
+    """Copies of different sizes are not read any further than the header."""
+    files = [ProviderFile(b'a' * ONE_MB), ProviderFile(b'a' * 2 * ONE_MB)]
+    task = compare_task(files)
+    task.execute()
+
+    assert task.equivalents == [[0], [1]]
+    assert all(file.closed for file in files)
+    # read to check for an encryption header
+    assert task.link.storages[0].open_read.called
+    assert max(file.bytes_read for file in files) < 1024
+
+
+def test_compare_content_hashes():
+    """Copies with the same content hash supplied by the storage are only compared once."""
+    files = [ProviderFile(b'a' * 100), ProviderFile(b'a' * 100), ProviderFile(b'a' * 100)]
+    task = compare_task(files, content_hashes=[('md5', 'x'), ('md5', 'x'), ('sha1', 'y')])
+    task.execute()
+
+    assert task.equivalents == [[0, 1, 2]]
+    assert not task.link.storages[1].open_read.called
+
+
+def test_compare_cached_content_hash():
+    """The cached content hash of a local copy counts like one supplied by a storage."""
+    files = [ProviderFile(b'a' * 100), ProviderFile(b'a' * 100)]
+    task = compare_task(files, content_hashes=[('md5', 'x'), None])
+    task.link.storages[1].cached_content_hash.return_value = ('md5', 'x')
+    task.execute()
+
+    assert task.equivalents == [[0, 1]]
+    task.link.storages[1].cached_content_hash.assert_called_once_with(['A'])
+    assert not task.link.storages[1].open_read.called
+
+
+def test_compare_early_exit():
+    """The copies are no longer read as soon as their blocks differ."""
+    size = 32 * ONE_MB
+    files = [ProviderFile(b'a' * size), ProviderFile(b'b' + b'a' * (size - 1)),
+             ProviderFile(b'a' * size)]
+    task = compare_task(files)
+    task.execute()
+
+    assert sorted(task.equivalents) == [[0, 2], [1]]
+    assert files[0].bytes_read == size
+    # the first block differs, only the blocks read ahead have been read
+    assert files[1].bytes_read < 5 * cc.synctask.COMPARE_BLOCK_SIZE
+    assert files[1].closed
+
+
+def test_compare_encrypted_copy():
+    """The size of the header of an encrypted copy is not compared."""
+    plaintext = b'hello' * 100000
+    encrypted = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB}).read()
+    task = compare_task([ProviderFile(plaintext), ProviderFile(encrypted)])
+    task.execute()
+
+    assert task.equivalents == [[0, 1]]
+
+
+def sequential_md5(task):
+    """Compare like the CompareSyncTask did before: download and hash one copy after another."""
+    hashes = collections.defaultdict(list)
+    for sip in task.storage_id_paths:
+        hash_ = hashlib.md5()
+        file_in = task.link.storages[sip.storage_id].open_read(path=sip.path)
+        while True:
+            buf = file_in.read(1024 * 512)
+            if not buf:
+                break
+            hash_.update(buf)
+        hashes[hash_.hexdigest()].append(sip.storage_id)
+    return list(hashes.values())
+
+
+@pytest.mark.parametrize('difference', ['first byte', 'last byte', None])
+def test_benchmark_compare(difference):
+    """Benchmark comparing two large conflicting files on providers with latency."""
+    size, latency = 64 * ONE_MB, 0.005
+    other = {'first byte': b'b' + b'a' * (size - 1),
+             'last byte': b'a' * (size - 1) + b'b',
+             None: b'a' * size}[difference]
+
+    timings = {}
+    for name, compare in [('sequential md5', sequential_md5),
+                          ('CompareSyncTask', lambda task: task.execute() or task.equivalents)]:
+        task = compare_task([ProviderFile(b'a' * size, latency), ProviderFile(other, latency)])
+        start = time.perf_counter()
+        equivalents = compare(task)
+        timings[name] = time.perf_counter() - start
+        assert len(equivalents) == (2 if difference else 1)
+        print('{} MiB {}, {}: {:.2f}s'.format(
+            size // ONE_MB, 'differing in the ' + difference if difference else 'equal', name,
+            timings[name]))
+
+    assert timings['CompareSyncTask'] < timings['sequential md5']
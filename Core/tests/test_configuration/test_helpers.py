@@ -166,6 +166,16 @@ def test_read_write_last_known_ac_csps(config):
     assert config.admin_console_csps == csps
 
 
+@pytest.mark.usefixtures("in_memory_keyring")
+def test_read_write_persistent_task_queue(config):
+    """ Tests the read and write operations for the persistent task queue flag """
+    config.persistent_task_queue = True
+    helpers.write_config(config)
+    config.persistent_task_queue = False
+    config = helpers.read_config(config)
+    assert config.persistent_task_queue is True
+
+
 def test_determine_csp_display_name(config):
     """ Tests generation of display name  """
     csps = [{'type': 'dropbox',
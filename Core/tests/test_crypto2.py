@@ -1,14 +1,31 @@
 """ tests the cc.crypto2 - the asymmentric encryption for cc"""
 
 # pylint:disable=redefined-outer-name
+import base64
+import concurrent.futures
+import hashlib
 import io
 import json
+import os
 import struct
+import time
+
+from unittest import mock
 
 import pytest
 
+import cc.crypto2
 from cc.crypto2 import EncryptionFileWrapper, DecryptionFileWrapper, create_header, \
-    MAGIC_NUMBER, read_header, HeaderError, AES_IV_LENGTH, calc_header_size, RSA_KEY_LENGTH
+    MAGIC_NUMBER, read_header, HeaderError, AES_IV_LENGTH, calc_header_size, RSA_KEY_LENGTH, \
+    VERSION, CHUNKED_VERSION, GCM_TAG_LENGTH, ChunkCipher, IntegrityError, \
+    calc_encrypted_size, calc_plaintext_size, ChunkPipeline, KeyCache, KEY_CACHE_SIZE, \
+    wrap_private_key, unwrap_private_key, load_pem_public_key, unwrap_encryption_params
+
+#: size of the file encrypted and decrypted in the benchmark
+BENCHMARK_SIZE = int(os.environ.get('CC_BENCHMARK_CRYPTO_SIZE', 128 * 1024 ** 2))
+
+#: number of small files encrypted and decrypted in the key cache benchmark
+BENCHMARK_SMALL_FILES = int(os.environ.get('CC_BENCHMARK_SMALL_FILES', 20))
 
 EXAMPLE_KEYPAIR_PUB = b'''-----BEGIN RSA PUBLIC KEY-----
 MIICCgKCAgEAvq6bVq54aNBnnJw785jJSaSyUyKaGM8arj+AolSpa9Tjgp79ftoH
@@ -90,10 +107,10 @@ def encrypting_file_wrapper():
                                  file_key=FILE_KEY)
 
 
-@pytest.mark.parametrize("read_patterns", [range(100), [1, 2, 3, 4, 5, 6, 7, 8, 9], [100],
+@pytest.mark.parametrize("read_patterns", [range(100), [1, 2, 3, 4, 5, 6, 7, 8, 9, 16], [100],
                                            [None]])
 def test_enc_readall(encrypting_file_wrapper, read_patterns):
-    """ Tests if readall returns a ciphertext in the same length as the plaintext """
+    """ Tests if readall returns a ciphertext in the same length as the plaintext and its tag """
     # skip magic number and version
     encrypting_file_wrapper.read(len(MAGIC_NUMBER))
 
@@ -109,7 +126,7 @@ def test_enc_readall(encrypting_file_wrapper, read_patterns):
 
     cypher_text = b''.join(cypher_text_parts)
 
-    assert len(EXAMPLE_PLAINTEXT) == len(cypher_text)
+    assert len(EXAMPLE_PLAINTEXT) + GCM_TAG_LENGTH == len(cypher_text)
 
 
 @pytest.mark.parametrize("read_patterns", [range(100), [1, 2, 3, 4, 5, 6, 7, 8, 9], [100],
@@ -196,4 +213,366 @@ def test_calc_header_size(subjects):
         create_header(AES_IV_LENGTH * b'\2', {subject: b'\3' * RSA_KEY_LENGTH
                                               for subject in subjects})
 
+    assert len(b''.join(header)) == calc_header_size(subjects, version=VERSION)
+
+    header = create_header(b'\2' * cc.crypto2.GCM_NONCE_PREFIX_LENGTH,
+                           {subject: b'\3' * RSA_KEY_LENGTH for subject in subjects},
+                           algorithm=cc.crypto2.CHUNKED_ALGORITHM, version=CHUNKED_VERSION,
+                           chunk_size=cc.crypto2.CHUNK_SIZE)
     assert len(b''.join(header)) == calc_header_size(subjects)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 64 * 1024])
+def test_enc_dec_readinto(chunk_size):
+    """ Tests if encrypting and decrypting into a reused buffer is working """
+    plaintext = EXAMPLE_PLAINTEXT * 1000
+    enc_file = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                                     file_key=FILE_KEY)
+    dec_file = DecryptionFileWrapper(io.BytesIO(enc_file.read()),
+                                     lambda subject_id: EXAMPLE_KEYPAIR_PRIVATE)
+
+    buffer = bytearray(chunk_size)
+    plaintext_parts = []
+    while True:
+        count = dec_file.readinto(buffer)
+        if not count:
+            break
+        plaintext_parts.append(bytes(buffer[:count]))
+
+    assert b''.join(plaintext_parts) == plaintext
+
+
+def test_encryption_params():
+    """ Tests if a file encrypted with the params of a previous encryption is the same """
+    plaintext = EXAMPLE_PLAINTEXT * 1000
+    enc_file = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB})
+    ciphertext = enc_file.read()
+
+    again = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                                  encryption_params=enc_file.encryption_params)
+    assert again.read() == ciphertext
+    assert EncryptionFileWrapper(io.BytesIO(plaintext),
+                                 {'bob': EXAMPLE_KEYPAIR_PUB}).read() != ciphertext
+
+
+def encrypt(plaintext, **kwargs):
+    """Return `plaintext` encrypted for bob."""
+    return EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                                 **kwargs).read()
+
+
+def decrypt(ciphertext):
+    """Return a DecryptionFileWrapper decrypting `ciphertext` with the key of bob."""
+    return DecryptionFileWrapper(io.BytesIO(ciphertext),
+                                 lambda subject_id: EXAMPLE_KEYPAIR_PRIVATE)
+
+
+@pytest.mark.parametrize('size', [0, 1, 99, 100, 101, 250, 300])
+@pytest.mark.parametrize('version', [VERSION, CHUNKED_VERSION])
+def test_versions(version, size):
+    """ Tests if files of both versions are decrypted, the chunks end at a boundary or not """
+    plaintext = os.urandom(size)
+    ciphertext = encrypt(plaintext, version=version, chunk_size=100)
+    assert len(ciphertext) == calc_encrypted_size(size, ['bob'], version, chunk_size=100)
+    assert calc_plaintext_size(len(ciphertext), ['bob'], version, chunk_size=100) == size
+
+    dec_file = decrypt(ciphertext)
+    assert dec_file.version == version
+    assert dec_file.plaintext_size(len(ciphertext)) == size
+    assert dec_file.read() == plaintext
+
+
+def test_encryption_params_version():
+    """ Tests if a file is encrypted again in the version of its previous encryption """
+    plaintext = EXAMPLE_PLAINTEXT * 10
+    enc_file = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                                     version=VERSION)
+    ciphertext = enc_file.read()
+    assert encrypt(plaintext, encryption_params=enc_file.encryption_params) == ciphertext
+
+
+@pytest.mark.parametrize('version', [VERSION, CHUNKED_VERSION])
+def test_resume_at(version):
+    """ Tests if the encryption continues with the same ciphertext at any offset """
+    plaintext = os.urandom(1000)
+    enc_file = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                                     version=version, chunk_size=64)
+    ciphertext = enc_file.read()
+    # the header holds the key wrapped only
+    encryption_params = unwrap_encryption_params(enc_file.header,
+                                                 lambda subject_id: EXAMPLE_KEYPAIR_PRIVATE)
+    assert encryption_params == enc_file.encryption_params
+
+    for offset in (0, 1, enc_file.header_size, enc_file.header_size + 1,
+                   enc_file.header_size + 64 + GCM_TAG_LENGTH, len(ciphertext) - 1,
+                   len(ciphertext)):
+        again = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                                      encryption_params=encryption_params)
+        again.resume_at(offset)
+        assert again.read() == ciphertext[offset:]
+
+    with pytest.raises(IOError):
+        EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                              encryption_params=encryption_params).resume_at(len(ciphertext) + 1)
+
+
+def test_unwrap_encryption_params_no_key():
+    """ Tests if the encryption params can't be recovered without a private key """
+    enc_file = EncryptionFileWrapper(io.BytesIO(b''), {'bob': EXAMPLE_KEYPAIR_PUB})
+
+    def no_key(subject_id):
+        raise KeyError(subject_id)
+
+    with pytest.raises(cc.crypto2.NoKeyError):
+        unwrap_encryption_params(enc_file.header, no_key)
+
+
+@pytest.mark.parametrize('tamper', [
+    lambda ciphertext: ciphertext[:-1] + bytes([ciphertext[-1] ^ 1]),
+    lambda ciphertext: ciphertext[:-150] + bytes([ciphertext[-150] ^ 1]) + ciphertext[-149:],
+    # the final chunk or the final chunks removed
+    lambda ciphertext: ciphertext[:-1],
+    lambda ciphertext: ciphertext[:-(100 + GCM_TAG_LENGTH + 50 + GCM_TAG_LENGTH)],
+    lambda ciphertext: ciphertext[:-(50 + GCM_TAG_LENGTH)],
+    # chunks swapped
+    lambda ciphertext: (ciphertext[:-382] + ciphertext[-266:-150] + ciphertext[-382:-266] +
+                        ciphertext[-150:]),
+    lambda ciphertext: ciphertext + b'appended',
+])
+def test_tampered_chunks(tamper):
+    """ Tests if a modified or truncated file of the chunked version fails to decrypt """
+    ciphertext = encrypt(os.urandom(350), chunk_size=100)
+    with pytest.raises(IntegrityError):
+        decrypt(tamper(ciphertext)).read()
+
+
+def test_seek():
+    """ Tests if a file of the chunked version is decrypted starting at any position """
+    plaintext = os.urandom(1000)
+    dec_file = decrypt(encrypt(plaintext, chunk_size=64))
+    assert dec_file.seekable()
+
+    for offset in (0, 1, 63, 64, 65, 500, 999, 1000):
+        assert dec_file.seek(offset) == offset
+        assert dec_file.read(100) == plaintext[offset:offset + 100]
+        assert dec_file.tell() == min(offset + 100, 1000)
+
+    dec_file.seek(130)
+    assert dec_file.seek(-10, io.SEEK_CUR) == 120
+    assert dec_file.read(10) == plaintext[120:130]
+    assert dec_file.seek(-70, io.SEEK_END) == 930
+    assert dec_file.read() == plaintext[930:]
+    with pytest.raises(ValueError):
+        dec_file.seek(2000)
+
+    assert not decrypt(encrypt(plaintext, version=VERSION)).seekable()
+
+
+def test_seek_truncated():
+    """ Tests if seeking to the end of a file missing its final chunk fails """
+    ciphertext = encrypt(os.urandom(1000), chunk_size=100)
+    # the final chunk of a plaintext of full chunks only consists of its tag
+    dec_file = decrypt(ciphertext[:-GCM_TAG_LENGTH])
+    with pytest.raises(IntegrityError):
+        dec_file.seek(0, io.SEEK_END)
+
+
+def test_chunk_cipher_out_of_order():
+    """ Tests if the chunks are encrypted and decrypted independently of each other """
+    plaintext = os.urandom(250)
+    enc_file = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                                     chunk_size=100)
+    ciphertext = enc_file.read()[enc_file.header_size:]
+
+    file_key, nonce_prefix, header = enc_file.encryption_params
+    cipher = ChunkCipher(file_key, nonce_prefix, chunk_size=100, header=header)
+    chunks = [(2, ciphertext[232:], True), (0, ciphertext[:116], False),
+              (1, ciphertext[116:232], False)]
+    assert [cipher.encrypt(index, plaintext[index * 100:index * 100 + 100], final)
+            for index, _, final in chunks] == [chunk for _, chunk, _ in chunks]
+    plaintext_chunks = {index: cipher.decrypt(index, chunk, final)
+                        for index, chunk, final in chunks}
+    assert b''.join(plaintext_chunks[index] for index in range(3)) == plaintext
+    with pytest.raises(IntegrityError):
+        cipher.decrypt(1, ciphertext[:116], False)
+    with pytest.raises(IntegrityError):
+        ChunkCipher(file_key, nonce_prefix, chunk_size=100).decrypt(0, ciphertext[:116], False)
+
+
+def rewrite_header(ciphertext, **changes):
+    """Return `ciphertext` with the entries of its header replaced by `changes`."""
+    file_obj = io.BytesIO(ciphertext)
+    metadata = read_header(file_obj)
+    metadata.update(changes)
+    return b''.join(create_header(base64.b64decode(metadata.pop('iv')),
+                                  {subject: base64.b64decode(key)
+                                   for subject, key in metadata.pop('keys').items()},
+                                  **metadata)) + file_obj.read()
+
+
+@pytest.mark.parametrize('changes', [
+    # downgraded to the unauthenticated version
+    {'version': VERSION, 'algorithm': 'AES256-CFB', 'chunk_size': None},
+    {'chunk_size': 128},
+    {'algorithm': 'AES256-GCM'},
+    # rejected before allocating the buffers
+    {'chunk_size': 2 ** 40},
+    {'chunk_size': 0},
+    {'chunk_size': '100'},
+])
+def test_tampered_header(changes):
+    """ Tests if a file of the chunked version with a modified header fails to decrypt """
+    plaintext = os.urandom(300)
+    ciphertext = encrypt(plaintext, chunk_size=100)
+    assert decrypt(rewrite_header(ciphertext)).read() == plaintext
+
+    with pytest.raises(IntegrityError):
+        decrypt(rewrite_header(ciphertext, **changes)).read()
+
+
+@pytest.mark.parametrize('executor_class', [concurrent.futures.ThreadPoolExecutor,
+                                            concurrent.futures.ProcessPoolExecutor])
+def test_parallel_chunks(executor_class):
+    """ Tests if the chunks processed by an executor are returned in order """
+    plaintext = os.urandom(10000)
+    with executor_class(max_workers=3) as executor:
+        enc_file = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                                         chunk_size=100, executor=executor)
+        ciphertext = enc_file.read()
+        assert encrypt(plaintext, encryption_params=enc_file.encryption_params) == ciphertext
+        assert decrypt(ciphertext).read() == plaintext
+
+        dec_file = DecryptionFileWrapper(io.BytesIO(ciphertext),
+                                         lambda subject_id: EXAMPLE_KEYPAIR_PRIVATE,
+                                         executor=executor)
+        assert dec_file.read(5050) == plaintext[:5050]
+        dec_file.seek(2020)
+        assert dec_file.read() == plaintext[2020:]
+
+
+def test_parallel_chunks_tampered():
+    """ Tests if the chunks before a modified or truncated one are returned before it fails """
+    plaintext = os.urandom(1000)
+    ciphertext = encrypt(plaintext, chunk_size=100)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        for tampered in (ciphertext[:-(50 + GCM_TAG_LENGTH)],
+                         ciphertext[:-200] + bytes([ciphertext[-200] ^ 1]) + ciphertext[-199:]):
+            dec_file = DecryptionFileWrapper(io.BytesIO(tampered),
+                                             lambda subject_id: EXAMPLE_KEYPAIR_PRIVATE,
+                                             executor=executor)
+            assert dec_file.read(800) == plaintext[:800]
+            with pytest.raises(IntegrityError):
+                dec_file.read()
+
+
+def test_pipeline_small_file():
+    """ Tests if a single final chunk is processed without the executor """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    executor.shutdown()
+    chunks = iter([(0, b'data', True), None])
+    pipeline = ChunkPipeline(lambda: next(chunks), lambda index, data, final: data.upper(),
+                             executor=executor)
+    assert pipeline.next() == b'DATA'
+    assert pipeline.next() is None
+
+
+def stream_crypto(plaintext, executor):
+    """Return the MB/s of encrypting and decrypting `plaintext` with `executor`."""
+    buffer = bytearray(1024 ** 2)
+    # without wrapping and unwrapping the file key
+    enc_file = EncryptionFileWrapper(io.BytesIO(plaintext), {'bob': EXAMPLE_KEYPAIR_PUB},
+                                     executor=executor)
+    start = time.perf_counter()
+    ciphertext = io.BytesIO()
+    count = enc_file.readinto(buffer)
+    while count:
+        ciphertext.write(buffer[:count])
+        count = enc_file.readinto(buffer)
+    encryption = time.perf_counter() - start
+
+    ciphertext.seek(0)
+    dec_file = DecryptionFileWrapper(ciphertext, lambda subject_id: EXAMPLE_KEYPAIR_PRIVATE,
+                                     executor=executor)
+    start = time.perf_counter()
+    digest = hashlib.md5()
+    count = dec_file.readinto(buffer)
+    while count:
+        digest.update(buffer[:count])
+        count = dec_file.readinto(buffer)
+    decryption = time.perf_counter() - start
+
+    assert digest.digest() == hashlib.md5(plaintext).digest()
+    return len(plaintext) / encryption / 1024 ** 2, len(plaintext) / decryption / 1024 ** 2
+
+
+def test_benchmark_parallel_chunks():
+    """Benchmark encrypting and decrypting a large file on 1 up to all cores.
+
+    The size can be reduced with the environment variable CC_BENCHMARK_CRYPTO_SIZE.
+    """
+    plaintext = os.urandom(BENCHMARK_SIZE)
+    encryption, decryption = stream_crypto(plaintext, executor=None)
+    print('no executor: encryption {:.1f} MB/s, decryption {:.1f} MB/s'.format(
+        encryption, decryption))
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        for executor_class in (concurrent.futures.ThreadPoolExecutor,
+                               concurrent.futures.ProcessPoolExecutor):
+            with executor_class(max_workers=workers) as executor:
+                encryption, decryption = stream_crypto(plaintext, executor)
+            print('{} {}: encryption {:.1f} MB/s, decryption {:.1f} MB/s'.format(
+                workers, 'threads' if executor_class is concurrent.futures.ThreadPoolExecutor
+                else 'processes', encryption, decryption))
+
+
+def test_key_cache():
+    """ Tests if parsed keys are cached by their PEM, the least recently used dropped first """
+    cache = KeyCache(max_entries=2)
+    public_key = cache.public_key(EXAMPLE_KEYPAIR_PUB)
+    private_key = cache.private_key(EXAMPLE_KEYPAIR_PRIVATE)
+    assert cache.public_key(bytes(EXAMPLE_KEYPAIR_PUB)) is public_key
+    assert cache.private_key(EXAMPLE_KEYPAIR_PRIVATE) is private_key
+
+    # the public key is the least recently used one
+    cache.public_key(EXAMPLE_KEYPAIR_PUB.replace(b'\n', b'\r\n'))
+    assert cache.private_key(EXAMPLE_KEYPAIR_PRIVATE) is private_key
+    assert cache.public_key(EXAMPLE_KEYPAIR_PUB) is not public_key
+    assert cache.statistics == {'entries': 2, 'hits': 3, 'misses': 4, 'evictions': 2}
+
+
+def test_key_cache_wrappers():
+    """ Tests if the file wrappers and unwrap_private_key parse every key once """
+    wrapped_object = wrap_private_key(b'wrapped key', load_pem_public_key(EXAMPLE_KEYPAIR_PUB))
+    with mock.patch('cc.crypto2.KEY_CACHE', KeyCache()), \
+            mock.patch('cc.crypto2.load_pem_public_key',
+                       wraps=load_pem_public_key) as load_public, \
+            mock.patch('cc.crypto2.load_pem_private_key',
+                       wraps=cc.crypto2.load_pem_private_key) as load_private:
+        for _ in range(3):
+            assert decrypt(encrypt(EXAMPLE_PLAINTEXT)).read() == EXAMPLE_PLAINTEXT
+            assert unwrap_private_key(wrapped_object, EXAMPLE_KEYPAIR_PRIVATE) == b'wrapped key'
+    assert load_public.call_count == 1
+    assert load_private.call_count == 1
+
+
+def test_benchmark_key_cache(monkeypatch):
+    """Benchmark encrypting and decrypting small files, e.g. uploads and downloads, with and
+    without parsing the keys again for every file.
+
+    The number of files can be set with the environment variable CC_BENCHMARK_SMALL_FILES.
+    """
+    plaintext = os.urandom(4096)
+    for max_entries in (0, KEY_CACHE_SIZE):
+        monkeypatch.setattr(cc.crypto2, 'KEY_CACHE', KeyCache(max_entries))
+
+        start = time.perf_counter()
+        ciphertexts = [encrypt(plaintext) for _ in range(BENCHMARK_SMALL_FILES)]
+        uploads = BENCHMARK_SMALL_FILES / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for ciphertext in ciphertexts:
+            assert decrypt(ciphertext).read() == plaintext
+        downloads = BENCHMARK_SMALL_FILES / (time.perf_counter() - start)
+
+        print('key cache of {} keys: {} files of 4 KiB, encryption {:.1f} files/s, '
+              'decryption {:.1f} files/s'.format(max_entries, BENCHMARK_SMALL_FILES, uploads,
+                                                 downloads))
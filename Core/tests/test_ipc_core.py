@@ -32,3 +32,15 @@ def test_getAccountTypes_with_filter(enabled_storage, config):
             assert account['enabled']
         else:
             assert not account['enabled']
+
+
+def test_setBandwidthLimits():
+    """The limits are passed on to the client, which applies and stores them."""
+    cc_core = mock.Mock(cc.ipc_core.CrossCloudCore)
+    cc_core.client = mock.Mock(cc.client.Client)
+    limits = {'upload': 512000}
+
+    response = cc.ipc_core.CrossCloudCore.setBandwidthLimits(cc_core, limits)
+
+    assert response == cc.ipc_core.SUCCESS_OPERATION_RESPONSE
+    cc_core.client.set_bandwidth_limits.assert_called_once_with(limits, [])
@@ -1,9 +1,19 @@
 """Tests for streaming utils"""
 
 import io
+import os
+import time
 from unittest.mock import Mock
 
-from cc.mime_type_stream import MimeTypeDetectingFileObject
+import cc.synctask
+from cc.crypto2 import EncryptionFileWrapper
+from cc.mime_type_stream import (MimeTypeDetectingFileObject, PreBufferedFileReader,
+                                 readinto_from, readinto_full)
+from cc.synchronization.models import ControlFileWrapper
+from .test_crypto2 import EXAMPLE_KEYPAIR_PUB
+
+#: size of the file streamed through the transfer chain in the benchmark
+BENCHMARK_SIZE = int(os.environ.get('CC_BENCHMARK_STREAM_SIZE', 2 * 1024 ** 3))
 
 EXAMPLE_HTML = b'''<html>
 <head>
@@ -82,3 +92,124 @@ def test_recoginze_maxx_buffer():
     callback_mock.reset_mock()
 
     assert not callback_mock.called
+
+
+def test_recognize_readinto():
+    """Test if the mime type is detected if the stream is read into a buffer."""
+    callback_mock = Mock()
+    mimetype_detector = MimeTypeDetectingFileObject(io.BytesIO(EXAMPLE_HTML),
+                                                    detection_callback=callback_mock)
+
+    buffer = bytearray(len(EXAMPLE_HTML) + 10)
+    assert mimetype_detector.readinto(buffer) == len(EXAMPLE_HTML)
+    assert buffer[:len(EXAMPLE_HTML)] == EXAMPLE_HTML
+    callback_mock.assert_called_once_with('text/html')
+
+
+def test_readinto_from_read_only():
+    """Test if file objects without readinto are read with read."""
+    class ReadOnly:
+        """File object only implementing read."""
+
+        def __init__(self, data):
+            self.data = data
+
+        def read(self, count):
+            result, self.data = self.data[:count], self.data[count:]
+            return result
+
+    buffer = bytearray(4)
+    file_obj = ReadOnly(b'abcdef')
+    assert readinto_from(file_obj, buffer) == 4
+    assert buffer == b'abcd'
+    assert readinto_from(file_obj, buffer) == 2
+    assert buffer[:2] == b'ef'
+    assert readinto_from(file_obj, buffer) == 0
+
+
+def test_readinto_full():
+    """Short reads are continued until the buffer is full or the file ended."""
+    class Trickling(io.RawIOBase):
+        """File object returning a single byte per read."""
+
+        def __init__(self, data):
+            self.data = data
+
+        def readinto(self, buffer):
+            count = min(1, len(self.data))
+            buffer[:count], self.data = self.data[:count], self.data[count:]
+            return count
+
+    file_obj = Trickling(b'abcdef')
+    buffer = bytearray(4)
+    assert readinto_full(file_obj, buffer) == 4
+    assert buffer == b'abcd'
+    assert readinto_full(file_obj, buffer) == 2
+    assert buffer[:2] == b'ef'
+    assert readinto_full(file_obj, buffer) == 0
+
+
+def test_pre_buffered_reader():
+    """Test if the pre buffer is returned before the wrapped file object."""
+    reader = PreBufferedFileReader(io.BytesIO(b'world'), pre_buffer=b'hello ')
+    assert reader.read(4) == b'hell'
+    assert reader.read(4) == b'o '
+    assert reader.read() == b'world'
+    assert reader.read(4) == b''
+
+
+class ZeroFile(io.RawIOBase):
+    """A file of `size` zeros, which are never stored anywhere."""
+
+    def __init__(self, size):
+        super().__init__()
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.remaining)
+        self.remaining -= count
+        # the buffer is not cleared, the reading layers only care about the number of bytes
+        return count
+
+
+def stream_transfer_chain(size, use_readinto, chunk_size=1024 * 1024):
+    """Stream `size` bytes through the chain of an encrypted upload like a provider would.
+
+    :return: the throughput in MB/s
+    """
+    task = cc.synctask.UploadSyncTask(path=['a'], target_storage_id='remote',
+                                      source_version_id=1)
+    file_obj = MimeTypeDetectingFileObject(
+        ControlFileWrapper(EncryptionFileWrapper(ZeroFile(size), {'bob': EXAMPLE_KEYPAIR_PUB}),
+                           task),
+        detection_callback=Mock())
+
+    buffer = bytearray(chunk_size)
+    transferred = 0
+    start = time.perf_counter()
+    while True:
+        if use_readinto:
+            count = file_obj.readinto(buffer)
+        else:
+            count = len(file_obj.read(chunk_size))
+        if not count:
+            break
+        transferred += count
+    duration = time.perf_counter() - start
+
+    assert transferred > size
+    return size / duration / 1024 ** 2
+
+
+def test_benchmark_transfer_chain():
+    """Benchmark streaming a large file through the encryption, control and mime layers.
+
+    The size can be reduced with the environment variable CC_BENCHMARK_STREAM_SIZE.
+    """
+    for use_readinto in (False, True):
+        throughput = stream_transfer_chain(BENCHMARK_SIZE, use_readinto)
+        print('{}: {} MiB in chunks of 1 MiB with {:.1f} MB/s'.format(
+            'readinto' if use_readinto else 'read', BENCHMARK_SIZE // 1024 ** 2, throughput))